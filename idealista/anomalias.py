@@ -0,0 +1,207 @@
+"""
+Puntuación de anomalías de precio: lo barato respecto a su mercado
+
+Cada piso se compara con su cohorte (operación, habitaciones, banda de
+metros y zona) mediante un z-score robusto de ln(precio/m²):
+
+    z = (ln(precio/m²) - mediana) / (1.4826 * MAD)
+
+Negativo = más barato que la cohorte. Si la cohorte tiene menos de
+MIN_COHORTE pisos se usa la siguiente más amplia (sin zona, y luego solo la
+operación).
+
+Las estadísticas viven en memoria: un histograma de ln(precio/m²) por
+cohorte (cubos de ~2%, como rollups.py) en una matriz NumPy. Se carga de
+`pisos` con una sola consulta la primera vez y después se actualiza con cada
+página (altas y cambios de precio); mediana y MAD se recalculan vectorizadas
+solo para las cohortes tocadas. Puntuar una página no lanza ninguna consulta.
+"""
+import math
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import config
+import db
+
+CUBOS_POR_LN = 50
+LN_MIN, LN_MAX = 0.0, math.log(50000)  # de 1 a 50.000 €/m²
+NUM_CUBOS = int((LN_MAX - LN_MIN) * CUBOS_POR_LN) + 1
+
+MIN_COHORTE = 8
+MAD_MINIMA = 0.05  # en ln: evita z enormes en cohortes con todos los precios iguales
+BANDAS_METROS = (50, 70, 90, 120, 160)  # límites de las bandas de tamaño
+NIVELES = 3  # cohorte completa, sin zona, solo operación
+
+
+def crear_tablas(conn):
+    """Columna de puntuación en pisos (llamado desde init_db)"""
+    db.ensure_column(conn, 'pisos', 'puntuacion_anomalia', 'REAL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pisos_anomalia ON pisos(puntuacion_anomalia)')
+
+
+def _cohortes(fila: Dict) -> Optional[Tuple[tuple, tuple, tuple]]:
+    """Claves de cohorte de los tres niveles, o None si no hay precio/m² válido"""
+    precio, metros = fila.get('precio'), fila.get('metros')
+    if not precio or not metros or precio <= 0 or metros <= 0:
+        return None
+    operacion = fila.get('operacion') or 'rent'
+    habitaciones = min(int(fila.get('habitaciones') or 0), 4)
+    banda = sum(metros >= limite for limite in BANDAS_METROS)
+    return ((operacion, habitaciones, banda, fila.get('zona') or ''),
+            (operacion, habitaciones, banda),
+            (operacion,))
+
+
+def _cubo(precio: float, metros: float) -> int:
+    ln = math.log(precio / metros)
+    return min(max(int(round((ln - LN_MIN) * CUBOS_POR_LN)), 0), NUM_CUBOS - 1)
+
+
+class ModeloMercado:
+    """Histogramas por cohorte y sus medianas/MAD (cacheadas, recalculadas al tocarse)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indices: Dict[tuple, int] = {}
+        self._conteos = np.zeros((64, NUM_CUBOS), dtype=np.int32)
+        self._total = np.zeros(64, dtype=np.int64)
+        self._mediana = np.zeros(64)
+        self._mad = np.zeros(64)
+        self._sucias = set()
+
+    def __len__(self):
+        return len(self._indices)
+
+    def _indice(self, clave: tuple) -> int:
+        i = self._indices.get(clave)
+        if i is None:
+            i = self._indices[clave] = len(self._indices)
+            if i >= len(self._total):
+                n = len(self._total) * 2
+                self._conteos = np.resize(self._conteos, (n, NUM_CUBOS))
+                self._conteos[i:] = 0
+                for nombre in ('_total', '_mediana', '_mad'):
+                    viejo = getattr(self, nombre)
+                    nuevo = np.zeros(n, dtype=viejo.dtype)
+                    nuevo[:len(viejo)] = viejo
+                    setattr(self, nombre, nuevo)
+        return i
+
+    def _sumar(self, claves: tuple, cubo: int, cantidad: int):
+        for clave in claves:
+            i = self._indice(clave)
+            self._conteos[i, cubo] += cantidad
+            self._total[i] += cantidad
+            self._sucias.add(i)
+
+    def _recalcular(self, indices: np.ndarray):
+        """Mediana y MAD (en cubos) de las cohortes dadas, a partir de sus histogramas"""
+        conteos = self._conteos[indices]
+        mitad = self._total[indices][:, None] / 2
+        mediana = np.argmax(conteos.cumsum(axis=1) >= mitad, axis=1)
+
+        # Desviaciones absolutas: el cubo k recoge mediana-k y mediana+k
+        k = np.arange(NUM_CUBOS)
+        arriba, abajo = mediana[:, None] + k, mediana[:, None] - k
+        desviaciones = (np.where(arriba < NUM_CUBOS,
+                                 np.take_along_axis(conteos, np.minimum(arriba, NUM_CUBOS - 1), 1), 0)
+                        + np.where((abajo >= 0) & (k > 0),
+                                   np.take_along_axis(conteos, np.maximum(abajo, 0), 1), 0))
+        mad = np.argmax(desviaciones.cumsum(axis=1) >= mitad, axis=1)
+
+        self._mediana[indices] = LN_MIN + mediana / CUBOS_POR_LN
+        self._mad[indices] = np.maximum(mad / CUBOS_POR_LN, MAD_MINIMA)
+
+    def cargar(self, conn):
+        """Estado inicial desde los pisos activos (una consulta)"""
+        filas = conn.execute("""SELECT precio, metros, habitaciones, zona, operacion FROM pisos
+                                WHERE COALESCE(estado, 'activo') = 'activo'
+                                AND precio > 0 AND metros > 0""")
+        columnas = ('precio', 'metros', 'habitaciones', 'zona', 'operacion')
+        with self._lock:
+            for row in filas:
+                fila = dict(zip(columnas, row))
+                self._sumar(_cohortes(fila), _cubo(fila['precio'], fila['metros']), 1)
+
+    def puntuar(self, filas: List[Dict]) -> np.ndarray:
+        """z-score robusto de cada fila (NaN si no hay precio/m² o cohorte suficiente)"""
+        n = len(filas)
+        indices = np.full((n, NIVELES), -1)
+        valores = np.full(n, np.nan)
+        with self._lock:
+            for j, fila in enumerate(filas):
+                claves = _cohortes(fila)
+                if claves is None:
+                    continue
+                valores[j] = math.log(fila['precio'] / fila['metros'])
+                for nivel, clave in enumerate(claves):
+                    indices[j, nivel] = self._indices.get(clave, -1)
+
+            tocadas = np.unique(indices[indices >= 0])
+            sucias = tocadas[[i in self._sucias for i in tocadas]] if len(tocadas) else tocadas
+            if len(sucias):
+                self._recalcular(sucias)
+                self._sucias.difference_update(sucias.tolist())
+
+            totales = np.where(indices >= 0, self._total[np.maximum(indices, 0)], 0)
+            suficiente = totales >= MIN_COHORTE
+            # Primer nivel (el más específico) con cohorte suficiente
+            nivel = np.argmax(suficiente, axis=1)
+            elegido = indices[np.arange(n), nivel]
+            valido = suficiente.any(axis=1) & ~np.isnan(valores)
+            elegido = np.maximum(elegido, 0)
+            with np.errstate(divide='ignore', invalid='ignore'):  # filas no válidas: se descartan abajo
+                z = (valores - self._mediana[elegido]) / (1.4826 * self._mad[elegido])
+        return np.where(valido, np.round(z, 2), np.nan)
+
+    def registrar(self, diff: Dict[str, List[Dict]]):
+        """Incorpora las altas y cambios de precio de una página ya aplicada"""
+        with self._lock:
+            for fila in diff['nuevos']:
+                claves = _cohortes(fila)
+                if claves:
+                    self._sumar(claves, _cubo(fila['precio'], fila['metros']), 1)
+            for fila in diff['bajadas'] + diff['subidas']:
+                claves = _cohortes(fila)
+                if not claves:
+                    continue
+                anterior = {**fila, 'precio': fila['precio_anterior']}
+                if _cohortes(anterior):
+                    self._sumar(claves, _cubo(anterior['precio'], fila['metros']), -1)
+                self._sumar(claves, _cubo(fila['precio'], fila['metros']), 1)
+
+
+_modelos: Dict[str, ModeloMercado] = {}
+_modelos_lock = threading.Lock()
+
+
+def modelo(conn) -> ModeloMercado:
+    """Modelo de la BD actual (config.DB_PATH), cargado la primera vez"""
+    clave = str(config.DB_PATH)
+    with _modelos_lock:
+        actual = _modelos.get(clave)
+        if actual is None:
+            actual = _modelos[clave] = ModeloMercado()
+            actual.cargar(conn)
+    return actual
+
+
+def puntuar_lote(conn, filas: List[Dict]):
+    """Rellena `puntuacion_anomalia` en cada fila parseada (None si no se puede puntuar)"""
+    if not filas:
+        return
+    for fila, z in zip(filas, modelo(conn).puntuar(filas)):
+        fila['puntuacion_anomalia'] = None if np.isnan(z) else float(z)
+
+
+def registrar_lote(conn, diff: Dict[str, List[Dict]]):
+    if diff['nuevos'] or diff['bajadas'] or diff['subidas']:
+        modelo(conn).registrar(diff)
+
+
+def invalidar():
+    """Descarta el modelo (se recarga de `pisos` en el siguiente uso): tras bajas o errores"""
+    with _modelos_lock:
+        _modelos.pop(str(config.DB_PATH), None)
@@ -0,0 +1,264 @@
+"""
+Archivo append-only de las respuestas crudas de la API de búsqueda
+
+Cada respuesta de /search se guarda tal cual llegó (bytes del JSON),
+comprimida con zlib, al final del segmento activo. Un índice SQLite pequeño
+(ejecución, perfil, página -> segmento, offset, longitud) permite leer una
+página concreta sin descomprimir nada más e iterar en orden leyendo cada
+segmento de forma secuencial. Así cualquier campo que hoy no guardamos se
+puede recuperar más adelante sin gastar quota.
+
+Estructura en ARCHIVE_DIR:
+    indice.db              ejecuciones y páginas archivadas
+    segmentos/<n>.seg      registros concatenados: cabecera + zlib(respuesta)
+
+Cada registro lleva su cabecera (magic, longitud, crc32 del original), de
+modo que un segmento se puede validar o recorrer aunque se pierda el índice.
+Un segmento se cierra al superar ARCHIVE_SEGMENT_BYTES y nunca se reescribe.
+
+Uso: python archivo.py listar | verificar | leer <ejecucion> <perfil> <pagina>
+"""
+import argparse
+import logging
+import os
+import struct
+import sys
+import threading
+import zlib
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import config
+import db
+import lotes
+
+logger = logging.getLogger('idealista')
+
+MAGIC = b'IDA1'
+CABECERA = struct.Struct('<4sII')  # magic, longitud comprimida, crc32 del original
+
+_COLUMNAS = ('id', 'ejecucion', 'perfil', 'pagina', 'fecha', 'segmento', 'offset',
+             'longitud', 'tamano', 'crc')
+
+_lock = threading.Lock()
+
+
+class ArchivoCorrupto(Exception):
+    """Un registro del archivo no coincide con lo que se guardó"""
+
+
+def _indice() -> Path:
+    return config.ARCHIVE_DIR / 'indice.db'
+
+
+def _segmentos() -> Path:
+    return config.ARCHIVE_DIR / 'segmentos'
+
+
+def _ruta_segmento(segmento: int) -> Path:
+    return _segmentos() / f"{segmento}.seg"
+
+
+def crear_tablas(conn):
+    """Crea las tablas del índice del archivo"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS ejecuciones (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        fecha DATETIME NOT NULL
+    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS paginas (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ejecucion INTEGER NOT NULL,
+        perfil TEXT NOT NULL,
+        pagina INTEGER NOT NULL,
+        fecha DATETIME NOT NULL,
+        segmento INTEGER NOT NULL,
+        offset INTEGER NOT NULL,
+        longitud INTEGER NOT NULL,
+        tamano INTEGER NOT NULL,
+        crc INTEGER NOT NULL,
+        UNIQUE (ejecucion, perfil, pagina)
+    )''')
+    # Cierre de la ejecución: fecha y si el barrido fue completo (para reproducir las bajas)
+    db.ensure_column(conn, 'ejecuciones', 'fecha_fin', 'DATETIME')
+    db.ensure_column(conn, 'ejecuciones', 'completo', 'BOOLEAN')
+
+
+def _abrir_indice() -> Path:
+    config.ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+    _segmentos().mkdir(exist_ok=True)
+    ruta = _indice()
+    with db.transaction(ruta) as conn:
+        crear_tablas(conn)
+    return ruta
+
+
+def iniciar_ejecucion(fecha: Optional[str] = None) -> int:
+    """Registra una ejecución nueva y devuelve su id"""
+    with db.transaction(_abrir_indice()) as conn:
+        return conn.execute("INSERT INTO ejecuciones (fecha) VALUES (?)",
+                            (fecha or lotes.fecha_actual(),)).lastrowid
+
+
+def cerrar_ejecucion(ejecucion: int, completo: bool, fecha: Optional[str] = None):
+    """Anota el final de la ejecución y si todos los perfiles llegaron a la última página"""
+    with db.transaction(_abrir_indice()) as conn:
+        conn.execute("UPDATE ejecuciones SET fecha_fin = ?, completo = ? WHERE id = ?",
+                     (fecha or lotes.fecha_actual(), completo, ejecucion))
+
+
+def ejecuciones() -> Dict[int, Dict]:
+    """Ejecuciones archivadas: id -> {'fecha', 'fecha_fin', 'completo'}"""
+    if not _indice().exists():
+        return {}
+    return {e: {'fecha': f, 'fecha_fin': ff, 'completo': None if c is None else bool(c)}
+            for e, f, ff, c in db.get_connection(_abrir_indice()).execute(
+                "SELECT id, fecha, fecha_fin, completo FROM ejecuciones ORDER BY id")}
+
+
+def _segmento_activo(conn) -> int:
+    """Último segmento, o uno nuevo si ese ya superó el tamaño máximo"""
+    segmento = conn.execute("SELECT COALESCE(MAX(segmento), 1) FROM paginas").fetchone()[0]
+    ruta = _ruta_segmento(segmento)
+    if ruta.exists() and ruta.stat().st_size >= config.ARCHIVE_SEGMENT_BYTES:
+        segmento += 1
+    return segmento
+
+
+def guardar(ejecucion: int, perfil: str, pagina: int, contenido: bytes,
+            fecha: Optional[str] = None) -> int:
+    """
+    Añade una respuesta cruda al archivo
+
+    Args:
+        ejecucion: Id de iniciar_ejecucion()
+        perfil: Nombre del perfil de búsqueda
+        pagina: Número de página (numPage)
+        contenido: Cuerpo de la respuesta tal como llegó
+        fecha: Fecha de la petición (por defecto ahora, UTC)
+
+    Returns:
+        Id del registro en el índice
+    """
+    comprimido = zlib.compress(contenido, 9)
+    crc = zlib.crc32(contenido)
+    ruta = _abrir_indice()
+    with _lock:
+        conn = db.get_connection(ruta)
+        segmento = _segmento_activo(conn)
+        with open(_ruta_segmento(segmento), 'ab') as f:
+            offset = f.tell()
+            f.write(CABECERA.pack(MAGIC, len(comprimido), crc) + comprimido)
+            f.flush()
+            os.fsync(f.fileno())
+        # Si se cae aquí el registro queda huérfano al final del segmento: no se indexa
+        with db.transaction(ruta) as conn:
+            return conn.execute(
+                """INSERT INTO paginas (ejecucion, perfil, pagina, fecha, segmento, offset,
+                                        longitud, tamano, crc)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (ejecucion, perfil, pagina, fecha or lotes.fecha_actual(), segmento,
+                 offset + CABECERA.size, len(comprimido), len(contenido), crc)).lastrowid
+
+
+def _leer_registro(f, registro: Dict) -> bytes:
+    """Lee, valida (cabecera, crc y tamaño) y descomprime un registro del segmento abierto"""
+    f.seek(registro['offset'] - CABECERA.size)
+    magic, longitud, crc = CABECERA.unpack(f.read(CABECERA.size))
+    if magic != MAGIC or longitud != registro['longitud'] or crc != registro['crc']:
+        raise ArchivoCorrupto(f"Registro {registro['id']}: cabecera no coincide con el índice")
+    try:
+        contenido = zlib.decompress(f.read(longitud))
+    except zlib.error as e:
+        raise ArchivoCorrupto(f"Registro {registro['id']}: {e}") from e
+    if zlib.crc32(contenido) != registro['crc'] or len(contenido) != registro['tamano']:
+        raise ArchivoCorrupto(f"Registro {registro['id']}: crc o tamaño no coinciden")
+    return contenido
+
+
+def leer(ejecucion: int, perfil: str, pagina: int) -> Optional[bytes]:
+    """Respuesta cruda de una página concreta (None si no está archivada)"""
+    if not _indice().exists():
+        return None
+    row = db.get_connection(_indice()).execute(
+        f"SELECT {', '.join(_COLUMNAS)} FROM paginas WHERE ejecucion=? AND perfil=? AND pagina=?",
+        (ejecucion, perfil, pagina)).fetchone()
+    if not row:
+        return None
+    registro = dict(zip(_COLUMNAS, row))
+    with open(_ruta_segmento(registro['segmento']), 'rb') as f:
+        return _leer_registro(f, registro)
+
+
+def iterar(desde_ejecucion: int = 0, perfil: Optional[str] = None) -> Iterator[Tuple[Dict, bytes]]:
+    """
+    Recorre el archivo en orden de escritura: (registro del índice, respuesta cruda)
+
+    Lee cada segmento secuencialmente con un solo fichero abierto a la vez.
+    """
+    if not _indice().exists():
+        return
+    filtro, params = "WHERE ejecucion >= ?", [desde_ejecucion]
+    if perfil is not None:
+        filtro += " AND perfil = ?"
+        params.append(perfil)
+    filas = db.get_connection(_indice()).execute(
+        f"SELECT {', '.join(_COLUMNAS)} FROM paginas {filtro} ORDER BY segmento, offset", params)
+
+    segmento, f = None, None
+    try:
+        for row in filas:
+            registro = dict(zip(_COLUMNAS, row))
+            if registro['segmento'] != segmento:
+                if f:
+                    f.close()
+                segmento = registro['segmento']
+                f = open(_ruta_segmento(segmento), 'rb')
+            yield registro, _leer_registro(f, registro)
+    finally:
+        if f:
+            f.close()
+
+
+def verificar() -> int:
+    """Lee y valida todos los registros; devuelve cuántos hay (ArchivoCorrupto si falla)"""
+    return sum(1 for _ in iterar())
+
+
+def listar() -> List[Dict]:
+    """Resumen por ejecución: páginas, bytes originales y bytes en disco"""
+    if not _indice().exists():
+        return []
+    columnas = ('ejecucion', 'fecha', 'paginas', 'perfiles', 'tamano', 'longitud')
+    filas = db.get_connection(_indice()).execute(
+        """SELECT e.id, e.fecha, COUNT(p.id), COUNT(DISTINCT p.perfil),
+                  COALESCE(SUM(p.tamano), 0), COALESCE(SUM(p.longitud), 0)
+           FROM ejecuciones e LEFT JOIN paginas p ON p.ejecucion = e.id
+           GROUP BY e.id ORDER BY e.id""").fetchall()
+    return [dict(zip(columnas, f)) for f in filas]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Archivo de respuestas crudas de la API")
+    sub = parser.add_subparsers(dest='accion', required=True)
+    sub.add_parser('listar')
+    sub.add_parser('verificar')
+    p_leer = sub.add_parser('leer')
+    p_leer.add_argument('ejecucion', type=int)
+    p_leer.add_argument('perfil')
+    p_leer.add_argument('pagina', type=int)
+    args = parser.parse_args()
+
+    if args.accion == 'listar':
+        for e in listar():
+            print(f"#{e['ejecucion']} {e['fecha']}  {e['paginas']} páginas, {e['perfiles']} perfiles, "
+                  f"{e['tamano'] / 1024:.1f} KiB -> {e['longitud'] / 1024:.1f} KiB")
+    elif args.accion == 'verificar':
+        try:
+            print(f"OK: {verificar()} registros")
+        except ArchivoCorrupto as e:
+            raise SystemExit(f"CORRUPTO: {e}")
+    elif args.accion == 'leer':
+        contenido = leer(args.ejecucion, args.perfil, args.pagina)
+        if contenido is None:
+            raise SystemExit("Página no archivada")
+        sys.stdout.buffer.write(contenido)
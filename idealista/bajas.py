@@ -0,0 +1,146 @@
+"""
+Detección de bajas: pisos que desaparecen de los resultados
+
+Cada ejecución guarda en `barridos` el conjunto de ids vistos (ordenado y
+comprimido con zlib, ~2-3 bytes por id). Si todos los perfiles recorrieron
+sus resultados hasta la última página, al final de la ejecución una sola
+diferencia de conjuntos contra una tabla temporal marca como retirados los
+pisos activos que no aparecieron, con fecha de baja y días en el mercado.
+
+Los barridos parciales (error, quota agotada, límite de páginas o parada
+incremental) se registran pero no dan de baja nada. Un piso retirado que
+vuelve a aparecer se reactiva. En modo incremental, cada
+DELISTING_FULL_SWEEP_EVERY ejecuciones se pagina sin parar para poder cerrar
+un barrido completo.
+"""
+import json
+import logging
+import zlib
+from typing import Iterable, Optional, Set
+
+import anomalias
+import config
+import db
+import geo
+import lotes
+
+logger = logging.getLogger('idealista')
+
+ACTIVO = 'activo'
+RETIRADO = 'retirado'
+
+
+def crear_tablas(conn):
+    """Crea la tabla de barridos y las columnas de baja (llamado desde init_db)"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS barridos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
+        completo BOOLEAN NOT NULL,
+        num_ids INTEGER NOT NULL,
+        ids BLOB NOT NULL,
+        bajas INTEGER DEFAULT 0,
+        reactivados INTEGER DEFAULT 0
+    )''')
+    db.ensure_column(conn, 'pisos', 'fecha_baja', 'DATETIME')
+    db.ensure_column(conn, 'pisos', 'dias_en_mercado', 'INTEGER')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pisos_estado ON pisos(estado)')
+
+
+def codificar(ids: Iterable[str]) -> bytes:
+    """Conjunto de ids -> blob compacto (ordenado, uno por línea, zlib)"""
+    return zlib.compress('\n'.join(sorted(set(ids))).encode())
+
+
+def decodificar(blob: bytes) -> Set[str]:
+    texto = zlib.decompress(blob).decode()
+    return set(texto.split('\n')) if texto else set()
+
+
+def cargar_barrido(id_barrido: Optional[int] = None) -> Optional[Set[str]]:
+    """Ids vistos en un barrido (por defecto el último)"""
+    conn = db.get_connection()
+    if id_barrido is None:
+        row = conn.execute("SELECT ids FROM barridos ORDER BY id DESC LIMIT 1").fetchone()
+    else:
+        row = conn.execute("SELECT ids FROM barridos WHERE id=?", (id_barrido,)).fetchone()
+    return decodificar(row[0]) if row else None
+
+
+def toca_barrido_completo() -> bool:
+    """True si en modo incremental esta ejecución debe paginar entera para detectar bajas"""
+    if (config.SEARCH_MODE != 'incremental' or not config.ENABLE_DELISTING
+            or config.DELISTING_FULL_SWEEP_EVERY <= 0):
+        return False
+    # Barridos parciales desde el último completo (o desde el principio si no hubo ninguno)
+    parciales = db.get_connection().execute(
+        """SELECT COUNT(*) FROM barridos
+           WHERE id > COALESCE((SELECT MAX(id) FROM barridos WHERE completo), 0)""").fetchone()[0]
+    return parciales >= config.DELISTING_FULL_SWEEP_EVERY - 1
+
+
+def cerrar_barrido(vistos: Set[str], completo: bool, fecha: Optional[str] = None) -> dict:
+    """
+    Registra el barrido y, si fue completo, da de baja lo que no se vio
+
+    Args:
+        vistos: Ids devueltos por la API en esta ejecución (todos los perfiles)
+        completo: True solo si todos los perfiles llegaron a la última página
+        fecha: Fecha de la baja (por defecto ahora, UTC)
+
+    Returns:
+        {'bajas': n, 'reactivados': n, 'completo': bool}
+    """
+    fecha = fecha or lotes.fecha_actual()
+    resultado = {'bajas': 0, 'reactivados': 0, 'completo': completo}
+    ordenados = sorted(vistos)
+
+    with db.transaction() as conn:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS tmp_vistos (id TEXT PRIMARY KEY) WITHOUT ROWID")
+        conn.execute("DELETE FROM tmp_vistos")
+        # Carga en una sola sentencia y en orden de clave: ~4x más rápido que executemany
+        conn.execute("INSERT OR IGNORE INTO tmp_vistos (id) SELECT value FROM json_each(?)",
+                     (json.dumps(ordenados),))
+
+        # Retirados que vuelven a aparecer (p. ej. un piso perdido al moverse de página)
+        reaparecen = "estado = :retirado AND id IN (SELECT id FROM tmp_vistos)"
+        geo.ajustar(conn, reaparecen, {'retirado': RETIRADO}, signo=1)
+        resultado['reactivados'] = conn.execute(
+            f"""UPDATE pisos SET estado = :activo, fecha_baja = NULL, dias_en_mercado = NULL
+                WHERE {reaparecen}""",
+            {'activo': ACTIVO, 'retirado': RETIRADO}).rowcount
+
+        if completo and vistos:
+            activos = conn.execute("SELECT COUNT(*) FROM pisos WHERE COALESCE(estado, ?) = ?",
+                                   (ACTIVO, ACTIVO)).fetchone()[0]
+            # Una única diferencia de conjuntos: activos que no están en tmp_vistos
+            no_vistos = """COALESCE(estado, :activo) = :activo
+                           AND NOT EXISTS (SELECT 1 FROM tmp_vistos v WHERE v.id = pisos.id)"""
+            candidatos = conn.execute(f"SELECT COUNT(*) FROM pisos WHERE {no_vistos}",
+                                      {'activo': ACTIVO}).fetchone()[0]
+            if activos and candidatos > activos * config.DELISTING_MAX_FRACTION:
+                logger.warning(f"Bajas descartadas: {candidatos}/{activos} pisos activos no vistos "
+                               f"supera el máximo ({config.DELISTING_MAX_FRACTION:.0%})")
+                resultado['completo'] = False
+            else:
+                geo.ajustar(conn, no_vistos, {'activo': ACTIVO}, signo=-1)
+                resultado['bajas'] = conn.execute(
+                    f"""UPDATE pisos SET estado = :retirado, fecha_baja = :fecha,
+                            dias_en_mercado = CAST(julianday(:fecha) - julianday(fecha_registro) AS INTEGER)
+                        WHERE {no_vistos}""",
+                    {'activo': ACTIVO, 'retirado': RETIRADO, 'fecha': fecha}).rowcount
+
+        conn.execute("""INSERT INTO barridos (fecha, completo, num_ids, ids, bajas, reactivados)
+                        VALUES (?, ?, ?, ?, ?, ?)""",
+                     (fecha, resultado['completo'], len(ordenados), codificar(ordenados),
+                      resultado['bajas'], resultado['reactivados']))
+        conn.execute("""DELETE FROM barridos WHERE id NOT IN
+                        (SELECT id FROM barridos ORDER BY id DESC LIMIT ?)""",
+                     (config.DELISTING_SWEEPS_KEEP,))
+        conn.execute("DELETE FROM tmp_vistos")
+
+    if resultado['bajas'] or resultado['reactivados']:
+        # Los retirados salen de las estadísticas de mercado (y los reactivados vuelven)
+        anomalias.invalidar()
+        logger.info(f"🏁 Barrido {'completo' if resultado['completo'] else 'parcial'}: "
+                    f"{resultado['bajas']} bajas, {resultado['reactivados']} reactivados")
+    return resultado
@@ -0,0 +1,925 @@
+"""
+Benchmarks del bot de Idealista
+Ejecutar con: python benchmarks.py <benchmark> [opciones]
+"""
+import argparse
+import contextlib
+import json
+import logging
+import math
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import config
+import db
+
+
+def _percentiles(muestras: List[float], unidad: str) -> Dict:
+    """Media, p50 y p99 de una lista de muestras"""
+    if not muestras:
+        return {}
+    muestras = sorted(muestras)
+    return {
+        f'media_{unidad}': round(statistics.fmean(muestras), 1),
+        f'p50_{unidad}': round(muestras[len(muestras) // 2], 1),
+        f'p99_{unidad}': round(muestras[max(0, math.ceil(len(muestras) * 0.99) - 1)], 1),
+    }
+
+
+def _cronometrar(func: Callable, repeticiones: int) -> Dict:
+    """Ejecuta func N veces y devuelve estadísticas de latencia en microsegundos"""
+    muestras = []
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        func()
+        muestras.append((time.perf_counter() - t0) * 1e6)
+    return _percentiles(muestras, 'us')
+
+
+@contextlib.contextmanager
+def _sustituir(objeto, **valores):
+    """Cambia atributos de un módulo u objeto y los restaura al salir"""
+    originales = {k: getattr(objeto, k) for k in valores}
+    for k, v in valores.items():
+        setattr(objeto, k, v)
+    try:
+        yield
+    finally:
+        for k, v in originales.items():
+            setattr(objeto, k, v)
+
+
+def _medido(func: Callable, muestras: List[float]) -> Callable:
+    """Envuelve func anotando en muestras la duración de cada llamada (ms)"""
+    def envoltura(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            muestras.append((time.perf_counter() - t0) * 1000)
+    return envoltura
+
+
+def _imprimir(titulo: str, resultados: Dict[str, Dict]):
+    print(f"\n=== {titulo} ===")
+    for nombre, r in resultados.items():
+        metricas = ', '.join(f"{k}={v}" for k, v in r.items())
+        print(f"{nombre:<32} {metricas}")
+
+
+def bench_conexion(args):
+    """Coste por llamada: conexión nueva por llamada vs conexión compartida (db.py)"""
+    with tempfile.TemporaryDirectory() as tmp:
+        ruta = Path(tmp) / 'bench.db'
+        with db.transaction(ruta) as conn:
+            conn.execute("""CREATE TABLE api_quota (mes_ano TEXT PRIMARY KEY, limite INTEGER,
+                            usado INTEGER, fecha_inicio DATETIME, fecha_fin DATETIME)""")
+            conn.execute("""CREATE TABLE api_requests (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            fecha DATETIME DEFAULT CURRENT_TIMESTAMP, endpoint TEXT, tipo TEXT,
+                            exitoso BOOLEAN, mes_ano TEXT)""")
+            conn.execute("INSERT INTO api_quota VALUES ('2026-01', 100, 10, NULL, NULL)")
+
+        def lectura_antes():
+            conn = sqlite3.connect(str(ruta))
+            conn.cursor().execute("SELECT usado FROM api_quota WHERE mes_ano=?", ('2026-01',)).fetchone()
+            conn.close()
+
+        def lectura_despues():
+            db.get_connection(ruta).execute(
+                "SELECT usado FROM api_quota WHERE mes_ano=?", ('2026-01',)).fetchone()
+
+        def escritura_antes():
+            conn = sqlite3.connect(str(ruta))
+            conn.execute("INSERT INTO api_requests (endpoint, tipo, exitoso, mes_ano) VALUES (?, ?, ?, ?)",
+                         ('bench', 'search', 1, '2026-01'))
+            conn.commit()
+            conn.close()
+
+        def escritura_despues():
+            with db.transaction(ruta) as conn:
+                conn.execute("INSERT INTO api_requests (endpoint, tipo, exitoso, mes_ano) VALUES (?, ?, ?, ?)",
+                             ('bench', 'search', 1, '2026-01'))
+
+        n = args.repeticiones
+        # La conexión compartida ya pone el fichero en WAL; las conexiones "antes"
+        # heredan ese modo, así que la diferencia medida es solo el coste de abrir/configurar.
+        _imprimir(f"Conexión SQLite ({n} llamadas)", {
+            'lectura conexión por llamada': _cronometrar(lectura_antes, n),
+            'lectura conexión compartida': _cronometrar(lectura_despues, n),
+            'escritura conexión por llamada': _cronometrar(escritura_antes, n),
+            'escritura conexión compartida': _cronometrar(escritura_despues, n),
+        })
+        db.close_all()
+
+
+def bench_pipeline(args):
+    """
+    Pipeline completo contra la API simulada: token, paginación, parseo,
+    upsert en SQLite y encolado de notificaciones. La primera ronda es la
+    carga inicial; las siguientes aplican la rotación y cambios de precio.
+    """
+    import fake_idealista
+    import lotes
+    import main_v2_quota
+    import quota
+    import token_cache
+
+    logging.getLogger('idealista').setLevel(logging.WARNING)
+    catalogo = fake_idealista.Catalogo(args.listados, rotacion=args.rotacion,
+                                       cambios_precio=args.cambios_precio)
+    paginas = -(-args.listados // args.por_pagina)
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            fake_idealista.FakeIdealista(catalogo, latencia=args.latencia,
+                                         tasa_error=args.tasa_error) as servidor, \
+            _sustituir(config, DB_PATH=Path(tmp) / 'bench.db', ARCHIVE_DIR=Path(tmp) / 'archivo',
+                       IDEALISTA_API_URL=servidor.search_url,
+                       IDEALISTA_TOKEN_URL=servidor.token_url,
+                       SEARCH_PROFILES_FILE=Path(tmp) / 'perfiles.json',
+                       ITEMS_PER_PAGE=args.por_pagina, PAGE_WAIT_TIME=0,
+                       SEARCH_MODE='completo'), \
+            _sustituir(main_v2_quota, _quota=quota.QuotaLedger(limite=10 ** 9),
+                       _token_cache=token_cache.TokenCache('idealista', main_v2_quota.solicitar_token)):
+        main_v2_quota.init_db()
+        resultados = {}
+        for ronda in range(args.rondas):
+            if ronda:
+                catalogo.avanzar()
+            latencias, escrituras = [], []
+            with _sustituir(main_v2_quota, _post_busqueda=_medido(main_v2_quota._post_busqueda, latencias)), \
+                    _sustituir(lotes, aplicar_lote=_medido(lotes.aplicar_lote, escrituras)):
+                t0 = time.perf_counter()
+                estadisticas = main_v2_quota.buscar_pisos(max_paginas=paginas)
+                total = time.perf_counter() - t0
+
+            resultados[f"ronda {ronda + 1}"] = {
+                'pisos': estadisticas['total_procesados'],
+                'pisos_s': round(estadisticas['total_procesados'] / total),
+                'nuevos': estadisticas['totales_nuevos'],
+                'modificados': estadisticas['totales_modificados'],
+                'errores': estadisticas['errores'],
+                **{k.replace('_ms', '_pagina_ms'): v for k, v in _percentiles(latencias, 'ms').items()
+                   if not k.startswith('media')},
+                'escritura_bd_s': round(sum(escrituras) / 1000, 2),
+                'total_s': round(total, 2),
+            }
+        db.close_all()
+
+    _imprimir(f"Pipeline ({args.listados} pisos, {args.por_pagina}/página, "
+              f"latencia {args.latencia}s, errores {args.tasa_error:.0%})", resultados)
+
+
+def _formato_anterior(record: logging.LogRecord) -> str:
+    """JSONFormatter + log_event de antes: payload serializado dentro del mensaje y vuelto a codificar"""
+    mensaje = record.getMessage()
+    if getattr(record, 'event_type', None):
+        mensaje = f"[{record.event_type}] {json.dumps(record.event_data, ensure_ascii=False)}"
+    return json.dumps({
+        'timestamp': datetime.fromtimestamp(record.created).isoformat(),
+        'level': record.levelname,
+        'message': mensaje,
+        'module': record.module,
+        'function': record.funcName,
+        'line': record.lineno,
+    }, ensure_ascii=False)
+
+
+def bench_logging(args):
+    """Líneas/s del formateo JSON (antes, json, orjson) y de log_event hasta fichero"""
+    import utils
+
+    datos = {'pagina': 3, 'perfil': 'granada_alquiler', 'pisos': 50,
+             'titulo': 'Ático con terraza en el Albaicín', 'precios': [950.0, 1100.0, 875.5]}
+    evento = logging.LogRecord('idealista', logging.INFO, __file__, 1, "[%s] %s",
+                               ('SEARCH_PAGE', utils._JSONPerezoso(datos)), None, func='buscar_perfil')
+    evento.event_type, evento.event_data = 'SEARCH_PAGE', datos
+    texto = logging.LogRecord('idealista', logging.INFO, __file__, 2, "Página %d: %d pisos",
+                              (3, 50), None, func='buscar_perfil')
+
+    def lineas_s(formatear: Callable, registro) -> int:
+        n = args.repeticiones
+        t0 = time.perf_counter()
+        for _ in range(n):
+            formatear(registro)
+        return round(n / (time.perf_counter() - t0))
+
+    backends = {'json': None}
+    if utils.orjson is not None:
+        backends['orjson'] = utils.orjson
+    resultados = {'antes': {'evento_lineas_s': lineas_s(_formato_anterior, evento),
+                            'texto_lineas_s': lineas_s(_formato_anterior, texto)}}
+    for nombre, backend in backends.items():
+        with _sustituir(utils, orjson=backend):
+            formatter = utils.JSONFormatter()
+            resultados[nombre] = {'evento_lineas_s': lineas_s(formatter.format, evento),
+                                  'texto_lineas_s': lineas_s(formatter.format, texto)}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        logger = utils.setup_logging(Path(tmp) / 'bench.log', queue_size=args.repeticiones + 1)
+        # Solo se mide el fichero: la consola se silencia
+        for handler in utils._listener.handlers:
+            if not isinstance(handler, logging.FileHandler):
+                handler.setLevel(logging.CRITICAL)
+        t0 = time.perf_counter()
+        for i in range(args.repeticiones):
+            utils.log_event(logger, 'SEARCH_PAGE', datos)
+        encolado = time.perf_counter() - t0
+        utils.vaciar_logging(timeout=600)
+        total = time.perf_counter() - t0
+        deshabilitado = _cronometrar(lambda: utils.log_event(logger, 'X', datos, level='debug'),
+                                     args.repeticiones)
+        utils.detener_logging()
+    resultados['log_event → fichero'] = {
+        'llamador_lineas_s': round(args.repeticiones / encolado),
+        'escritas_lineas_s': round(args.repeticiones / total),
+        'deshabilitado_p50_us': deshabilitado['p50_us'],
+    }
+    _imprimir(f"Logging JSON ({args.repeticiones} líneas)", resultados)
+
+
+def bench_metricas(args):
+    """Coste por llamada de registrar métricas en el bucle"""
+    import metrics
+
+    histograma = metrics.Histogram('bench_seconds', 'bench', ('tipo',))
+    contador = metrics.Counter('bench_total', 'bench')
+    serie = histograma.labels('search')
+    n = args.repeticiones
+
+    def con_cronometro():
+        with metrics.cronometrar(serie):
+            pass
+
+    _imprimir(f"Métricas ({n} llamadas)", {
+        'Counter.inc': _cronometrar(contador.inc, n),
+        'Histogram.labels().observe': _cronometrar(lambda: histograma.labels('search').observe(0.01), n),
+        'cronometrar()': _cronometrar(con_cronometro, n),
+        'exponer() (scrape)': _cronometrar(metrics.exponer, max(1, n // 100)),
+    })
+    metrics.REGISTRO.remove(histograma)
+    metrics.REGISTRO.remove(contador)
+
+
+def bench_replay(args):
+    """
+    Reproducción del archivo: se archivan --rondas ejecuciones completas del
+    catálogo simulado (sin HTTP) y se reproducen sobre una BD vacía, con el
+    parseo en este proceso y en --procesos procesos.
+    """
+    import archivo
+    import fake_idealista
+    import replay
+
+    logging.getLogger('idealista').setLevel(logging.WARNING)
+    catalogo = fake_idealista.Catalogo(args.listados, rotacion=args.rotacion,
+                                       cambios_precio=args.cambios_precio)
+    paginas = -(-args.listados // args.por_pagina)
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            _sustituir(config, ARCHIVE_DIR=Path(tmp) / 'archivo',
+                       SEARCH_PROFILES_FILE=Path(tmp) / 'perfiles.json'):
+        t0 = time.perf_counter()
+        for ronda in range(args.rondas):
+            if ronda:
+                catalogo.avanzar()
+            ejecucion = archivo.iniciar_ejecucion()
+            fecha = f"2026-01-{1 + ronda % 28:02d} {ronda // 28 % 24:02d}:00:00"
+            for n in range(1, paginas + 1):
+                contenido = json.dumps(catalogo.pagina(n, args.por_pagina)).encode()
+                archivo.guardar(ejecucion, 'default', n, contenido, fecha)
+            archivo.cerrar_ejecucion(ejecucion, True, fecha)
+        archivado = time.perf_counter() - t0
+        en_disco = sum(f.stat().st_size for f in (Path(tmp) / 'archivo').rglob('*') if f.is_file())
+
+        resultados = {}
+        for procesos in sorted({0, args.procesos}):
+            with _sustituir(config, DB_PATH=Path(tmp) / f'replay_{procesos}.db'):
+                r = replay.reproducir_archivo(procesos=procesos)
+                db.close_all()
+            resultados[f"{procesos or 1} proceso(s)"] = {
+                'paginas': r['paginas'],
+                'pisos': r['pisos'],
+                'pisos_s': round(r['pisos'] / r['segundos']),
+                'paginas_s': round(r['paginas'] / r['segundos']),
+                'total_s': r['segundos'],
+            }
+        db.close_all()
+
+    _imprimir(f"Replay ({args.rondas} ejecuciones x {paginas} páginas de {args.por_pagina}; "
+              f"archivado en {archivado:.1f}s, {en_disco / 1024:.0f} KiB en disco)", resultados)
+
+
+def bench_anomalias(args):
+    """
+    Coste de puntuar una página (z-score por cohorte) con el modelo en memoria
+    cargado con --listados pisos, frente a una consulta SQL de cohorte por piso
+    """
+    import anomalias
+    import fake_idealista
+    import lotes
+    import main_v2_quota
+
+    logging.getLogger('idealista').setLevel(logging.WARNING)
+    catalogo = fake_idealista.Catalogo(args.listados)
+    por_pagina = args.por_pagina
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            _sustituir(config, DB_PATH=Path(tmp) / 'bench.db',
+                       SEARCH_PROFILES_FILE=Path(tmp) / 'perfiles.json'):
+        main_v2_quota.init_db()
+        with db.transaction() as conn:
+            for n in range(1, -(-args.listados // 1000) + 1):
+                lotes.aplicar_lote(conn, [lotes.parsear_piso(p) for p in
+                                          catalogo.pagina(n, 1000)['elementList']])
+        conn = db.get_connection()
+        t0 = time.perf_counter()
+        modelo = anomalias.ModeloMercado()
+        modelo.cargar(conn)
+        carga = time.perf_counter() - t0
+
+        catalogo.avanzar()
+        paginas = [[lotes.parsear_piso(p) for p in catalogo.pagina(n, por_pagina)['elementList']]
+                   for n in range(1, 21)]
+        ciclo = iter(range(10 ** 9))
+
+        def puntuar_y_registrar():
+            pagina = paginas[next(ciclo) % len(paginas)]
+            modelo.puntuar(pagina)
+            # Marca sus cohortes como tocadas, como tras aplicar una página
+            modelo.registrar({'nuevos': pagina[:1], 'bajadas': [], 'subidas': []})
+
+        def consulta_por_piso():
+            for fila in paginas[0]:
+                conn.execute("""SELECT AVG(precio * 1.0 / metros), COUNT(*) FROM pisos
+                                WHERE operacion = ? AND habitaciones = ? AND zona = ?
+                                AND metros BETWEEN ? AND ?""",
+                             (fila['operacion'], fila['habitaciones'], fila['zona'],
+                              fila['metros'] * 0.8, fila['metros'] * 1.2)).fetchone()
+
+        repeticiones = max(1, args.repeticiones // 10)
+        resultados = {
+            'puntuar página (modelo)': _cronometrar(lambda: modelo.puntuar(paginas[0]), repeticiones),
+            'puntuar + recalcular cohortes': _cronometrar(puntuar_y_registrar, repeticiones),
+            'SQL por piso (referencia)': _cronometrar(consulta_por_piso, max(1, repeticiones // 20)),
+        }
+        for r in resultados.values():
+            r['por_piso_us'] = round(r['media_us'] / por_pagina, 1)
+        db.close_all()
+
+    _imprimir(f"Anomalías ({args.listados} pisos, {len(modelo)} cohortes, carga {carga:.2f}s, "
+              f"{por_pagina} pisos/página)", resultados)
+
+
+def bench_geo(args):
+    """
+    Consultas espaciales con --listados pisos (la mayoría en 25 ciudades):
+    radio, caja y mapa de calor por celdas, frente a recorrer pisos filtrando
+    por coordenadas (referencia sin índice). Usar --listados 1000000
+    """
+    import geo
+    import main_v2_quota
+
+    logging.getLogger('idealista').setLevel(logging.WARNING)
+    rnd = random.Random(args.semilla)
+    km = 1000 / geo.METROS_POR_GRADO
+    # 25 ciudades de 8x8 km con el 80% de los pisos; el resto repartido en ±150 km
+    ciudades = [(config.SEARCH_LATITUDE + rnd.uniform(-150, 150) * km,
+                 config.SEARCH_LONGITUDE + rnd.uniform(-150, 150) * km * 1.25) for _ in range(25)]
+
+    def coordenadas(i):
+        if i % 5:
+            lat, lon = ciudades[i % len(ciudades)]
+            return lat + rnd.uniform(-4, 4) * km, lon + rnd.uniform(-4, 4) * km * 1.25
+        return (config.SEARCH_LATITUDE + rnd.uniform(-150, 150) * km,
+                config.SEARCH_LONGITUDE + rnd.uniform(-150, 150) * km * 1.25)
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            _sustituir(config, DB_PATH=Path(tmp) / 'bench.db',
+                       SEARCH_PROFILES_FILE=Path(tmp) / 'perfiles.json'):
+        main_v2_quota.init_db()
+        t0 = time.perf_counter()
+        with db.transaction() as conn:
+            filas = []
+            for i in range(args.listados):
+                lat, lon = coordenadas(i)
+                filas.append((str(i), f'Piso {i}', f'/inmueble/{i}/', 600 + i % 900, 50 + i % 100, 'rent',
+                              lat, lon, geo.celda(lat, lon)))
+            conn.executemany("""INSERT INTO pisos (id, titulo, link, precio, metros, operacion,
+                                                  latitud, longitud, celda)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", filas)
+        carga = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        celdas = geo.reconstruir()
+        reconstruccion = time.perf_counter() - t0
+
+        conn = db.get_connection()
+        # Centros de consulta dentro de las ciudades; medio km en cada dirección
+        puntos = [coordenadas(i) for i in range(1, 250) if i % 5]
+        dlat, dlon = km / 2, km / 2 * 1.25
+        ciclo = iter(range(10 ** 9))
+
+        def punto():
+            return puntos[next(ciclo) % len(puntos)]
+
+        def radio(metros):
+            def consulta():
+                lat, lon = punto()
+                return geo.en_radio(lat, lon, metros)
+            return consulta
+
+        def caja():
+            lat, lon = punto()
+            return geo.en_caja(lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+
+        def mapa_de_calor():
+            lat, lon = punto()
+            return geo.celdas_en_caja(lat - 10 * dlat, lon - 10 * dlon, lat + 10 * dlat, lon + 10 * dlon)
+
+        def recorrido():
+            lat, lon = punto()
+            return conn.execute("""SELECT id FROM pisos WHERE latitud BETWEEN ? AND ?
+                                   AND longitud BETWEEN ? AND ?""",
+                                (lat - dlat, lat + dlat, lon - dlon, lon + dlon)).fetchall()
+
+        repeticiones = max(1, args.repeticiones // 10)
+        resultados = {}
+        for nombre, consulta in (('radio 500 m', radio(500)), ('radio 2 km', radio(2000)),
+                                 ('caja 1x1 km', caja), ('mapa de calor 10x10 km', mapa_de_calor),
+                                 ('recorrido sin índice', recorrido)):
+            pisos = [len(consulta()) for _ in range(20)]
+            veces = repeticiones if nombre != 'recorrido sin índice' else max(1, repeticiones // 20)
+            resultados[nombre] = {**_cronometrar(consulta, veces), 'filas_media': round(statistics.fmean(pisos))}
+        db.close_all()
+
+    _imprimir(f"Geo ({args.listados} pisos, {celdas} celdas de {config.GEO_CELL_METERS:g} m, "
+              f"carga {carga:.1f}s, reconstruir {reconstruccion:.1f}s)", resultados)
+
+
+def bench_dedup(args):
+    """
+    Coste por piso nuevo de la búsqueda de duplicados (firma MinHash,
+    candidatos LSH y verificación) con --tamanos pisos ya indexados; el 10%
+    de los nuevos son otro anuncio de un piso existente. Debe crecer mucho
+    menos que el número de pisos.
+    """
+    import dedup
+    import geo
+    import lotes
+    import main_v2_quota
+
+    logging.getLogger('idealista').setLevel(logging.WARNING)
+    km = 1000 / geo.METROS_POR_GRADO
+    ciudades = [(config.SEARCH_LATITUDE + random.Random(c).uniform(-150, 150) * km,
+                 config.SEARCH_LONGITUDE + random.Random(-c).uniform(-150, 150) * km * 1.25) for c in range(25)]
+    tipos = ('Piso', 'Ático', 'Estudio', 'Dúplex', 'Casa')
+    planta = ('bj', '1', '2', '3', '4', '5', '6')
+
+    def piso(i: int) -> Dict:
+        rnd = random.Random(i * 7919 + args.semilla)
+        lat, lon = ciudades[i % len(ciudades)]
+        metros = rnd.randint(35, 180)
+        return {'id': str(i), 'titulo': f"{rnd.choice(tipos)} en calle v{rnd.randrange(2000)}, b{rnd.randrange(60)}",
+                'precio': round(metros * rnd.uniform(7, 16)), 'metros': metros,
+                'habitaciones': min(1 + metros // 35, 5), 'planta': rnd.choice(planta), 'operacion': 'rent',
+                'latitud': lat + rnd.uniform(-4, 4) * km, 'longitud': lon + rnd.uniform(-4, 4) * km * 1.25}
+
+    def duplicado(original: Dict, nuevo_id: int, rnd: random.Random) -> Dict:
+        return {**original, 'id': str(nuevo_id), 'titulo': original['titulo'].split(',')[0] + f" ref {nuevo_id}",
+                'precio': round(original['precio'] * rnd.uniform(0.97, 1.03)),
+                'latitud': original['latitud'] + rnd.uniform(-30, 30) * km / 1000}
+
+    resultados = {}
+    for existentes in args.tamanos:
+        with tempfile.TemporaryDirectory() as tmp, _sustituir(config, DB_PATH=Path(tmp) / 'bench.db'):
+            main_v2_quota.init_db()
+            f = dedup.firmador()
+            t0 = time.perf_counter()
+            with db.transaction() as conn:
+                for inicio in range(0, existentes, 10000):
+                    filas = [{**lotes.parsear_piso({}), **piso(i)} for i in range(inicio, min(inicio + 10000, existentes))]
+                    conn.executemany(f"INSERT INTO pisos ({', '.join(lotes.COLUMNAS)}, cluster_id) "
+                                     f"VALUES ({', '.join('?' for _ in lotes.COLUMNAS)}, ?)",
+                                     ([fila[c] for c in lotes.COLUMNAS] + [fila['id']] for fila in filas))
+                    dedup._cargar_claves(conn, {fila['id']: dedup.claves_busqueda(fila, f.firma(dedup.rasgos(fila)))
+                                                for fila in filas})
+                    dedup._indexar(conn)
+            carga = time.perf_counter() - t0
+
+            rnd = random.Random(args.semilla)
+            siguiente, inyectados, encontrados, falsos = existentes, 0, 0, 0
+            latencias = []
+            for _ in range(args.paginas):
+                pagina, originales = [], {}
+                for _ in range(args.por_pagina):
+                    if rnd.random() < 0.1:
+                        original = rnd.randrange(existentes)
+                        pagina.append({**lotes.parsear_piso({}), **duplicado(piso(original), siguiente, rnd)})
+                        originales[str(siguiente)] = str(original)
+                    else:
+                        pagina.append({**lotes.parsear_piso({}), **piso(siguiente)})
+                    siguiente += 1
+                with db.transaction() as conn:
+                    diff = lotes.aplicar_lote(conn, pagina)
+                    t = time.perf_counter()
+                    dedup.agrupar_lote(conn, diff['nuevos'])
+                    latencias.append((time.perf_counter() - t) * 1e6 / len(pagina))
+                for fila in diff['nuevos']:
+                    if fila['id'] in originales:
+                        inyectados += 1
+                        encontrados += fila['duplicado_de'] == originales[fila['id']]
+                    else:
+                        falsos += fila['duplicado_de'] is not None
+            db.close_all()
+
+        resultados[f"{existentes} pisos"] = {
+            **{k.replace('_us', '_por_piso_us'): v for k, v in _percentiles(latencias, 'us').items()},
+            'recall': round(encontrados / max(inyectados, 1), 3),
+            'falsos_positivos': falsos, 'indexar_s': round(carga, 1),
+        }
+
+    _imprimir(f"Duplicados ({args.paginas} páginas de {args.por_pagina} nuevos, 10% duplicados, "
+              f"{config.DEDUP_NUM_PERM} permutaciones en {config.DEDUP_BANDS} bandas)", resultados)
+
+
+def bench_reglas(args):
+    """
+    Coste por página de evaluar --reglas reglas de alerta compiladas sobre el
+    diff clasificado (70% con zona), con el índice por (evento, zona) y
+    evaluando todas las del evento contra cada piso.
+    """
+    import reglas
+
+    rnd = random.Random(args.semilla)
+    zonas = [f"zona{z}" for z in range(30)]
+
+    def regla(i: int) -> Dict:
+        condiciones = rnd.choice([{'precio_m2': {'<': rnd.uniform(6, 14)}},
+                                  {'exterior': True, 'habitaciones': {'>=': rnd.randint(1, 4)}},
+                                  {'metros': {'>=': rnd.randint(40, 120)}, 'precio': {'<=': rnd.randint(600, 1500)}},
+                                  {'titulo': {'contiene': rnd.choice(['ático', 'terraza', 'reformado'])}}])
+        evento = 'nuevo'
+        if rnd.random() < 0.3:
+            evento, condiciones = 'bajada', {**condiciones, 'bajada_pct': {'>=': rnd.choice([3, 5, 10])}}
+        if rnd.random() < 0.7:
+            condiciones['zona'] = rnd.choice(zonas)
+        return {'nombre': f"r{i}", 'evento': evento, 'condiciones': condiciones}
+
+    def fila(i: int) -> Dict:
+        metros = rnd.randint(35, 160)
+        precio = round(metros * rnd.uniform(6, 15))
+        return {'id': str(i), 'titulo': rnd.choice(['Ático con terraza', 'Piso reformado', 'Piso']),
+                'precio': precio, 'precio_m2': round(precio / metros, 1), 'metros': metros,
+                'habitaciones': rnd.randint(1, 5), 'exterior': rnd.random() < 0.5, 'zona': rnd.choice(zonas),
+                'precio_anterior': round(precio * rnd.uniform(1.01, 1.15)), 'duplicado_de': None}
+
+    paginas = []
+    for _ in range(args.paginas):
+        filas = [fila(i) for i in range(args.por_pagina)]
+        corte = int(len(filas) * 0.8)
+        paginas.append({'nuevos': filas[:corte], 'bajadas': filas[corte:], 'subidas': [], 'sin_cambios': []})
+
+    resultados = {}
+    for n in args.reglas:
+        definiciones = [regla(i) for i in range(n)]
+        t0 = time.perf_counter()
+        compiladas = [reglas.compilar(r['nombre'], r['evento'], r['condiciones']) for r in definiciones]
+        motor = reglas.Motor(compiladas)
+        compilacion = (time.perf_counter() - t0) * 1000
+        # Sin índice: todas las reglas del evento (la zona, como una condición más)
+        sin_indice = reglas.Motor([reglas.compilar(r['nombre'], r['evento'],
+                                                   {k: v if k != 'zona' else {'en': [v]}
+                                                    for k, v in r['condiciones'].items()})
+                                   for r in definiciones])
+        iteracion = iter(range(10 ** 9))
+        for nombre, m in (('indexado', motor), ('sin índice', sin_indice)):
+            resultados[f"{n} reglas, {nombre}"] = {
+                **_cronometrar(lambda: m.evaluar(paginas[next(iteracion) % len(paginas)]),
+                               max(1, args.repeticiones // 10)),
+                'compilar_ms': round(compilacion, 1),
+            }
+
+    _imprimir(f"Reglas de alerta (páginas de {args.por_pagina} pisos, 20% bajadas)", resultados)
+
+
+def bench_suscripciones(args):
+    """
+    Coste de encontrar los destinatarios de un evento con --suscriptores
+    suscripciones: índice invertido frente a filtrar una a una
+    """
+    import suscripciones
+
+    rnd = random.Random(args.semilla)
+    zonas = [f"zona{z}" for z in range(30)]
+
+    def opcional(valor, probabilidad=0.6):
+        return valor if rnd.random() < probabilidad else None
+
+    def suscripcion(i: int):
+        minimo = rnd.choice([300, 500, 700, 900, 150000])
+        return suscripciones.normalizar({
+            'chat_id': i, 'eventos': opcional(rnd.choice(['nuevo', 'bajada', 'nuevo,bajada']), 0.3),
+            'operacion': opcional(rnd.choice(['rent', 'sale']), 0.3),
+            'habitaciones': opcional(','.join(rnd.sample('01234', rnd.randint(1, 3)))),
+            'precio_min': opcional(minimo), 'precio_max': opcional(minimo * rnd.uniform(1.5, 3)),
+            'zonas': opcional(','.join(rnd.sample(zonas, rnd.randint(1, 3))), 0.8)})
+
+    eventos = [(rnd.choice(['nuevo', 'nuevo', 'bajada']),
+                {'operacion': 'rent', 'habitaciones': rnd.randint(0, 5), 'precio': rnd.randint(400, 2000),
+                 'zona': rnd.choice(zonas)}) for _ in range(1000)]
+
+    resultados = {}
+    for n in args.suscriptores:
+        todas = [suscripcion(i) for i in range(n)]
+        t0 = time.perf_counter()
+        indice = suscripciones.Indice(todas)
+        construccion = (time.perf_counter() - t0) * 1000
+        iteracion = iter(range(10 ** 9))
+
+        def indexado():
+            return indice.suscriptores(*eventos[next(iteracion) % len(eventos)])
+
+        def recorrido():
+            evento, fila = eventos[next(iteracion) % len(eventos)]
+            return [s for s in todas if suscripciones.coincide(s, evento, fila)]
+
+        destinatarios = statistics.fmean(len(indice.suscriptores(*e)) for e in eventos)
+        for nombre, funcion in (('índice', indexado), ('recorrido', recorrido)):
+            resultados[f"{n} suscripciones, {nombre}"] = {
+                **_cronometrar(funcion, max(1, args.repeticiones // (10 if nombre == 'índice' else 100))),
+                'destinatarios_media': round(destinatarios, 1), 'construir_ms': round(construccion, 1),
+            }
+
+    _imprimir("Reparto entre suscripciones (por evento)", resultados)
+
+
+# (nuevos, cambios de precio) por página; el resto son pisos sin cambios
+MEZCLAS = {
+    'solo_nuevos': (1.0, 0.0),
+    'mixta': (0.2, 0.1),
+    'sin_cambios': (0.0, 0.0),
+}
+
+# Métricas en las que más es mejor; en el resto (latencias, crecimiento) menos es mejor
+_MAS_ES_MEJOR = {'pisos_s'}
+
+
+def _tamano_bd(ruta: Path) -> int:
+    """Bytes del fichero principal tras volcar el WAL"""
+    db.get_connection(ruta).execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return ruta.stat().st_size
+
+
+def _sembrar(catalogo, existentes: int):
+    """Carga `existentes` pisos (y su primer precio) en una sola transacción"""
+    import lotes
+    columnas = ', '.join(lotes.COLUMNAS)
+    marcadores = ', '.join('?' for _ in lotes.COLUMNAS)
+    fecha = lotes.fecha_actual()
+    with db.transaction() as conn:
+        for inicio in range(0, existentes, 10000):
+            filas = [lotes.parsear_piso(catalogo.piso(h))
+                     for h in range(inicio, min(inicio + 10000, existentes))]
+            conn.executemany(
+                f"INSERT INTO pisos ({columnas}, fecha_registro, fecha_actualizacion) "
+                f"VALUES ({marcadores}, '{fecha}', '{fecha}')",
+                ([f[c] for c in lotes.COLUMNAS] for f in filas))
+            conn.executemany("INSERT INTO historial_precios (id_piso, precio, fecha) VALUES (?, ?, ?)",
+                             ((f['id'], f['precio'], fecha) for f in filas))
+
+
+def _paginas_mezcla(catalogo, existentes: int, mezcla, paginas: int, por_pagina: int,
+                    estado: Dict) -> List[List[Dict]]:
+    """
+    Genera las páginas de una mezcla. `estado` guarda entre mezclas el
+    siguiente hueco libre y los precios ya cambiados, para que los pisos
+    "sin cambios" lo sean de verdad frente a la BD.
+    """
+    rng = estado['rng']
+    fraccion_nuevos, fraccion_cambios = mezcla
+    resultado = []
+    for _ in range(paginas):
+        pagina = []
+        nuevos = round(por_pagina * fraccion_nuevos)
+        cambios = round(por_pagina * fraccion_cambios)
+        for i in range(por_pagina):
+            if i < nuevos:
+                hueco = estado['siguiente']
+                estado['siguiente'] += 1
+                pagina.append(catalogo.piso(hueco))
+                continue
+            hueco = rng.randrange(existentes)
+            piso = catalogo.piso(hueco)
+            if i < nuevos + cambios:
+                estado['cambio'] += 1
+                estado['precios'][hueco] = piso['price'] + 10 * estado['cambio']
+            if hueco in estado['precios']:
+                piso['price'] = estado['precios'][hueco]
+            pagina.append(piso)
+        resultado.append(pagina)
+    return resultado
+
+
+def _comparar(resultados: Dict, baseline: Dict, tolerancia: float) -> List[str]:
+    """Imprime la comparación con la baseline y devuelve las regresiones"""
+    regresiones = []
+    print(f"\n=== Comparación con baseline ({baseline.get('fecha', '?')}) ===")
+    for caso, metricas in resultados.items():
+        base = baseline.get('resultados', {}).get(caso)
+        if not base:
+            print(f"{caso:<32} (sin baseline)")
+            continue
+        for metrica, valor in metricas.items():
+            anterior = base.get(metrica)
+            if not anterior or not isinstance(valor, (int, float)):
+                continue
+            cambio = (valor - anterior) / anterior
+            peor = -cambio if metrica in _MAS_ES_MEJOR else cambio
+            marca = ''
+            if peor > tolerancia:
+                marca = '  ⚠️ REGRESIÓN'
+                regresiones.append(f"{caso} {metrica}")
+            print(f"{caso:<32} {metrica:<16} {anterior} → {valor} ({cambio:+.1%}){marca}")
+    return regresiones
+
+
+def bench_almacenamiento(args):
+    """
+    procesar_lote, esquema pisos/historial_precios y funciones de quota con
+    10k/100k/1M pisos ya existentes y distintas mezclas de nuevos/cambiados/
+    sin cambios. Guarda los resultados en JSON y compara con una baseline.
+    """
+    import fake_idealista
+    import main_v2_quota
+    import quota
+
+    logging.getLogger('idealista').setLevel(logging.WARNING)
+    resultados = {}
+    for existentes in args.tamanos:
+        catalogo = fake_idealista.Catalogo(existentes, semilla=args.semilla)
+        with tempfile.TemporaryDirectory() as tmp:
+            ruta = Path(tmp) / 'bench.db'
+            ledger = quota.QuotaLedger(limite=10 ** 9)
+            with _sustituir(config, DB_PATH=ruta), _sustituir(main_v2_quota, _quota=ledger):
+                main_v2_quota.init_db()
+                t0 = time.perf_counter()
+                _sembrar(catalogo, existentes)
+                resultados[f"{existentes}/carga"] = {
+                    'carga_s': round(time.perf_counter() - t0, 2),
+                    'tamano_mb': round(_tamano_bd(ruta) / 2 ** 20, 1),
+                }
+
+                estado = {'rng': random.Random(args.semilla), 'siguiente': existentes,
+                          'cambio': 0, 'precios': {}}
+                for nombre, mezcla in MEZCLAS.items():
+                    paginas = _paginas_mezcla(catalogo, existentes, mezcla, args.paginas,
+                                              args.por_pagina, estado)
+                    tamano = _tamano_bd(ruta)
+                    latencias = []
+                    t0 = time.perf_counter()
+                    for pagina in paginas:
+                        t = time.perf_counter()
+                        main_v2_quota.procesar_lote(pagina)
+                        latencias.append((time.perf_counter() - t) * 1000)
+                    total = time.perf_counter() - t0
+                    resultados[f"{existentes}/{nombre}"] = {
+                        'pisos_s': round(len(paginas) * args.por_pagina / total),
+                        **{k.replace('_ms', '_commit_ms'): v
+                           for k, v in _percentiles(latencias, 'ms').items()},
+                        'crecimiento_kb': round((_tamano_bd(ruta) - tamano) / 1024, 1),
+                    }
+
+                resultados[f"{existentes}/quota"] = {
+                    **{k.replace('_us', '_registrar_us'): v
+                       for k, v in _cronometrar(ledger.registrar, args.repeticiones).items()
+                       if not k.startswith('media')},
+                    **{k.replace('_us', '_estado_us'): v
+                       for k, v in _cronometrar(main_v2_quota.check_api_quota, args.repeticiones).items()
+                       if not k.startswith('media')},
+                }
+            db.close_all()
+
+    _imprimir(f"Almacenamiento ({args.paginas} páginas de {args.por_pagina} por mezcla)", resultados)
+
+    informe = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'parametros': {'tamanos': args.tamanos, 'paginas': args.paginas,
+                       'por_pagina': args.por_pagina, 'repeticiones': args.repeticiones,
+                       'semilla': args.semilla},
+        'resultados': resultados,
+    }
+    args.salida.parent.mkdir(parents=True, exist_ok=True)
+    args.salida.write_text(json.dumps(informe, indent=2, ensure_ascii=False), encoding='utf-8')
+    print(f"\nResultados guardados en {args.salida}")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding='utf-8'))
+        regresiones = _comparar(resultados, baseline, args.tolerancia)
+        if regresiones:
+            print(f"\n{len(regresiones)} regresiones por encima del {args.tolerancia:.0%}")
+            sys.exit(1)
+
+
+def bench_backup(args):
+    """
+    Instantáneas incrementales (backup.crear) con 10k/100k/1M pisos: la
+    primera completa y otra tras una ronda de páginas 'mixta'. Las páginas
+    nuevas siguen al volumen de cambios; la duración, al tamaño de la BD.
+    """
+    import backup
+    import fake_idealista
+    import main_v2_quota
+    import quota
+
+    logging.getLogger('idealista').setLevel(logging.WARNING)
+    resultados = {}
+    for existentes in args.tamanos:
+        catalogo = fake_idealista.Catalogo(existentes, semilla=args.semilla)
+        with tempfile.TemporaryDirectory() as tmp:
+            ruta = Path(tmp) / 'bench.db'
+            with _sustituir(config, DB_PATH=ruta, BACKUP_DIR=Path(tmp) / 'backups'), \
+                    _sustituir(main_v2_quota, _quota=quota.QuotaLedger(limite=10 ** 9)):
+                main_v2_quota.init_db()
+                _sembrar(catalogo, existentes)
+                _tamano_bd(ruta)
+                completa = backup.crear()
+                estado = {'rng': random.Random(args.semilla), 'siguiente': existentes,
+                          'cambio': 0, 'precios': {}}
+                for pagina in _paginas_mezcla(catalogo, existentes, MEZCLAS['mixta'], args.paginas,
+                                              args.por_pagina, estado):
+                    main_v2_quota.procesar_lote(pagina)
+                _tamano_bd(ruta)
+                incremental = backup.crear()
+                for nombre, r in (('completa', completa), ('incremental', incremental)):
+                    resultados[f"{existentes}/{nombre}"] = {
+                        'paginas': r['num_paginas'],
+                        'paginas_nuevas': r['paginas_nuevas'],
+                        'kb_nuevos': round(r['bytes_nuevos'] / 1024, 1),
+                        'duracion_s': r['duracion'],
+                    }
+            db.close_all()
+
+    _imprimir(f"Backup ({args.paginas} páginas 'mixta' de {args.por_pagina} entre instantáneas)", resultados)
+
+
+BENCHMARKS = {
+    'conexion': bench_conexion,
+    'pipeline': bench_pipeline,
+    'almacenamiento': bench_almacenamiento,
+    'logging': bench_logging,
+    'metricas': bench_metricas,
+    'replay': bench_replay,
+    'anomalias': bench_anomalias,
+    'geo': bench_geo,
+    'dedup': bench_dedup,
+    'reglas': bench_reglas,
+    'suscripciones': bench_suscripciones,
+    'backup': bench_backup,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks del bot de Idealista")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('-n', '--repeticiones', type=int, default=2000)
+    # pipeline
+    parser.add_argument('--listados', type=int, default=10000, help="Pisos del catálogo simulado")
+    parser.add_argument('--rondas', type=int, default=3)
+    parser.add_argument('--por-pagina', type=int, default=config.ITEMS_PER_PAGE)
+    parser.add_argument('--rotacion', type=float, default=0.01)
+    parser.add_argument('--cambios-precio', type=float, default=0.02)
+    parser.add_argument('--latencia', type=float, default=0.0, help="Segundos por página")
+    parser.add_argument('--tasa-error', type=float, default=0.0)
+    # reglas
+    parser.add_argument('--reglas', type=lambda v: [int(x) for x in v.split(',')],
+                        default=[2, 100, 1000], help="Reglas de alerta, separadas por comas")
+    # suscripciones
+    parser.add_argument('--suscriptores', type=lambda v: [int(x) for x in v.split(',')],
+                        default=[100, 1000, 10000, 100000], help="Suscripciones, separadas por comas")
+    # replay
+    parser.add_argument('--procesos', type=int, default=4, help="Procesos de parseo")
+    # almacenamiento, backup
+    parser.add_argument('--tamanos', type=lambda v: [int(x) for x in v.split(',')],
+                        default=[10_000, 100_000, 1_000_000], help="Pisos existentes, separados por comas")
+    parser.add_argument('--paginas', type=int, default=100, help="Páginas por mezcla")
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--salida', type=Path, default=config.DATA_DIR / 'benchmarks' / 'almacenamiento.json')
+    parser.add_argument('--baseline', type=Path, help="JSON de una ejecución anterior con el que comparar")
+    parser.add_argument('--tolerancia', type=float, default=0.10, help="Empeoramiento admitido")
+    args = parser.parse_args(argv)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,7 @@ from typing import Optional
 APP_DIR = Path(__file__).parent
 DATA_DIR = APP_DIR / "data"
 DB_PATH = DATA_DIR / "pisos.db"
-LOG_PATH = DATA_DIR / "logs.log"
+LOG_PATH = Path(os.getenv('LOG_PATH', str(DATA_DIR / "logs.log")))
 
 # Crear directorios si no existen
 DATA_DIR.mkdir(exist_ok=True)
@@ -30,24 +30,64 @@ SEARCH_RADIUS = int(os.getenv('SEARCH_RADIUS', 6000))  # metros
 SEARCH_BEDROOMS = os.getenv('SEARCH_BEDROOMS', '2,3,4').split(',')
 SEARCH_BATHROOMS = os.getenv('SEARCH_BATHROOMS', '1,2,3').split(',')
 
+# Perfiles múltiples (zonas, alquiler/venta): fichero JSON o tabla perfiles_busqueda.
+# Sin perfiles se usa uno solo con los parámetros de arriba.
+SEARCH_PROFILES_FILE = Path(os.getenv('SEARCH_PROFILES_FILE', str(DATA_DIR / 'perfiles.json')))
+PROFILE_WORKERS = int(os.getenv('PROFILE_WORKERS', 3))  # perfiles buscados en paralelo
+
 # --- ESTRATEGIA DE CONSUMO Y QUOTA ---
 MAX_PAGES_PER_DAY = int(os.getenv('MAX_PAGES_PER_DAY', 5))
 ITEMS_PER_PAGE = int(os.getenv('ITEMS_PER_PAGE', 50))
 
+# Paginación: 'incremental' (por recencia, para al alcanzar lo ya conocido) o 'completo'
+SEARCH_MODE = os.getenv('SEARCH_MODE', 'completo').lower()
+INCREMENTAL_ORDER = os.getenv('INCREMENTAL_ORDER', 'modificationDate')
+INCREMENTAL_PRICE_THRESHOLD = float(os.getenv('INCREMENTAL_PRICE_THRESHOLD', 0.02))  # 2%: cambios menores no cuentan
+
 # CRÍTICO: Idealista API tiene límite de 100 requests/mes
 MONTHLY_REQUEST_LIMIT = int(os.getenv('MONTHLY_REQUEST_LIMIT', 100))
 # Búsquedas por mes = 100 requests / (5 páginas * 24 búsquedas/mes) ≈ 0.83 búsquedas/día
 # Recomendado: 1 búsqueda cada 2-3 días para estar seguro
 SEARCH_INTERVAL_HOURS = int(os.getenv('SEARCH_INTERVAL_HOURS', 72))  # 72h = 3 días
+# Planificador adaptativo: reparte la quota restante hasta fin de mes
+ADAPTIVE_SCHEDULING = os.getenv('ADAPTIVE_SCHEDULING', 'true').lower() == 'true'
+PLAN_MIN_INTERVAL_HOURS = float(os.getenv('PLAN_MIN_INTERVAL_HOURS', 6))
+PLAN_MAX_INTERVAL_HOURS = float(os.getenv('PLAN_MAX_INTERVAL_HOURS', 168))
+PLAN_MAX_SLEEP_HOURS = float(os.getenv('PLAN_MAX_SLEEP_HOURS', 6))  # replanificar al menos cada N horas
+PLAN_YIELD_WINDOW = int(os.getenv('PLAN_YIELD_WINDOW', 10))  # ejecuciones para medir rendimiento
+PLAN_YIELD_SATURATION = float(os.getenv('PLAN_YIELD_SATURATION', 0.5))  # fracción de novedades por página para pedir el máximo
+PLAN_TOKEN_COST = int(os.getenv('PLAN_TOKEN_COST', 1))  # peticiones de token reservadas por búsqueda
 QUOTA_WARNING_THRESHOLD = float(os.getenv('QUOTA_WARNING_THRESHOLD', 0.8))  # Alerta al 80%
 PAUSE_AT_QUOTA = os.getenv('PAUSE_AT_QUOTA', 'true').lower() == 'true'  # Pausar si alcanza 100%
 
+# --- SQLITE ---
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', 5000))  # Espera ante locks
+DB_LOCK_RETRIES = int(os.getenv('DB_LOCK_RETRIES', 5))  # Reintentos de BEGIN IMMEDIATE
+DB_CACHED_STATEMENTS = int(os.getenv('DB_CACHED_STATEMENTS', 256))  # Sentencias preparadas por conexión
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', 268435456))  # 256MB
+DB_CACHE_KB = int(os.getenv('DB_CACHE_KB', 16384))  # 16MB de page cache
+DB_JOURNAL_SIZE_LIMIT = int(os.getenv('DB_JOURNAL_SIZE_LIMIT', 67108864))  # 64MB máx. para -wal
+
 # --- TIEMPOS Y REINTENTOS ---
 LOOP_INTERVAL = int(os.getenv('LOOP_INTERVAL', 86400))  # 24 horas en segundos (SOBREESCRITO por SEARCH_INTERVAL_HOURS)
 REQUEST_TIMEOUT = int(os.getenv('REQUEST_TIMEOUT', 15))  # segundos
 PAGE_WAIT_TIME = float(os.getenv('PAGE_WAIT_TIME', 1.5))  # segundos entre páginas
 TELEGRAM_TIMEOUT = int(os.getenv('TELEGRAM_TIMEOUT', 10))
 
+# --- CLIENTE HTTP ---
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 4))  # conexiones keep-alive por host
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))  # segundos (lectura: REQUEST_TIMEOUT / TELEGRAM_TIMEOUT)
+
+# --- COLA DE TELEGRAM ---
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))  # mensajes/s en total
+TELEGRAM_CHAT_INTERVAL = float(os.getenv('TELEGRAM_CHAT_INTERVAL', 1.0))  # segundos entre mensajes a un chat
+TELEGRAM_GROUP_PER_MINUTE = int(os.getenv('TELEGRAM_GROUP_PER_MINUTE', 20))  # límite en grupos
+TELEGRAM_MAX_INTENTOS = int(os.getenv('TELEGRAM_MAX_INTENTOS', 5))
+TELEGRAM_BACKOFF_BASE = float(os.getenv('TELEGRAM_BACKOFF_BASE', 2))  # segundos, se duplica por intento
+TELEGRAM_BACKOFF_MAX = float(os.getenv('TELEGRAM_BACKOFF_MAX', 300))
+TELEGRAM_POLL_INTERVAL = float(os.getenv('TELEGRAM_POLL_INTERVAL', 5))  # revisión periódica de la cola
+
 # --- REINTENTOS ---
 MAX_RETRIES = int(os.getenv('MAX_RETRIES', 3))
 RETRY_DELAY = int(os.getenv('RETRY_DELAY', 5))  # segundos
@@ -56,18 +96,68 @@ RETRY_DELAY = int(os.getenv('RETRY_DELAY', 5))  # segundos
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 5242880))  # 5MB
 LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))  # registros pendientes de escribir
+LOG_QUEUE_TIMEOUT = float(os.getenv('LOG_QUEUE_TIMEOUT', 1.0))  # espera de WARNING+ con la cola llena
 
 # --- FEATURES ---
 ENABLE_TELEGRAM = TELEGRAM_TOKEN and TELEGRAM_CHAT_ID
 ENABLE_BACKUPS = os.getenv('ENABLE_BACKUPS', 'true').lower() == 'true'
 BACKUP_DIR = DATA_DIR / "backups"
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', 7))  # instantáneas a conservar
+BACKUP_PAGES_PER_STEP = int(os.getenv('BACKUP_PAGES_PER_STEP', 256))  # páginas por paso de la API de backup
+BACKUP_STEP_SLEEP = float(os.getenv('BACKUP_STEP_SLEEP', 0.005))  # pausa entre pasos (segundos)
 
 if ENABLE_BACKUPS:
     BACKUP_DIR.mkdir(exist_ok=True)
 
+# --- ARCHIVO DE RESPUESTAS CRUDAS ---
+ENABLE_ARCHIVE = os.getenv('ENABLE_ARCHIVE', 'true').lower() == 'true'
+ARCHIVE_DIR = Path(os.getenv('ARCHIVE_DIR', DATA_DIR / "archivo"))
+ARCHIVE_SEGMENT_BYTES = int(os.getenv('ARCHIVE_SEGMENT_BYTES', 64 * 1024 * 1024))  # tamaño al que se cierra un segmento
+REPLAY_BATCH_PAGES = int(os.getenv('REPLAY_BATCH_PAGES', 200))  # páginas por transacción al reproducir
+
+# --- ANOMALÍAS DE PRECIO ---
+ANOMALY_Z_THRESHOLD = float(os.getenv('ANOMALY_Z_THRESHOLD', -2.5))  # z-score a partir del cual se destaca un piso
+
+# --- MODO DE NOTIFICACIÓN ---
+NOTIFICATION_MODE = os.getenv('NOTIFICATION_MODE', 'inmediato')  # inmediato | digest | hibrido (chat por defecto)
+DIGEST_MAX_MESSAGES = int(os.getenv('DIGEST_MAX_MESSAGES', 3))  # mensajes como máximo por resumen
+DIGEST_LINKS = os.getenv('DIGEST_LINKS', 'true').lower() == 'true'  # enlace al anuncio en cada línea del resumen
+HYBRID_MIN_SCORE = float(os.getenv('HYBRID_MIN_SCORE', 2.5))  # puntuación mínima para enviar al momento en modo híbrido
+HYBRID_MAX_IMMEDIATE = int(os.getenv('HYBRID_MAX_IMMEDIATE', 5))  # envíos al momento por ejecución y chat en modo híbrido
+
+# --- ÍNDICE GEOESPACIAL ---
+GEO_CELL_METERS = float(os.getenv('GEO_CELL_METERS', 250))  # lado de las celdas de la rejilla (cambiarlo recalcula el índice)
+
+# --- DUPLICADOS (mismo piso con varios anuncios) ---
+ENABLE_DEDUP = os.getenv('ENABLE_DEDUP', 'true').lower() == 'true'
+DEDUP_NUM_PERM = int(os.getenv('DEDUP_NUM_PERM', 16))  # valores MinHash por firma
+DEDUP_BANDS = int(os.getenv('DEDUP_BANDS', 8))  # bandas LSH (umbral efectivo ~ (1/bandas)^(bandas/perm))
+DEDUP_THRESHOLD = float(os.getenv('DEDUP_THRESHOLD', 0.5))  # Jaccard mínimo de los rasgos para ser duplicado
+DEDUP_SIZE_TOLERANCE = float(os.getenv('DEDUP_SIZE_TOLERANCE', 0.05))  # diferencia de m² admitida
+DEDUP_PRICE_TOLERANCE = float(os.getenv('DEDUP_PRICE_TOLERANCE', 0.15))  # diferencia de precio admitida
+DEDUP_MAX_METERS = float(os.getenv('DEDUP_MAX_METERS', 150))  # distancia máxima entre duplicados
+DEDUP_MAX_CANDIDATES = int(os.getenv('DEDUP_MAX_CANDIDATES', 50))  # candidatos LSH verificados por piso
+DEDUP_MAX_BUCKET = int(os.getenv('DEDUP_MAX_BUCKET', 100))  # pisos por cubeta LSH (las llenas no admiten más)
+
+# --- BAJAS (pisos retirados) ---
+ENABLE_DELISTING = os.getenv('ENABLE_DELISTING', 'true').lower() == 'true'
+DELISTING_SWEEPS_KEEP = int(os.getenv('DELISTING_SWEEPS_KEEP', 30))  # conjuntos de vistos a conservar
+DELISTING_MAX_FRACTION = float(os.getenv('DELISTING_MAX_FRACTION', 0.5))  # más bajas que esto = barrido sospechoso
+# Con SEARCH_MODE=incremental los barridos paran pronto y nunca son completos: uno completo cada N ejecuciones (0 = nunca)
+DELISTING_FULL_SWEEP_EVERY = int(os.getenv('DELISTING_FULL_SWEEP_EVERY', 7))
+
+# --- MÉTRICAS PROMETHEUS ---
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))  # endpoint /metrics
+
+# --- TOKEN OAUTH ---
+TOKEN_REFRESH_MARGIN = int(os.getenv('TOKEN_REFRESH_MARGIN', 300))  # renovar 5 min antes de caducar
+
 # --- URLS API ---
-IDEALISTA_API_URL = "https://api.idealista.com/3.5/es/search"
-IDEALISTA_TOKEN_URL = "https://api.idealista.com/oauth/token"
+# Sobrescribibles para apuntar al servidor simulado (fake_idealista.py)
+IDEALISTA_API_URL = os.getenv('IDEALISTA_API_URL', "https://api.idealista.com/3.5/es/search")
+IDEALISTA_TOKEN_URL = os.getenv('IDEALISTA_TOKEN_URL', "https://api.idealista.com/oauth/token")
 
 
 def validate_config() -> tuple[bool, Optional[str]]:
@@ -81,4 +171,8 @@ def validate_config() -> tuple[bool, Optional[str]]:
         return False, "IDEALISTA_SECRET no configurada"
     if ENABLE_TELEGRAM and not TELEGRAM_CHAT_ID:
         return False, "TELEGRAM_CHAT_ID no configurada"
+    if NOTIFICATION_MODE not in ('inmediato', 'digest', 'hibrido'):
+        return False, f"NOTIFICATION_MODE inválido: {NOTIFICATION_MODE}"
+    if SEARCH_MODE not in ('incremental', 'completo'):
+        return False, f"SEARCH_MODE inválido: {SEARCH_MODE}"
     return True, None
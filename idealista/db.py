@@ -0,0 +1,147 @@
+"""
+Gestor de conexiones SQLite compartido por todo el bot
+
+Mantiene una conexión abierta por hilo y por fichero de BD, configurada en
+modo WAL para que los lectores (Metabase) nunca bloqueen al escritor.
+"""
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+import config
+import metrics
+
+# PRAGMAs aplicados a cada conexión nueva
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('temp_store', 'MEMORY'),
+    ('foreign_keys', 'OFF'),
+)
+
+_local = threading.local()
+_registro_lock = threading.Lock()
+_todas: list = []
+_generacion = 0  # Se incrementa en close_all() para invalidar cachés por hilo
+
+
+def _ruta(db_path: Optional[Union[str, Path]]) -> str:
+    return str(db_path if db_path is not None else config.DB_PATH)
+
+
+def _abrir(ruta: str) -> sqlite3.Connection:
+    """Abre y configura una conexión nueva"""
+    conn = sqlite3.connect(
+        ruta,
+        timeout=config.DB_BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,  # Transacciones explícitas con transaction()
+        cached_statements=config.DB_CACHED_STATEMENTS,
+        check_same_thread=False,  # Cada hilo usa la suya; close_all() cierra todas
+    )
+    for nombre, valor in PRAGMAS:
+        conn.execute(f"PRAGMA {nombre}={valor}")
+    conn.execute(f"PRAGMA busy_timeout={config.DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size={config.DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{config.DB_CACHE_KB}")
+    # Evita que el fichero -wal crezca sin límite entre checkpoints
+    conn.execute(f"PRAGMA journal_size_limit={config.DB_JOURNAL_SIZE_LIMIT}")
+    return conn
+
+
+def get_connection(db_path: Optional[Union[str, Path]] = None) -> sqlite3.Connection:
+    """
+    Devuelve la conexión persistente del hilo actual para la BD indicada
+
+    Args:
+        db_path: Ruta de la BD (por defecto config.DB_PATH)
+    """
+    ruta = _ruta(db_path)
+    conexiones = getattr(_local, 'conexiones', None)
+    if conexiones is None or _local.generacion != _generacion:
+        conexiones = _local.conexiones = {}
+        _local.generacion = _generacion
+
+    conn = conexiones.get(ruta)
+    if conn is None:
+        conn = _abrir(ruta)
+        conexiones[ruta] = conn
+        with _registro_lock:
+            _todas.append((ruta, conn))
+    return conn
+
+
+@contextmanager
+def transaction(db_path: Optional[Union[str, Path]] = None,
+                inmediata: bool = True) -> Iterator[sqlite3.Connection]:
+    """
+    Abre una transacción corta sobre la conexión compartida
+
+    Con inmediata=True se toma el lock de escritura al empezar (BEGIN IMMEDIATE),
+    reintentando con backoff si otro proceso lo tiene ocupado más allá del
+    busy_timeout. Hace COMMIT al salir o ROLLBACK si hay excepción.
+    """
+    conn = get_connection(db_path)
+    if conn.in_transaction:
+        # Transacción anidada: la gestiona el llamador exterior
+        yield conn
+        return
+
+    _begin(conn, 'BEGIN IMMEDIATE' if inmediata else 'BEGIN')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    with metrics.cronometrar(metrics.COMMIT_SQLITE):
+        conn.execute('COMMIT')
+
+
+def _begin(conn: sqlite3.Connection, sentencia: str):
+    for intento in range(config.DB_LOCK_RETRIES):
+        try:
+            conn.execute(sentencia)
+            return
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) or intento == config.DB_LOCK_RETRIES - 1:
+                raise
+            time.sleep(0.05 * (2 ** intento))
+
+
+def ensure_column(conn: sqlite3.Connection, tabla: str, columna: str, definicion: str):
+    """Añade una columna a una tabla existente si todavía no la tiene (migración)"""
+    columnas = {row[1] for row in conn.execute(f"PRAGMA table_info({tabla})")}
+    if columna not in columnas:
+        conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}")
+
+
+def versionar(conn: sqlite3.Connection, tabla: str):
+    """Contador en `versiones_tablas` que los triggers suben con cada cambio de la tabla"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS versiones_tablas (
+        tabla TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    ) WITHOUT ROWID''')
+    conn.execute("INSERT OR IGNORE INTO versiones_tablas (tabla, version) VALUES (?, 0)", (tabla,))
+    for accion in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_version_{tabla}_{accion.lower()}
+                         AFTER {accion} ON {tabla} BEGIN
+                             UPDATE versiones_tablas SET version = version + 1 WHERE tabla = '{tabla}';
+                         END""")
+
+
+def version(conn: sqlite3.Connection, tabla: str) -> int:
+    """Versión de una tabla registrada con versionar (para invalidar cachés derivadas de ella)"""
+    return conn.execute("SELECT version FROM versiones_tablas WHERE tabla = ?", (tabla,)).fetchone()[0]
+
+
+def close_all():
+    """Cierra todas las conexiones abiertas (al parar el bot o en tests)"""
+    global _generacion
+    with _registro_lock:
+        pendientes = list(_todas)
+        _todas.clear()
+        _generacion += 1
+    for _, conn in pendientes:
+        conn.close()
@@ -0,0 +1,337 @@
+"""
+Detección de duplicados: el mismo piso publicado con varios propertyCode
+
+Cada piso nuevo con coordenadas se resume en un conjunto de rasgos (palabras
+del título normalizado y tamaño) y en una firma MinHash de DEDUP_NUM_PERM
+valores partida en DEDUP_BANDS bandas. La clave de cada banda en
+`lsh_buckets` incluye además un bloque de ~1 km y lo que dos duplicados
+comparten exactamente (operación, habitaciones y planta): solo colisionan
+pisos cercanos y comparables, y las palabras comunes del título no reúnen
+media ciudad en una cubeta.
+
+Los candidatos de un piso salen de búsquedas por clave primaria (su bloque y
+los vecinos a menos de DEDUP_MAX_METERS), todas en una sola consulta contra
+la tabla temporal de la página. Cada cubeta admite como mucho
+DEDUP_MAX_BUCKET pisos, así que el coste por piso está acotado y no crece
+con `pisos`.
+
+Los candidatos se confirman con la similitud de Jaccard exacta de los rasgos
+y con reglas duras: tamaño y precio parecidos y coordenadas de los dos a
+menos de DEDUP_MAX_METERS (sin coordenadas no hay pruebas suficientes). Cada piso recibe un `cluster_id`
+(el del piso al que duplica, o el suyo si no duplica a ninguno); los nuevos
+que duplican a un piso activo no generan NOVEDAD.
+
+Los pisos guardados antes de este índice (o que reciben sus coordenadas más
+tarde) no están en `lsh_buckets`: `python dedup.py --reconstruir` vuelve a
+firmar, agrupar e indexar todos los pisos con coordenadas, por fecha de
+registro.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import math
+import re
+import struct
+import unicodedata
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+
+import config
+import db
+import geo
+
+logger = logging.getLogger('idealista')
+
+_PRIMO = np.uint64((1 << 61) - 1)
+_MASCARA = np.uint64(0xFFFFFFFF)
+
+# Peso (repeticiones) del tamaño frente a cada palabra del título
+PESO_TAMANO = 3
+# Lado de los bloques de posición de las claves LSH (~1,1 km de norte a sur)
+GRADOS_BLOQUE = 0.01
+
+# Palabras del título que casi todos los anuncios comparten: no distinguen pisos
+PALABRAS_VACIAS = frozenset('a al c calle con de del el en la las los y avda avenida plaza paseo camino'.split())
+
+# Columnas de `pisos` con las que se compara un candidato
+_COLUMNAS = ('id', 'titulo', 'precio', 'metros', 'habitaciones', 'planta', 'operacion',
+             'latitud', 'longitud', 'estado', 'cluster_id')
+
+
+def crear_tablas(conn):
+    """Tabla de cubetas LSH y columna de cluster (llamado desde init_db)"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS lsh_buckets (
+        banda INTEGER NOT NULL,
+        clave INTEGER NOT NULL,
+        id_piso TEXT NOT NULL,
+        PRIMARY KEY (banda, clave, id_piso)
+    ) WITHOUT ROWID''')
+    db.ensure_column(conn, 'pisos', 'cluster_id', 'TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pisos_cluster ON pisos(cluster_id)')
+    # Un piso por cluster (el más barato de los activos): recuentos sin duplicados
+    conn.execute('''CREATE VIEW IF NOT EXISTS v_pisos_unicos AS
+        SELECT * FROM (
+            SELECT p.*, COUNT(*) OVER w AS publicaciones,
+                   ROW_NUMBER() OVER (w ORDER BY precio, fecha_registro, id) AS orden_cluster
+            FROM pisos p WHERE COALESCE(estado, 'activo') = 'activo'
+            WINDOW w AS (PARTITION BY COALESCE(cluster_id, id))
+        ) WHERE orden_cluster = 1''')
+
+
+def _sin_acentos(texto: str) -> str:
+    return ''.join(c for c in unicodedata.normalize('NFKD', texto) if not unicodedata.combining(c))
+
+
+def rasgos(fila: Dict) -> Set[str]:
+    """Conjunto de rasgos de un piso (lo que compara MinHash)"""
+    titulo = _sin_acentos((fila.get('titulo') or '').lower())
+    # Números largos del título (referencias de la agencia) no describen el piso
+    resultado = {f"t:{p}" for p in re.findall(r'[a-z0-9]+', titulo)
+                 if p not in PALABRAS_VACIAS and not (p.isdigit() and len(p) >= 5)}
+    metros = fila.get('metros')
+    if metros:
+        # Dos cubos de 5 m desplazados: 79 y 81 m² comparten uno de los dos
+        resultado.update(f"{cubo}#{i}" for cubo in (f"m:{int(metros // 5)}", f"m':{int((metros + 2.5) // 5)}")
+                         for i in range(PESO_TAMANO))
+    return resultado
+
+
+def similitud(a: Set[str], b: Set[str]) -> float:
+    """Jaccard de dos conjuntos de rasgos"""
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+
+def _bloque(lat: float, lon: float) -> Tuple[int, int]:
+    return math.floor(lat / GRADOS_BLOQUE), math.floor(lon / GRADOS_BLOQUE)
+
+
+def bloques(lat: float, lon: float) -> List[Tuple[int, int]]:
+    """Bloque del piso seguido de los vecinos a menos de DEDUP_MAX_METERS"""
+    dlat = config.DEDUP_MAX_METERS / geo.METROS_POR_GRADO
+    dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    propio = _bloque(lat, lon)
+    (i0, j0), (i1, j1) = _bloque(lat - dlat, lon - dlon), _bloque(lat + dlat, lon + dlon)
+    return [propio] + [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1) if (i, j) != propio]
+
+
+class Firmador:
+    """MinHash con permutaciones a*x + b mod (2^61 - 1) fijas por semilla"""
+
+    def __init__(self, num_perm: int, bandas: int, semilla: int = 1):
+        if num_perm % bandas:
+            raise ValueError(f"DEDUP_NUM_PERM ({num_perm}) debe ser múltiplo de DEDUP_BANDS ({bandas})")
+        rnd = np.random.default_rng(semilla)
+        self.a = rnd.integers(1, 1 << 32, num_perm, dtype=np.uint64)
+        self.b = rnd.integers(0, 1 << 32, num_perm, dtype=np.uint64)
+        self.bandas = bandas
+        self.filas = num_perm // bandas
+
+    def firma(self, conjunto: Set[str]) -> np.ndarray:
+        if not conjunto:
+            return np.full(len(self.a), _MASCARA, dtype=np.uint64)
+        x = np.fromiter((int.from_bytes(hashlib.blake2b(r.encode(), digest_size=4).digest(), 'little')
+                         for r in conjunto), dtype=np.uint64, count=len(conjunto))
+        # a, x < 2^32: a*x + b cabe en 64 bits
+        return ((self.a[:, None] * x[None, :] + self.b[:, None]) % _PRIMO & _MASCARA).min(axis=1)
+
+    def claves(self, firma: np.ndarray, grupo: bytes) -> List[int]:
+        """Clave (entero de 64 bits con signo) de cada banda de la firma dentro de un grupo"""
+        return [int.from_bytes(hashlib.blake2b(grupo + banda.tobytes(), digest_size=8).digest(),
+                               'little', signed=True)
+                for banda in firma.reshape(self.bandas, self.filas)]
+
+
+_firmadores: Dict[tuple, Firmador] = {}
+
+
+def firmador() -> Firmador:
+    clave = (config.DEDUP_NUM_PERM, config.DEDUP_BANDS)
+    if clave not in _firmadores:
+        _firmadores[clave] = Firmador(*clave)
+    return _firmadores[clave]
+
+
+def _grupo(fila: Dict, bloque: Tuple[int, int]) -> bytes:
+    """Lo que dos duplicados comparten exactamente: bloque, operación, habitaciones y planta"""
+    comparables = f"{fila.get('operacion') or 'rent'}|{fila.get('habitaciones')}|{fila.get('planta')}"
+    return struct.pack('<ii', *bloque) + comparables.encode()
+
+
+def claves_busqueda(fila: Dict, firma: np.ndarray) -> List[Tuple[int, int, bool]]:
+    """(banda, clave, propia) con las que se busca un piso; se indexa solo con las propias"""
+    f = firmador()
+    resultado = []
+    for n, bloque in enumerate(bloques(fila['latitud'], fila['longitud'])):
+        resultado += [(banda, clave, n == 0) for banda, clave in enumerate(f.claves(firma, _grupo(fila, bloque)))]
+    return resultado
+
+
+def compatibles(a: Dict, b: Dict) -> bool:
+    """Reglas duras: misma operación, habitaciones y planta; tamaño, precio y posición parecidos"""
+    if None in (a.get('latitud'), a.get('longitud'), b.get('latitud'), b.get('longitud')):
+        return False
+    if geo.distancia(a['latitud'], a['longitud'], b['latitud'], b['longitud']) > config.DEDUP_MAX_METERS:
+        return False
+    if (a.get('operacion') or 'rent') != (b.get('operacion') or 'rent'):
+        return False
+    for campo in ('habitaciones', 'planta'):
+        if a.get(campo) is not None and b.get(campo) is not None and a[campo] != b[campo]:
+            return False
+    for campo, tolerancia in (('metros', config.DEDUP_SIZE_TOLERANCE), ('precio', config.DEDUP_PRICE_TOLERANCE)):
+        if a.get(campo) and b.get(campo) and abs(a[campo] - b[campo]) > tolerancia * max(a[campo], b[campo]):
+            return False
+    return True
+
+
+def _cargar_claves(conn, claves: Dict[str, List[Tuple[int, int, bool]]]):
+    """Claves de la página en la tabla temporal tmp_lsh"""
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS tmp_lsh (id TEXT, banda INTEGER, clave INTEGER, propia INTEGER)")
+    conn.execute("DELETE FROM tmp_lsh")
+    conn.executemany("INSERT INTO tmp_lsh (id, banda, clave, propia) VALUES (?, ?, ?, ?)",
+                     ((id_piso, banda, clave, propia) for id_piso, lista in claves.items()
+                      for banda, clave, propia in lista))
+
+
+def _indexar(conn):
+    """Añade las claves propias de tmp_lsh a lsh_buckets salvo en las cubetas ya llenas"""
+    # Una cubeta llena no aporta: sin esta cota una banda degenerada haría crecer
+    # la consulta de candidatos con el tamaño de `pisos`
+    conn.execute("""INSERT OR IGNORE INTO lsh_buckets (banda, clave, id_piso)
+                    SELECT banda, clave, id FROM tmp_lsh t
+                    WHERE propia AND NOT EXISTS (SELECT 1 FROM lsh_buckets b
+                                                 WHERE b.banda = t.banda AND b.clave = t.clave
+                                                 LIMIT 1 OFFSET :maximo - 1)""",
+                 {'maximo': config.DEDUP_MAX_BUCKET})
+    conn.execute("DELETE FROM tmp_lsh")
+
+
+def _candidatos(conn) -> Dict[str, List[str]]:
+    """Pisos ya guardados que comparten alguna cubeta con cada nuevo (tmp_lsh), los de más bandas primero"""
+    candidatos: Dict[str, List[str]] = {}
+    # Una búsqueda por clave primaria de lsh_buckets por cada clave de la página
+    for id_piso, candidato in conn.execute(
+            """SELECT t.id, b.id_piso FROM tmp_lsh t CROSS JOIN lsh_buckets b
+               WHERE b.banda = t.banda AND b.clave = t.clave AND b.id_piso != t.id
+               GROUP BY t.id, b.id_piso ORDER BY t.id, COUNT(*) DESC, b.id_piso"""):
+        lista = candidatos.setdefault(id_piso, [])
+        if len(lista) < config.DEDUP_MAX_CANDIDATES:
+            lista.append(candidato)
+    return candidatos
+
+
+def agrupar_lote(conn, nuevos: List[Dict]) -> int:
+    """
+    Asigna cluster a los pisos nuevos de una página ya aplicada y los indexa
+
+    Debe llamarse en la transacción de lotes.aplicar_lote. Anota en cada fila
+    `cluster_id` y `duplicado_de` (el piso activo al que duplica, o None).
+
+    Returns:
+        Número de duplicados de pisos activos
+    """
+    for fila in nuevos:
+        fila['cluster_id'], fila['duplicado_de'] = fila['id'], None
+    # Sin coordenadas nunca son compatibles: ni se buscan ni se indexan
+    nuevos = [fila for fila in nuevos if fila.get('latitud') is not None and fila.get('longitud') is not None]
+    if not nuevos:
+        return 0
+    conjuntos = {fila['id']: rasgos(fila) for fila in nuevos}
+    claves = {fila['id']: claves_busqueda(fila, firmador().firma(conjuntos[fila['id']])) for fila in nuevos}
+    _cargar_claves(conn, claves)
+    candidatos = _candidatos(conn)
+
+    guardados: Dict[str, Dict] = {}
+    pendientes = sorted({c for lista in candidatos.values() for c in lista})
+    if pendientes:
+        for row in conn.execute(f"""SELECT {', '.join(_COLUMNAS)} FROM pisos
+                                    WHERE id IN (SELECT value FROM json_each(?))""",
+                                (json.dumps(pendientes),)):
+            fila = dict(zip(_COLUMNAS, row))
+            fila['rasgos'] = rasgos(fila)
+            guardados[fila['id']] = fila
+
+    # Los de la propia página también son candidatos de los que vienen detrás
+    en_pagina: Dict[tuple, List[str]] = {}
+    asignados: Dict[str, Dict] = {}
+    duplicados = 0
+    for fila in nuevos:
+        id_piso = fila['id']
+        opciones = [guardados[c] for c in candidatos.get(id_piso, []) if c in guardados]
+        de_pagina = dict.fromkeys(c for banda, clave, _ in claves[id_piso]
+                                  for c in en_pagina.get((banda, clave), []))
+        opciones += [asignados[c] for c in list(de_pagina)[:config.DEDUP_MAX_CANDIDATES]]
+
+        mejor, mejor_clave = None, None
+        for opcion in opciones:
+            s = similitud(conjuntos[id_piso], opcion['rasgos'])
+            if s < config.DEDUP_THRESHOLD or not compatibles(fila, opcion):
+                continue
+            # Antes un duplicado de un piso activo; entre ellos, el más parecido
+            clave = ((opcion.get('estado') or 'activo') == 'activo', s)
+            if mejor_clave is None or clave > mejor_clave:
+                mejor, mejor_clave = opcion, clave
+
+        if mejor:
+            fila['cluster_id'] = mejor.get('cluster_id') or mejor['id']
+            fila['duplicado_de'] = mejor['id'] if mejor_clave[0] else None
+            duplicados += fila['duplicado_de'] is not None
+        asignados[id_piso] = {**fila, 'rasgos': conjuntos[id_piso], 'estado': fila.get('estado') or 'activo'}
+        for banda, clave, propia in claves[id_piso]:
+            if propia:
+                en_pagina.setdefault((banda, clave), []).append(id_piso)
+
+    _indexar(conn)
+    conn.executemany("UPDATE pisos SET cluster_id = ? WHERE id = ?",
+                     ((fila['cluster_id'], fila['id']) for fila in nuevos))
+    return duplicados
+
+
+def cluster(id_piso: str) -> List[Dict]:
+    """Pisos del cluster de un piso (él incluido), por fecha de registro"""
+    columnas = ('id', 'titulo', 'precio', 'link', 'estado', 'fecha_registro')
+    conn = db.get_connection()
+    row = conn.execute("SELECT COALESCE(cluster_id, id) FROM pisos WHERE id = ?", (id_piso,)).fetchone()
+    if not row:
+        return []
+    # Sin cluster_id (pisos anteriores o sin coordenadas) el piso es su propio cluster
+    filas = conn.execute(f"""SELECT {', '.join(columnas)} FROM pisos WHERE cluster_id = :c OR id = :c
+                             ORDER BY fecha_registro, id""", {'c': row[0]})
+    return [dict(zip(columnas, f)) for f in filas]
+
+
+def reconstruir(lote: int = 500) -> int:
+    """
+    Vacía lsh_buckets y los clusters y vuelve a agrupar (en una transacción)
+    todos los pisos con coordenadas, por fecha de registro, como si fueran
+    llegando en páginas de `lote`
+
+    Returns:
+        Pisos que quedan en el cluster de otro
+    """
+    columnas = [c for c in _COLUMNAS if c != 'cluster_id']
+    with db.transaction() as conn:
+        conn.execute("DELETE FROM lsh_buckets")
+        conn.execute("UPDATE pisos SET cluster_id = NULL WHERE cluster_id IS NOT NULL")
+        filas = [dict(zip(columnas, row)) for row in conn.execute(
+            f"""SELECT {', '.join(columnas)} FROM pisos
+                WHERE latitud IS NOT NULL AND longitud IS NOT NULL
+                ORDER BY fecha_registro, id""")]
+        for inicio in range(0, len(filas), lote):
+            agrupar_lote(conn, filas[inicio:inicio + lote])
+        agrupados = conn.execute("SELECT COUNT(*) FROM pisos WHERE cluster_id != id").fetchone()[0]
+    logger.info(f"Índice de duplicados reconstruido: {len(filas)} pisos, {agrupados} en el cluster de otro")
+    return agrupados
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Detección de anuncios duplicados")
+    parser.add_argument('--reconstruir', action='store_true',
+                        help="Vuelve a firmar e indexar los pisos con coordenadas y recalcula los clusters")
+    args = parser.parse_args()
+
+    if args.reconstruir:
+        print(f"{reconstruir()} pisos duplicados de otro")
+    else:
+        parser.print_help()
@@ -0,0 +1,153 @@
+"""
+Resumen por ejecución de los avisos de Telegram
+
+En modo 'digest' los avisos de un chat no se envían uno a uno: se acumulan
+durante la ejecución y al final se envía un resumen ordenado por
+relevancia, una línea por piso, en como mucho DIGEST_MAX_MESSAGES mensajes
+de hasta 4096 caracteres. Si no cabe todo se quedan los mejor puntuados.
+En modo 'hibrido' los avisos con puntuación de al menos HYBRID_MIN_SCORE
+(hasta HYBRID_MAX_IMMEDIATE por ejecución y chat) salen en el momento y
+el resto va al resumen.
+
+Puntuación de un aviso: lo barato respecto a su mercado (-z de anomalías),
+más un punto por cada 5% de bajada y un punto si lo pidió una regla propia.
+"""
+import html
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import config
+import notificaciones
+import reglas
+
+# Evento -> título de su sección del resumen, en el orden en que aparecen
+SECCIONES = {'nuevo': '🆕 Novedades', 'bajada': '📉 Bajadas', 'subida': '📈 Subidas'}
+LARGO_TITULO = 70
+
+
+def puntuacion(alerta: Dict) -> float:
+    """Relevancia de un aviso (más es mejor)"""
+    fila = alerta['fila']
+    z = fila.get('puntuacion_anomalia')
+    resultado = max(0.0, -z) if z is not None else 0.0
+    anterior, precio = fila.get('precio_anterior'), fila.get('precio')
+    if alerta['evento'] == 'bajada' and anterior and precio:
+        resultado += 100 * (anterior - precio) / anterior / 5
+    if any(nombre not in reglas.REGLAS_DEFECTO for nombre in alerta['reglas']):
+        resultado += 1
+    return round(resultado, 2)
+
+
+def _euros(valor) -> str:
+    return f"{valor:,.0f}€".replace(',', '.') if valor is not None else '?'
+
+
+def _linea(alerta: Dict) -> str:
+    """Un aviso en una línea (HTML de Telegram, con el título escapado)"""
+    fila = alerta['fila']
+    titulo = html.escape((fila.get('titulo') or 'Sin título')[:LARGO_TITULO])
+    if config.DIGEST_LINKS and fila.get('link'):
+        titulo = f"<a href=\"{html.escape(fila['link'])}\">{titulo}</a>"
+    z = fila.get('puntuacion_anomalia')
+    marca = ' 🔥' if z is not None and z <= config.ANOMALY_Z_THRESHOLD else ''
+    if alerta['evento'] == 'nuevo':
+        datos = f"{_euros(fila.get('precio'))} · {fila.get('habitaciones')} hab · {fila.get('metros')} m²"
+    else:
+        anterior, precio = fila.get('precio_anterior'), fila.get('precio')
+        datos = f"{_euros(anterior)} ➡️ {_euros(precio)}"
+        if anterior and precio:
+            datos += f" ({100 * (precio - anterior) / anterior:+.0f}%)"
+    return f"• {datos} · {titulo}{marca}"
+
+
+def _bloques(alertas: List[Dict], cabecera: str, omitidas: int, pie: Optional[str]) -> List[str]:
+    bloques = [cabecera]
+    for evento, titulo in SECCIONES.items():
+        lineas = [_linea(a) for a in alertas if a['evento'] == evento]
+        if lineas:
+            bloques.append(f"\n<b>{titulo} ({len(lineas)})</b>")
+            bloques += lineas
+    if omitidas:
+        bloques.append(f"\n… y {omitidas} avisos más")
+    if pie:
+        bloques.append(f"\n{pie}")
+    return bloques
+
+
+def renderizar(alertas: List[Dict], pie: Optional[str] = None) -> List[str]:
+    """
+    Mensajes del resumen: secciones por evento y, dentro, por puntuación
+
+    Si no cabe en DIGEST_MAX_MESSAGES mensajes se queda con los K avisos
+    mejor puntuados que caben (búsqueda binaria sobre K).
+    """
+    ordenadas = sorted(alertas, key=puntuacion, reverse=True)
+    cabecera = f"📬 <b>Resumen: {len(alertas)} avisos</b>"
+
+    def mensajes(k: int) -> List[str]:
+        return notificaciones.trocear(_bloques(ordenadas[:k], cabecera, len(ordenadas) - k, pie), separador='\n')
+
+    resultado = mensajes(len(ordenadas))
+    if len(resultado) <= config.DIGEST_MAX_MESSAGES:
+        return resultado
+    cabe, no_cabe = 0, len(ordenadas)
+    while no_cabe - cabe > 1:
+        k = (cabe + no_cabe) // 2
+        if len(mensajes(k)) <= config.DIGEST_MAX_MESSAGES:
+            cabe = k
+        else:
+            no_cabe = k
+    return mensajes(cabe)
+
+
+class Acumulador:
+    """Avisos de la ejecución en curso por destinatario (compartido por los hilos de perfiles)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._alertas: Dict[object, List[Dict]] = {}
+        self._inmediatos: Dict[object, int] = {}
+
+    def inmediato(self, destino, alerta: Dict) -> bool:
+        """En modo híbrido: si el aviso sale ya (y lo cuenta) o va al resumen"""
+        if puntuacion(alerta) < config.HYBRID_MIN_SCORE:
+            return False
+        with self._lock:
+            if self._inmediatos.get(destino, 0) >= config.HYBRID_MAX_IMMEDIATE:
+                return False
+            self._inmediatos[destino] = self._inmediatos.get(destino, 0) + 1
+        return True
+
+    def acumular(self, destino, alerta: Dict):
+        with self._lock:
+            self._alertas.setdefault(destino, []).append(alerta)
+
+    def vaciar(self) -> Dict[object, List[Dict]]:
+        """Lo acumulado por destinatario; empieza la ejecución siguiente"""
+        with self._lock:
+            alertas, self._alertas, self._inmediatos = self._alertas, {}, {}
+        return alertas
+
+
+_acumulador = Acumulador()
+
+
+def inmediato(destino, alerta: Dict) -> bool:
+    return _acumulador.inmediato(destino, alerta)
+
+
+def acumular(destino, alerta: Dict):
+    _acumulador.acumular(destino, alerta)
+
+
+def resumenes(pie_defecto: Optional[str] = None) -> Iterator[Tuple[object, str]]:
+    """
+    Vacía lo acumulado: (destinatario, mensaje) de cada resumen
+
+    Args:
+        pie_defecto: Texto al final del resumen del chat por defecto (chat_id None)
+    """
+    for destino, alertas in _acumulador.vaciar().items():
+        pie = pie_defecto if getattr(destino, 'chat_id', None) is None else None
+        for mensaje in renderizar(alertas, pie):
+            yield destino, mensaje
@@ -0,0 +1,275 @@
+"""
+Servidor local que imita la API de Idealista (OAuth + /3.5/es/search)
+
+Genera páginas de `elementList` sintéticas y deterministas a partir de una
+semilla, a cualquier escala (hasta 1M de pisos sin materializarlos: cada
+página se calcula al pedirla). Entre rondas (avanzar()) una parte de los
+pisos se da de baja y se sustituye por otros nuevos y otra parte cambia de
+precio; los pisos tocados en la última ronda salen primero, como al ordenar
+por modificationDate desc. Permite inyectar latencia y errores.
+
+Uso en tests y benchmarks:
+    servidor = FakeIdealista(Catalogo(100_000))
+    config.IDEALISTA_API_URL = servidor.search_url
+    config.IDEALISTA_TOKEN_URL = servidor.token_url
+
+Uso manual: python fake_idealista.py --listados 100000 --puerto 8000
+    (IDEALISTA_API_URL=http://127.0.0.1:8000/3.5/es/search,
+     IDEALISTA_TOKEN_URL=http://127.0.0.1:8000/oauth/token;
+     POST /_avanzar pasa a la siguiente ronda)
+"""
+import argparse
+import bisect
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Sequence
+from urllib.parse import parse_qs
+
+import config
+
+DISTRITOS = ('Centro', 'Albaicín', 'Beiro', 'Chana', 'Genil', 'Norte',
+             'Ronda', 'Zaidín', 'Realejo', 'Sacromonte')
+MUNICIPIOS = ('Granada', 'Armilla', 'Maracena', 'La Zubia', 'Ogíjares')
+PLANTAS = ('bj', '1', '2', '3', '4', '5', '6')
+
+
+class Catalogo:
+    """
+    Catálogo sintético de pisos, estable entre rondas salvo rotación y cambios
+
+    Args:
+        total: Número de pisos activos (constante: cada baja se sustituye por un alta)
+        semilla: Semilla de todos los valores generados
+        rotacion: Fracción de pisos que se sustituyen en cada ronda
+        cambios_precio: Fracción de pisos que cambian de precio en cada ronda
+        operacion: 'rent' o 'sale' (escala de precios)
+    """
+
+    def __init__(self, total: int, semilla: int = 0, rotacion: float = 0.01,
+                 cambios_precio: float = 0.02, operacion: str = 'rent'):
+        self.total = total
+        self.semilla = semilla
+        self.rotacion = rotacion
+        self.cambios_precio = cambios_precio
+        self.operacion = operacion
+        self.ronda = 0
+        self._lock = threading.Lock()
+        self._generacion: Dict[int, int] = {}  # hueco -> nº de veces sustituido
+        self._precio: Dict[int, int] = {}  # hueco -> precio tras cambios
+        self._recientes: List[int] = []  # huecos tocados en la última ronda (ordenados)
+        self.ultima_ronda = {'altas': 0, 'cambios_precio': 0}
+
+    def _hash(self, codigo: int) -> int:
+        return zlib.crc32(f"{self.semilla}:{codigo}".encode())
+
+    def codigo(self, hueco: int) -> int:
+        return 1 + hueco + self._generacion.get(hueco, 0) * self.total
+
+    def _precio_base(self, codigo: int, metros: int) -> int:
+        h = self._hash(codigo) >> 12
+        if self.operacion == 'sale':
+            return metros * (1500 + h % 2500) // 1000 * 1000
+        return metros * (8 + h % 10) // 10 * 10
+
+    def piso(self, hueco: int) -> Dict:
+        """Elemento de `elementList` del hueco en la ronda actual"""
+        codigo = self.codigo(hueco)
+        h = self._hash(codigo)
+        metros = 40 + (h >> 4) % 120
+        precio = self._precio.get(hueco) or self._precio_base(codigo, metros)
+        return {
+            'propertyCode': str(codigo),
+            'price': float(precio),
+            'size': float(metros),
+            'priceByArea': round(precio / metros, 1),
+            'rooms': 1 + h % 4,
+            'bathrooms': 1 + (h >> 2) % 2,
+            'floor': PLANTAS[(h >> 8) % len(PLANTAS)],
+            'exterior': bool((h >> 11) & 1),
+            'propertyType': 'flat',
+            'operation': self.operacion,
+            'district': DISTRITOS[(h >> 16) % len(DISTRITOS)],
+            'municipality': MUNICIPIOS[(h >> 20) % len(MUNICIPIOS)],
+            'neighborhood': f"{DISTRITOS[(h >> 16) % len(DISTRITOS)]} {1 + (h >> 24) % 3}",
+            'latitude': round(config.SEARCH_LATITUDE + ((h >> 6) % 2000 - 1000) / 40000, 6),
+            'longitude': round(config.SEARCH_LONGITUDE + ((h >> 17) % 2000 - 1000) / 40000, 6),
+            'url': f'https://www.idealista.com/inmueble/{codigo}/',
+            'suggestedTexts': {'title': f'Piso en {DISTRITOS[(h >> 16) % len(DISTRITOS)]} ({codigo})'},
+        }
+
+    def avanzar(self):
+        """Pasa a la siguiente ronda: bajas sustituidas por altas y cambios de precio"""
+        with self._lock:
+            self.ronda += 1
+            rng = random.Random(f"{self.semilla}-{self.ronda}")
+            rotados = rng.sample(range(self.total), int(self.total * self.rotacion))
+            for hueco in rotados:
+                self._generacion[hueco] = self._generacion.get(hueco, 0) + 1
+                self._precio.pop(hueco, None)
+
+            sustituidos = set(rotados)
+            cambiados = [h for h in rng.sample(range(self.total), int(self.total * self.cambios_precio))
+                         if h not in sustituidos]
+            for hueco in cambiados:
+                precio = self.piso(hueco)['price']
+                factor = rng.choice((0.9, 0.95, 0.97, 1.03, 1.05))
+                self._precio[hueco] = int(precio * factor) // 10 * 10 or 10
+
+            self._recientes = sorted(sustituidos | set(cambiados))
+            self.ultima_ronda = {'altas': len(rotados), 'cambios_precio': len(cambiados)}
+
+    def _hueco(self, posicion: int) -> int:
+        """Hueco en la posición dada del orden de la ronda (tocados primero)"""
+        recientes = self._recientes
+        if posicion < len(recientes):
+            return recientes[posicion]
+        # k-ésimo hueco no tocado: el menor h con h - tocados(<= h) >= k
+        k = posicion - len(recientes)
+        lo, hi = k, k + len(recientes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mid - bisect.bisect_right(recientes, mid) < k:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def pagina(self, num_pagina: int, por_pagina: int) -> Dict:
+        """Respuesta de /search para una página (numPage empieza en 1)"""
+        with self._lock:
+            inicio = (num_pagina - 1) * por_pagina
+            fin = min(inicio + por_pagina, self.total)
+            elementos = [self.piso(self._hueco(i)) for i in range(inicio, fin)]
+        return {
+            'elementList': elementos,
+            'total': self.total,
+            'totalPages': -(-self.total // por_pagina),
+            'actualPage': num_pagina,
+            'itemsPerPage': por_pagina,
+        }
+
+
+class FakeIdealista:
+    """
+    Servidor HTTP en segundo plano con los endpoints de token y búsqueda
+
+    Args:
+        catalogo: Catálogo a servir
+        latencia: Segundos de espera añadidos a cada búsqueda
+        tasa_error: Fracción de búsquedas que fallan
+        errores: Códigos HTTP a devolver en los fallos inyectados
+        semilla: Semilla de la inyección de errores
+        puerto: 0 para uno libre
+    """
+
+    def __init__(self, catalogo: Catalogo, latencia: float = 0.0, tasa_error: float = 0.0,
+                 errores: Sequence[int] = (500,), semilla: int = 0, puerto: int = 0):
+        self.catalogo = catalogo
+        self.latencia = latencia
+        self.tasa_error = tasa_error
+        self.errores = tuple(errores)
+        self._rng = random.Random(semilla)
+        self._lock = threading.Lock()
+        self.tokens = set()
+        self.peticiones = {'token': 0, 'search': 0, 'errores': 0}
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True  # cabeceras y cuerpo van en escrituras separadas
+
+            def _responder(self, status: int, cuerpo: Dict):
+                datos = json.dumps(cuerpo).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(datos)))
+                self.end_headers()
+                self.wfile.write(datos)
+
+            def do_POST(self):
+                longitud = int(self.headers.get('Content-Length') or 0)
+                form = {k: v[0] for k, v in parse_qs(self.rfile.read(longitud).decode()).items()}
+                if self.path.endswith('/oauth/token'):
+                    self._responder(*fake._token(self.headers.get('Authorization', '')))
+                elif self.path.endswith('/search'):
+                    self._responder(*fake._buscar(self.headers.get('Authorization', ''), form))
+                elif self.path == '/_avanzar':
+                    fake.catalogo.avanzar()
+                    self._responder(200, {'ronda': fake.catalogo.ronda, **fake.catalogo.ultima_ronda})
+                else:
+                    self._responder(404, {'error': 'not found'})
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', puerto), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.search_url = f"{self.url}/3.5/es/search"
+        self.token_url = f"{self.url}/oauth/token"
+        self._hilo = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._hilo.start()
+
+    def _token(self, autorizacion: str):
+        if not autorizacion.startswith('Basic '):
+            return 401, {'error': 'invalid_client'}
+        with self._lock:
+            self.peticiones['token'] += 1
+            token = f"fake-{self.peticiones['token']}"
+            self.tokens.add(token)
+        return 200, {'access_token': token, 'token_type': 'bearer',
+                     'expires_in': 43200, 'scope': 'read'}
+
+    def _buscar(self, autorizacion: str, form: Dict[str, str]):
+        if autorizacion.removeprefix('Bearer ') not in self.tokens:
+            return 401, {'error': 'invalid_token'}
+        with self._lock:
+            self.peticiones['search'] += 1
+            fallo = self._rng.random() < self.tasa_error
+            if fallo:
+                self.peticiones['errores'] += 1
+                status = self._rng.choice(self.errores)
+        if self.latencia:
+            time.sleep(self.latencia)
+        if fallo:
+            return status, {'error': 'injected', 'status': status}
+        num_pagina = int(form.get('numPage', 1))
+        por_pagina = int(form.get('maxItems', config.ITEMS_PER_PAGE))
+        return 200, self.catalogo.pagina(num_pagina, por_pagina)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="API de Idealista simulada")
+    parser.add_argument('--listados', type=int, default=10000)
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--rotacion', type=float, default=0.01)
+    parser.add_argument('--cambios-precio', type=float, default=0.02)
+    parser.add_argument('--latencia', type=float, default=0.0, help="Segundos por búsqueda")
+    parser.add_argument('--tasa-error', type=float, default=0.0)
+    parser.add_argument('--puerto', type=int, default=8000)
+    args = parser.parse_args()
+
+    catalogo = Catalogo(args.listados, args.semilla, args.rotacion, args.cambios_precio)
+    servidor = FakeIdealista(catalogo, args.latencia, args.tasa_error,
+                             semilla=args.semilla, puerto=args.puerto)
+    print(f"Idealista simulado en {servidor.url} ({args.listados} pisos)")
+    print(f"  IDEALISTA_API_URL={servidor.search_url}")
+    print(f"  IDEALISTA_TOKEN_URL={servidor.token_url}")
+    try:
+        servidor._hilo.join()
+    except KeyboardInterrupt:
+        servidor.close()
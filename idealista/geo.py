@@ -0,0 +1,300 @@
+"""
+Índice geoespacial de pisos por celdas de una rejilla fija
+
+Cada piso con coordenadas recibe una `celda` entera: fila * columnas +
+columna de una rejilla de GEO_CELL_METERS de lado (aprox. cuadrada en la
+latitud de SEARCH_LATITUDE). Con un índice sobre `pisos(celda, latitud, longitud)`:
+
+- radio y caja: la caja envolvente se traduce en un rango de celdas
+  contiguas por fila de la rejilla; cada rango es una búsqueda en el índice
+  y solo se filtran con exactitud (caja o círculo) los pisos de esas
+  celdas. Nunca se recorre la tabla.
+- mapas de calor: `geo_celdas` agrega por celda y operación los pisos
+  activos (número, sumas de precio y precio/m²), mantenida en la misma
+  transacción que el upsert y que las bajas. `v_geo_celdas` añade el centro
+  de cada celda y las medias para Metabase.
+
+Si cambia la rejilla (GEO_CELL_METERS o SEARCH_LATITUDE), init_db recalcula
+las celdas y la tabla de agregados. `python geo.py --reconstruir` lo fuerza.
+"""
+import argparse
+import logging
+import math
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import config
+import db
+
+logger = logging.getLogger('idealista')
+
+RADIO_TIERRA = 6371008.8  # radio medio, en metros
+METROS_POR_GRADO = RADIO_TIERRA * math.pi / 180
+
+# Columnas devueltas por las consultas espaciales
+COLUMNAS = ('id', 'titulo', 'precio', 'precio_m2', 'metros', 'habitaciones', 'operacion',
+            'zona', 'distrito', 'barrio', 'latitud', 'longitud', 'link')
+
+
+@lru_cache(maxsize=8)
+def _rejilla(metros: float, latitud_ref: float) -> Tuple[float, float, int]:
+    """(alto en grados, ancho en grados, columnas) de la rejilla"""
+    alto = metros / METROS_POR_GRADO
+    ancho = metros / (METROS_POR_GRADO * math.cos(math.radians(latitud_ref)))
+    return alto, ancho, math.ceil(360 / ancho)
+
+
+def rejilla() -> Tuple[float, float, int]:
+    return _rejilla(float(config.GEO_CELL_METERS), float(config.SEARCH_LATITUDE))
+
+
+def _fila_columna(lat: float, lon: float) -> Tuple[int, int]:
+    alto, ancho, _ = rejilla()
+    return math.floor((lat + 90) / alto), math.floor((lon + 180) / ancho)
+
+
+def celda(lat: Optional[float], lon: Optional[float]) -> Optional[int]:
+    """Celda de unas coordenadas (None si faltan o no son válidas)"""
+    if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    fila, columna = _fila_columna(lat, lon)
+    return fila * rejilla()[2] + columna
+
+
+def asignar_celdas(filas: List[Dict]):
+    """Rellena `celda` en cada fila parseada a partir de latitud y longitud"""
+    for fila in filas:
+        fila['celda'] = celda(fila.get('latitud'), fila.get('longitud'))
+
+
+def distancia(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distancia haversine en metros"""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((p2 - p1) / 2) ** 2
+         + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * RADIO_TIERRA * math.asin(math.sqrt(min(1.0, a)))
+
+
+def _parametros_rejilla() -> Dict:
+    alto, ancho, columnas = rejilla()
+    return {'alto': alto, 'ancho': ancho, 'columnas': columnas}
+
+
+def crear_tablas(conn):
+    """Columnas geográficas, índice de celdas y agregados (llamado desde init_db)"""
+    for columna, tipo in (('latitud', 'REAL'), ('longitud', 'REAL'), ('distrito', 'TEXT'),
+                          ('barrio', 'TEXT'), ('celda', 'INTEGER')):
+        db.ensure_column(conn, 'pisos', columna, tipo)
+    # Con latitud y longitud en el índice, las consultas descartan sin leer la fila del piso
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_pisos_celda ON pisos(celda, latitud, longitud)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS geo_celdas (
+        celda INTEGER NOT NULL,
+        operacion TEXT NOT NULL,
+        n INTEGER DEFAULT 0,
+        n_precio INTEGER DEFAULT 0,
+        suma_precio REAL DEFAULT 0,
+        n_precio_m2 INTEGER DEFAULT 0,
+        suma_precio_m2 REAL DEFAULT 0,
+        lat_centro REAL,
+        lon_centro REAL,
+        PRIMARY KEY (celda, operacion)
+    ) WITHOUT ROWID''')
+    conn.execute('''CREATE VIEW IF NOT EXISTS v_geo_celdas AS
+        SELECT celda, operacion, n, lat_centro, lon_centro,
+               round(suma_precio / NULLIF(n_precio, 0), 2) AS precio_medio,
+               round(suma_precio_m2 / NULLIF(n_precio_m2, 0), 2) AS precio_m2_medio
+        FROM geo_celdas WHERE n > 0''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS geo_rejilla (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        metros REAL NOT NULL,
+        latitud_ref REAL NOT NULL
+    )''')
+
+    actual = (float(config.GEO_CELL_METERS), float(config.SEARCH_LATITUDE))
+    guardada = conn.execute("SELECT metros, latitud_ref FROM geo_rejilla").fetchone()
+    if guardada != actual:
+        if guardada:
+            logger.warning(f"Rejilla geográfica cambiada {guardada} -> {actual}: recalculando celdas")
+        _recalcular(conn)
+        conn.execute("INSERT OR REPLACE INTO geo_rejilla (id, metros, latitud_ref) VALUES (1, ?, ?)", actual)
+
+
+# Aportación de un piso a su celda; :signo = 1 suma, -1 resta
+_APORTACION = """
+    SELECT celda, COALESCE(operacion, 'rent') AS operacion,
+           :signo * COUNT(*) AS n,
+           :signo * COUNT(precio) AS n_precio,
+           :signo * COALESCE(SUM(precio), 0) AS suma_precio,
+           :signo * COUNT(CASE WHEN metros > 0 AND precio > 0 THEN 1 END) AS n_precio_m2,
+           :signo * COALESCE(SUM(CASE WHEN metros > 0 AND precio > 0
+                                      THEN precio * 1.0 / metros END), 0) AS suma_precio_m2"""
+
+_ACUMULAR = """
+    INSERT INTO geo_celdas (celda, operacion, n, n_precio, suma_precio, n_precio_m2, suma_precio_m2,
+                            lat_centro, lon_centro)
+    SELECT celda, operacion, SUM(n), SUM(n_precio), SUM(suma_precio), SUM(n_precio_m2),
+           SUM(suma_precio_m2),
+           (celda / :columnas + 0.5) * :alto - 90, (celda % :columnas + 0.5) * :ancho - 180
+    FROM ({aportaciones}) GROUP BY celda, operacion
+    ON CONFLICT (celda, operacion) DO UPDATE SET
+        n = n + excluded.n,
+        n_precio = n_precio + excluded.n_precio,
+        suma_precio = suma_precio + excluded.suma_precio,
+        n_precio_m2 = n_precio_m2 + excluded.n_precio_m2,
+        suma_precio_m2 = suma_precio_m2 + excluded.suma_precio_m2"""
+
+
+def ajustar(conn, condicion: str, parametros: Optional[Dict] = None, signo: int = 1):
+    """
+    Suma (signo=1) o resta (signo=-1) de geo_celdas los pisos que cumplen la condición
+
+    La usa bajas.py antes de retirar o reactivar pisos, con el mismo WHERE
+    sobre `pisos` que el UPDATE.
+    """
+    aportaciones = f"""{_APORTACION} FROM pisos
+                       WHERE celda IS NOT NULL AND ({condicion})
+                       GROUP BY 1, 2"""
+    conn.execute(_ACUMULAR.format(aportaciones=aportaciones),
+                 {**(parametros or {}), 'signo': signo, **_parametros_rejilla()})
+
+
+def actualizar_lote(conn):
+    """
+    Acumula la página recién aplicada (tmp_lote clasificada por lotes.aplicar_lote)
+
+    Altas: el piso suma en su celda. Cambios de precio: la diferencia de
+    precio (y de precio/m²) con el precio anterior. Pisos ya guardados que
+    reciben ahora sus coordenadas (localizados): suman entero, con el precio
+    actual. Usa la celda guardada en `pisos` y solo pisos activos (los
+    retirados no cuentan hasta reactivarse).
+    """
+    aportaciones = """
+        SELECT p.celda, COALESCE(p.operacion, 'rent') AS operacion,
+               SUM(t.clase = 'nuevos') AS n,
+               SUM(t.clase = 'nuevos' AND p.precio IS NOT NULL) AS n_precio,
+               COALESCE(SUM(CASE WHEN t.clase = 'nuevos' THEN p.precio
+                                 ELSE p.precio - t.precio_anterior END), 0) AS suma_precio,
+               SUM(t.clase = 'nuevos' AND p.metros > 0 AND p.precio > 0) AS n_precio_m2,
+               COALESCE(SUM(CASE WHEN NOT p.metros > 0 THEN 0
+                                 WHEN t.clase = 'nuevos' THEN
+                                     CASE WHEN p.precio > 0 THEN p.precio * 1.0 / p.metros END
+                                 ELSE (p.precio - t.precio_anterior) * 1.0 / p.metros END), 0)
+                   AS suma_precio_m2
+        FROM tmp_lote t CROSS JOIN pisos p
+        WHERE p.id = t.id AND t.clase != 'sin_cambios' AND NOT t.localizado AND p.celda IS NOT NULL
+        AND COALESCE(p.estado, 'activo') = 'activo'
+        GROUP BY 1, 2"""
+    conn.execute(_ACUMULAR.format(aportaciones=aportaciones), _parametros_rejilla())
+    ajustar(conn, """COALESCE(estado, 'activo') = 'activo'
+                     AND id IN (SELECT id FROM tmp_lote WHERE localizado)""")
+
+
+def _recalcular(conn):
+    """Celda de cada piso con coordenadas y agregados desde cero (tras cambiar la rejilla)"""
+    filas = conn.execute("SELECT id, latitud, longitud FROM pisos WHERE latitud IS NOT NULL").fetchall()
+    conn.executemany("UPDATE pisos SET celda = ? WHERE id = ?",
+                     ((celda(lat, lon), id_piso) for id_piso, lat, lon in filas))
+    conn.execute("DELETE FROM geo_celdas")
+    ajustar(conn, "COALESCE(estado, 'activo') = 'activo'")
+
+
+def reconstruir():
+    """Recalcula celdas y agregados en una transacción"""
+    with db.transaction() as conn:
+        _recalcular(conn)
+        return conn.execute("SELECT COUNT(*) FROM geo_celdas WHERE n > 0").fetchone()[0]
+
+
+def _rangos(lat_min: float, lon_min: float, lat_max: float, lon_max: float) -> List[Tuple[int, int]]:
+    """Rangos [desde, hasta] de celdas contiguas (uno por fila) que cubren la caja"""
+    columnas = rejilla()[2]
+    fila0, col0 = _fila_columna(lat_min, lon_min)
+    fila1, col1 = _fila_columna(lat_max, lon_max)
+    return [(f * columnas + col0, f * columnas + col1) for f in range(fila0, fila1 + 1)]
+
+
+def _consultar(lat_min: float, lon_min: float, lat_max: float, lon_max: float,
+               operacion: Optional[str], solo_activos: bool,
+               centro: Optional[Tuple[float, float]] = None, radio: Optional[float] = None) -> List[Dict]:
+    """
+    Pisos de la caja (y del círculo, si se da centro y radio) a partir de los
+    rangos de celdas: el índice (celda, latitud, longitud) descarta lo que
+    queda fuera sin leer la fila del piso
+    """
+    rangos = _rangos(lat_min, lon_min, lat_max, lon_max)
+    valores = ', '.join(f'(:desde{i}, :hasta{i})' for i in range(len(rangos)))
+    params = {'lat_min': lat_min, 'lat_max': lat_max, 'lon_min': lon_min, 'lon_max': lon_max}
+    for i, (desde, hasta) in enumerate(rangos):
+        params.update({f'desde{i}': desde, f'hasta{i}': hasta})
+    filtros = ["p.latitud BETWEEN :lat_min AND :lat_max", "p.longitud BETWEEN :lon_min AND :lon_max"]
+    columnas = ', '.join('p.' + c for c in COLUMNAS)
+    orden = ''
+    if centro:
+        # Distancia equirrectangular en m² con aritmética simple (no requiere las funciones
+        # matemáticas de SQLite): error < 0,1 % para radios de pocos km
+        params.update(lat=centro[0], lon=centro[1], m_lat=METROS_POR_GRADO, radio2=radio * radio,
+                      m_lon=METROS_POR_GRADO * math.cos(math.radians(centro[0])))
+        distancia2 = """((p.latitud - :lat) * :m_lat) * ((p.latitud - :lat) * :m_lat)
+                        + ((p.longitud - :lon) * :m_lon) * ((p.longitud - :lon) * :m_lon)"""
+        columnas += f", {distancia2} AS distancia2"
+        filtros.append("distancia2 <= :radio2")
+        orden = "ORDER BY distancia2"
+    if operacion:
+        filtros.append("p.operacion = :operacion")
+        params['operacion'] = operacion
+    if solo_activos:
+        filtros.append("COALESCE(p.estado, 'activo') = 'activo'")
+    # CROSS JOIN: una búsqueda por rango en idx_pisos_celda, nunca un recorrido de pisos
+    filas = db.get_connection().execute(
+        f"""WITH rangos(desde, hasta) AS (VALUES {valores})
+            SELECT {columnas}
+            FROM rangos r CROSS JOIN pisos p
+            WHERE p.celda BETWEEN r.desde AND r.hasta AND {' AND '.join(filtros)} {orden}""", params)
+    if not centro:
+        return [dict(zip(COLUMNAS, f)) for f in filas]
+    return [{**dict(zip(COLUMNAS, f)), 'distancia': round(math.sqrt(f[-1]), 1)} for f in filas]
+
+
+def en_caja(lat_min: float, lon_min: float, lat_max: float, lon_max: float,
+            operacion: Optional[str] = None, solo_activos: bool = True) -> List[Dict]:
+    """Pisos dentro de una caja de coordenadas"""
+    return _consultar(lat_min, lon_min, lat_max, lon_max, operacion, solo_activos)
+
+
+def en_radio(lat: float, lon: float, radio: float, operacion: Optional[str] = None,
+             solo_activos: bool = True) -> List[Dict]:
+    """
+    Pisos a menos de `radio` metros, ordenados por distancia
+
+    Cada piso lleva además `distancia` (metros).
+    """
+    dlat = radio / METROS_POR_GRADO
+    dlon = radio / (METROS_POR_GRADO * max(math.cos(math.radians(lat)), 1e-6))
+    return _consultar(lat - dlat, lon - dlon, lat + dlat, lon + dlon, operacion, solo_activos,
+                      centro=(lat, lon), radio=radio)
+
+
+def celdas_en_caja(lat_min: float, lon_min: float, lat_max: float, lon_max: float,
+                   operacion: Optional[str] = None) -> List[Dict]:
+    """Mapa de calor: v_geo_celdas de las celdas que cubren la caja"""
+    columnas = ('celda', 'operacion', 'n', 'lat_centro', 'lon_centro', 'precio_medio', 'precio_m2_medio')
+    filtro, params = '', []
+    if operacion:
+        filtro, params = 'AND operacion = ?', [operacion]
+    conn = db.get_connection()
+    return [dict(zip(columnas, f))
+            for desde, hasta in _rangos(lat_min, lon_min, lat_max, lon_max)
+            for f in conn.execute(f"""SELECT {', '.join(columnas)} FROM v_geo_celdas
+                                      WHERE celda BETWEEN ? AND ? {filtro}""", [desde, hasta] + params)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Índice geoespacial de pisos")
+    parser.add_argument('--reconstruir', action='store_true',
+                        help="Recalcula las celdas y geo_celdas desde pisos")
+    args = parser.parse_args()
+
+    if args.reconstruir:
+        print(f"{reconstruir()} celdas con pisos")
+    else:
+        parser.print_help()
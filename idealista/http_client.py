@@ -0,0 +1,121 @@
+"""
+Cliente HTTP compartido para Idealista y Telegram
+
+Una sesión `requests` persistente por host (keep-alive + pool de conexiones),
+timeouts de conexión/lectura separados, gzip y contadores por host de
+latencia y bytes de cada petición.
+"""
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+
+_lock = threading.Lock()
+_sesiones: Dict[str, requests.Session] = {}
+_estadisticas: Dict[str, Dict] = {}
+
+
+def _nueva_sesion() -> requests.Session:
+    sesion = requests.Session()
+    adaptador = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=config.HTTP_POOL_SIZE,
+        max_retries=0,  # Los reintentos los decide cada llamador (quota, 429...)
+    )
+    sesion.mount('https://', adaptador)
+    sesion.mount('http://', adaptador)
+    sesion.headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+        'User-Agent': 'home-intelligence-bot',
+    })
+    return sesion
+
+
+def get_session(url: str) -> requests.Session:
+    """Devuelve la sesión persistente del host de la URL"""
+    host = urlsplit(url).netloc
+    sesion = _sesiones.get(host)
+    if sesion is None:
+        with _lock:
+            sesion = _sesiones.get(host)
+            if sesion is None:
+                sesion = _sesiones[host] = _nueva_sesion()
+    return sesion
+
+
+def _registrar(host: str, segundos: float, enviados: int, recibidos: int, error: bool):
+    with _lock:
+        stats = _estadisticas.get(host)
+        if stats is None:
+            stats = _estadisticas[host] = {
+                'peticiones': 0,
+                'errores': 0,
+                'segundos_total': 0.0,
+                'segundos_max': 0.0,
+                'bytes_enviados': 0,
+                'bytes_recibidos': 0,
+            }
+        stats['peticiones'] += 1
+        stats['errores'] += int(error)
+        stats['segundos_total'] += segundos
+        stats['segundos_max'] = max(stats['segundos_max'], segundos)
+        stats['bytes_enviados'] += enviados
+        stats['bytes_recibidos'] += recibidos
+
+
+def post(url: str, read_timeout: Optional[float] = None, **kwargs) -> requests.Response:
+    """
+    POST a través de la sesión compartida del host
+
+    Args:
+        url: URL destino
+        read_timeout: Timeout de lectura (por defecto config.REQUEST_TIMEOUT)
+        **kwargs: Se pasan a requests.Session.post (headers, data...)
+    """
+    kwargs.setdefault('timeout', (config.HTTP_CONNECT_TIMEOUT, read_timeout or config.REQUEST_TIMEOUT))
+    host = urlsplit(url).netloc
+    t0 = time.perf_counter()
+    try:
+        response = get_session(url).post(url, **kwargs)
+    except requests.RequestException:
+        _registrar(host, time.perf_counter() - t0, 0, 0, error=True)
+        raise
+
+    cuerpo = response.request.body or b''
+    # Bytes en la red: Content-Length (comprimido) si el servidor lo envía
+    recibidos = int(response.headers.get('Content-Length', len(response.content)))
+    _registrar(host, time.perf_counter() - t0, len(cuerpo), recibidos,
+               error=response.status_code >= 400)
+    return response
+
+
+def estadisticas() -> Dict[str, Dict]:
+    """Copia de los contadores por host, con latencia media en ms"""
+    with _lock:
+        resultado = {}
+        for host, stats in _estadisticas.items():
+            copia = dict(stats)
+            copia['latencia_media_ms'] = round(stats['segundos_total'] / stats['peticiones'] * 1000, 1)
+            copia['segundos_total'] = round(stats['segundos_total'], 3)
+            copia['segundos_max'] = round(stats['segundos_max'], 3)
+            resultado[host] = copia
+        return resultado
+
+
+def reiniciar_estadisticas():
+    with _lock:
+        _estadisticas.clear()
+
+
+def cerrar():
+    """Cierra todas las sesiones (y sus conexiones abiertas)"""
+    with _lock:
+        for sesion in _sesiones.values():
+            sesion.close()
+        _sesiones.clear()
@@ -0,0 +1,81 @@
+"""
+Paginación incremental: dejar de pedir páginas cuando ya estamos al día
+
+En modo incremental se ordena por recencia (modificationDate desc) y se
+guarda por perfil una marca de agua (el primer piso visto en la última
+búsqueda). Una página está "al día" si no trae ids nuevos ni cambios de
+precio por encima del umbral, o si a partir de la marca de agua ya todo
+es conocido; en ese caso no se piden más páginas y se ahorra quota.
+"""
+from typing import Dict, Iterable, List, Optional, Set
+
+import config
+import db
+
+PERFIL_DEFECTO = 'default'
+
+
+def crear_tablas(conn):
+    """Crea la tabla de marcas de agua (llamado desde init_db)"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS marcas_agua (
+        perfil TEXT PRIMARY KEY,
+        id_piso TEXT NOT NULL,
+        fecha DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+
+def cargar_marca(perfil: str = PERFIL_DEFECTO) -> Optional[str]:
+    row = db.get_connection().execute(
+        "SELECT id_piso FROM marcas_agua WHERE perfil=?", (perfil,)).fetchone()
+    return row[0] if row else None
+
+
+def guardar_marca(id_piso: str, perfil: str = PERFIL_DEFECTO):
+    with db.transaction() as conn:
+        conn.execute("""INSERT INTO marcas_agua (perfil, id_piso, fecha)
+                        VALUES (?, ?, datetime('now'))
+                        ON CONFLICT(perfil) DO UPDATE SET
+                            id_piso = excluded.id_piso, fecha = excluded.fecha""",
+                     (perfil, id_piso))
+
+
+def cambio_significativo(fila: Dict, umbral: float = config.INCREMENTAL_PRICE_THRESHOLD) -> bool:
+    """True si la variación relativa de precio supera el umbral"""
+    anterior = fila.get('precio_anterior')
+    if not anterior:
+        return True
+    return abs(fila['precio'] - anterior) / anterior > umbral
+
+
+def novedades(diff: Dict[str, List[Dict]],
+              umbral: float = config.INCREMENTAL_PRICE_THRESHOLD) -> Set[str]:
+    """Ids de la página que son nuevos o cambiaron de precio por encima del umbral"""
+    ids = {f['id'] for f in diff['nuevos']}
+    ids.update(f['id'] for f in diff['bajadas'] + diff['subidas']
+               if cambio_significativo(f, umbral))
+    return ids
+
+
+def pagina_al_dia(ids_pagina: List[str], diff: Dict[str, List[Dict]],
+                  marca: Optional[str] = None,
+                  umbral: float = config.INCREMENTAL_PRICE_THRESHOLD,
+                  ajenos: Iterable[str] = ()) -> bool:
+    """
+    Decide si se puede dejar de paginar
+
+    Args:
+        ids_pagina: Ids de la página en el orden devuelto por la API
+        diff: Diff clasificado de la página (lotes.aplicar_lote)
+        marca: Primer id visto en la búsqueda anterior de este perfil
+        umbral: Variación relativa mínima de precio que cuenta como cambio
+        ajenos: Ids de la página que no están en el diff (los procesó otro
+            perfil) y fueron un cambio o aún no se sabe
+    """
+    cambios = novedades(diff, umbral)
+    cambios.update(ajenos)
+    if not cambios:
+        return True
+    if marca in ids_pagina:
+        # Todo lo que hay a partir de la marca ya lo vimos la última vez
+        return not any(i in cambios for i in ids_pagina[ids_pagina.index(marca):])
+    return False
@@ -0,0 +1,176 @@
+"""
+Motor de upsert por lotes para procesar_lote
+
+Carga una página de pisos en una tabla temporal, la clasifica contra `pisos`
+con un único join (nuevo / bajada / subida / sin cambios) y aplica los
+cambios con sentencias set-based dentro de la transacción del llamador.
+"""
+import json
+import sqlite3
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+# Columnas de `pisos` que se alimentan desde cada elemento de la API
+COLUMNAS = ('id', 'titulo', 'precio', 'precio_m2', 'metros', 'habitaciones',
+            'planta', 'exterior', 'link', 'operacion', 'zona', 'puntuacion_anomalia',
+            'latitud', 'longitud', 'distrito', 'barrio', 'celda')
+
+CLASES = ('nuevos', 'bajadas', 'subidas', 'sin_cambios')
+
+# Columnas que un piso ya guardado sin ellas (anterior a su migración) recibe
+# la próxima vez que la API lo devuelve, aunque no haya cambiado de precio
+COLUMNAS_RELLENO = ('zona', 'latitud', 'longitud', 'distrito', 'barrio', 'celda')
+
+_CLASE_SQL = """CASE
+    WHEN NOT existe THEN 'nuevos'
+    WHEN precio IS NULL OR precio = 0 OR precio_anterior IS NULL THEN 'sin_cambios'
+    WHEN precio < precio_anterior THEN 'bajadas'
+    WHEN precio > precio_anterior THEN 'subidas'
+    ELSE 'sin_cambios'
+END"""
+
+
+def parsear_piso(p: Dict) -> Dict:
+    """Extrae de un elemento de `elementList` las columnas que guardamos"""
+    precio = p.get('price')
+    metros = p.get('size')
+    precio_m2 = p.get('priceByArea')
+    if not precio_m2 and metros and precio:
+        precio_m2 = round(precio / metros, 1)
+
+    return {
+        'id': str(p.get('propertyCode')),
+        'titulo': p.get('suggestedTexts', {}).get('title', 'Sin título'),
+        'precio': precio,
+        'precio_m2': precio_m2,
+        'metros': metros,
+        'habitaciones': p.get('rooms'),
+        'planta': p.get('floor', 'Bajo'),
+        'exterior': p.get('exterior', False),
+        'link': p.get('url', ''),
+        'operacion': p.get('operation'),
+        'zona': p.get('district') or p.get('municipality'),
+        'puntuacion_anomalia': None,  # la rellena anomalias.puntuar_lote
+        'latitud': p.get('latitude'),
+        'longitud': p.get('longitude'),
+        'distrito': p.get('district'),
+        'barrio': p.get('neighborhood'),
+        'celda': None,  # la rellena geo.asignar_celdas
+    }
+
+
+def parsear_pagina(contenido: bytes, operacion: Optional[str] = None) -> Tuple[List[str], List[Dict], int]:
+    """
+    Parsea una respuesta cruda de /search (para replay.py, también en otro proceso)
+
+    Args:
+        contenido: Cuerpo JSON de la respuesta
+        operacion: Operación del perfil, para los elementos que no la traen
+
+    Returns:
+        (ids de la página en orden, filas parseadas, elementos que no se pudieron parsear)
+    """
+    pisos = json.loads(contenido).get('elementList', [])
+    ids = [str(p.get('propertyCode')) for p in pisos]
+    filas, errores = [], 0
+    for p in pisos:
+        if operacion:
+            p.setdefault('operation', operacion)
+        try:
+            filas.append(parsear_piso(p))
+        except Exception:
+            errores += 1
+    return ids, filas, errores
+
+
+def fecha_actual() -> str:
+    """Fecha UTC en el mismo formato que datetime('now') de SQLite"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _preparar_tabla_temporal(conn: sqlite3.Connection):
+    conn.execute(f"""CREATE TEMP TABLE IF NOT EXISTS tmp_lote (
+        {', '.join(c + (' TEXT PRIMARY KEY' if c == 'id' else '') for c in COLUMNAS)},
+        orden INTEGER,
+        existe INTEGER DEFAULT 0,
+        precio_anterior REAL,
+        clase TEXT,
+        relleno INTEGER DEFAULT 0,
+        localizado INTEGER DEFAULT 0
+    )""")
+    conn.execute("DELETE FROM tmp_lote")
+
+
+def aplicar_lote(conn: sqlite3.Connection, filas: List[Dict],
+                 fecha: Optional[str] = None) -> Dict[str, List[Dict]]:
+    """
+    Clasifica y persiste una página de pisos ya parseados
+
+    Debe llamarse dentro de una transacción (db.transaction()). Si un id se
+    repite en la página gana la última aparición, igual que al procesarlos
+    uno a uno.
+
+    Args:
+        conn: Conexión con la transacción abierta
+        filas: Pisos parseados con parsear_piso()
+        fecha: Marca temporal a registrar (por defecto ahora, UTC)
+
+    Returns:
+        Diff clasificado: {'nuevos': [...], 'bajadas': [...], 'subidas': [...],
+        'sin_cambios': [...]}, cada fila con las columnas de `pisos` más
+        `precio_anterior`
+    """
+    diff = {clase: [] for clase in CLASES}
+    if not filas:
+        return diff
+    fecha = fecha or fecha_actual()
+
+    _preparar_tabla_temporal(conn)
+    marcadores = ', '.join('?' for _ in range(len(COLUMNAS) + 1))
+    conn.executemany(
+        f"INSERT OR REPLACE INTO tmp_lote ({', '.join(COLUMNAS)}, orden) VALUES ({marcadores})",
+        ([f[c] for c in COLUMNAS] + [i] for i, f in enumerate(filas))
+    )
+
+    # Un único join contra pisos (búsqueda por PK) para clasificar toda la página.
+    # CROSS JOIN fija el orden: recorrer la página y buscar en pisos; sin él,
+    # sin estadísticas, SQLite puede elegir recorrer pisos entero.
+    relleno = ' OR '.join(f"(p.{c} IS NULL AND t.{c} IS NOT NULL)" for c in COLUMNAS_RELLENO)
+    conn.execute(f"""UPDATE tmp_lote SET existe = 1, precio_anterior = p.precio,
+                         relleno = {relleno}, localizado = p.celda IS NULL AND t.celda IS NOT NULL
+                     FROM tmp_lote t CROSS JOIN pisos p
+                     WHERE p.id = t.id AND t.id = tmp_lote.id""")
+    conn.execute(f"UPDATE tmp_lote SET clase = {_CLASE_SQL}")
+
+    columnas_diff = COLUMNAS + ('precio_anterior', 'clase', 'relleno')
+    rellenos = 0
+    for row in conn.execute(f"SELECT {', '.join(columnas_diff)} FROM tmp_lote ORDER BY orden"):
+        fila = dict(zip(columnas_diff, row))
+        rellenos += fila.pop('relleno')
+        diff[fila.pop('clase')].append(fila)
+
+    # Las coordenadas, la celda y la zona no cambian una vez guardadas (geo_celdas
+    # cuenta cada piso en su celda): solo se rellenan si faltaban
+    if rellenos:
+        conn.execute(f"""UPDATE pisos SET {', '.join(f'{c} = COALESCE(pisos.{c}, t.{c})' for c in COLUMNAS_RELLENO)}
+                         FROM tmp_lote t
+                         WHERE t.id = pisos.id AND t.relleno AND t.clase = 'sin_cambios'""")
+    if len(diff['sin_cambios']) == len(filas):
+        return diff
+
+    columnas = ', '.join(COLUMNAS)
+    conn.execute(f"""INSERT INTO pisos ({columnas}, fecha_registro, fecha_actualizacion)
+                     SELECT {columnas}, :fecha, :fecha FROM tmp_lote
+                     WHERE clase != 'sin_cambios'
+                     ON CONFLICT(id) DO UPDATE SET
+                         precio = excluded.precio,
+                         precio_m2 = excluded.precio_m2,
+                         puntuacion_anomalia = excluded.puntuacion_anomalia,
+                         fecha_actualizacion = excluded.fecha_actualizacion,
+                         {', '.join(f'{c} = COALESCE(pisos.{c}, excluded.{c})' for c in COLUMNAS_RELLENO)}""",
+                 {'fecha': fecha})
+    conn.execute("""INSERT INTO historial_precios (id_piso, precio, fecha)
+                    SELECT id, precio, :fecha FROM tmp_lote
+                    WHERE clase != 'sin_cambios' ORDER BY orden""",
+                 {'fecha': fecha})
+    return diff
@@ -21,7 +21,9 @@ logger = setup_logging(
     config.LOG_PATH,
     level=config.LOG_LEVEL,
     max_bytes=config.LOG_MAX_BYTES,
-    backup_count=config.LOG_BACKUP_COUNT
+    backup_count=config.LOG_BACKUP_COUNT,
+    queue_size=config.LOG_QUEUE_SIZE,
+    queue_timeout=config.LOG_QUEUE_TIMEOUT
 )
 
 
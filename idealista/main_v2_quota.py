@@ -3,18 +3,36 @@ Bot de rastreo de pisos en Idealista - CON CONTROL DE QUOTA API
 Desplegado en Docker + SQLite + Metabase
 ⭐ CRÍTICO: API limitado a 100 peticiones/mes
 """
-import requests
 import base64
-import sqlite3
 import time
 import logging
-import shutil
-from datetime import datetime, timedelta
+from datetime import datetime
 from pathlib import Path
 from typing import Optional, Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import wraps
 
+import anomalias
+import archivo
+import backup
+import bajas
 import config
+import db
+import dedup
+import digest
+import geo
+import http_client
+import incremental
+import lotes
+import metrics
+import notificaciones
+import perfiles
+import planificador
+import quota
+import reglas
+import rollups
+import suscripciones
+import token_cache
 from utils import setup_logging, log_event
 
 # Configurar logging
@@ -22,44 +40,59 @@ logger = setup_logging(
     config.LOG_PATH,
     level=config.LOG_LEVEL,
     max_bytes=config.LOG_MAX_BYTES,
-    backup_count=config.LOG_BACKUP_COUNT
+    backup_count=config.LOG_BACKUP_COUNT,
+    queue_size=config.LOG_QUEUE_SIZE,
+    queue_timeout=config.LOG_QUEUE_TIMEOUT
 )
 
 
-def track_api_request(exitoso: bool = True, tipo: str = 'search'):
+# ⭐ Ledger de quota en memoria, reflejado en api_quota con upsert atómico
+_quota = quota.QuotaLedger()
+
+# Perfiles de la última búsqueda: el planificador no relee perfiles.json en cada ciclo
+_num_perfiles: Optional[int] = None
+
+
+def _perfiles_plan() -> int:
+    """Perfiles con los que planificar (los de la última búsqueda, o los del fichero al arrancar)"""
+    global _num_perfiles
+    if _num_perfiles is None:
+        try:
+            _num_perfiles = len(perfiles.cargar_perfiles())
+        except Exception as e:
+            logger.error(f"Perfiles inválidos, se planifica con uno: {e}")
+            return 1
+    return _num_perfiles
+
+
+# ⭐ Planificador: cuándo buscar y cuántas páginas según la quota restante
+_planificador = planificador.Planificador(
+    disponible=lambda: _quota.disponible(),
+    num_perfiles=_perfiles_plan
+)
+
+# ⭐ Gauges de quota: se calculan al hacer scrape, sin coste en el bucle
+metrics.QUOTA_USADA.set_funcion(lambda: _quota.estado()[1])
+metrics.QUOTA_RESTANTE.set_funcion(lambda: _quota.disponible())
+
+
+def track_api_request(exitoso: bool = True, tipo: str = 'search', reserva: Optional[int] = None):
     """
     ⭐ CRÍTICO: Registra una petición API en la BD para tracking de quota
     
     Args:
         exitoso: Si la petición fue exitosa
         tipo: Tipo de petición (search, token, etc)
+        reserva: Reserva hecha con _quota.reservar() antes de la petición
     """
     try:
-        mes_ano = datetime.now().strftime("%Y-%m")
-        
-        conn = sqlite3.connect(str(config.DB_PATH))
-        c = conn.cursor()
-        
-        # Registrar petición
-        c.execute("""INSERT INTO api_requests (endpoint, tipo, exitoso, mes_ano)
-                     VALUES (?, ?, ?, ?)""",
-                  ('https://api.idealista.com', tipo, exitoso, mes_ano))
-        
-        # Actualizar quota
-        c.execute("SELECT COUNT(*) FROM api_requests WHERE mes_ano=? AND exitoso=1", 
-                 (mes_ano,))
-        total_usado = c.fetchone()[0]
-        
-        c.execute("""INSERT OR REPLACE INTO api_quota 
-                     (mes_ano, usado, fecha_inicio, fecha_fin)
-                     VALUES (?, ?, datetime('now'), datetime('now', '+1 month'))""",
-                  (mes_ano, total_usado))
-        
-        conn.commit()
-        conn.close()
+        if reserva is None:
+            total_usado = _quota.registrar(exitoso, tipo)
+        else:
+            total_usado = _quota.confirmar(reserva, exitoso)
         
         log_event(logger, 'API_REQUEST_TRACKED', {
-            'mes': mes_ano,
+            'mes': datetime.now().strftime("%Y-%m"),
             'total_usado': total_usado,
             'limite': config.MONTHLY_REQUEST_LIMIT,
             'porcentaje': round((total_usado / config.MONTHLY_REQUEST_LIMIT) * 100, 1)
@@ -77,42 +110,47 @@ def check_api_quota() -> Tuple[bool, int, int]:
         (puede_continuar, usado, limite)
     """
     try:
-        mes_ano = datetime.now().strftime("%Y-%m")
-        
-        conn = sqlite3.connect(str(config.DB_PATH))
-        c = conn.cursor()
-        
-        c.execute("SELECT usado FROM api_quota WHERE mes_ano=?", (mes_ano,))
-        row = c.fetchone()
-        usado = row[0] if row else 0
-        
-        conn.close()
-        
-        puede_continuar = usado < config.MONTHLY_REQUEST_LIMIT
+        puede_continuar, usado, limite = _quota.estado()
         
         # Logging de estado
-        porcentaje = (usado / config.MONTHLY_REQUEST_LIMIT) * 100
+        porcentaje = (usado / limite) * 100
         if porcentaje >= 100:
-            logger.critical(f"❌ QUOTA AGOTADA: {usado}/{config.MONTHLY_REQUEST_LIMIT} peticiones")
+            logger.critical(f"❌ QUOTA AGOTADA: {usado}/{limite} peticiones")
             if config.PAUSE_AT_QUOTA:
                 logger.warning("⏸️  Búsquedas pausadas hasta fin de mes")
         elif porcentaje >= (config.QUOTA_WARNING_THRESHOLD * 100):
-            logger.warning(f"⚠️  QUOTA AL {porcentaje:.1f}%: {usado}/{config.MONTHLY_REQUEST_LIMIT} peticiones")
+            logger.warning(f"⚠️  QUOTA AL {porcentaje:.1f}%: {usado}/{limite} peticiones")
         else:
-            logger.debug(f"✅ Quota OK: {usado}/{config.MONTHLY_REQUEST_LIMIT} ({porcentaje:.1f}%)")
+            logger.debug(f"✅ Quota OK: {usado}/{limite} ({porcentaje:.1f}%)")
         
-        return puede_continuar, usado, config.MONTHLY_REQUEST_LIMIT
+        return puede_continuar, usado, limite
         
     except Exception as e:
         logger.error(f"Error verificando quota: {e}")
         return True, 0, config.MONTHLY_REQUEST_LIMIT
 
 
-def should_search_now() -> bool:
+def _post_con_quota(url: str, tipo: str, **kwargs):
+    """POST a Idealista reservando quota antes y confirmándola después"""
+    reserva = _quota.reservar(tipo)
+    try:
+        with metrics.cronometrar(metrics.PETICION_IDEALISTA.labels(tipo)):
+            response = http_client.post(url, **kwargs)
+    except Exception:
+        _quota.cancelar(reserva)
+        metrics.ERRORES.labels('api').inc()
+        raise
+    
+    # ⭐ REGISTRAR PETICIÓN API
+    track_api_request(exitoso=(response.status_code == 200), tipo=tipo, reserva=reserva)
+    return response
+
+
+def should_search_now(plan: Optional[Dict] = None) -> bool:
     """
     ⭐ CRÍTICO: Determina si se debe hacer búsqueda ahora considerando:
     1. Quota disponible
-    2. Última búsqueda (espaciadas para economizar quota)
+    2. Plan del planificador (reparte la quota restante hasta fin de mes)
     
     Returns:
         True si se debe buscar, False si no
@@ -123,25 +161,16 @@ def should_search_now() -> bool:
         logger.warning(f"Búsqueda saltada: quota agotada ({usado}/{limite})")
         return False
     
-    # Verificar si es tiempo de buscar (basado en SEARCH_INTERVAL_HOURS)
     try:
-        conn = sqlite3.connect(str(config.DB_PATH))
-        c = conn.cursor()
-        
-        c.execute("""SELECT fecha_fin FROM ejecuciones 
-                     WHERE status='success' 
-                     ORDER BY fecha_inicio DESC LIMIT 1""")
-        row = c.fetchone()
-        conn.close()
-        
-        if row:
-            ultima_busqueda = datetime.fromisoformat(row[0])
-            tiempo_desde = datetime.now() - ultima_busqueda
-            
-            if tiempo_desde < timedelta(hours=config.SEARCH_INTERVAL_HOURS):
-                horas_restantes = config.SEARCH_INTERVAL_HOURS - (tiempo_desde.total_seconds() / 3600)
-                logger.info(f"⏳ Próxima búsqueda en {horas_restantes:.1f} horas (economizando quota)")
-                return False
+        plan = plan or _planificador.planificar()
+        if plan['paginas'] == 0:
+            logger.info("⏳ Sin presupuesto para otra búsqueda este mes")
+            return False
+        
+        horas_restantes = (plan['proxima_ejecucion'] - datetime.now()).total_seconds() / 3600
+        if horas_restantes > 0:
+            logger.info(f"⏳ Próxima búsqueda en {horas_restantes:.1f} horas (economizando quota)")
+            return False
         
         return True
         
@@ -154,13 +183,14 @@ def get_quota_status_message() -> str:
     """⭐ Retorna mensaje de estado de quota para Telegram"""
     puede, usado, limite = check_api_quota()
     porcentaje = (usado / limite) * 100
+    intervalo = _planificador.planificar()['intervalo_horas']
     
     if porcentaje >= 100:
         return f"🚨 QUOTA AGOTADA\n{usado}/{limite} peticiones\nProxima búsqueda: próximo mes"
     elif porcentaje >= 80:
-        return f"⚠️ QUOTA AL {porcentaje:.0f}%\n{usado}/{limite} peticiones\nBúsquedas espaciadas: cada {config.SEARCH_INTERVAL_HOURS}h"
+        return f"⚠️ QUOTA AL {porcentaje:.0f}%\n{usado}/{limite} peticiones\nBúsquedas espaciadas: cada {intervalo:.0f}h"
     else:
-        return f"✅ QUOTA OK\n{usado}/{limite} peticiones ({porcentaje:.0f}% usado)\nBúsquedas cada {config.SEARCH_INTERVAL_HOURS}h"
+        return f"✅ QUOTA OK\n{usado}/{limite} peticiones ({porcentaje:.0f}% usado)\nBúsquedas cada {intervalo:.0f}h"
 
 
 def retry_on_exception(max_retries: int = config.MAX_RETRIES, 
@@ -172,6 +202,9 @@ def retry_on_exception(max_retries: int = config.MAX_RETRIES,
             for attempt in range(max_retries):
                 try:
                     return func(*args, **kwargs)
+                except quota.QuotaAgotada:
+                    # Reintentar no tiene sentido hasta el mes que viene
+                    raise
                 except Exception as e:
                     if attempt == max_retries - 1:
                         raise
@@ -191,77 +224,102 @@ def init_db():
     """
     try:
         logger.info("Inicializando base de datos...")
-        conn = sqlite3.connect(str(config.DB_PATH))
-        c = conn.cursor()
-        
-        # Tabla principal de pisos
-        c.execute('''CREATE TABLE IF NOT EXISTS pisos (
-            id TEXT PRIMARY KEY,
-            titulo TEXT NOT NULL,
-            precio REAL,
-            precio_m2 REAL,
-            metros INTEGER,
-            habitaciones INTEGER,
-            planta TEXT,
-            exterior BOOLEAN,
-            estado TEXT,
-            link TEXT NOT NULL,
-            fecha_registro DATETIME DEFAULT CURRENT_TIMESTAMP,
-            fecha_actualizacion DATETIME DEFAULT CURRENT_TIMESTAMP
-        )''')
-        
-        # Tabla de historial de precios
-        c.execute('''CREATE TABLE IF NOT EXISTS historial_precios (
-            id_piso TEXT,
-            precio REAL,
-            fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (id_piso) REFERENCES pisos(id)
-        )''')
-        
-        # Crear índices para performance
-        c.execute('CREATE INDEX IF NOT EXISTS idx_pisos_precio ON pisos(precio)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_pisos_fecha ON pisos(fecha_actualizacion)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_historial_piso ON historial_precios(id_piso)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_historial_fecha ON historial_precios(fecha)')
-        
-        # Tabla de estadísticas de ejecución
-        c.execute('''CREATE TABLE IF NOT EXISTS ejecuciones (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            fecha_inicio DATETIME DEFAULT CURRENT_TIMESTAMP,
-            fecha_fin DATETIME,
-            pisos_procesados INTEGER,
-            pisos_nuevos INTEGER,
-            pisos_modificados INTEGER,
-            errores INTEGER,
-            status TEXT
-        )''')
-        
-        # ⭐ NUEVA TABLA: Tracking de peticiones API (CRÍTICO)
-        c.execute('''CREATE TABLE IF NOT EXISTS api_requests (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
-            endpoint TEXT,
-            tipo TEXT,
-            exitoso BOOLEAN,
-            mes_ano TEXT,
-            FOREIGN KEY (mes_ano) REFERENCES api_quota(mes_ano)
-        )''')
-        
-        # ⭐ NUEVA TABLA: Quota de API por mes (CRÍTICO: 100 requests/mes)
-        c.execute('''CREATE TABLE IF NOT EXISTS api_quota (
-            mes_ano TEXT PRIMARY KEY,
-            limite INTEGER DEFAULT 100,
-            usado INTEGER DEFAULT 0,
-            fecha_inicio DATETIME,
-            fecha_fin DATETIME
-        )''')
-        
-        # Crear índices
-        c.execute('CREATE INDEX IF NOT EXISTS idx_api_requests_fecha ON api_requests(fecha)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_api_requests_mes ON api_requests(mes_ano)')
-        
-        conn.commit()
-        conn.close()
+        with db.transaction() as conn:
+            c = conn.cursor()
+        
+            # Tabla principal de pisos
+            c.execute('''CREATE TABLE IF NOT EXISTS pisos (
+                id TEXT PRIMARY KEY,
+                titulo TEXT NOT NULL,
+                precio REAL,
+                precio_m2 REAL,
+                metros INTEGER,
+                habitaciones INTEGER,
+                planta TEXT,
+                exterior BOOLEAN,
+                estado TEXT,
+                link TEXT NOT NULL,
+                fecha_registro DATETIME DEFAULT CURRENT_TIMESTAMP,
+                fecha_actualizacion DATETIME DEFAULT CURRENT_TIMESTAMP
+            )''')
+        
+            # Tabla de historial de precios
+            c.execute('''CREATE TABLE IF NOT EXISTS historial_precios (
+                id_piso TEXT,
+                precio REAL,
+                fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (id_piso) REFERENCES pisos(id)
+            )''')
+        
+            # Crear índices para performance
+            c.execute('CREATE INDEX IF NOT EXISTS idx_pisos_precio ON pisos(precio)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_pisos_fecha ON pisos(fecha_actualizacion)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_historial_piso ON historial_precios(id_piso)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_historial_fecha ON historial_precios(fecha)')
+        
+            # Tabla de estadísticas de ejecución
+            c.execute('''CREATE TABLE IF NOT EXISTS ejecuciones (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fecha_inicio DATETIME DEFAULT CURRENT_TIMESTAMP,
+                fecha_fin DATETIME,
+                pisos_procesados INTEGER,
+                pisos_nuevos INTEGER,
+                pisos_modificados INTEGER,
+                errores INTEGER,
+                status TEXT
+            )''')
+        
+            # ⭐ NUEVA TABLA: Tracking de peticiones API (CRÍTICO)
+            c.execute('''CREATE TABLE IF NOT EXISTS api_requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fecha DATETIME DEFAULT CURRENT_TIMESTAMP,
+                endpoint TEXT,
+                tipo TEXT,
+                exitoso BOOLEAN,
+                mes_ano TEXT,
+                FOREIGN KEY (mes_ano) REFERENCES api_quota(mes_ano)
+            )''')
+        
+            # ⭐ NUEVA TABLA: Quota de API por mes (CRÍTICO: 100 requests/mes)
+            c.execute('''CREATE TABLE IF NOT EXISTS api_quota (
+                mes_ano TEXT PRIMARY KEY,
+                limite INTEGER DEFAULT 100,
+                usado INTEGER DEFAULT 0,
+                fecha_inicio DATETIME,
+                fecha_fin DATETIME
+            )''')
+        
+            # Crear índices
+            c.execute('CREATE INDEX IF NOT EXISTS idx_api_requests_fecha ON api_requests(fecha)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_api_requests_mes ON api_requests(mes_ano)')
+            
+            # Migración: peticiones por ejecución (rendimiento para el planificador)
+            db.ensure_column(conn, 'ejecuciones', 'peticiones', 'INTEGER')
+            db.ensure_column(conn, 'ejecuciones', 'peticiones_ahorradas', 'INTEGER')
+            
+            # Marcas de agua de la paginación incremental y perfiles de búsqueda
+            incremental.crear_tablas(conn)
+            perfiles.crear_tablas(conn)
+            
+            # Migración: operación (alquiler/venta) y zona (distrito o municipio) de cada piso
+            db.ensure_column(conn, 'pisos', 'operacion', 'TEXT')
+            db.ensure_column(conn, 'pisos', 'zona', 'TEXT')
+            
+            # Bajas: fecha de baja, días en el mercado y conjuntos de vistos por barrido
+            bajas.crear_tablas(conn)
+            
+            # Agregados de mercado para Metabase y puntuación de anomalías de precio
+            rollups.crear_tablas(conn)
+            anomalias.crear_tablas(conn)
+            geo.crear_tablas(conn)
+            dedup.crear_tablas(conn)
+            
+            # Reglas de alerta, suscripciones, cola persistente de notificaciones y caché de tokens OAuth
+            reglas.crear_tablas(conn)
+            suscripciones.crear_tablas(conn)
+            notificaciones.crear_tablas(conn)
+            token_cache.crear_tablas(conn)
+        
         logger.info("✅ Base de datos inicializada correctamente (CON QUOTA TRACKING)")
         
     except Exception as e:
@@ -269,29 +327,11 @@ def init_db():
         raise
 
 
-@retry_on_exception(max_retries=config.MAX_RETRIES, delay=config.RETRY_DELAY)
-def enviar_telegram(msg: str, notification_type: str = 'info'):
-    """Envía mensaje a Telegram con reintentos automáticos"""
-    if not config.ENABLE_TELEGRAM:
-        logger.debug("Telegram deshabilitado, skip")
-        return
-    
+def enviar_telegram(msg: str, notification_type: str = 'info', chat_id: Optional[str] = None,
+                    no_antes: Optional[float] = None):
+    """Encola un mensaje de Telegram (por defecto a TELEGRAM_CHAT_ID); lo envía el trabajador en segundo plano"""
     try:
-        url = f"https://api.telegram.org/bot{config.TELEGRAM_TOKEN}/sendMessage"
-        payload = {
-            'chat_id': config.TELEGRAM_CHAT_ID,
-            'text': msg,
-            'parse_mode': 'HTML'
-        }
-        
-        response = requests.post(url, data=payload, timeout=config.TELEGRAM_TIMEOUT)
-        response.raise_for_status()
-        
-        log_event(logger, 'TELEGRAM_SENT', {
-            'notification_type': notification_type,
-            'length': len(msg)
-        })
-        
+        notificaciones.encolar(msg, tipo=notification_type, chat_id=chat_id, no_antes=no_antes)
     except Exception as e:
         log_event(logger, 'TELEGRAM_ERROR', {
             'error': str(e),
@@ -300,8 +340,13 @@ def enviar_telegram(msg: str, notification_type: str = 'info'):
 
 
 @retry_on_exception(max_retries=config.MAX_RETRIES, delay=config.RETRY_DELAY)
-def obtener_token() -> Optional[str]:
-    """Obtiene token OAuth de Idealista - ⭐ REGISTRA PETICIÓN API"""
+def solicitar_token() -> Optional[Tuple[str, int]]:
+    """
+    Pide un token OAuth nuevo a Idealista - ⭐ REGISTRA PETICIÓN API
+    
+    Returns:
+        (access_token, expires_in) o None si falla
+    """
     try:
         credenciales = f"{config.IDEALISTA_API_KEY}:{config.IDEALISTA_SECRET}"
         auth_b64 = base64.b64encode(credenciales.encode()).decode()
@@ -312,20 +357,17 @@ def obtener_token() -> Optional[str]:
         }
         
         logger.debug("Solicitando token OAuth...")
-        response = requests.post(
+        response = _post_con_quota(
             config.IDEALISTA_TOKEN_URL,
+            'token',
             headers=headers,
-            data={"grant_type": "client_credentials", "scope": "read"},
-            timeout=config.REQUEST_TIMEOUT
+            data={"grant_type": "client_credentials", "scope": "read"}
         )
         
-        # ⭐ REGISTRAR PETICIÓN API
-        track_api_request(exitoso=(response.status_code == 200), tipo='token')
-        
         if response.status_code == 200:
-            token = response.json().get('access_token')
+            data = response.json()
             logger.debug("Token obtenido correctamente")
-            return token
+            return data.get('access_token'), int(data.get('expires_in', 0))
         
         logger.error(f"Error obteniendo token ({response.status_code}): {response.text}")
         return None
@@ -335,246 +377,486 @@ def obtener_token() -> Optional[str]:
         raise
 
 
-def buscar_pisos() -> Dict:
+# ⭐ Token reutilizado entre ciclos y reinicios: solo se pide (y gasta quota) al caducar
+_token_cache = token_cache.TokenCache('idealista', solicitar_token)
+
+
+def obtener_token() -> Optional[str]:
+    """Devuelve un token OAuth válido de Idealista (cacheado)"""
+    return _token_cache.obtener()
+
+
+def _post_busqueda(params: Dict):
     """
-    ⭐ CRÍTICO: Busca pisos en Idealista con control de quota
-    - Verifica quota antes de buscar
-    - Registra cada petición
-    - Pausa automáticamente si se alcanza límite
+    Lanza una petición de búsqueda; si el token es rechazado (401)
+    lo invalida y reintenta una vez con uno nuevo
     """
-    estadisticas = {
+    for intento in range(2):
+        token = obtener_token()
+        if not token:
+            raise RuntimeError("No se pudo obtener token")
+        
+        response = _post_con_quota(
+            config.IDEALISTA_API_URL,
+            'search',
+            headers={"Authorization": f"Bearer {token}"},
+            data=params
+        )
+        
+        if response.status_code != 401 or intento == 1:
+            return response
+        
+        logger.warning("Token rechazado (401): solicitando uno nuevo")
+        _token_cache.invalidar()
+
+
+def _estadisticas_vacias() -> Dict:
+    return {
         'total_procesados': 0,
         'totales_nuevos': 0,
         'totales_modificados': 0,
         'errores': 0,
+        'peticiones': 0,
+        'peticiones_ahorradas': 0,
         'status': 'success',
-        'quota_alcanzada': False
+        'quota_alcanzada': False,
+        'omitida': False,
+        'barrido_completo': False,
+        'bajas': 0
     }
+
+
+def buscar_pisos(max_paginas: Optional[int] = None) -> Dict:
+    """
+    ⭐ CRÍTICO: Busca pisos en Idealista con control de quota
+    - Verifica quota antes de buscar
+    - Lanza todos los perfiles en paralelo (pool acotado) contra la quota compartida
+    - Registra cada petición
+    - Pausa automáticamente si se alcanza límite
+    
+    Args:
+        max_paginas: Páginas a pedir por perfil (por defecto las que decida el planificador)
+    """
+    estadisticas = _estadisticas_vacias()
     
     try:
-        # ⭐ VERIFICAR QUOTA PRIMERO
-        if not should_search_now():
+        # ⭐ VERIFICAR QUOTA Y PLAN PRIMERO
+        plan = _planificador.planificar()
+        log_event(logger, 'SEARCH_PLAN', planificador.plan_para_log(plan))
+        if not should_search_now(plan):
             logger.info("Búsqueda saltada: próxima búsqueda no es ahora")
+            estadisticas['omitida'] = True
             return estadisticas
+        paginas = max_paginas or plan['paginas']
         
         logger.info("=== INICIANDO BÚSQUEDA DE PISOS ===")
         
-        token = obtener_token()
-        if not token:
+        if not obtener_token():
             logger.error("No se pudo obtener token")
             estadisticas['status'] = 'error'
             return estadisticas
         
-        headers = {"Authorization": f"Bearer {token}"}
-        
-        for num_pagina in range(1, config.MAX_PAGES_PER_DAY + 1):
-            logger.info(f"Solicitando página {num_pagina}...")
-            
-            params = {
-                "country": "es",
-                "operation": "rent",
-                "propertyType": "homes",
-                "center": f"{config.SEARCH_LATITUDE},{config.SEARCH_LONGITUDE}",
-                "distance": config.SEARCH_RADIUS,
-                "sort": "asc",
-                "maxItems": config.ITEMS_PER_PAGE,
-                "numPage": num_pagina,
-                "bedrooms": ','.join(config.SEARCH_BEDROOMS),
-                "bathrooms": ','.join(config.SEARCH_BATHROOMS),
-                "hasMultimedia": "true"
-            }
-            
-            try:
-                response = requests.post(
-                    config.IDEALISTA_API_URL,
-                    headers=headers,
-                    data=params,
-                    timeout=config.REQUEST_TIMEOUT
-                )
-                
-                # ⭐ REGISTRAR PETICIÓN API
-                track_api_request(exitoso=(response.status_code == 200), tipo='search')
-                
-                # ⭐ VERIFICAR QUOTA DESPUÉS DE CADA PETICIÓN
-                puede, usado, limite = check_api_quota()
-                if not puede:
-                    logger.critical(f"❌ QUOTA AGOTADA ({usado}/{limite})")
-                    estadisticas['quota_alcanzada'] = True
-                    break
-                
-                if response.status_code != 200:
-                    logger.error(f"Error API ({response.status_code}): {response.text}")
+        lista_perfiles = perfiles.cargar_perfiles()
+        global _num_perfiles
+        _num_perfiles = len(lista_perfiles)
+        vistos = perfiles.VistosCiclo()
+        completos = 0
+        ejecucion = archivo.iniciar_ejecucion() if config.ENABLE_ARCHIVE else None
+        
+        # ⭐ BARRIDO COMPLETO PERIÓDICO: sin él, en modo incremental nunca se detectan bajas
+        completo = bajas.toca_barrido_completo()
+        if completo:
+            logger.info("🏁 Barrido completo programado: se pagina sin parada incremental")
+        
+        with ThreadPoolExecutor(max_workers=config.PROFILE_WORKERS,
+                                thread_name_prefix='perfil') as pool:
+            futuros = {pool.submit(buscar_perfil, perfil, paginas, vistos, ejecucion, completo):
+                       perfil['nombre'] for perfil in lista_perfiles}
+            for futuro in as_completed(futuros):
+                try:
+                    parcial = futuro.result()
+                except Exception as e:
+                    logger.error(f"Error en perfil {futuros[futuro]}: {e}", exc_info=True)
                     estadisticas['errores'] += 1
-                    break
-                
-                data = response.json()
-                pisos = data.get('elementList', [])
-                total_disponible = data.get('total', 0)
-                total_paginas = data.get('totalPages', 1)
-                
-                logger.info(f"Página {num_pagina}: {len(pisos)} pisos (Total: {total_disponible})")
-                
-                if not pisos:
-                    logger.info("No hay más pisos disponibles")
-                    break
-                
-                nuevos, modificados = procesar_lote(pisos)
-                estadisticas['total_procesados'] += len(pisos)
-                estadisticas['totales_nuevos'] += nuevos
-                estadisticas['totales_modificados'] += modificados
-                
-                if num_pagina >= total_paginas:
-                    logger.info("Fin de resultados disponibles")
-                    break
-                
-                time.sleep(config.PAGE_WAIT_TIME)
-                
+                    continue
+                for clave in ('total_procesados', 'totales_nuevos', 'totales_modificados',
+                              'errores', 'peticiones', 'peticiones_ahorradas'):
+                    estadisticas[clave] += parcial[clave]
+                estadisticas['quota_alcanzada'] |= parcial['quota_alcanzada']
+                completos += parcial['barrido_completo']
+        
+        # ⭐ BAJAS: solo si todos los perfiles recorrieron sus resultados enteros
+        estadisticas['barrido_completo'] = completos == len(lista_perfiles)
+        fecha_fin = lotes.fecha_actual()
+        if config.ENABLE_DELISTING:
+            try:
+                estadisticas['bajas'] = bajas.cerrar_barrido(
+                    vistos.ids(), estadisticas['barrido_completo'], fecha_fin)['bajas']
             except Exception as e:
-                logger.error(f"Error procesando página {num_pagina}: {e}", exc_info=True)
-                estadisticas['errores'] += 1
-                break
+                logger.error(f"Error detectando bajas: {e}", exc_info=True)
+                metrics.ERRORES.labels('bd').inc()
+        if ejecucion is not None:
+            archivo.cerrar_ejecucion(ejecucion, estadisticas['barrido_completo'], fecha_fin)
         
         logger.info(
             f"=== FIN DE BÚSQUEDA === "
+            f"Perfiles: {len(lista_perfiles)}, "
             f"Nuevos: {estadisticas['totales_nuevos']}, "
-            f"Modificados: {estadisticas['totales_modificados']}"
+            f"Modificados: {estadisticas['totales_modificados']}, "
+            f"Bajas: {estadisticas['bajas']}, "
+            f"Peticiones ahorradas: {estadisticas['peticiones_ahorradas']}"
         )
         
-        # ⭐ MOSTRAR STATUS DE QUOTA AL FINAL
+        log_event(logger, 'HTTP_STATS', http_client.estadisticas(), level='debug')
+        
+        # ⭐ MOSTRAR STATUS DE QUOTA AL FINAL (dentro del resumen si el chat por defecto lo tiene)
         puede, usado, limite = check_api_quota()
-        if puede:
-            enviar_telegram(get_quota_status_message(), notification_type='info')
+        estado_quota = get_quota_status_message() if puede else None
+        if not enviar_resumenes(estado_quota) and estado_quota:
+            enviar_telegram(estado_quota, notification_type='info')
+        
+    except quota.QuotaAgotada as e:
+        logger.critical(f"❌ {e}")
+        estadisticas['quota_alcanzada'] = True
         
     except Exception as e:
         logger.error(f"Error crítico en búsqueda: {e}", exc_info=True)
+        metrics.ERRORES.labels('busqueda').inc()
         estadisticas['status'] = 'error'
     
     return estadisticas
 
 
+def buscar_perfil(perfil: Dict, paginas: int, vistos: perfiles.VistosCiclo,
+                  ejecucion: Optional[int] = None, completo: bool = False) -> Dict:
+    """
+    Pagina la búsqueda de un perfil y procesa cada página
+    
+    Args:
+        perfil: Perfil de búsqueda (perfiles.cargar_perfiles)
+        paginas: Máximo de páginas a pedir
+        vistos: Ids ya procesados en este ciclo por otros perfiles
+        ejecucion: Id de la ejecución en el archivo de respuestas (None = no archivar)
+        completo: Paginar sin parada incremental (barrido completo para detectar bajas)
+    """
+    estadisticas = _estadisticas_vacias()
+    nombre = perfil['nombre']
+    
+    # ⭐ MODO INCREMENTAL: ordenar por recencia y parar al alcanzar lo ya conocido
+    incremental_activo = config.SEARCH_MODE == 'incremental' and not completo
+    marca = incremental.cargar_marca(nombre) if incremental_activo else None
+    ids_perfil = set()
+    
+    for num_pagina in range(1, paginas + 1):
+        logger.info(f"[{nombre}] Solicitando página {num_pagina}...")
+        
+        params = perfiles.parametros_busqueda(perfil, num_pagina)
+        if incremental_activo:
+            params["order"] = config.INCREMENTAL_ORDER
+            params["sort"] = "desc"
+        
+        try:
+            estadisticas['peticiones'] += 1
+            response = _post_busqueda(params)
+            
+            if response.status_code != 200:
+                logger.error(f"[{nombre}] Error API ({response.status_code}): {response.text}")
+                metrics.ERRORES.labels('api').inc()
+                estadisticas['errores'] += 1
+                break
+            
+            # ⭐ ARCHIVO: la respuesta cruda completa, antes de quedarnos con unos campos
+            fecha = lotes.fecha_actual()
+            if ejecucion is not None:
+                try:
+                    archivo.guardar(ejecucion, nombre, num_pagina, response.content, fecha)
+                except Exception as e:
+                    logger.warning(f"[{nombre}] No se pudo archivar la página {num_pagina}: {e}")
+                    metrics.ERRORES.labels('archivo').inc()
+            
+            data = response.json()
+            pisos = data.get('elementList', [])
+            total_disponible = data.get('total', 0)
+            total_paginas = data.get('totalPages', 1)
+            
+            logger.info(f"[{nombre}] Página {num_pagina}: {len(pisos)} pisos (Total: {total_disponible})")
+            
+            if not pisos:
+                logger.info(f"[{nombre}] No hay más pisos disponibles")
+                estadisticas['barrido_completo'] = len(ids_perfil) >= total_disponible
+                break
+            
+            ids_pagina = [str(p.get('propertyCode')) for p in pisos]
+            ids_perfil.update(ids_pagina)
+            # ⭐ DEDUP ENTRE PERFILES: cada piso se procesa una sola vez por ciclo
+            propios = set(vistos.reclamar(ids_pagina))
+            lote = [p for p, pid in zip(pisos, ids_pagina) if pid in propios]
+            for p in lote:
+                p.setdefault('operation', perfil['operacion'])
+            
+            diff = procesar_lote_diff(lote, fecha)
+            vistos.registrar(propios, incremental.novedades(diff))
+            estadisticas['total_procesados'] += len(lote)
+            estadisticas['totales_nuevos'] += len(diff['nuevos'])
+            estadisticas['totales_modificados'] += len(diff['bajadas']) + len(diff['subidas'])
+            
+            if incremental_activo and num_pagina == 1:
+                incremental.guardar_marca(ids_pagina[0], nombre)
+            
+            if num_pagina >= total_paginas:
+                logger.info(f"[{nombre}] Fin de resultados disponibles")
+                # Completo si no se perdió ningún piso al moverse entre páginas
+                estadisticas['barrido_completo'] = len(ids_perfil) >= total_disponible
+                break
+            
+            # ⭐ VERIFICAR QUOTA DESPUÉS DE CADA PETICIÓN
+            puede, usado, limite = check_api_quota()
+            if not puede:
+                logger.critical(f"❌ QUOTA AGOTADA ({usado}/{limite})")
+                estadisticas['quota_alcanzada'] = True
+                break
+            
+            # Los pisos de la página que procesó otro perfil también cuentan para parar
+            ajenos = vistos.cambios(pid for pid in ids_pagina if pid not in propios)
+            if incremental_activo and incremental.pagina_al_dia(ids_pagina, diff, marca, ajenos=ajenos):
+                ahorradas = min(paginas, total_paginas) - num_pagina
+                estadisticas['peticiones_ahorradas'] = ahorradas
+                log_event(logger, 'INCREMENTAL_STOP', {
+                    'perfil': nombre,
+                    'pagina': num_pagina,
+                    'peticiones_ahorradas': ahorradas
+                })
+                logger.info(f"[{nombre}] ✅ Al día en la página {num_pagina}: "
+                            f"{ahorradas} peticiones ahorradas")
+                break
+            
+            time.sleep(config.PAGE_WAIT_TIME)
+            
+        except quota.QuotaAgotada as e:
+            logger.critical(f"❌ {e}")
+            estadisticas['quota_alcanzada'] = True
+            break
+            
+        except Exception as e:
+            logger.error(f"[{nombre}] Error procesando página {num_pagina}: {e}", exc_info=True)
+            metrics.ERRORES.labels('pagina').inc()
+            estadisticas['errores'] += 1
+            break
+    
+    return estadisticas
+
+
 def procesar_lote(pisos: List[Dict]) -> Tuple[int, int]:
     """Procesa un lote de pisos y los almacena en BD"""
-    nuevos = 0
-    modificados = 0
+    diff = procesar_lote_diff(pisos)
+    return len(diff['nuevos']), len(diff['bajadas']) + len(diff['subidas'])
+
+
+def persistir_lote(conn, filas: List[Dict], fecha: str) -> Dict[str, List[Dict]]:
+    """
+    Clasifica y guarda una página ya parseada dentro de la transacción abierta
+    (pisos, historial, puntuación de anomalía, celda, cluster de duplicados y
+    agregados de mercado y por celda). Sin notificaciones: lo comparten procesar_lote_diff y la
+    reproducción del archivo (replay.py).
+    """
+    # ⭐ z-score de precio/m² frente a su cohorte, con las estadísticas en memoria
+    anomalias.puntuar_lote(conn, filas)
+    geo.asignar_celdas(filas)
+    diff = lotes.aplicar_lote(conn, filas, fecha)
+    anomalias.registrar_lote(conn, diff)
+    if config.ENABLE_DEDUP:
+        # ⭐ Mismo piso con otro propertyCode: cluster por MinHash/LSH (anota duplicado_de)
+        dedup.agrupar_lote(conn, diff['nuevos'])
+    if diff['nuevos'] or diff['bajadas'] or diff['subidas']:
+        # ⭐ Agregados de Metabase al día, en la misma transacción
+        rollups.actualizar_lote(conn, fecha)
+    if filas:
+        # También sin cambios de precio: pisos antiguos que reciben ahora sus coordenadas
+        geo.actualizar_lote(conn)
+    return diff
+
+
+def procesar_lote_diff(pisos: List[Dict], fecha: Optional[str] = None) -> Dict[str, List[Dict]]:
+    """
+    Procesa un lote de pisos y devuelve el diff clasificado
+    (nuevos, bajadas, subidas, sin_cambios) para consumidores posteriores.
+    La transacción se cierra antes de enviar ninguna notificación.
+    
+    Args:
+        pisos: Elementos de `elementList`
+        fecha: Marca temporal a registrar (por defecto ahora, UTC)
+    """
+    t0 = time.perf_counter()
+    diff = {clase: [] for clase in lotes.CLASES}
+    
+    filas = []
+    for p in pisos:
+        try:
+            filas.append(lotes.parsear_piso(p))
+        except Exception as e:
+            logger.warning(f"Error procesando piso {p.get('propertyCode')}: {e}")
     
     try:
-        conn = sqlite3.connect(str(config.DB_PATH))
-        c = conn.cursor()
-        
-        for p in pisos:
-            try:
-                pid = str(p.get('propertyCode'))
-                titulo = p.get('suggestedTexts', {}).get('title', 'Sin título')
-                precio = p.get('price')
-                metros = p.get('size')
-                habitaciones = p.get('rooms')
-                planta = p.get('floor', 'Bajo')
-                exterior = p.get('exterior', False)
-                link = p.get('url', '')
-                
-                precio_m2 = p.get('priceByArea')
-                if not precio_m2 and metros and precio:
-                    precio_m2 = round(precio / metros, 1)
-                
-                c.execute("SELECT precio FROM pisos WHERE id=?", (pid,))
-                row = c.fetchone()
-                
-                if not row:
-                    c.execute("""INSERT INTO pisos 
-                                 (id, titulo, precio, precio_m2, metros, habitaciones, 
-                                  planta, exterior, link, fecha_registro, fecha_actualizacion) 
-                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'), datetime('now'))""",
-                              (pid, titulo, precio, precio_m2, metros, habitaciones, planta, exterior, link))
-                    c.execute("INSERT INTO historial_precios VALUES (?, ?, datetime('now'))", (pid, precio))
-                    
-                    msg = (
-                        f"🆕 <b>NOVEDAD ({precio}€)</b>\n"
-                        f"🏠 {titulo}\n"
-                        f"🛏️ {habitaciones} hab | 📏 {metros}m² | 💰 {precio_m2}€/m²\n"
-                        f"<a href='{link}'>🔗 Ver en Idealista</a>"
-                    )
-                    enviar_telegram(msg, notification_type='new')
-                    nuevos += 1
-                    
-                elif precio and precio < row[0]:
-                    diff = row[0] - precio
-                    c.execute("UPDATE pisos SET precio=?, precio_m2=?, fecha_actualizacion=datetime('now') WHERE id=?", 
-                             (precio, precio_m2, pid))
-                    c.execute("INSERT INTO historial_precios VALUES (?, ?, datetime('now'))", (pid, precio))
-                    
-                    msg = (
-                        f"📉 <b>BAJADA DE PRECIO (-{diff}€)</b>\n"
-                        f"🏠 {titulo}\n"
-                        f"Antes: {row[0]}€ ➡️ {precio}€\n"
-                        f"<a href='{link}'>🔗 Ver piso</a>"
-                    )
-                    enviar_telegram(msg, notification_type='warning')
-                    modificados += 1
-                
-                elif precio and precio > row[0]:
-                    c.execute("UPDATE pisos SET precio=?, fecha_actualizacion=datetime('now') WHERE id=?", 
-                             (precio, pid))
-                    c.execute("INSERT INTO historial_precios VALUES (?, ?, datetime('now'))", (pid, precio))
-                    modificados += 1
-                    
-            except Exception as e:
-                logger.warning(f"Error procesando piso {p.get('propertyCode')}: {e}")
-                continue
-        
-        conn.commit()
-        conn.close()
-        
-        if nuevos > 0 or modificados > 0:
-            logger.info(f"✨ Procesado: {nuevos} nuevos, {modificados} modificados")
-        
+        with db.transaction() as conn:
+            diff = persistir_lote(conn, filas, fecha or lotes.fecha_actual())
     except Exception as e:
         logger.error(f"Error procesando lote: {e}", exc_info=True)
+        metrics.ERRORES.labels('bd').inc()
+        # El modelo de anomalías pudo contar la página deshecha: se recarga de la BD
+        anomalias.invalidar()
+        return diff
+    
+    # ⭐ Reglas de alerta compiladas, evaluadas sobre toda la página
+    # (las de por defecto: novedades que no son duplicados y bajadas)
+    alertas = reglas.evaluar_lote(diff)
+    indice = suscripciones.indice(db.get_connection()) if alertas else None
+    # ⭐ PRIORIDAD: por evento, primero lo más barato respecto a su mercado
+    orden_eventos = list(reglas.EVENTOS)
+    for alerta in sorted(alertas, key=lambda a: (orden_eventos.index(a['evento']), _prioridad(a['fila']))):
+        mensaje, tipo = _MENSAJES[alerta['evento']]
+        texto = mensaje(alerta['fila'], alerta['reglas'])
+        # ⭐ FAN-OUT: índice invertido de suscripciones, sin recorrer todos los chats
+        for s in indice.suscriptores(alerta['evento'], alerta['fila']):
+            # ⭐ DIGEST: al resumen del final de la ejecución (en híbrido, salvo lo más relevante)
+            if s.modo == suscripciones.DIGEST or (s.modo == suscripciones.HIBRIDO
+                                                  and not digest.inmediato(s, alerta)):
+                digest.acumular(s, alerta)
+            else:
+                enviar_telegram(texto, notification_type=tipo, chat_id=s.chat_id,
+                                no_antes=suscripciones.fin_silencio(s))
+        for nombre in alerta['reglas']:
+            metrics.ALERTAS.labels(nombre).inc()
     
-    return nuevos, modificados
+    duplicados = sum(1 for fila in diff['nuevos'] if fila.get('duplicado_de'))
+    nuevos = len(diff['nuevos'])
+    modificados = len(diff['bajadas']) + len(diff['subidas'])
+    if nuevos > 0 or modificados > 0:
+        logger.info(f"✨ Procesado: {nuevos} nuevos ({duplicados} duplicados), {modificados} modificados")
+    
+    metrics.PISOS_NUEVOS.inc(nuevos)
+    metrics.PISOS_DUPLICADOS.inc(duplicados)
+    metrics.BAJADAS_PRECIO.inc(len(diff['bajadas']))
+    metrics.PROCESADO_PAGINA.observe(time.perf_counter() - t0)
+    return diff
+
+
+def _prioridad(fila: Dict) -> float:
+    """Orden de envío: puntuación de anomalía ascendente (sin puntuación al final)"""
+    z = fila.get('puntuacion_anomalia')
+    return z if z is not None else float('inf')
+
+
+def _linea_anomalia(fila: Dict) -> str:
+    z = fila.get('puntuacion_anomalia')
+    if z is None or z > config.ANOMALY_Z_THRESHOLD:
+        return ""
+    return f"🔥 Muy por debajo de su mercado (z = {z:.1f})\n"
+
+
+def _linea_reglas(nombres: List[str]) -> str:
+    """Reglas de usuario que ha cumplido el piso (las de por defecto no se nombran)"""
+    propias = [n for n in nombres if n not in reglas.REGLAS_DEFECTO]
+    return f"🔔 {', '.join(propias)}\n" if propias else ""
+
+
+def _mensaje_novedad(fila: Dict, nombres: List[str] = ()) -> str:
+    return (
+        f"🆕 <b>NOVEDAD ({fila['precio']}€)</b>\n"
+        f"🏠 {fila['titulo']}\n"
+        f"🛏️ {fila['habitaciones']} hab | 📏 {fila['metros']}m² | 💰 {fila['precio_m2']}€/m²\n"
+        f"{_linea_anomalia(fila)}"
+        f"{_linea_reglas(nombres)}"
+        f"<a href='{fila['link']}'>🔗 Ver en Idealista</a>"
+    )
+
+
+def _mensaje_bajada(fila: Dict, nombres: List[str] = ()) -> str:
+    diff = fila['precio_anterior'] - fila['precio']
+    return (
+        f"📉 <b>BAJADA DE PRECIO (-{diff}€)</b>\n"
+        f"🏠 {fila['titulo']}\n"
+        f"Antes: {fila['precio_anterior']}€ ➡️ {fila['precio']}€\n"
+        f"{_linea_anomalia(fila)}"
+        f"{_linea_reglas(nombres)}"
+        f"<a href='{fila['link']}'>🔗 Ver piso</a>"
+    )
+
+
+def _mensaje_subida(fila: Dict, nombres: List[str] = ()) -> str:
+    diff = fila['precio'] - fila['precio_anterior']
+    return (
+        f"📈 <b>SUBIDA DE PRECIO (+{diff}€)</b>\n"
+        f"🏠 {fila['titulo']}\n"
+        f"Antes: {fila['precio_anterior']}€ ➡️ {fila['precio']}€\n"
+        f"{_linea_reglas(nombres)}"
+        f"<a href='{fila['link']}'>🔗 Ver piso</a>"
+    )
+
+
+# Evento de reglas.py -> (mensaje, tipo de notificación)
+_MENSAJES = {
+    'nuevo': (_mensaje_novedad, 'new'),
+    'bajada': (_mensaje_bajada, 'warning'),
+    'subida': (_mensaje_subida, 'info'),
+}
 
 
 def backup_database():
-    """Realiza backup de la base de datos SQLite"""
+    """Realiza backup de la base de datos SQLite (ver backup.py)"""
     if not config.ENABLE_BACKUPS:
         return
     
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_path = config.BACKUP_DIR / f"pisos_backup_{timestamp}.db"
+        # ⭐ Instantánea online e incremental: solo se guardan las páginas que cambiaron
+        resumen = backup.crear()
+        logger.info(f"Backup realizado: instantánea {resumen['id']} "
+                    f"({resumen['paginas_nuevas']}/{resumen['num_paginas']} páginas nuevas, "
+                    f"{resumen['bytes_nuevos'] / 1024:.0f} KB)")
         
-        shutil.copy2(str(config.DB_PATH), str(backup_path))
-        logger.info(f"Backup realizado: {backup_path}")
-        
-        for backup_file in sorted(config.BACKUP_DIR.glob("pisos_backup_*.db"))[:-7]:
-            backup_file.unlink()
-            logger.debug(f"Backup antiguo eliminado: {backup_file}")
+        backup.podar(config.BACKUP_KEEP)
         
     except Exception as e:
         logger.error(f"Error realizando backup: {e}", exc_info=True)
 
 
 def registrar_ejecucion(estadisticas: Dict):
-    """Registra la ejecución en BD para monitoreo"""
+    """Registra la ejecución en BD para monitoreo (las búsquedas omitidas no cuentan)"""
+    if estadisticas.get('omitida'):
+        return
+    
     try:
-        conn = sqlite3.connect(str(config.DB_PATH))
-        c = conn.cursor()
-        
-        c.execute("""INSERT INTO ejecuciones 
-                     (fecha_fin, pisos_procesados, pisos_nuevos, pisos_modificados, errores, status)
-                     VALUES (datetime('now'), ?, ?, ?, ?, ?)""",
-                  (estadisticas['total_procesados'],
-                   estadisticas['totales_nuevos'],
-                   estadisticas['totales_modificados'],
-                   estadisticas['errores'],
-                   estadisticas['status']))
-        
-        conn.commit()
-        conn.close()
+        with db.transaction() as conn:
+            conn.execute("""INSERT INTO ejecuciones 
+                            (fecha_fin, pisos_procesados, pisos_nuevos, pisos_modificados, errores,
+                             peticiones, peticiones_ahorradas, status)
+                            VALUES (datetime('now'), ?, ?, ?, ?, ?, ?, ?)""",
+                         (estadisticas['total_procesados'],
+                          estadisticas['totales_nuevos'],
+                          estadisticas['totales_modificados'],
+                          estadisticas['errores'],
+                          estadisticas.get('peticiones', 0),
+                          estadisticas.get('peticiones_ahorradas', 0),
+                          estadisticas['status']))
         
     except Exception as e:
         logger.error(f"Error registrando ejecución: {e}", exc_info=True)
 
 
+def enviar_resumenes(estado_quota: Optional[str] = None) -> bool:
+    """
+    Envía los resúmenes de la ejecución (suscripciones en modo digest o híbrido)
+
+    Returns:
+        True si `estado_quota` fue al final del resumen del chat por defecto
+    """
+    con_pie = False
+    for s, texto in digest.resumenes(estado_quota):
+        con_pie |= s.chat_id is None and bool(estado_quota)
+        enviar_telegram(texto, notification_type='info', chat_id=s.chat_id,
+                        no_antes=suscripciones.fin_silencio(s))
+    return con_pie
+
+
 def health_check() -> bool:
     """Verifica que todo esté funcionando correctamente"""
     try:
@@ -582,11 +864,9 @@ def health_check() -> bool:
             logger.error("BD no existe")
             return False
         
-        conn = sqlite3.connect(str(config.DB_PATH))
-        c = conn.cursor()
-        c.execute("SELECT 1 FROM pisos LIMIT 1")
-        c.execute("SELECT 1 FROM api_quota LIMIT 1")
-        conn.close()
+        conn = db.get_connection()
+        conn.execute("SELECT 1 FROM pisos LIMIT 1")
+        conn.execute("SELECT 1 FROM api_quota LIMIT 1")
         
         valid, msg = config.validate_config()
         if not valid:
@@ -602,6 +882,7 @@ def health_check() -> bool:
 
 
 if __name__ == "__main__":
+    trabajador_telegram = None
     try:
         valid_config, config_error = config.validate_config()
         if not valid_config:
@@ -614,9 +895,23 @@ if __name__ == "__main__":
             logger.error("Health check fallido al iniciar")
             exit(1)
         
+        trabajador_telegram = notificaciones.TrabajadorTelegram()
+        if config.ENABLE_TELEGRAM:
+            trabajador_telegram.start()
+        
+        if config.METRICS_ENABLED:
+            metrics.iniciar_servidor(config.METRICS_PORT)
+        
         logger.info("🚀 Bot iniciado correctamente (CON CONTROL DE QUOTA)")
         logger.info(f"⭐ Límite API: {config.MONTHLY_REQUEST_LIMIT} peticiones/mes")
-        logger.info(f"⭐ Intervalo búsqueda: cada {config.SEARCH_INTERVAL_HOURS} horas")
+        if config.ADAPTIVE_SCHEDULING:
+            logger.info("⭐ Intervalo búsqueda: adaptativo según quota restante")
+        else:
+            logger.info(f"⭐ Intervalo búsqueda: cada {config.SEARCH_INTERVAL_HOURS} horas")
+        if (config.SEARCH_MODE == 'incremental' and config.ENABLE_DELISTING
+                and config.DELISTING_FULL_SWEEP_EVERY <= 0):
+            logger.warning("⚠️  SEARCH_MODE=incremental con DELISTING_FULL_SWEEP_EVERY=0: "
+                           "los barridos nunca son completos y no se detectarán bajas")
         
         contador_ciclos = 0
         while True:
@@ -628,6 +923,9 @@ if __name__ == "__main__":
                 backup_database()
                 registrar_ejecucion(estadisticas)
                 
+                # ⭐ AUDITORÍA: el ledger debe cuadrar con api_requests
+                _quota.reconciliar()
+                
                 logger.info(
                     f"📊 Resumen: Nuevos={estadisticas['totales_nuevos']}, "
                     f"Modificados={estadisticas['totales_modificados']}, "
@@ -643,9 +941,20 @@ if __name__ == "__main__":
                 logger.error(f"Error en ciclo {contador_ciclos}: {e}", exc_info=True)
                 enviar_telegram(f"❌ Error en búsqueda: {str(e)}", notification_type='error')
             
-            # INTERVALO CONFIGURABLE (por defecto cada 3 días para economizar quota)
-            logger.info(f"💤 Esperando {config.SEARCH_INTERVAL_HOURS}h hasta próxima búsqueda...")
-            time.sleep(config.SEARCH_INTERVAL_HOURS * 3600)
+            # ⭐ INTERVALO ADAPTATIVO: según quota restante, días de mes y rendimiento
+            try:
+                plan = _planificador.planificar()
+                log_event(logger, 'SEARCH_PLAN', planificador.plan_para_log(plan))
+                espera = (plan['proxima_ejecucion'] - datetime.now()).total_seconds()
+                detalle = f"{plan['paginas']} páginas, {plan['disponible']} peticiones disponibles"
+            except Exception as e:
+                # Un fallo al planificar no para el bot: intervalo fijo y se reintenta
+                logger.error(f"Error planificando la próxima búsqueda: {e}", exc_info=True)
+                espera = config.SEARCH_INTERVAL_HOURS * 3600
+                detalle = "intervalo fijo por error al planificar"
+            espera = min(max(espera, 60), config.PLAN_MAX_SLEEP_HOURS * 3600)
+            logger.info(f"💤 Esperando {espera / 3600:.1f}h hasta próxima búsqueda ({detalle})...")
+            time.sleep(espera)
             
     except KeyboardInterrupt:
         logger.info("⏹️ Bot detenido por usuario")
@@ -653,3 +962,9 @@ if __name__ == "__main__":
     except Exception as e:
         logger.critical(f"Error crítico no recuperable: {e}", exc_info=True)
         exit(1)
+    finally:
+        # También si se para durante el arranque o por un error no recuperable
+        if trabajador_telegram and trabajador_telegram.is_alive():
+            trabajador_telegram.detener()
+        http_client.cerrar()
+        db.close_all()
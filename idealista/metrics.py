@@ -0,0 +1,249 @@
+"""
+Métricas Prometheus del bot, sin dependencias externas
+
+Contadores, gauges e histogramas en memoria (un lock por métrica, sin E/S
+en el bucle) y un endpoint /metrics en formato de texto 0.0.4 servido por un
+hilo aparte. Los gauges de quota se calculan al hacer scrape, no en el bucle.
+
+    with metrics.cronometrar(metrics.PROCESADO_PAGINA):
+        ...
+    metrics.ERRORES.labels('api').inc()
+"""
+import bisect
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger('idealista')
+
+BUCKETS_DEFECTO = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRO: List['_Metrica'] = []
+
+
+def _escapar(valor: str) -> str:
+    return valor.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _numero(valor: float) -> str:
+    if math.isinf(valor):
+        return '+Inf' if valor > 0 else '-Inf'
+    return repr(float(valor)) if not float(valor).is_integer() else str(int(valor))
+
+
+class _Valor:
+    """Valor de un contador o gauge (una combinación de etiquetas)"""
+
+    __slots__ = ('_lock', 'valor', 'funcion')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.valor = 0.0
+        self.funcion: Optional[Callable[[], float]] = None
+
+    def inc(self, cantidad: float = 1):
+        with self._lock:
+            self.valor += cantidad
+
+    def dec(self, cantidad: float = 1):
+        with self._lock:
+            self.valor -= cantidad
+
+    def set(self, valor: float):
+        self.valor = valor
+
+    def set_funcion(self, funcion: Callable[[], float]):
+        """El valor se calcula al hacer scrape"""
+        self.funcion = funcion
+
+    def leer(self) -> float:
+        return float(self.funcion()) if self.funcion else self.valor
+
+
+class _ValorHistograma:
+    """Cubos (no acumulados), suma y cuenta de un histograma"""
+
+    __slots__ = ('_lock', 'limites', 'cubos', 'suma', 'cuenta')
+
+    def __init__(self, limites: Tuple[float, ...]):
+        self._lock = threading.Lock()
+        self.limites = limites
+        self.cubos = [0] * (len(limites) + 1)
+        self.suma = 0.0
+        self.cuenta = 0
+
+    def observe(self, valor: float):
+        i = bisect.bisect_left(self.limites, valor)
+        with self._lock:
+            self.cubos[i] += 1
+            self.suma += valor
+            self.cuenta += 1
+
+    def leer(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            return list(self.cubos), self.suma, self.cuenta
+
+
+class _Metrica:
+    tipo = ''
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: Sequence[str] = ()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._lock = threading.Lock()
+        self._hijos: Dict[tuple, object] = {}
+        if not self.etiquetas:
+            self._hijos[()] = self._nuevo()
+        REGISTRO.append(self)
+
+    def _nuevo(self):
+        return _Valor()
+
+    def labels(self, *valores: str):
+        """Serie de la combinación de etiquetas dada (se crea la primera vez)"""
+        hijo = self._hijos.get(valores)
+        if hijo is None:
+            if len(valores) != len(self.etiquetas):
+                raise ValueError(f"{self.nombre}: se esperaban etiquetas {self.etiquetas}")
+            with self._lock:
+                hijo = self._hijos.setdefault(valores, self._nuevo())
+        return hijo
+
+    def _sin_etiquetas(self):
+        return self._hijos[()]
+
+    def _selector(self, valores: tuple, extra: str = '') -> str:
+        pares = [f'{k}="{_escapar(str(v))}"' for k, v in zip(self.etiquetas, valores)]
+        if extra:
+            pares.append(extra)
+        return '{' + ','.join(pares) + '}' if pares else ''
+
+    def _muestras(self) -> List[str]:
+        lineas = []
+        for valores, hijo in list(self._hijos.items()):
+            try:
+                lineas.append(f"{self.nombre}{self._selector(valores)} {_numero(hijo.leer())}")
+            except Exception as e:
+                logger.debug(f"Métrica {self.nombre} no disponible: {e}")
+        return lineas
+
+    def exponer(self) -> str:
+        cabecera = f"# HELP {self.nombre} {self.ayuda}\n# TYPE {self.nombre} {self.tipo}\n"
+        return cabecera + ''.join(l + '\n' for l in self._muestras())
+
+
+class Counter(_Metrica):
+    tipo = 'counter'
+
+    def inc(self, cantidad: float = 1):
+        self._sin_etiquetas().inc(cantidad)
+
+
+class Gauge(_Metrica):
+    tipo = 'gauge'
+
+    def set(self, valor: float):
+        self._sin_etiquetas().set(valor)
+
+    def inc(self, cantidad: float = 1):
+        self._sin_etiquetas().inc(cantidad)
+
+    def dec(self, cantidad: float = 1):
+        self._sin_etiquetas().dec(cantidad)
+
+    def set_funcion(self, funcion: Callable[[], float]):
+        self._sin_etiquetas().set_funcion(funcion)
+
+
+class Histogram(_Metrica):
+    tipo = 'histogram'
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: Sequence[str] = (),
+                 buckets: Sequence[float] = BUCKETS_DEFECTO):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(nombre, ayuda, etiquetas)
+
+    def _nuevo(self):
+        return _ValorHistograma(self.buckets)
+
+    def observe(self, valor: float):
+        self._sin_etiquetas().observe(valor)
+
+    def _muestras(self) -> List[str]:
+        lineas = []
+        for valores, hijo in list(self._hijos.items()):
+            cubos, suma, cuenta = hijo.leer()
+            acumulado = 0
+            for limite, n in zip(self.buckets + (math.inf,), cubos):
+                acumulado += n
+                le = f'le="{_numero(limite)}"'
+                lineas.append(f"{self.nombre}_bucket{self._selector(valores, le)} {acumulado}")
+            lineas.append(f"{self.nombre}_sum{self._selector(valores)} {_numero(suma)}")
+            lineas.append(f"{self.nombre}_count{self._selector(valores)} {cuenta}")
+        return lineas
+
+
+@contextmanager
+def cronometrar(histograma):
+    """Observa en el histograma (o serie) la duración del bloque en segundos"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        histograma.observe(time.perf_counter() - t0)
+
+
+def exponer() -> str:
+    """Todas las métricas en formato de texto de Prometheus"""
+    return ''.join(m.exponer() for m in REGISTRO)
+
+
+# --- MÉTRICAS DEL BOT ---
+PETICION_IDEALISTA = Histogram('idealista_request_duration_seconds',
+                               'Latencia de las peticiones a la API de Idealista', ('tipo',))
+PROCESADO_PAGINA = Histogram('idealista_page_processing_seconds',
+                             'Tiempo de procesar una página (parseo, upsert y encolado)')
+COMMIT_SQLITE = Histogram('idealista_sqlite_commit_seconds', 'Duración de los COMMIT de SQLite',
+                          buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                                   0.025, 0.05, 0.1, 0.25, 1.0))
+ENVIO_TELEGRAM = Histogram('idealista_telegram_send_duration_seconds',
+                           'Latencia de sendMessage de Telegram')
+PISOS_NUEVOS = Counter('idealista_listings_new_total', 'Pisos nuevos detectados')
+PISOS_DUPLICADOS = Counter('idealista_listings_duplicate_total', 'Pisos nuevos que duplican a uno activo')
+BAJADAS_PRECIO = Counter('idealista_price_drops_total', 'Bajadas de precio detectadas')
+ALERTAS = Counter('idealista_alerts_total', 'Alertas enviadas por regla', ('regla',))
+ERRORES = Counter('idealista_errors_total', 'Errores por origen', ('origen',))
+QUOTA_USADA = Gauge('idealista_quota_used', 'Peticiones a la API consumidas este mes')
+QUOTA_RESTANTE = Gauge('idealista_quota_remaining', 'Peticiones a la API que quedan este mes')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        cuerpo = exponer().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+
+def iniciar_servidor(puerto: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """Sirve /metrics en un hilo en segundo plano"""
+    servidor = ThreadingHTTPServer((host, puerto), _Handler)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"📈 Métricas Prometheus en http://{host}:{servidor.server_port}/metrics")
+    return servidor
@@ -0,0 +1,307 @@
+"""
+Cola persistente de notificaciones de Telegram
+
+Los mensajes se guardan en SQLite (`cola_telegram`) y un hilo en segundo
+plano los envía respetando los límites de Telegram (global y por chat),
+el `retry_after` de las respuestas 429 y reintentos con backoff. La
+búsqueda solo encola: nunca espera a Telegram.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+
+import config
+import db
+import http_client
+import metrics
+from utils import log_event
+
+logger = logging.getLogger('idealista')
+
+PENDIENTE = 'pendiente'
+ENVIADO = 'enviado'
+FALLIDO = 'fallido'
+
+LIMITE_MENSAJE = 4096  # caracteres de un mensaje de Telegram
+
+
+def crear_tablas(conn):
+    """Crea la tabla de la cola (llamado desde init_db)"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS cola_telegram (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id TEXT NOT NULL,
+        texto TEXT NOT NULL,
+        tipo TEXT,
+        estado TEXT DEFAULT 'pendiente',
+        intentos INTEGER DEFAULT 0,
+        proximo_intento REAL DEFAULT 0,
+        ultimo_error TEXT,
+        fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP,
+        fecha_envio DATETIME
+    )''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_cola_pendientes
+                    ON cola_telegram(estado, proximo_intento)''')
+
+
+def trocear(bloques: List[str], limite: int = LIMITE_MENSAJE, separador: str = '\n\n') -> List[str]:
+    """Agrupa bloques de texto en el menor número de mensajes de hasta `limite` caracteres"""
+    mensajes, actual = [], ''
+    for bloque in bloques:
+        if len(bloque) > limite:
+            # Un bloque que no cabe ni solo se corta (mejor que un 400 de Telegram)
+            bloque = bloque[:limite - 1] + '…'
+        if actual and len(actual) + len(separador) + len(bloque) > limite:
+            mensajes.append(actual)
+            actual = ''
+        actual = f"{actual}{separador}{bloque}" if actual else bloque
+    if actual:
+        mensajes.append(actual)
+    return mensajes
+
+
+_despertar = threading.Event()
+
+
+def encolar(texto: str, tipo: str = 'info', chat_id: Optional[str] = None,
+            no_antes: Optional[float] = None) -> Optional[int]:
+    """
+    Añade un mensaje a la cola y despierta al trabajador
+
+    Args:
+        chat_id: Destino (por defecto TELEGRAM_CHAT_ID)
+        no_antes: Epoch a partir del cual se puede enviar (horas de silencio)
+
+    Returns:
+        id del mensaje en la cola, o None si Telegram está deshabilitado
+    """
+    if not config.ENABLE_TELEGRAM:
+        logger.debug("Telegram deshabilitado, skip")
+        return None
+
+    with db.transaction() as conn:
+        cur = conn.execute(
+            "INSERT INTO cola_telegram (chat_id, texto, tipo, proximo_intento) VALUES (?, ?, ?, ?)",
+            (str(chat_id or config.TELEGRAM_CHAT_ID), texto, tipo, no_antes or 0))
+    _despertar.set()
+    return cur.lastrowid
+
+
+class LimitadorTelegram:
+    """
+    Límites de envío de Telegram
+
+    - Global: cubo de tokens de `por_segundo` mensajes/s
+    - Chat privado: un mensaje cada `intervalo_chat` segundos
+    - Grupo (chat_id negativo): `por_minuto_grupo` mensajes por minuto
+    - Bloqueos temporales por chat tras un 429 con retry_after
+    """
+
+    def __init__(self, por_segundo: float = config.TELEGRAM_GLOBAL_RATE,
+                 intervalo_chat: float = config.TELEGRAM_CHAT_INTERVAL,
+                 por_minuto_grupo: int = config.TELEGRAM_GROUP_PER_MINUTE,
+                 reloj: Callable[[], float] = time.monotonic):
+        self.por_segundo = por_segundo
+        self.intervalo_chat = intervalo_chat
+        self.por_minuto_grupo = por_minuto_grupo
+        self.reloj = reloj
+        self._tokens = float(por_segundo)
+        self._ultima_recarga = reloj()
+        self._envios_chat: Dict[str, deque] = {}
+        self._bloqueos: Dict[str, float] = {}
+
+    def _recargar(self, ahora: float):
+        transcurrido = ahora - self._ultima_recarga
+        self._tokens = min(self.por_segundo, self._tokens + transcurrido * self.por_segundo)
+        self._ultima_recarga = ahora
+
+    def espera_global(self) -> float:
+        """Segundos hasta que haya un token global disponible"""
+        self._recargar(self.reloj())
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.por_segundo
+
+    def espera_chat(self, chat_id: str) -> float:
+        """Segundos hasta que se pueda enviar a ese chat"""
+        ahora = self.reloj()
+        espera = max(0.0, self._bloqueos.get(chat_id, 0.0) - ahora)
+        envios = self._envios_chat.get(chat_id)
+        if envios:
+            if chat_id.startswith('-'):
+                while envios and ahora - envios[0] >= 60:
+                    envios.popleft()
+                if len(envios) >= self.por_minuto_grupo:
+                    espera = max(espera, envios[0] + 60 - ahora)
+            else:
+                espera = max(espera, envios[-1] + self.intervalo_chat - ahora)
+        return espera
+
+    def registrar(self, chat_id: str):
+        """Consume un token global y anota el envío en el chat"""
+        ahora = self.reloj()
+        self._recargar(ahora)
+        self._tokens -= 1
+        envios = self._envios_chat.setdefault(chat_id, deque(maxlen=max(self.por_minuto_grupo, 1)))
+        envios.append(ahora)
+
+    def bloquear(self, chat_id: str, segundos: float):
+        """Bloquea un chat tras un 429 (retry_after)"""
+        self._bloqueos[chat_id] = max(self._bloqueos.get(chat_id, 0.0), self.reloj() + segundos)
+
+
+def enviar_mensaje(chat_id: str, texto: str) -> Tuple[bool, Optional[float], str]:
+    """
+    Envía un mensaje a la API de Telegram (sin reintentos)
+
+    Returns:
+        (enviado, retry_after, error). retry_after no es None si hubo 429;
+        error empieza por 'permanente' si no tiene sentido reintentar.
+    """
+    url = f"{config.TELEGRAM_API_URL}/bot{config.TELEGRAM_TOKEN}/sendMessage"
+    payload = {
+        'chat_id': chat_id,
+        'text': texto,
+        'parse_mode': 'HTML'
+    }
+    try:
+        with metrics.cronometrar(metrics.ENVIO_TELEGRAM):
+            response = http_client.post(url, read_timeout=config.TELEGRAM_TIMEOUT, data=payload)
+    except requests.RequestException as e:
+        metrics.ERRORES.labels('telegram').inc()
+        return False, None, str(e)
+
+    if response.status_code == 200:
+        return True, None, ''
+    metrics.ERRORES.labels('telegram').inc()
+    if response.status_code == 429:
+        try:
+            retry_after = float(response.json().get('parameters', {}).get('retry_after', 1))
+        except ValueError:
+            retry_after = float(response.headers.get('Retry-After', 1))
+        return False, retry_after, 'HTTP 429'
+    if 400 <= response.status_code < 500:
+        return False, None, f"permanente: HTTP {response.status_code} {response.text[:200]}"
+    return False, None, f"HTTP {response.status_code}"
+
+
+class TrabajadorTelegram(threading.Thread):
+    """Hilo que vacía la cola `cola_telegram` en segundo plano"""
+
+    def __init__(self, limitador: Optional[LimitadorTelegram] = None,
+                 enviar: Callable[[str, str], Tuple[bool, Optional[float], str]] = enviar_mensaje,
+                 lote: int = 50):
+        super().__init__(name='telegram-worker', daemon=True)
+        self.limitador = limitador or LimitadorTelegram()
+        self.enviar = enviar
+        self.lote = lote
+        self._parar = threading.Event()
+
+    def _backoff(self, intentos: int) -> float:
+        return min(config.TELEGRAM_BACKOFF_MAX, config.TELEGRAM_BACKOFF_BASE * (2 ** (intentos - 1)))
+
+    def procesar_pendientes(self) -> Tuple[int, float]:
+        """
+        Intenta enviar los mensajes que ya tocan
+
+        Returns:
+            (mensajes_enviados, segundos_hasta_el_siguiente_pendiente)
+        """
+        conn = db.get_connection()
+        ahora = time.time()
+        filas = conn.execute(
+            """SELECT id, chat_id, texto, tipo, intentos FROM cola_telegram
+               WHERE estado=? AND proximo_intento<=? ORDER BY id LIMIT ?""",
+            (PENDIENTE, ahora, self.lote)).fetchall()
+
+        enviados = 0
+        esperando = set()  # Chats en espera: no adelantar sus mensajes posteriores
+        espera_min = config.TELEGRAM_POLL_INTERVAL
+        for msg_id, chat_id, texto, tipo, intentos in filas:
+            if self._parar.is_set():
+                break
+            if chat_id in esperando:
+                continue
+            espera = self.limitador.espera_chat(chat_id)
+            if espera > 0:
+                esperando.add(chat_id)
+                espera_min = min(espera_min, espera)
+                continue
+            espera = self.limitador.espera_global()
+            if espera > 0:
+                time.sleep(espera)
+
+            self.limitador.registrar(chat_id)
+            ok, retry_after, error = self.enviar(chat_id, texto)
+            intentos += 1
+
+            if ok:
+                with db.transaction() as c:
+                    c.execute("""UPDATE cola_telegram SET estado=?, intentos=?, fecha_envio=datetime('now')
+                                 WHERE id=?""", (ENVIADO, intentos, msg_id))
+                log_event(logger, 'TELEGRAM_SENT', {
+                    'notification_type': tipo,
+                    'length': len(texto)
+                })
+                enviados += 1
+                continue
+
+            esperando.add(chat_id)
+            if retry_after is not None:
+                # 429: Telegram dice cuánto esperar; no cuenta como intento fallido
+                intentos -= 1
+                self.limitador.bloquear(chat_id, retry_after)
+                retraso = retry_after
+            else:
+                retraso = self._backoff(intentos)
+
+            estado = PENDIENTE
+            if error.startswith('permanente') or intentos >= config.TELEGRAM_MAX_INTENTOS:
+                estado = FALLIDO
+                log_event(logger, 'TELEGRAM_ERROR', {
+                    'error': error,
+                    'message_preview': texto[:100]
+                }, level='error')
+            else:
+                logger.warning(f"Telegram: reintento de mensaje {msg_id} en {retraso:.1f}s ({error})")
+                espera_min = min(espera_min, retraso)
+
+            with db.transaction() as c:
+                c.execute("""UPDATE cola_telegram SET estado=?, intentos=?, proximo_intento=?, ultimo_error=?
+                             WHERE id=?""", (estado, intentos, time.time() + retraso, error, msg_id))
+
+        if len(filas) == self.lote and not esperando:
+            espera_min = 0.0
+        else:
+            # Los pendientes ya vencidos pero en espera por su chat están cubiertos por espera_min
+            siguiente = conn.execute(
+                "SELECT MIN(proximo_intento) FROM cola_telegram WHERE estado=? AND proximo_intento>?",
+                (PENDIENTE, ahora)).fetchone()[0]
+            if siguiente is not None:
+                espera_min = min(espera_min, max(0.0, siguiente - time.time()))
+        return enviados, espera_min
+
+    def pendientes(self) -> int:
+        return db.get_connection().execute(
+            "SELECT COUNT(*) FROM cola_telegram WHERE estado=?", (PENDIENTE,)).fetchone()[0]
+
+    def run(self):
+        logger.info("📨 Trabajador de Telegram iniciado")
+        while not self._parar.is_set():
+            _despertar.clear()
+            try:
+                _, espera = self.procesar_pendientes()
+            except Exception as e:
+                logger.error(f"Error en el trabajador de Telegram: {e}", exc_info=True)
+                espera = config.TELEGRAM_POLL_INTERVAL
+            if espera > 0:
+                _despertar.wait(espera)
+
+    def detener(self, timeout: float = 10.0):
+        """Para el hilo; los mensajes pendientes quedan en la cola para el siguiente arranque"""
+        self._parar.set()
+        _despertar.set()
+        self.join(timeout)
@@ -0,0 +1,153 @@
+"""
+Perfiles de búsqueda (varias zonas, alquiler y venta)
+
+Los perfiles se leen de un fichero JSON (SEARCH_PROFILES_FILE) o de la
+tabla `perfiles_busqueda`; si no hay ninguno se usa un único perfil
+'default' construido con los parámetros globales de config.py.
+
+Ejemplo de perfiles.json:
+    [
+      {"nombre": "granada_alquiler", "operacion": "rent"},
+      {"nombre": "centro_venta", "operacion": "sale", "latitud": 37.176,
+       "longitud": -3.598, "radio": 1500, "habitaciones": ["2", "3"]}
+    ]
+"""
+import json
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional, Set
+
+import config
+import db
+from incremental import PERFIL_DEFECTO
+
+logger = logging.getLogger('idealista')
+
+OPERACIONES = ('rent', 'sale')
+
+
+def crear_tablas(conn):
+    """Crea la tabla de perfiles (llamado desde init_db)"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS perfiles_busqueda (
+        nombre TEXT PRIMARY KEY,
+        operacion TEXT NOT NULL DEFAULT 'rent',
+        latitud REAL,
+        longitud REAL,
+        radio INTEGER,
+        habitaciones TEXT,
+        banos TEXT,
+        activo BOOLEAN DEFAULT 1
+    )''')
+
+
+def perfil_defecto() -> Dict:
+    """Perfil equivalente a la configuración global de config.py"""
+    return {
+        'nombre': PERFIL_DEFECTO,
+        'operacion': 'rent',
+        'latitud': config.SEARCH_LATITUDE,
+        'longitud': config.SEARCH_LONGITUDE,
+        'radio': config.SEARCH_RADIUS,
+        'habitaciones': list(config.SEARCH_BEDROOMS),
+        'banos': list(config.SEARCH_BATHROOMS),
+    }
+
+
+def normalizar(datos: Dict) -> Dict:
+    """Completa un perfil con los valores por defecto y lo valida"""
+    perfil = perfil_defecto()
+    perfil.update({k: v for k, v in datos.items() if v is not None})
+    for campo in ('habitaciones', 'banos'):
+        if isinstance(perfil[campo], str):
+            perfil[campo] = perfil[campo].split(',')
+        perfil[campo] = [str(v).strip() for v in perfil[campo]]
+    if perfil['operacion'] not in OPERACIONES:
+        raise ValueError(f"Perfil {perfil['nombre']}: operación inválida '{perfil['operacion']}'")
+    return perfil
+
+
+def _desde_fichero() -> List[Dict]:
+    ruta = config.SEARCH_PROFILES_FILE
+    if not ruta.exists():
+        return []
+    with open(ruta, encoding='utf-8') as f:
+        return [p for p in json.load(f) if p.get('activo', True)]
+
+
+def _desde_tabla() -> List[Dict]:
+    conn = db.get_connection()
+    rows = conn.execute("""SELECT nombre, operacion, latitud, longitud, radio, habitaciones, banos
+                           FROM perfiles_busqueda WHERE activo=1 ORDER BY nombre""")
+    columnas = [c[0] for c in rows.description]
+    return [dict(zip(columnas, row)) for row in rows]
+
+
+def cargar_perfiles() -> List[Dict]:
+    """Perfiles activos: fichero JSON, si no la tabla, si no el perfil por defecto"""
+    datos = _desde_fichero() or _desde_tabla()
+    if not datos:
+        return [perfil_defecto()]
+    perfiles = [normalizar(p) for p in datos]
+    nombres = [p['nombre'] for p in perfiles]
+    if len(set(nombres)) != len(nombres):
+        raise ValueError(f"Nombres de perfil duplicados: {nombres}")
+    return perfiles
+
+
+def parametros_busqueda(perfil: Dict, num_pagina: int) -> Dict:
+    """Parámetros de /search para una página de un perfil"""
+    return {
+        "country": "es",
+        "operation": perfil['operacion'],
+        "propertyType": "homes",
+        "center": f"{perfil['latitud']},{perfil['longitud']}",
+        "distance": perfil['radio'],
+        "sort": "asc",
+        "maxItems": config.ITEMS_PER_PAGE,
+        "numPage": num_pagina,
+        "bedrooms": ','.join(perfil['habitaciones']),
+        "bathrooms": ','.join(perfil['banos']),
+        "hasMultimedia": "true"
+    }
+
+
+class VistosCiclo:
+    """
+    Ids ya procesados en el ciclo actual, compartidos entre perfiles
+
+    Un piso que devuelven varios perfiles solapados se procesa (y notifica)
+    una sola vez por ciclo: el primer perfil que lo reclama se lo queda. Por
+    cada id se guarda además si resultó ser un cambio (None mientras el
+    perfil que lo reclamó no lo ha procesado), para que la parada
+    incremental de los demás perfiles tenga en cuenta la página entera.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids: Dict[str, Optional[bool]] = {}
+
+    def reclamar(self, ids: Iterable[str]) -> List[str]:
+        """Marca los ids como vistos y devuelve solo los que no lo estaban"""
+        with self._lock:
+            nuevos = [i for i in ids if i not in self._ids]
+            self._ids.update(dict.fromkeys(nuevos))
+            return nuevos
+
+    def registrar(self, ids: Iterable[str], cambios: Set[str]):
+        """Anota qué ids reclamados fueron novedad o cambio de precio"""
+        with self._lock:
+            for i in ids:
+                self._ids[i] = i in cambios
+
+    def cambios(self, ids: Iterable[str]) -> Set[str]:
+        """Ids que fueron un cambio o aún no se sabe (reclamados y sin registrar)"""
+        with self._lock:
+            return {i for i in ids if self._ids.get(i) is not False}
+
+    def ids(self) -> Set[str]:
+        """Copia de todos los ids vistos en el ciclo"""
+        with self._lock:
+            return set(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
@@ -0,0 +1,221 @@
+"""
+Planificador adaptativo de búsquedas según la quota restante
+
+Decide cuándo lanzar la próxima búsqueda y cuántas páginas pedir a partir
+de la quota disponible, lo que queda de mes y el rendimiento reciente
+(pisos nuevos por petición en `ejecuciones`), para gastar el presupuesto
+mensual completo sin agotarlo antes de fin de mes.
+
+Ejecutar simulación: python planificador.py --simular [--dias 30] [--nuevos 10]
+"""
+import argparse
+import math
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+import config
+import db
+
+# (pisos_nuevos, peticiones) de las ejecuciones recientes, de más nueva a más antigua
+Historial = List[Tuple[int, int]]
+
+
+def inicio_mes_siguiente(ahora: datetime) -> datetime:
+    return (ahora.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            + timedelta(days=32)).replace(day=1)
+
+
+def _utc_a_local(fecha: str) -> datetime:
+    """Convierte un datetime('now') de SQLite (UTC) a hora local naive"""
+    return datetime.fromisoformat(fecha).replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+
+def historial_bd(ventana: int = config.PLAN_YIELD_WINDOW) -> Historial:
+    rows = db.get_connection().execute(
+        """SELECT pisos_nuevos, peticiones FROM ejecuciones
+           WHERE status='success' AND peticiones > 0
+           ORDER BY id DESC LIMIT ?""", (ventana,)).fetchall()
+    return [(nuevos or 0, peticiones) for nuevos, peticiones in rows]
+
+
+def ultima_ejecucion_bd() -> Optional[datetime]:
+    row = db.get_connection().execute(
+        """SELECT fecha_fin FROM ejecuciones
+           WHERE status='success'
+           ORDER BY id DESC LIMIT 1""").fetchone()
+    return _utc_a_local(row[0]) if row and row[0] else None
+
+
+class Planificador:
+    """
+    Calcula el plan de búsqueda
+
+    Args:
+        disponible: Devuelve las peticiones que quedan este mes (QuotaLedger.disponible)
+        reloj: Hora local actual (inyectable para simulación y tests)
+        historial: Devuelve el rendimiento de las ejecuciones recientes
+        ultima_ejecucion: Devuelve la hora local de la última búsqueda completada
+        adaptativo: Si es False se usa el intervalo fijo SEARCH_INTERVAL_HOURS
+        num_perfiles: Devuelve cuántos perfiles se buscan en cada ejecución;
+            `paginas` del plan es por perfil
+    """
+
+    def __init__(self, disponible: Callable[[], int],
+                 reloj: Callable[[], datetime] = datetime.now,
+                 historial: Callable[[], Historial] = historial_bd,
+                 ultima_ejecucion: Callable[[], Optional[datetime]] = ultima_ejecucion_bd,
+                 adaptativo: Optional[bool] = None,
+                 num_perfiles: Callable[[], int] = lambda: 1):
+        self.disponible = disponible
+        self.num_perfiles = num_perfiles
+        self.reloj = reloj
+        self.historial = historial
+        self.ultima_ejecucion = ultima_ejecucion
+        self.adaptativo = config.ADAPTIVE_SCHEDULING if adaptativo is None else adaptativo
+
+    def rendimiento(self) -> Optional[float]:
+        """Pisos nuevos por petición de búsqueda en la ventana reciente"""
+        historial = self.historial()
+        peticiones = sum(p for _, p in historial)
+        if not peticiones:
+            return None
+        return sum(n for n, _ in historial) / peticiones
+
+    def _paginas(self, rendimiento: Optional[float]) -> int:
+        """
+        Más páginas cuando cada página trae muchas novedades (probablemente
+        haya más detrás); una sola cuando casi todo es ya conocido.
+        """
+        if rendimiento is None:
+            return config.MAX_PAGES_PER_DAY
+        fraccion = min(1.0, rendimiento / (config.ITEMS_PER_PAGE * config.PLAN_YIELD_SATURATION))
+        return 1 + round((config.MAX_PAGES_PER_DAY - 1) * fraccion)
+
+    def planificar(self) -> Dict:
+        """
+        Returns:
+            Plan con proxima_ejecucion (datetime local), paginas (por perfil),
+            perfiles, intervalo_horas, disponible, dias_restantes,
+            ejecuciones_restantes y rendimiento
+        """
+        ahora = self.reloj()
+        fin_mes = inicio_mes_siguiente(ahora)
+        horas_restantes = (fin_mes - ahora).total_seconds() / 3600
+        disponible = self.disponible()
+        rendimiento = self.rendimiento()
+        coste_token = config.PLAN_TOKEN_COST
+        perfiles = max(1, self.num_perfiles())
+
+        if self.adaptativo:
+            paginas = self._paginas(rendimiento)
+            ejecuciones = disponible // (paginas * perfiles + coste_token)
+            if ejecuciones == 0 and disponible >= perfiles + coste_token:
+                # Apurar lo que queda con una última búsqueda más corta
+                paginas = (disponible - coste_token) // perfiles
+                ejecuciones = 1
+            if ejecuciones:
+                # +1: la última búsqueda cae un intervalo antes de fin de mes, no en el límite
+                intervalo = horas_restantes / (ejecuciones + 1)
+                intervalo = min(max(intervalo, config.PLAN_MIN_INTERVAL_HOURS),
+                                config.PLAN_MAX_INTERVAL_HOURS)
+        else:
+            paginas = config.MAX_PAGES_PER_DAY
+            ejecuciones = math.ceil(disponible / (paginas * perfiles + coste_token)) if disponible else 0
+            intervalo = config.SEARCH_INTERVAL_HOURS
+
+        if ejecuciones:
+            ultima = self.ultima_ejecucion()
+            proxima = ahora if ultima is None else max(ahora, ultima + timedelta(hours=intervalo))
+        else:
+            # Sin presupuesto: esperar a que se renueve la quota
+            paginas, intervalo, proxima = 0, horas_restantes, fin_mes
+
+        return {
+            'proxima_ejecucion': proxima,
+            'paginas': paginas,
+            'perfiles': perfiles,
+            'intervalo_horas': round(intervalo, 2),
+            'disponible': disponible,
+            'dias_restantes': round(horas_restantes / 24, 2),
+            'ejecuciones_restantes': ejecuciones,
+            'rendimiento': None if rendimiento is None else round(rendimiento, 2),
+            'adaptativo': self.adaptativo,
+        }
+
+
+def plan_para_log(plan: Dict) -> Dict:
+    """Plan serializable para log_event"""
+    return {**plan, 'proxima_ejecucion': plan['proxima_ejecucion'].isoformat(timespec='minutes')}
+
+
+def simular(inicio: datetime, dias: int, nuevos_por_pagina: Callable[[datetime], float],
+            limite: int = config.MONTHLY_REQUEST_LIMIT,
+            duracion: timedelta = timedelta(minutes=2)) -> List[Dict]:
+    """
+    Simula el planificador con un reloj virtual, sin BD ni red
+
+    Args:
+        inicio: Hora local de arranque
+        dias: Días a simular
+        nuevos_por_pagina: Pisos nuevos por página en función de la hora
+        limite: Quota mensual
+        duracion: Lo que dura cada búsqueda simulada
+
+    Returns:
+        Lista de ejecuciones: {'fecha', 'paginas', 'nuevos', 'usado_mes'}
+    """
+    reloj = [inicio]
+    usado: Dict[str, int] = {}
+    historial: Historial = []
+    ultima: List[Optional[datetime]] = [None]
+    ejecuciones: List[Dict] = []
+
+    def mes() -> str:
+        return reloj[0].strftime('%Y-%m')
+
+    planificador = Planificador(
+        disponible=lambda: limite - usado.get(mes(), 0),
+        reloj=lambda: reloj[0],
+        historial=lambda: historial[:config.PLAN_YIELD_WINDOW],
+        ultima_ejecucion=lambda: ultima[0],
+        adaptativo=True,
+    )
+
+    fin = inicio + timedelta(days=dias)
+    while reloj[0] < fin:
+        plan = planificador.planificar()
+        if plan['proxima_ejecucion'] > reloj[0]:
+            reloj[0] = plan['proxima_ejecucion']
+            continue
+
+        paginas = plan['paginas']
+        nuevos = round(nuevos_por_pagina(reloj[0]) * paginas)
+        usado[mes()] = usado.get(mes(), 0) + paginas + config.PLAN_TOKEN_COST
+        historial.insert(0, (nuevos, paginas))
+        ejecuciones.append({
+            'fecha': reloj[0],
+            'paginas': paginas,
+            'nuevos': nuevos,
+            'usado_mes': usado[mes()],
+        })
+        reloj[0] += duracion
+        ultima[0] = reloj[0]
+    return ejecuciones
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Planificador adaptativo de búsquedas")
+    parser.add_argument('--simular', action='store_true', help="Simula un mes con reloj virtual")
+    parser.add_argument('--dias', type=int, default=30)
+    parser.add_argument('--nuevos', type=float, default=10.0, help="Pisos nuevos por página")
+    args = parser.parse_args()
+
+    if args.simular:
+        inicio = datetime.now().replace(day=1, hour=8, minute=0, second=0, microsecond=0)
+        for e in simular(inicio, args.dias, lambda _: args.nuevos):
+            print(f"{e['fecha']:%Y-%m-%d %H:%M}  páginas={e['paginas']}  "
+                  f"nuevos={e['nuevos']}  usado_mes={e['usado_mes']}")
+    else:
+        import quota
+        plan = Planificador(quota.QuotaLedger().disponible).planificar()
+        print(plan_para_log(plan))
@@ -0,0 +1,164 @@
+"""
+Libro mayor de quota de la API de Idealista (100 peticiones/mes)
+
+Mantiene en memoria el uso del mes y lo refleja en `api_quota` con un upsert
+atómico (usado = usado + 1), sin recontar `api_requests` en cada petición.
+Permite reservar quota antes de una petición y confirmarla o cancelarla
+después; reconciliar() audita el contador contra `api_requests`.
+"""
+import itertools
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Optional, Tuple
+
+import config
+import db
+from utils import log_event
+
+logger = logging.getLogger('idealista')
+
+ENDPOINT = 'https://api.idealista.com'
+
+
+class QuotaAgotada(Exception):
+    """No queda quota para lanzar otra petición este mes"""
+
+
+class QuotaLedger:
+    """
+    Contador incremental de peticiones por mes
+
+    Args:
+        limite: Peticiones permitidas al mes (por defecto MONTHLY_REQUEST_LIMIT)
+        reloj: Fuente de fecha/hora local, inyectable en tests
+    """
+
+    def __init__(self, limite: Optional[int] = None,
+                 reloj: Callable[[], datetime] = datetime.now):
+        self._limite = limite
+        self.reloj = reloj
+        self._lock = threading.Lock()
+        self._usado: Dict[str, int] = {}
+        self._reservas: Dict[int, Tuple[str, str]] = {}
+        self._ids = itertools.count(1)
+
+    @property
+    def limite(self) -> int:
+        return self._limite if self._limite is not None else config.MONTHLY_REQUEST_LIMIT
+
+    def _mes(self) -> str:
+        return self.reloj().strftime("%Y-%m")
+
+    def _usado_mes(self, mes: str) -> int:
+        """Uso confirmado del mes; se lee de SQLite solo la primera vez"""
+        if mes not in self._usado:
+            row = db.get_connection().execute(
+                "SELECT usado FROM api_quota WHERE mes_ano=?", (mes,)).fetchone()
+            self._usado[mes] = row[0] if row else 0
+        return self._usado[mes]
+
+    def _reservadas(self, mes: str) -> int:
+        return sum(1 for m, _ in self._reservas.values() if m == mes)
+
+    def estado(self) -> Tuple[bool, int, int]:
+        """(puede_continuar, usado, limite) del mes actual, sin consultas de agregación"""
+        with self._lock:
+            usado = self._usado_mes(self._mes())
+        return usado < self.limite, usado, self.limite
+
+    def disponible(self) -> int:
+        """Peticiones que aún se pueden reservar este mes"""
+        with self._lock:
+            mes = self._mes()
+            return max(0, self.limite - self._usado_mes(mes) - self._reservadas(mes))
+
+    def reservar(self, tipo: str = 'search') -> int:
+        """
+        Reserva una petición antes de lanzarla
+
+        Raises:
+            QuotaAgotada: si el uso más las reservas abiertas alcanzan el límite
+        """
+        with self._lock:
+            mes = self._mes()
+            if self._usado_mes(mes) + self._reservadas(mes) >= self.limite:
+                raise QuotaAgotada(f"Quota agotada ({self._usado[mes]}/{self.limite})")
+            reserva = next(self._ids)
+            self._reservas[reserva] = (mes, tipo)
+            return reserva
+
+    def confirmar(self, reserva: int, exitoso: bool = True) -> int:
+        """
+        Registra la petición reservada; solo las exitosas consumen quota
+
+        Returns:
+            Uso del mes tras confirmar
+        """
+        with self._lock:
+            mes, tipo = self._reservas.pop(reserva)
+            usado = self._usado_mes(mes)
+            with db.transaction() as conn:
+                conn.execute("""INSERT INTO api_requests (endpoint, tipo, exitoso, mes_ano)
+                                VALUES (?, ?, ?, ?)""",
+                             (ENDPOINT, tipo, exitoso, mes))
+                if exitoso:
+                    conn.execute("""INSERT INTO api_quota (mes_ano, limite, usado, fecha_inicio, fecha_fin)
+                                    VALUES (?, ?, 1, date(? || '-01'), date(? || '-01', '+1 month'))
+                                    ON CONFLICT(mes_ano) DO UPDATE SET usado = usado + 1""",
+                                 (mes, self.limite, mes, mes))
+            if exitoso:
+                usado = self._usado[mes] = usado + 1
+            return usado
+
+    def cancelar(self, reserva: int):
+        """Libera una reserva de una petición que no llegó a lanzarse"""
+        with self._lock:
+            self._reservas.pop(reserva, None)
+
+    def registrar(self, exitoso: bool = True, tipo: str = 'search') -> int:
+        """Registra una petición ya lanzada (reserva + confirmación)"""
+        with self._lock:
+            reserva = next(self._ids)
+            self._reservas[reserva] = (self._mes(), tipo)
+        return self.confirmar(reserva, exitoso)
+
+    def reconciliar(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Audita `api_quota` contra `api_requests` y corrige las diferencias
+
+        Returns:
+            {mes: (usado_en_ledger, usado_real)} de los meses que no cuadraban
+        """
+        with self._lock:
+            conn = db.get_connection()
+            reales = dict(conn.execute(
+                """SELECT mes_ano, COUNT(*) FROM api_requests
+                   WHERE exitoso=1 GROUP BY mes_ano""").fetchall())
+            ledger = dict(conn.execute("SELECT mes_ano, usado FROM api_quota").fetchall())
+
+            discrepancias = {}
+            for mes in set(reales) | set(ledger):
+                real, anotado = reales.get(mes, 0), ledger.get(mes, 0)
+                if real != anotado:
+                    discrepancias[mes] = (anotado, real)
+
+            if discrepancias:
+                with db.transaction() as c:
+                    for mes, (_, real) in discrepancias.items():
+                        c.execute("""INSERT INTO api_quota (mes_ano, limite, usado, fecha_inicio, fecha_fin)
+                                     VALUES (?, ?, ?, date(? || '-01'), date(? || '-01', '+1 month'))
+                                     ON CONFLICT(mes_ano) DO UPDATE SET usado = excluded.usado""",
+                                  (mes, self.limite, real, mes, mes))
+                log_event(logger, 'QUOTA_RECONCILED', {
+                    mes: {'ledger': anotado, 'real': real} for mes, (anotado, real) in discrepancias.items()
+                }, level='warning')
+            self._usado.clear()
+            return discrepancias
+
+
+if __name__ == '__main__':
+    ledger = QuotaLedger()
+    print(f"Discrepancias corregidas: {ledger.reconciliar()}")
+    puede, usado, limite = ledger.estado()
+    print(f"Quota {ledger._mes()}: {usado}/{limite} ({'OK' if puede else 'AGOTADA'})")
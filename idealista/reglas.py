@@ -0,0 +1,330 @@
+"""
+Reglas de alerta definidas por el usuario
+
+Cada regla de `reglas_alerta` tiene un evento ('nuevo', 'bajada' o
+'subida') y unas condiciones en JSON sobre las columnas del piso y algunos
+campos derivados; todas deben cumplirse:
+
+    {"precio_m2": {"<": 9}, "zona": "Centro"}
+    {"bajada_pct": {">=": 5}}
+    {"exterior": true, "habitaciones": {">=": 3}}
+
+Un valor suelto es igualdad y una lista es pertenencia. Operadores: ==, !=,
+<, <=, >, >=, en, no_en y contiene (texto, sin distinguir mayúsculas). Un
+campo sin valor no cumple ninguna condición. Los tipos se comprueban al
+compilar: <, <=, > y >= solo en campos numéricos y con un número; el resto,
+con textos o números. Si aun así una regla falla con un piso, se omite (con
+un aviso en el log) y las demás se siguen evaluando.
+
+Las reglas se compilan una sola vez (cada una a una única expresión de
+Python) y se indexan por evento y zona: para cada piso solo se evalúan las
+reglas de su evento que no exigen zona o exigen la suya. El motor compilado
+se reutiliza mientras no cambie la tabla (db.versionar).
+
+Las reglas por defecto reproducen el comportamiento anterior: aviso de cada
+piso nuevo que no duplica a uno activo y de cada bajada de precio. Se crean
+en init_db si no existen; para quitarlas, desactivarlas.
+"""
+import argparse
+import json
+import logging
+import sqlite3
+import threading
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import config
+import db
+import lotes
+
+logger = logging.getLogger('idealista')
+
+# Evento de una regla -> clase del diff de lotes.aplicar_lote
+EVENTOS = {'nuevo': 'nuevos', 'bajada': 'bajadas', 'subida': 'subidas'}
+
+REGLAS_DEFECTO = {
+    'novedad': ('nuevo', {'duplicado': False}),
+    'bajada': ('bajada', {}),
+}
+
+# Operador -> expresión de Python (v: valor del campo, r: referencia de la regla)
+OPERADORES = {
+    '==': '{v} == {r}',
+    '!=': '{v} != {r}',
+    '<': '{v} < {r}',
+    '<=': '{v} <= {r}',
+    '>': '{v} > {r}',
+    '>=': '{v} >= {r}',
+    'en': '{v} in {r}',
+    'no_en': '{v} not in {r}',
+    'contiene': '{r} in str({v}).lower()',
+}
+
+# Calculados por piso antes de evaluar (ver _valores)
+CAMPOS_DERIVADOS = ('precio_anterior', 'bajada', 'bajada_pct', 'duplicado')
+CAMPOS = frozenset(lotes.COLUMNAS + CAMPOS_DERIVADOS)
+# Los únicos que admiten <, <=, > y >= (con un número)
+CAMPOS_NUMERICOS = frozenset(('precio', 'precio_m2', 'metros', 'habitaciones', 'puntuacion_anomalia',
+                              'latitud', 'longitud', 'celda', 'precio_anterior', 'bajada', 'bajada_pct'))
+ORDEN = ('<', '<=', '>', '>=')
+
+
+def crear_tablas(conn):
+    """Tabla de reglas y reglas por defecto (llamado desde init_db)"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS reglas_alerta (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nombre TEXT UNIQUE NOT NULL,
+        evento TEXT NOT NULL,
+        condiciones TEXT NOT NULL DEFAULT '{}',
+        activa BOOLEAN DEFAULT 1,
+        fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+    # Cualquier cambio en la tabla (también desde fuera del bot) invalida el motor compilado
+    db.versionar(conn, 'reglas_alerta')
+    conn.executemany("INSERT OR IGNORE INTO reglas_alerta (nombre, evento, condiciones) VALUES (?, ?, ?)",
+                     ((nombre, evento, json.dumps(condiciones))
+                      for nombre, (evento, condiciones) in REGLAS_DEFECTO.items()))
+
+
+class Regla(NamedTuple):
+    nombre: str
+    evento: str
+    zonas: Optional[frozenset]  # None: cualquier zona (no entra en el predicado)
+    predicado: Callable[[Dict], bool]
+
+
+def _escalar(valor) -> bool:
+    return isinstance(valor, (str, int, float, bool))
+
+
+def _numero(valor) -> bool:
+    return isinstance(valor, (int, float)) and not isinstance(valor, bool)
+
+
+def _lista(campo: str, simbolo: str, referencia) -> frozenset:
+    if not isinstance(referencia, list) or not all(_escalar(v) for v in referencia):
+        raise ValueError(f"'{simbolo}' en '{campo}' necesita una lista de textos o números")
+    return frozenset(referencia)
+
+
+def _condicion(campo: str, especificacion) -> List[Tuple[str, object]]:
+    """(operador, referencia) de la condición de un campo; ValueError si los tipos no encajan"""
+    if isinstance(especificacion, list):
+        especificacion = {'en': especificacion}
+    elif not isinstance(especificacion, dict):
+        especificacion = {'==': especificacion}
+    resultado = []
+    for simbolo, referencia in especificacion.items():
+        if simbolo not in OPERADORES:
+            raise ValueError(f"Operador desconocido en '{campo}': {simbolo}")
+        if simbolo in ORDEN:
+            if campo not in CAMPOS_NUMERICOS:
+                raise ValueError(f"'{simbolo}' solo se admite en campos numéricos, no en '{campo}'")
+            if not _numero(referencia):
+                raise ValueError(f"'{simbolo}' en '{campo}' necesita un número, no {referencia!r}")
+        elif simbolo in ('en', 'no_en'):
+            referencia = _lista(campo, simbolo, referencia)
+        elif not _escalar(referencia):
+            raise ValueError(f"'{simbolo}' en '{campo}' necesita un texto o un número, no {referencia!r}")
+        elif simbolo == 'contiene':
+            referencia = str(referencia).lower()
+        resultado.append((simbolo, referencia))
+    return resultado
+
+
+def _zonas(especificacion) -> Optional[frozenset]:
+    """Zonas de una condición indexable (igualdad o pertenencia), o None si no lo es"""
+    if isinstance(especificacion, list):
+        return frozenset(especificacion)
+    if not isinstance(especificacion, dict):
+        return frozenset([especificacion])
+    if list(especificacion) == ['=='] and especificacion['=='] is not None:
+        return frozenset([especificacion['==']])
+    if list(especificacion) == ['en'] and isinstance(especificacion['en'], list):
+        return frozenset(especificacion['en'])
+    return None
+
+
+def compilar(nombre: str, evento: str, condiciones: Dict) -> Regla:
+    """Valida una regla y la convierte en predicado; ValueError si no es válida"""
+    if evento not in EVENTOS:
+        raise ValueError(f"Regla {nombre}: evento inválido '{evento}' (válidos: {', '.join(EVENTOS)})")
+    if not isinstance(condiciones, dict):
+        raise ValueError(f"Regla {nombre}: las condiciones deben ser un objeto JSON")
+    desconocidos = set(condiciones) - CAMPOS
+    if desconocidos:
+        raise ValueError(f"Regla {nombre}: campos desconocidos {sorted(desconocidos)}")
+    for campo, especificacion in condiciones.items():
+        try:
+            _condicion(campo, especificacion)
+        except ValueError as e:
+            raise ValueError(f"Regla {nombre}: {e}") from None
+
+    condiciones = dict(condiciones)
+    zonas = _zonas(condiciones['zona']) if 'zona' in condiciones else None
+    if zonas is not None:
+        # La garantiza el índice: no hace falta comprobarla otra vez
+        del condiciones['zona']
+    return Regla(nombre, evento, zonas, _predicado(condiciones))
+
+
+def _predicado(condiciones: Dict) -> Callable[[Dict], bool]:
+    """Una sola expresión de Python con todas las condiciones, compilada una vez"""
+    # Los campos ya están validados contra CAMPOS y las referencias van como
+    # variables: en el código generado no entra nada escrito por el usuario
+    referencias = {}
+    partes = []
+    for campo, especificacion in condiciones.items():
+        valor = f"v.get({campo!r})"
+        partes.append(f"{valor} is not None")
+        for simbolo, referencia in _condicion(campo, especificacion):
+            nombre = f"r{len(referencias)}"
+            referencias[nombre] = referencia
+            partes.append(OPERADORES[simbolo].format(v=valor, r=nombre))
+    return eval(f"lambda v: {' and '.join(partes) or 'True'}", referencias)
+
+
+def _valores(fila: Dict) -> Dict:
+    """Fila del diff con los campos derivados"""
+    valores = dict(fila)
+    anterior, precio = fila.get('precio_anterior'), fila.get('precio')
+    if anterior and precio:
+        valores['bajada'] = anterior - precio
+        valores['bajada_pct'] = round(100 * (anterior - precio) / anterior, 2)
+    valores['duplicado'] = bool(fila.get('duplicado_de'))
+    return valores
+
+
+class Motor:
+    """Reglas compiladas e indexadas por (evento, zona)"""
+
+    def __init__(self, reglas: List[Regla]):
+        self.reglas = reglas
+        self._fallidas = set()  # Reglas que ya dieron error (se avisa una vez)
+        self._eventos = {regla.evento for regla in reglas}
+        self._generales: Dict[str, List[Regla]] = {evento: [] for evento in EVENTOS}
+        por_zona: Dict[tuple, List[Regla]] = {}
+        for regla in reglas:
+            if regla.zonas is None:
+                self._generales[regla.evento].append(regla)
+            else:
+                for zona in regla.zonas:
+                    por_zona.setdefault((regla.evento, zona), []).append(regla)
+        # Listas ya combinadas y en orden de definición: una búsqueda por piso
+        orden = {regla.nombre: i for i, regla in enumerate(reglas)}
+        self._por_zona = {clave: sorted(self._generales[clave[0]] + lista, key=lambda r: orden[r.nombre])
+                          for clave, lista in por_zona.items()}
+
+    def candidatas(self, evento: str, zona: Optional[str]) -> List[Regla]:
+        """Reglas que pueden cumplirse para un piso de esa zona"""
+        return self._por_zona.get((evento, zona), self._generales[evento])
+
+    def evaluar(self, diff: Dict[str, List[Dict]]) -> List[Dict]:
+        """
+        Alertas de una página clasificada
+
+        Returns:
+            [{'evento': ..., 'fila': ..., 'reglas': [nombres]}] (un elemento por
+            piso con al menos una regla cumplida)
+        """
+        alertas = []
+        for evento, clase in EVENTOS.items():
+            filas = diff.get(clase)
+            if not filas or evento not in self._eventos:
+                continue
+            for fila in filas:
+                candidatas = self.candidatas(evento, fila.get('zona'))
+                if not candidatas:
+                    continue
+                valores = _valores(fila)
+                nombres = [regla.nombre for regla in candidatas if self._cumple(regla, valores)]
+                if nombres:
+                    alertas.append({'evento': evento, 'fila': fila, 'reglas': nombres})
+        return alertas
+
+    def _cumple(self, regla: Regla, valores: Dict) -> bool:
+        """Una regla que falla con un piso se da por no cumplida: no tumba la página"""
+        try:
+            return regla.predicado(valores)
+        except Exception as e:
+            if regla.nombre not in self._fallidas:
+                self._fallidas.add(regla.nombre)
+                logger.warning(f"Regla de alerta {regla.nombre} falla y se omite: {e}")
+            return False
+
+
+def cargar(conn) -> Motor:
+    """Compila las reglas activas; las inválidas se descartan con un aviso"""
+    compiladas = []
+    for nombre, evento, condiciones in conn.execute(
+            "SELECT nombre, evento, condiciones FROM reglas_alerta WHERE activa = 1 ORDER BY id"):
+        try:
+            compiladas.append(compilar(nombre, evento, json.loads(condiciones)))
+        except ValueError as e:
+            logger.warning(f"Regla de alerta ignorada: {e}")
+    return Motor(compiladas)
+
+
+_motores: Dict[str, Tuple[int, Motor]] = {}
+_motores_lock = threading.Lock()
+
+
+def motor(conn) -> Motor:
+    """Motor de la BD actual (config.DB_PATH), recompilado solo si cambió la tabla"""
+    version = db.version(conn, 'reglas_alerta')
+    clave = str(config.DB_PATH)
+    with _motores_lock:
+        actual = _motores.get(clave)
+        if actual is None or actual[0] != version:
+            actual = _motores[clave] = (version, cargar(conn))
+    return actual[1]
+
+
+def evaluar_lote(diff: Dict[str, List[Dict]]) -> List[Dict]:
+    """Alertas de una página ya guardada (fuera de su transacción)"""
+    if not (diff['nuevos'] or diff['bajadas'] or diff['subidas']):
+        return []
+    return motor(db.get_connection()).evaluar(diff)
+
+
+def anadir(nombre: str, evento: str, condiciones: Dict):
+    """Valida y guarda una regla nueva"""
+    compilar(nombre, evento, condiciones)
+    with db.transaction() as conn:
+        conn.execute("INSERT INTO reglas_alerta (nombre, evento, condiciones) VALUES (?, ?, ?)",
+                     (nombre, evento, json.dumps(condiciones, ensure_ascii=False)))
+
+
+def activar(nombre: str, activa: bool = True) -> bool:
+    with db.transaction() as conn:
+        return conn.execute("UPDATE reglas_alerta SET activa = ? WHERE nombre = ?",
+                            (activa, nombre)).rowcount > 0
+
+
+def listar() -> List[Dict]:
+    columnas = ('id', 'nombre', 'evento', 'condiciones', 'activa')
+    filas = db.get_connection().execute(f"SELECT {', '.join(columnas)} FROM reglas_alerta ORDER BY id")
+    return [dict(zip(columnas, f)) for f in filas]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reglas de alerta")
+    sub = parser.add_subparsers(dest='accion', required=True)
+    sub.add_parser('listar')
+    p_anadir = sub.add_parser('anadir')
+    p_anadir.add_argument('nombre')
+    p_anadir.add_argument('evento', choices=sorted(EVENTOS))
+    p_anadir.add_argument('condiciones', help='JSON, p. ej. \'{"bajada_pct": {">=": 5}}\'')
+    for accion in ('activar', 'desactivar'):
+        sub.add_parser(accion).add_argument('nombre')
+    args = parser.parse_args()
+
+    if args.accion == 'listar':
+        for r in listar():
+            print(f"{r['id']:>4}  {'✓' if r['activa'] else '·'}  {r['nombre']:<24} {r['evento']:<7} {r['condiciones']}")
+    elif args.accion == 'anadir':
+        try:
+            anadir(args.nombre, args.evento, json.loads(args.condiciones))
+        except (ValueError, sqlite3.IntegrityError) as e:
+            raise SystemExit(str(e))
+    elif not activar(args.nombre, args.accion == 'activar'):
+        raise SystemExit(f"No existe la regla {args.nombre}")
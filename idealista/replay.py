@@ -0,0 +1,208 @@
+"""
+Reproducción (replay/backfill) de respuestas archivadas
+
+Pasa las páginas guardadas por archivo.py (o un directorio de volcados JSON
+de /search) por el mismo camino que una búsqueda real: parseo, dedup entre
+perfiles de la misma ejecución, clasificación contra `pisos`, historial,
+agregados de mercado y, al cerrar cada ejecución, bajas. Cada página se
+registra con la fecha con la que se archivó, así que reproducir el archivo
+sobre una BD vacía deja las mismas filas que las búsquedas originales.
+
+Solo sobre una BD sin pisos: una página antigua se clasificaría contra el
+precio actual y duplicaría historial, agregados y bajas. Para regenerar
+`pisos` (cambios de parseo o columnas nuevas) se reproduce en una BD nueva
+y se sustituye la de producción.
+
+Modo masivo: sin Telegram ni métricas, una transacción por cada
+REPLAY_BATCH_PAGES páginas (incluidas las bajas de las ejecuciones que se
+cierran dentro) y, opcionalmente, el parseo en varios procesos (solapado
+con la escritura del lote anterior).
+
+Uso:
+    python replay.py --destino data/pisos_nuevo.db                # todo el archivo
+    python replay.py --destino data/pisos_nuevo.db --desde 120    # desde la ejecución 120
+    python replay.py --destino data/pisos_nuevo.db --directorio volcados/   # *.json de /search
+"""
+import argparse
+import itertools
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import archivo
+import bajas
+import config
+import db
+import lotes
+import main_v2_quota
+import perfiles
+from utils import log_event
+
+logger = logging.getLogger('idealista')
+
+
+def paginas_archivo(desde_ejecucion: int = 0) -> Iterator[Dict]:
+    """Páginas del archivo en orden de escritura"""
+    for registro, contenido in archivo.iterar(desde_ejecucion):
+        yield {'ejecucion': registro['ejecucion'], 'perfil': registro['perfil'],
+               'pagina': registro['pagina'], 'fecha': registro['fecha'], 'contenido': contenido}
+
+
+def paginas_directorio(ruta: Path) -> Iterator[Dict]:
+    """
+    Volcados JSON de /search (*.json, en orden de nombre)
+
+    Cada fichero es una página suelta: sin ejecución (no hay dedup entre
+    perfiles ni bajas) y con la fecha de modificación del fichero.
+    """
+    for fichero in sorted(ruta.rglob('*.json')):
+        fecha = datetime.fromtimestamp(fichero.stat().st_mtime, timezone.utc)
+        yield {'ejecucion': None, 'perfil': None, 'pagina': None,
+               'fecha': fecha.strftime('%Y-%m-%d %H:%M:%S'), 'contenido': fichero.read_bytes()}
+
+
+def _trozos(paginas: Iterable[Dict], tamano: int) -> Iterator[List[Dict]]:
+    iterador = iter(paginas)
+    while trozo := list(itertools.islice(iterador, tamano)):
+        yield trozo
+
+
+class _Reproductor:
+    """Estado de la reproducción: ejecución en curso, vistos y totales"""
+
+    def __init__(self, cierres: Dict[int, Dict], procesos: int):
+        self.operaciones = {p['nombre']: p['operacion'] for p in perfiles.cargar_perfiles()}
+        self.cierres = dict(cierres)
+        self.procesos = procesos
+        self.ejecucion = None
+        self.vistos = perfiles.VistosCiclo()
+        self.estadisticas = {'paginas': 0, 'pisos': 0, 'nuevos': 0, 'modificados': 0,
+                             'bajas': 0, 'errores': 0, 'ejecuciones': 0}
+
+    def parsear(self, pool: Optional[ProcessPoolExecutor], trozo: List[Dict]) -> Iterator:
+        contenidos = [p['contenido'] for p in trozo]
+        operaciones = [self.operaciones.get(p['perfil']) for p in trozo]
+        if pool:
+            return pool.map(lotes.parsear_pagina, contenidos, operaciones,
+                            chunksize=max(1, len(trozo) // (4 * self.procesos)))
+        return map(lotes.parsear_pagina, contenidos, operaciones)
+
+    def _cerrar_hasta(self, ejecucion: Optional[int]):
+        """Cierra (bajas) las ejecuciones archivadas anteriores a `ejecucion` (None = todas)"""
+        for e in sorted(self.cierres):
+            if ejecucion is not None and e >= ejecucion:
+                break
+            info = self.cierres.pop(e)
+            ids = self.vistos.ids() if e == self.ejecucion else set()
+            if config.ENABLE_DELISTING:
+                self.estadisticas['bajas'] += bajas.cerrar_barrido(
+                    ids, info['completo'], info['fecha_fin'])['bajas']
+            self.estadisticas['ejecuciones'] += 1
+
+    def escribir(self, trozo: List[Dict], parseado: Iterable):
+        """Aplica un trozo de páginas (y los cierres de ejecución que caen dentro) en una transacción"""
+        with db.transaction() as conn:
+            for pagina, (ids, filas, errores) in zip(trozo, parseado):
+                ejecucion = pagina['ejecucion']
+                if ejecucion is not None and ejecucion != self.ejecucion:
+                    # bajas.cerrar_barrido se anida en esta misma transacción
+                    self._cerrar_hasta(ejecucion)
+                    self.ejecucion = ejecucion
+                    self.vistos = perfiles.VistosCiclo()
+                if ejecucion is not None:
+                    propios = set(self.vistos.reclamar(ids))
+                    filas = [f for f in filas if f['id'] in propios]
+                diff = main_v2_quota.persistir_lote(conn, filas, pagina['fecha'])
+                self.estadisticas['paginas'] += 1
+                self.estadisticas['pisos'] += len(filas)
+                self.estadisticas['nuevos'] += len(diff['nuevos'])
+                self.estadisticas['modificados'] += len(diff['bajadas']) + len(diff['subidas'])
+                self.estadisticas['errores'] += errores
+
+    def terminar(self):
+        self._cerrar_hasta(None)
+
+
+def reproducir(paginas: Iterable[Dict], procesos: int = 0, lote: Optional[int] = None,
+               cierres: Optional[Dict[int, Dict]] = None) -> Dict:
+    """
+    Reproduce páginas (paginas_archivo() o paginas_directorio()) sobre config.DB_PATH
+
+    Args:
+        paginas: Páginas en orden cronológico
+        procesos: Procesos para el parseo (0 = en este proceso)
+        lote: Páginas por transacción (por defecto REPLAY_BATCH_PAGES)
+        cierres: Ejecuciones a cerrar (bajas) al pasar a la siguiente: id ->
+            {'fecha_fin', 'completo'} (archivo.ejecuciones())
+
+    Returns:
+        Totales: paginas, pisos, nuevos, modificados, bajas, errores, ejecuciones, segundos
+
+    Raises:
+        ValueError: si la BD de destino ya tiene pisos
+    """
+    t0 = time.perf_counter()
+    lote = lote or config.REPLAY_BATCH_PAGES
+    main_v2_quota.init_db()
+    existentes = db.get_connection().execute("SELECT COUNT(*) FROM pisos").fetchone()[0]
+    if existentes:
+        # Las páginas antiguas se clasificarían contra el precio actual (historial,
+        # agregados y bajas duplicados o falsos): solo sobre una BD vacía
+        raise ValueError(f"{config.DB_PATH} ya tiene {existentes} pisos: reproducir en una BD "
+                         f"nueva (--destino) y sustituirla después")
+    reproductor = _Reproductor(cierres or {}, procesos)
+
+    pool = ProcessPoolExecutor(procesos) if procesos > 1 else None
+    try:
+        # El parseo del trozo siguiente (en el pool) se solapa con la escritura del actual
+        pendiente = None
+        for trozo in _trozos(paginas, lote):
+            parseado = reproductor.parsear(pool, trozo)
+            if pendiente:
+                reproductor.escribir(*pendiente)
+            pendiente = (trozo, parseado)
+        if pendiente:
+            reproductor.escribir(*pendiente)
+        reproductor.terminar()
+    finally:
+        if pool:
+            pool.shutdown()
+
+    estadisticas = reproductor.estadisticas
+    estadisticas['segundos'] = round(time.perf_counter() - t0, 3)
+    log_event(logger, 'REPLAY', estadisticas)
+    logger.info(f"🔁 Replay: {estadisticas['paginas']} páginas, {estadisticas['pisos']} pisos "
+                f"({estadisticas['nuevos']} nuevos, {estadisticas['modificados']} modificados, "
+                f"{estadisticas['bajas']} bajas) en {estadisticas['segundos']}s")
+    return estadisticas
+
+
+def reproducir_archivo(desde_ejecucion: int = 0, procesos: int = 0, lote: Optional[int] = None) -> Dict:
+    """Reproduce el archivo desde una ejecución, con las bajas de cada ejecución cerrada"""
+    cierres = {e: info for e, info in archivo.ejecuciones().items()
+               if e >= desde_ejecucion and info['completo'] is not None}
+    return reproducir(paginas_archivo(desde_ejecucion), procesos, lote, cierres)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reproduce respuestas archivadas sobre la BD")
+    parser.add_argument('--directorio', type=Path, help="Volcados JSON en lugar del archivo")
+    parser.add_argument('--desde', type=int, default=0, help="Primera ejecución archivada")
+    parser.add_argument('--destino', type=Path, help="BD de destino, vacía (por defecto DB_PATH)")
+    parser.add_argument('--procesos', type=int, default=0, help="Procesos de parseo")
+    parser.add_argument('--lote', type=int, default=config.REPLAY_BATCH_PAGES,
+                        help="Páginas por transacción")
+    args = parser.parse_args()
+
+    if args.destino:
+        config.DB_PATH = args.destino
+    try:
+        if args.directorio:
+            print(reproducir(paginas_directorio(args.directorio), args.procesos, args.lote))
+        else:
+            print(reproducir_archivo(args.desde, args.procesos, args.lote))
+    except ValueError as e:
+        raise SystemExit(str(e))
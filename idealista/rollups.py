@@ -0,0 +1,171 @@
+"""
+Agregados de mercado para Metabase (diarios y semanales)
+
+Cada precio que entra en `historial_precios` (alta o cambio de precio) se
+acumula en `mercado_rollup` por periodo (día o semana, que empieza en lunes),
+dimensión ('total', 'habitaciones', 'zona') y operación: altas, bajadas,
+subidas, sumas de precio y precio/m² y mín/máx. `mercado_hist` guarda un
+histograma logarítmico de precio/m² (~2% por cubo) del que la vista
+`v_mercado` saca la mediana sin recorrer el historial.
+
+procesar_lote los actualiza en la misma transacción a partir de la página
+(tmp_lote); `python rollups.py --reconstruir` los regenera desde el historial.
+"""
+import argparse
+import logging
+
+import db
+
+logger = logging.getLogger('idealista')
+
+# Cubos por unidad de ln(precio/m²): exp(1/50) ≈ 2% de resolución en la mediana
+CUBOS_POR_LN = 50
+
+_CLAVE = 'granularidad, periodo, dimension, valor, operacion'
+
+# Cada evento se multiplica por granularidad y dimensión
+_EXPANDIR = """
+    SELECT g.granularidad,
+           CASE g.granularidad WHEN 'dia' THEN date(e.fecha)
+                ELSE date(e.fecha, 'weekday 0', '-6 days') END AS periodo,
+           d.dimension,
+           CASE d.dimension WHEN 'total' THEN ''
+                WHEN 'habitaciones' THEN COALESCE(CAST(e.habitaciones AS TEXT), 'desconocido')
+                ELSE COALESCE(e.zona, 'desconocida') END AS valor,
+           COALESCE(e.operacion, 'rent') AS operacion,
+           e.clase, e.precio,
+           CASE WHEN e.metros > 0 AND e.precio > 0 THEN e.precio * 1.0 / e.metros END AS precio_m2
+    FROM eventos e
+    CROSS JOIN (SELECT 'dia' AS granularidad UNION ALL SELECT 'semana') g
+    CROSS JOIN (SELECT 'total' AS dimension UNION ALL SELECT 'habitaciones'
+                UNION ALL SELECT 'zona') d"""
+
+# Eventos de la página actual (lotes.aplicar_lote ya clasificó tmp_lote)
+_EVENTOS_LOTE = """
+    SELECT :fecha AS fecha, habitaciones, zona, operacion, metros, precio, clase
+    FROM tmp_lote WHERE clase != 'sin_cambios'"""
+
+# Eventos reconstruidos del historial: la primera entrada de cada piso es el alta
+_EVENTOS_HISTORIAL = """
+    SELECT h.fecha, p.habitaciones, p.zona, p.operacion, p.metros, h.precio,
+           CASE WHEN h.anterior IS NULL THEN 'nuevos'
+                WHEN h.precio < h.anterior THEN 'bajadas'
+                WHEN h.precio > h.anterior THEN 'subidas'
+                ELSE 'sin_cambios' END AS clase
+    FROM (SELECT id_piso, precio, fecha,
+                 LAG(precio) OVER (PARTITION BY id_piso ORDER BY fecha, rowid) AS anterior
+          FROM historial_precios) h
+    JOIN pisos p ON p.id = h.id_piso"""
+
+
+def crear_tablas(conn):
+    """Crea las tablas y vistas de agregados (llamado desde init_db)"""
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS mercado_rollup (
+        granularidad TEXT NOT NULL,
+        periodo TEXT NOT NULL,
+        dimension TEXT NOT NULL,
+        valor TEXT NOT NULL,
+        operacion TEXT NOT NULL,
+        nuevos INTEGER DEFAULT 0,
+        bajadas INTEGER DEFAULT 0,
+        subidas INTEGER DEFAULT 0,
+        n_precio INTEGER DEFAULT 0,
+        suma_precio REAL DEFAULT 0,
+        n_precio_m2 INTEGER DEFAULT 0,
+        suma_precio_m2 REAL DEFAULT 0,
+        min_precio_m2 REAL,
+        max_precio_m2 REAL,
+        PRIMARY KEY ({_CLAVE})
+    ) WITHOUT ROWID''')
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS mercado_hist (
+        granularidad TEXT NOT NULL,
+        periodo TEXT NOT NULL,
+        dimension TEXT NOT NULL,
+        valor TEXT NOT NULL,
+        operacion TEXT NOT NULL,
+        cubo INTEGER NOT NULL,
+        n INTEGER NOT NULL,
+        PRIMARY KEY ({_CLAVE}, cubo)
+    ) WITHOUT ROWID''')
+    conn.execute(f'''CREATE VIEW IF NOT EXISTS v_mercado_mediana AS
+        WITH acumulado AS (
+            SELECT {_CLAVE}, cubo,
+                   SUM(n) OVER (PARTITION BY {_CLAVE} ORDER BY cubo) AS acumulado,
+                   SUM(n) OVER (PARTITION BY {_CLAVE}) AS total
+            FROM mercado_hist)
+        SELECT {_CLAVE}, round(exp(MIN(cubo) * 1.0 / {CUBOS_POR_LN}), 2) AS mediana_precio_m2
+        FROM acumulado WHERE acumulado * 2 >= total
+        GROUP BY {_CLAVE}''')
+    conn.execute(f'''CREATE VIEW IF NOT EXISTS v_mercado AS
+        SELECT r.granularidad, r.periodo, r.dimension, r.valor, r.operacion,
+               r.nuevos, r.bajadas, r.subidas,
+               round(r.suma_precio / NULLIF(r.n_precio, 0), 2) AS precio_medio,
+               round(r.suma_precio_m2 / NULLIF(r.n_precio_m2, 0), 2) AS precio_m2_medio,
+               m.mediana_precio_m2, r.min_precio_m2, r.max_precio_m2, r.n_precio
+        FROM mercado_rollup r
+        LEFT JOIN v_mercado_mediana m USING ({_CLAVE})''')
+
+
+def _acumular(conn, eventos: str, parametros: dict):
+    """Suma los eventos de la consulta `eventos` a las tablas de agregados"""
+    conn.execute(f"""
+        WITH eventos AS ({eventos}), expandido AS ({_EXPANDIR})
+        INSERT INTO mercado_rollup ({_CLAVE}, nuevos, bajadas, subidas, n_precio, suma_precio,
+                                    n_precio_m2, suma_precio_m2, min_precio_m2, max_precio_m2)
+        SELECT {_CLAVE}, SUM(clase = 'nuevos'), SUM(clase = 'bajadas'), SUM(clase = 'subidas'),
+               COUNT(precio), COALESCE(SUM(precio), 0),
+               COUNT(precio_m2), COALESCE(SUM(precio_m2), 0), MIN(precio_m2), MAX(precio_m2)
+        FROM expandido WHERE clase != 'sin_cambios'
+        GROUP BY {_CLAVE}
+        ON CONFLICT ({_CLAVE}) DO UPDATE SET
+            nuevos = nuevos + excluded.nuevos,
+            bajadas = bajadas + excluded.bajadas,
+            subidas = subidas + excluded.subidas,
+            n_precio = n_precio + excluded.n_precio,
+            suma_precio = suma_precio + excluded.suma_precio,
+            n_precio_m2 = n_precio_m2 + excluded.n_precio_m2,
+            suma_precio_m2 = suma_precio_m2 + excluded.suma_precio_m2,
+            min_precio_m2 = COALESCE(min(min_precio_m2, excluded.min_precio_m2),
+                                     min_precio_m2, excluded.min_precio_m2),
+            max_precio_m2 = COALESCE(max(max_precio_m2, excluded.max_precio_m2),
+                                     max_precio_m2, excluded.max_precio_m2)""", parametros)
+    conn.execute(f"""
+        WITH eventos AS ({eventos}), expandido AS ({_EXPANDIR})
+        INSERT INTO mercado_hist ({_CLAVE}, cubo, n)
+        SELECT {_CLAVE}, CAST(round(ln(precio_m2) * {CUBOS_POR_LN}) AS INTEGER) AS cubo, COUNT(*)
+        FROM expandido WHERE clase != 'sin_cambios' AND precio_m2 IS NOT NULL
+        GROUP BY {_CLAVE}, cubo
+        ON CONFLICT ({_CLAVE}, cubo) DO UPDATE SET n = n + excluded.n""", parametros)
+
+
+def actualizar_lote(conn, fecha: str):
+    """
+    Acumula la página recién aplicada (tmp_lote clasificada por lotes.aplicar_lote)
+
+    Debe llamarse en la misma transacción que aplicar_lote y con la misma fecha
+    que se registró en historial_precios.
+    """
+    _acumular(conn, _EVENTOS_LOTE, {'fecha': fecha})
+
+
+def reconstruir():
+    """Regenera los agregados desde historial_precios (en una transacción)"""
+    with db.transaction() as conn:
+        conn.execute("DELETE FROM mercado_rollup")
+        conn.execute("DELETE FROM mercado_hist")
+        _acumular(conn, _EVENTOS_HISTORIAL, {})
+        filas = conn.execute("SELECT COUNT(*) FROM mercado_rollup").fetchone()[0]
+    logger.info(f"Agregados de mercado reconstruidos: {filas} filas")
+    return filas
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Agregados de mercado para Metabase")
+    parser.add_argument('--reconstruir', action='store_true',
+                        help="Regenera mercado_rollup y mercado_hist desde el historial")
+    args = parser.parse_args()
+
+    if args.reconstruir:
+        print(f"{reconstruir()} filas en mercado_rollup")
+    else:
+        parser.print_help()
@@ -0,0 +1,302 @@
+"""
+Suscripciones: varios chats de Telegram, cada uno con sus filtros
+
+Cada fila de `suscripciones` es un chat con filtros opcionales (eventos,
+operación, habitaciones, rango de precio y zonas), horas de silencio
+('23:00-08:00': lo que llega en ese tramo se encola para su final) y modo
+'inmediato', 'digest' o 'hibrido' (ver digest.py).
+Un filtro vacío admite cualquier valor; habitaciones 4 es "4 o más", como
+en la búsqueda de Idealista.
+
+El reparto no recorre los suscriptores: un índice invertido guarda, por
+atributo y valor, la máscara de bits de las suscripciones que lo admiten
+(el precio en bandas logarítmicas de ~10%). Los destinatarios de un evento
+son el AND de una máscara por atributo; solo las bandas de los extremos se
+comprueban después con el precio exacto. El índice se reconstruye cuando
+cambia la tabla (db.versionar).
+
+Sin suscripciones activas se avisa a TELEGRAM_CHAT_ID sin filtros y en el
+modo NOTIFICATION_MODE. TELEGRAM_CHAT_ID sigue recibiendo siempre los avisos del bot
+(quota, errores).
+"""
+import argparse
+import logging
+import math
+import sqlite3
+import threading
+from datetime import datetime, time as hora, timedelta
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+import config
+import db
+import reglas
+
+logger = logging.getLogger('idealista')
+
+INMEDIATO = 'inmediato'
+DIGEST = 'digest'
+HIBRIDO = 'hibrido'
+MODOS = (INMEDIATO, DIGEST, HIBRIDO)
+
+BANDAS_POR_LN = 10  # bandas de precio de ~10,5%
+PRECIO_MAXIMO = 1e8  # límite superior de las suscripciones sin precio máximo
+ATRIBUTOS = ('evento', 'operacion', 'habitaciones', 'banda', 'zona')
+
+
+def crear_tablas(conn):
+    """Crea la tabla de suscripciones (llamado desde init_db)"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS suscripciones (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id TEXT UNIQUE NOT NULL,
+        nombre TEXT,
+        eventos TEXT,
+        operacion TEXT,
+        habitaciones TEXT,
+        precio_min REAL,
+        precio_max REAL,
+        zonas TEXT,
+        silencio TEXT,
+        modo TEXT NOT NULL DEFAULT 'inmediato',
+        activa BOOLEAN DEFAULT 1,
+        fecha_creacion DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+    # Cualquier cambio en la tabla (también desde fuera del bot) reconstruye el índice
+    db.versionar(conn, 'suscripciones')
+
+
+class Suscripcion(NamedTuple):
+    chat_id: Optional[str]  # None: TELEGRAM_CHAT_ID
+    nombre: str = ''
+    eventos: Optional[frozenset] = None  # None en un filtro: cualquier valor
+    operacion: Optional[str] = None
+    habitaciones: Optional[frozenset] = None
+    precio_min: Optional[float] = None
+    precio_max: Optional[float] = None
+    zonas: Optional[frozenset] = None
+    silencio: Optional[Tuple[hora, hora]] = None
+    modo: str = INMEDIATO
+
+
+def _lista(texto: Optional[str]) -> Optional[List[str]]:
+    """'a, b' -> ['a', 'b']; vacío -> None"""
+    valores = [v.strip() for v in (texto or '').split(',') if v.strip()]
+    return valores or None
+
+
+def _silencio(texto: Optional[str]) -> Optional[Tuple[hora, hora]]:
+    """'23:00-08:00' -> (23:00, 08:00)"""
+    if not texto:
+        return None
+    try:
+        desde, hasta = (hora.fromisoformat(parte.strip()) for parte in texto.split('-'))
+    except ValueError:
+        raise ValueError(f"Horas de silencio inválidas '{texto}' (formato HH:MM-HH:MM)") from None
+    return desde, hasta
+
+
+def normalizar(datos: Dict) -> Suscripcion:
+    """Fila de la tabla (o de la CLI) -> Suscripcion validada"""
+    eventos = _lista(datos.get('eventos'))
+    if eventos and set(eventos) - set(reglas.EVENTOS):
+        raise ValueError(f"Eventos inválidos {eventos} (válidos: {', '.join(reglas.EVENTOS)})")
+    modo = datos.get('modo') or INMEDIATO
+    if modo not in MODOS:
+        raise ValueError(f"Modo inválido '{modo}' (válidos: {', '.join(MODOS)})")
+    habitaciones = _lista(datos.get('habitaciones'))
+    zonas = _lista(datos.get('zonas'))
+    return Suscripcion(
+        chat_id=str(datos['chat_id']),
+        nombre=datos.get('nombre') or '',
+        eventos=frozenset(eventos) if eventos else None,
+        operacion=datos.get('operacion') or None,
+        habitaciones=frozenset(min(int(h), 4) for h in habitaciones) if habitaciones else None,
+        precio_min=datos.get('precio_min'),
+        precio_max=datos.get('precio_max'),
+        zonas=frozenset(zonas) if zonas else None,
+        silencio=_silencio(datos.get('silencio')),
+        modo=modo,
+    )
+
+
+def banda(precio: float) -> int:
+    return int(math.log(max(precio, 1)) * BANDAS_POR_LN)
+
+
+def coincide(s: Suscripcion, evento: str, fila: Dict) -> bool:
+    """Si un evento pasa los filtros de una suscripción (la definición que sigue el índice)"""
+    habitaciones = fila.get('habitaciones')
+    precio = fila.get('precio')
+    return ((s.eventos is None or evento in s.eventos)
+            and (s.operacion is None or (fila.get('operacion') or 'rent') == s.operacion)
+            and (s.habitaciones is None
+                 or (habitaciones is not None and min(int(habitaciones), 4) in s.habitaciones))
+            and (s.precio_min is None or (precio is not None and precio >= s.precio_min))
+            and (s.precio_max is None or (precio is not None and precio <= s.precio_max))
+            and (s.zonas is None or fila.get('zona') in s.zonas))
+
+
+def _claves_suscripcion(s: Suscripcion) -> Dict[str, Optional[frozenset]]:
+    """Valores de cada atributo que admite la suscripción (None: cualquiera)"""
+    bandas = None
+    if s.precio_min is not None or s.precio_max is not None:
+        bandas = range(banda(s.precio_min or 1), banda(s.precio_max or PRECIO_MAXIMO) + 1)
+    return {'evento': s.eventos, 'operacion': s.operacion and (s.operacion,),
+            'habitaciones': s.habitaciones, 'banda': bandas, 'zona': s.zonas}
+
+
+def _claves_evento(evento: str, fila: Dict) -> Tuple:
+    habitaciones, precio = fila.get('habitaciones'), fila.get('precio')
+    return (evento, fila.get('operacion') or 'rent',
+            min(int(habitaciones), 4) if habitaciones is not None else None,
+            banda(precio) if precio is not None else None,
+            fila.get('zona'))
+
+
+class Indice:
+    """Índice invertido: (atributo, valor) -> máscara de bits de suscripciones"""
+
+    def __init__(self, suscripciones: List[Suscripcion]):
+        self.suscripciones = suscripciones
+        self._bytes = len(suscripciones) // 8 + 1
+        self._todas = (1 << len(suscripciones)) - 1
+        posiciones: List[Dict] = [{} for _ in ATRIBUTOS]
+        cualquiera: List[List[int]] = [[] for _ in ATRIBUTOS]
+        for i, s in enumerate(suscripciones):
+            claves = _claves_suscripcion(s)
+            for n, atributo in enumerate(ATRIBUTOS):
+                if claves[atributo] is None:
+                    cualquiera[n].append(i)
+                else:
+                    for valor in claves[atributo]:
+                        posiciones[n].setdefault(valor, []).append(i)
+        self._valores = [{valor: self._mascara(lista) for valor, lista in p.items()} for p in posiciones]
+        self._cualquiera = [self._mascara(lista) for lista in cualquiera]
+
+    def _mascara(self, posiciones: List[int]) -> int:
+        bits = np.zeros(self._bytes * 8, dtype=np.uint8)
+        bits[posiciones] = 1
+        return int.from_bytes(np.packbits(bits, bitorder='little').tobytes(), 'little')
+
+    def suscriptores(self, evento: str, fila: Dict) -> List[Suscripcion]:
+        """Suscripciones cuyos filtros pasa el evento, en orden de la tabla"""
+        mascara = self._todas
+        for n, valor in enumerate(_claves_evento(evento, fila)):
+            mascara &= self._valores[n].get(valor, 0) | self._cualquiera[n]
+            if not mascara:
+                return []
+        # Posiciones de los bits a 1 en un solo paso (bit a bit sería cuadrático)
+        bits = np.unpackbits(np.frombuffer(mascara.to_bytes(self._bytes, 'little'), dtype=np.uint8),
+                             bitorder='little')
+        precio = fila.get('precio')
+        resultado = []
+        for i in np.flatnonzero(bits).tolist():
+            s = self.suscripciones[i]
+            # La banda es aproximada: el precio exacto solo importa en los extremos
+            if ((s.precio_min is None or precio >= s.precio_min)
+                    and (s.precio_max is None or precio <= s.precio_max)):
+                resultado.append(s)
+        return resultado
+
+
+def cargar(conn) -> List[Suscripcion]:
+    """Suscripciones activas; sin ninguna, TELEGRAM_CHAT_ID sin filtros en NOTIFICATION_MODE"""
+    filas = conn.execute("""SELECT chat_id, nombre, eventos, operacion, habitaciones, precio_min,
+                                   precio_max, zonas, silencio, modo
+                            FROM suscripciones WHERE activa = 1 ORDER BY id""")
+    columnas = [c[0] for c in filas.description]
+    suscripciones = []
+    for fila in filas:
+        datos = dict(zip(columnas, fila))
+        try:
+            suscripciones.append(normalizar(datos))
+        except ValueError as e:
+            logger.warning(f"Suscripción {datos['chat_id']} ignorada: {e}")
+    return suscripciones or [Suscripcion(chat_id=None, modo=config.NOTIFICATION_MODE)]
+
+
+_indices: Dict[str, Tuple[int, Indice]] = {}
+_indices_lock = threading.Lock()
+
+
+def indice(conn) -> Indice:
+    """Índice de la BD actual (config.DB_PATH), reconstruido solo si cambió la tabla"""
+    version = db.version(conn, 'suscripciones')
+    clave = str(config.DB_PATH)
+    with _indices_lock:
+        actual = _indices.get(clave)
+        if actual is None or actual[0] != version:
+            actual = _indices[clave] = (version, Indice(cargar(conn)))
+    return actual[1]
+
+
+def fin_silencio(s: Suscripcion, ahora: Optional[datetime] = None) -> Optional[float]:
+    """Epoch del final de las horas de silencio si ahora (hora local) está dentro; si no, None"""
+    if s.silencio is None:
+        return None
+    ahora = ahora or datetime.now()
+    desde, hasta = s.silencio
+    actual = ahora.time()
+    dentro = desde <= actual < hasta if desde <= hasta else (actual >= desde or actual < hasta)
+    if not dentro:
+        return None
+    fin = datetime.combine(ahora.date(), hasta)
+    if fin <= ahora:
+        fin += timedelta(days=1)
+    return fin.timestamp()
+
+
+def anadir(datos: Dict):
+    """Valida y guarda una suscripción nueva"""
+    normalizar(datos)
+    columnas = [c for c in ('chat_id', 'nombre', 'eventos', 'operacion', 'habitaciones', 'precio_min',
+                            'precio_max', 'zonas', 'silencio', 'modo') if datos.get(c) is not None]
+    with db.transaction() as conn:
+        conn.execute(f"INSERT INTO suscripciones ({', '.join(columnas)}) VALUES ({', '.join('?' for _ in columnas)})",
+                     [datos[c] for c in columnas])
+
+
+def activar(chat_id: str, activa: bool = True) -> bool:
+    with db.transaction() as conn:
+        return conn.execute("UPDATE suscripciones SET activa = ? WHERE chat_id = ?",
+                            (activa, chat_id)).rowcount > 0
+
+
+def listar() -> List[Dict]:
+    filas = db.get_connection().execute("SELECT * FROM suscripciones ORDER BY id")
+    columnas = [c[0] for c in filas.description]
+    return [dict(zip(columnas, f)) for f in filas]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Suscripciones de Telegram")
+    sub = parser.add_subparsers(dest='accion', required=True)
+    sub.add_parser('listar')
+    p_anadir = sub.add_parser('anadir')
+    p_anadir.add_argument('chat_id')
+    p_anadir.add_argument('--nombre')
+    p_anadir.add_argument('--eventos', help="nuevo,bajada,subida")
+    p_anadir.add_argument('--operacion', choices=('rent', 'sale'))
+    p_anadir.add_argument('--habitaciones', help="p. ej. 2,3,4 (4 = 4 o más)")
+    p_anadir.add_argument('--precio-min', type=float)
+    p_anadir.add_argument('--precio-max', type=float)
+    p_anadir.add_argument('--zonas', help="Separadas por comas")
+    p_anadir.add_argument('--silencio', help="HH:MM-HH:MM, hora local")
+    p_anadir.add_argument('--modo', choices=MODOS, default=INMEDIATO)
+    for accion in ('activar', 'desactivar'):
+        sub.add_parser(accion).add_argument('chat_id')
+    args = parser.parse_args()
+
+    if args.accion == 'listar':
+        for s in listar():
+            filtros = ', '.join(f"{k}={v}" for k, v in s.items()
+                                if k not in ('id', 'chat_id', 'activa', 'fecha_creacion') and v is not None)
+            print(f"{s['id']:>4}  {'✓' if s['activa'] else '·'}  {s['chat_id']:<16} {filtros}")
+    elif args.accion == 'anadir':
+        try:
+            anadir({k: v for k, v in vars(args).items() if k != 'accion'})
+        except (ValueError, sqlite3.IntegrityError) as e:
+            raise SystemExit(str(e))
+    elif not activar(args.chat_id, args.accion == 'activar'):
+        raise SystemExit(f"No existe la suscripción {args.chat_id}")
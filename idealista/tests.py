@@ -2,6 +2,8 @@
 Tests unitarios para el bot de Idealista
 Ejecutar con: python -m pytest tests.py -v
 """
+import io
+import logging
 import unittest
 from unittest.mock import patch, MagicMock
 from pathlib import Path
@@ -9,11 +11,45 @@ import tempfile
 import sqlite3
 import sys
 import os
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
 
 # Agregar el directorio principal al path
 sys.path.insert(0, str(Path(__file__).parent))
+# Los logs de los tests no van a data/ (main_v2_quota configura el logging al importarse)
+os.environ.setdefault('LOG_PATH', str(Path(tempfile.mkdtemp()) / 'logs.log'))
 
+import anomalias
+import archivo
+import backup
+import bajas
+import benchmarks
 import config
+import db
+import dedup
+import digest
+import fake_idealista
+import geo
+import lotes
+import metrics
+import http_client
+import incremental
+import main_v2_quota
+import notificaciones
+import perfiles
+import planificador
+import quota
+import reglas
+import replay
+import rollups
+import suscripciones
+import token_cache
+import utils
 from utils import setup_logging, log_event
 
 
@@ -42,6 +78,17 @@ class TestConfig(unittest.TestCase):
             valid, msg = config.validate_config()
             self.assertFalse(valid)
             self.assertIsNotNone(msg)
+    
+    def test_validate_config_search_mode(self):
+        """Test que un modo de paginación desconocido se rechaza"""
+        with patch.object(config, 'IDEALISTA_API_KEY', 'k'), \
+                patch.object(config, 'IDEALISTA_SECRET', 's'), \
+                patch.object(config, 'ENABLE_TELEGRAM', False), \
+                patch.object(config, 'NOTIFICATION_MODE', 'inmediato'):
+            with patch.object(config, 'SEARCH_MODE', 'full'):
+                self.assertEqual(config.validate_config(), (False, "SEARCH_MODE inválido: full"))
+            with patch.object(config, 'SEARCH_MODE', 'completo'):
+                self.assertEqual(config.validate_config(), (True, None))
 
 
 class TestDatabase(unittest.TestCase):
@@ -104,6 +151,1645 @@ class TestDatabase(unittest.TestCase):
         conn.close()
 
 
+class TestConexionDB(unittest.TestCase):
+    """Tests para el gestor de conexiones compartidas"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.temp_dir.name) / 'test.db'
+    
+    def tearDown(self):
+        db.close_all()
+        self.temp_dir.cleanup()
+    
+    def test_pragmas_wal(self):
+        """Test que la conexión queda en WAL con synchronous=NORMAL"""
+        conn = db.get_connection(self.db_path)
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+        self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 1)
+        self.assertEqual(conn.execute("PRAGMA busy_timeout").fetchone()[0], config.DB_BUSY_TIMEOUT_MS)
+    
+    def test_conexion_reutilizada_por_hilo(self):
+        """Test misma conexión en el mismo hilo y distinta en otro hilo"""
+        conn = db.get_connection(self.db_path)
+        self.assertIs(conn, db.get_connection(self.db_path))
+        
+        otras = []
+        hilo = threading.Thread(target=lambda: otras.append(db.get_connection(self.db_path)))
+        hilo.start()
+        hilo.join()
+        self.assertIsNot(conn, otras[0])
+    
+    def test_transaccion_rollback(self):
+        """Test que una excepción deshace la transacción"""
+        with db.transaction(self.db_path) as conn:
+            conn.execute("CREATE TABLE t (x INTEGER)")
+        
+        with self.assertRaises(ValueError):
+            with db.transaction(self.db_path) as conn:
+                conn.execute("INSERT INTO t VALUES (1)")
+                raise ValueError("fallo")
+        
+        count = db.get_connection(self.db_path).execute("SELECT COUNT(*) FROM t").fetchone()[0]
+        self.assertEqual(count, 0)
+    
+    def test_lector_no_bloquea_escritor(self):
+        """Test que un lector con transacción abierta no bloquea al escritor (WAL)"""
+        with db.transaction(self.db_path) as conn:
+            conn.execute("CREATE TABLE t (x INTEGER)")
+        
+        lector = sqlite3.connect(str(self.db_path))
+        lector.execute("BEGIN")
+        lector.execute("SELECT COUNT(*) FROM t").fetchone()
+        
+        with db.transaction(self.db_path) as conn:
+            conn.execute("INSERT INTO t VALUES (1)")
+        
+        lector.rollback()
+        lector.close()
+
+
+class BDTemporalMixin:
+    """Crea una BD temporal con el esquema completo del bot"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.temp_dir.name) / 'pisos.db'
+        self.patcher_db = patch.object(config, 'DB_PATH', self.db_path)
+        self.patcher_db.start()
+        self.patcher_perfiles = patch.object(config, 'SEARCH_PROFILES_FILE',
+                                             Path(self.temp_dir.name) / 'perfiles.json')
+        self.patcher_perfiles.start()
+        self.patcher_archivo = patch.object(config, 'ARCHIVE_DIR', Path(self.temp_dir.name) / 'archivo')
+        self.patcher_archivo.start()
+        self.patcher_quota = patch.object(main_v2_quota, '_quota', quota.QuotaLedger())
+        self.patcher_quota.start()
+        main_v2_quota.init_db()
+    
+    def tearDown(self):
+        db.close_all()
+        self.patcher_quota.stop()
+        self.patcher_archivo.stop()
+        self.patcher_perfiles.stop()
+        self.patcher_db.stop()
+        self.temp_dir.cleanup()
+
+
+def piso_api(codigo, precio, **extra):
+    """Elemento de `elementList` mínimo para tests"""
+    piso = {
+        'propertyCode': codigo,
+        'price': precio,
+        'size': 80,
+        'rooms': 3,
+        'url': f'https://www.idealista.com/inmueble/{codigo}/',
+        'suggestedTexts': {'title': f'Piso {codigo}'},
+    }
+    piso.update(extra)
+    return piso
+
+
+class TestLotes(BDTemporalMixin, unittest.TestCase):
+    """Tests para el upsert por lotes"""
+    
+    def test_clasificacion(self):
+        """Test clasificación nuevo / bajada / subida / sin cambios"""
+        main_v2_quota.procesar_lote([piso_api(1, 1000), piso_api(2, 1000), piso_api(3, 1000)])
+        
+        with patch.object(main_v2_quota, 'enviar_telegram') as enviar:
+            diff = main_v2_quota.procesar_lote_diff(
+                [piso_api(1, 900), piso_api(2, 1100), piso_api(3, 1000), piso_api(4, 700)])
+        
+        self.assertEqual([f['id'] for f in diff['nuevos']], ['4'])
+        self.assertEqual([f['id'] for f in diff['bajadas']], ['1'])
+        self.assertEqual(diff['bajadas'][0]['precio_anterior'], 1000)
+        self.assertEqual([f['id'] for f in diff['subidas']], ['2'])
+        self.assertEqual([f['id'] for f in diff['sin_cambios']], ['3'])
+        # Una novedad y una bajada notificadas
+        self.assertEqual(enviar.call_count, 2)
+    
+    def test_persistencia_e_historial(self):
+        """Test que precios e historial quedan actualizados"""
+        with patch.object(main_v2_quota, 'enviar_telegram'):
+            self.assertEqual(main_v2_quota.procesar_lote([piso_api(1, 1000)]), (1, 0))
+            self.assertEqual(main_v2_quota.procesar_lote([piso_api(1, 800), piso_api(1, 850)]), (0, 1))
+        
+        conn = db.get_connection()
+        self.assertEqual(conn.execute("SELECT precio, precio_m2 FROM pisos WHERE id='1'").fetchone(),
+                         (850, 10.6))
+        historial = [r[0] for r in conn.execute("SELECT precio FROM historial_precios ORDER BY rowid")]
+        self.assertEqual(historial, [1000, 850])
+    
+    def test_parsear_piso(self):
+        """Test cálculo de precio_m2 cuando la API no lo trae"""
+        fila = lotes.parsear_piso(piso_api(7, 1200))
+        self.assertEqual(fila['id'], '7')
+        self.assertEqual(fila['precio_m2'], 15.0)
+
+
+class FakeTelegram:
+    """Servidor HTTP local que imita sendMessage de Telegram"""
+    
+    def __init__(self):
+        self.recibidos = []
+        self.respuestas = []  # (status, cuerpo) a devolver antes de responder OK
+        self.conexiones = set()  # Puertos cliente vistos (keep-alive)
+        fake = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def do_POST(self):
+                fake.conexiones.add(self.client_address[1])
+                longitud = int(self.headers['Content-Length'])
+                datos = parse_qs(self.rfile.read(longitud).decode())
+                status, cuerpo = fake.respuestas.pop(0) if fake.respuestas else (200, {'ok': True})
+                if status == 200:
+                    fake.recibidos.append((self.path, datos['chat_id'][0], datos['text'][0]))
+                respuesta = json.dumps(cuerpo).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(respuesta)))
+                self.end_headers()
+                self.wfile.write(respuesta)
+            
+            def log_message(self, *args):
+                pass
+        
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestNotificaciones(BDTemporalMixin, unittest.TestCase):
+    """Tests para la cola de Telegram contra un servidor falso local"""
+    
+    def setUp(self):
+        super().setUp()
+        self.fake = FakeTelegram()
+        self.patchers = [
+            patch.object(config, 'TELEGRAM_API_URL', self.fake.url),
+            patch.object(config, 'TELEGRAM_TOKEN', 'TEST'),
+            patch.object(config, 'TELEGRAM_CHAT_ID', '1000'),
+            patch.object(config, 'ENABLE_TELEGRAM', True),
+            patch.object(config, 'TELEGRAM_BACKOFF_BASE', 0.05),
+        ]
+        for p in self.patchers:
+            p.start()
+        self.trabajador = notificaciones.TrabajadorTelegram(
+            limitador=notificaciones.LimitadorTelegram(por_segundo=100, intervalo_chat=0))
+    
+    def tearDown(self):
+        for p in self.patchers:
+            p.stop()
+        self.fake.close()
+        super().tearDown()
+    
+    def _estados(self):
+        return [r[0] for r in db.get_connection().execute("SELECT estado FROM cola_telegram ORDER BY id")]
+    
+    def test_envio_en_orden(self):
+        """Test que los mensajes encolados llegan en orden al servidor"""
+        notificaciones.encolar("uno")
+        notificaciones.encolar("dos", chat_id='2000')
+        enviados, _ = self.trabajador.procesar_pendientes()
+        
+        self.assertEqual(enviados, 2)
+        self.assertEqual([r[1:] for r in self.fake.recibidos], [('1000', 'uno'), ('2000', 'dos')])
+        self.assertEqual(self.fake.recibidos[0][0], '/botTEST/sendMessage')
+        self.assertEqual(self._estados(), ['enviado', 'enviado'])
+    
+    def test_retry_after_429(self):
+        """Test que un 429 respeta retry_after y no adelanta mensajes del mismo chat"""
+        self.fake.respuestas.append((429, {'ok': False, 'parameters': {'retry_after': 0.2}}))
+        notificaciones.encolar("uno")
+        notificaciones.encolar("dos")
+        
+        enviados, espera = self.trabajador.procesar_pendientes()
+        self.assertEqual(enviados, 0)
+        self.assertGreater(espera, 0)
+        self.assertEqual(self._estados(), ['pendiente', 'pendiente'])
+        
+        time.sleep(0.25)
+        enviados, _ = self.trabajador.procesar_pendientes()
+        self.assertEqual([r[2] for r in self.fake.recibidos], ['uno', 'dos'])
+    
+    def test_backoff_y_fallo_permanente(self):
+        """Test reintento con backoff tras 5xx y descarte tras 4xx"""
+        self.fake.respuestas.append((500, {'ok': False}))
+        notificaciones.encolar("reintentable")
+        self.trabajador.procesar_pendientes()
+        intentos = db.get_connection().execute("SELECT intentos FROM cola_telegram").fetchone()[0]
+        self.assertEqual(intentos, 1)
+        
+        time.sleep(0.1)
+        self.trabajador.procesar_pendientes()
+        self.assertEqual(self._estados(), ['enviado'])
+        
+        self.fake.respuestas.append((400, {'ok': False, 'description': 'bad request'}))
+        notificaciones.encolar("roto")
+        self.trabajador.procesar_pendientes()
+        self.assertEqual(self._estados(), ['enviado', 'fallido'])
+    
+    def test_limitador_por_chat(self):
+        """Test límites por chat privado y por grupo con reloj simulado"""
+        ahora = [0.0]
+        limitador = notificaciones.LimitadorTelegram(
+            por_segundo=30, intervalo_chat=1.0, por_minuto_grupo=2, reloj=lambda: ahora[0])
+        
+        limitador.registrar('1')
+        self.assertAlmostEqual(limitador.espera_chat('1'), 1.0)
+        ahora[0] = 1.0
+        self.assertEqual(limitador.espera_chat('1'), 0)
+        
+        limitador.registrar('-5')
+        limitador.registrar('-5')
+        self.assertAlmostEqual(limitador.espera_chat('-5'), 60.0)
+        
+        limitador.bloquear('1', 10)
+        self.assertAlmostEqual(limitador.espera_chat('1'), 10.0)
+    
+    def test_procesar_lote_no_espera_a_telegram(self):
+        """Test que procesar_lote solo encola las notificaciones"""
+        main_v2_quota.procesar_lote([piso_api(1, 1000), piso_api(2, 900)])
+        self.assertEqual(self._estados(), ['pendiente', 'pendiente'])
+        self.assertEqual(self.fake.recibidos, [])
+
+
+class TestHttpClient(unittest.TestCase):
+    """Tests para las sesiones HTTP compartidas"""
+    
+    def setUp(self):
+        self.fake = FakeTelegram()
+        http_client.reiniciar_estadisticas()
+    
+    def tearDown(self):
+        http_client.cerrar()
+        self.fake.close()
+    
+    def test_keep_alive(self):
+        """Test que varias peticiones reutilizan la misma conexión TCP"""
+        url = f"{self.fake.url}/botTEST/sendMessage"
+        self.assertIs(http_client.get_session(url), http_client.get_session(self.fake.url))
+        for i in range(5):
+            response = http_client.post(url, data={'chat_id': '1', 'text': str(i)})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.fake.recibidos), 5)
+        self.assertEqual(len(self.fake.conexiones), 1)
+    
+    def test_estadisticas(self):
+        """Test contadores de peticiones, errores y bytes por host"""
+        url = f"{self.fake.url}/botTEST/sendMessage"
+        self.fake.respuestas.append((500, {'ok': False}))
+        http_client.post(url, data={'chat_id': '1', 'text': 'a'})
+        http_client.post(url, data={'chat_id': '1', 'text': 'b'})
+        
+        stats = http_client.estadisticas()[self.fake.url.split('//')[1]]
+        self.assertEqual(stats['peticiones'], 2)
+        self.assertEqual(stats['errores'], 1)
+        self.assertGreater(stats['bytes_enviados'], 0)
+        self.assertEqual(stats['bytes_recibidos'], len(b'{"ok": false}') + len(b'{"ok": true}'))
+
+
+class TestTokenCache(BDTemporalMixin, unittest.TestCase):
+    """Tests para la caché de tokens OAuth"""
+    
+    def setUp(self):
+        super().setUp()
+        self.ahora = [1000.0]
+        self.pedidos = []
+    
+    def _solicitar(self):
+        self.pedidos.append(self.ahora[0])
+        return f"token-{len(self.pedidos)}", 3600
+    
+    def _cache(self):
+        return token_cache.TokenCache('idealista', self._solicitar, margen=60,
+                                      reloj=lambda: self.ahora[0])
+    
+    def test_reutiliza_hasta_caducar(self):
+        """Test que solo se pide token nuevo al acercarse la caducidad"""
+        cache = self._cache()
+        self.assertEqual(cache.obtener(), 'token-1')
+        self.ahora[0] += 3000
+        self.assertEqual(cache.obtener(), 'token-1')
+        self.ahora[0] += 600  # Dentro del margen de 60s
+        self.assertEqual(cache.obtener(), 'token-2')
+        self.assertEqual(len(self.pedidos), 2)
+    
+    def test_persistente_entre_reinicios(self):
+        """Test que un proceso nuevo reutiliza el token guardado en SQLite"""
+        self._cache().obtener()
+        self.assertEqual(self._cache().obtener(), 'token-1')
+        self.assertEqual(len(self.pedidos), 1)
+    
+    def test_invalidar_tras_401(self):
+        """Test que invalidar fuerza un token nuevo"""
+        cache = self._cache()
+        cache.obtener()
+        cache.invalidar()
+        self.assertEqual(self._cache().obtener(), 'token-2')
+    
+    def test_respuesta_sin_token(self):
+        """Test que una respuesta sin access_token da un error claro y no se guarda"""
+        for resultado in ((None, 3600), ('', 3600), ('abc', 0)):
+            cache = token_cache.TokenCache('idealista', lambda: resultado)
+            with self.assertRaises(token_cache.TokenInvalido):
+                cache.obtener()
+        self.assertIsNone(db.get_connection().execute("SELECT * FROM oauth_tokens").fetchone())
+    
+    def test_ahorro_en_api_requests(self):
+        """Test que las peticiones de token contabilizadas bajan a una"""
+        respuesta = MagicMock(status_code=200)
+        respuesta.json.return_value = {'access_token': 'abc', 'expires_in': 43200}
+        cache = token_cache.TokenCache('idealista', main_v2_quota.solicitar_token)
+        
+        with patch.object(main_v2_quota, '_token_cache', cache), \
+                patch.object(main_v2_quota.http_client, 'post', return_value=respuesta):
+            for _ in range(3):
+                self.assertEqual(main_v2_quota.obtener_token(), 'abc')
+        
+        tokens = db.get_connection().execute(
+            "SELECT COUNT(*) FROM api_requests WHERE tipo='token'").fetchone()[0]
+        self.assertEqual(tokens, 1)
+
+
+class TestQuotaLedger(BDTemporalMixin, unittest.TestCase):
+    """Tests para el ledger incremental de quota"""
+    
+    def setUp(self):
+        super().setUp()
+        self.ledger = quota.QuotaLedger(limite=3, reloj=lambda: datetime(2026, 3, 15))
+    
+    def test_reservas(self):
+        """Test que reservas abiertas cuentan contra el límite y se pueden cancelar"""
+        r1 = self.ledger.reservar()
+        r2 = self.ledger.reservar()
+        self.ledger.confirmar(r1, exitoso=True)
+        self.ledger.confirmar(r2, exitoso=False)
+        self.assertEqual(self.ledger.estado(), (True, 1, 3))
+        
+        r3 = self.ledger.reservar()
+        self.ledger.reservar()
+        with self.assertRaises(quota.QuotaAgotada):
+            self.ledger.reservar()
+        self.ledger.cancelar(r3)
+        self.assertEqual(self.ledger.disponible(), 1)
+    
+    def test_upsert_conserva_fechas_y_limite(self):
+        """Test que usado se incrementa sin reescribir fecha_inicio ni limite"""
+        self.ledger.registrar()
+        conn = db.get_connection()
+        conn.execute("UPDATE api_quota SET limite=500")
+        self.ledger.registrar()
+        self.ledger.registrar(tipo='token')
+        
+        row = conn.execute("SELECT usado, limite, fecha_inicio, fecha_fin FROM api_quota "
+                           "WHERE mes_ano='2026-03'").fetchone()
+        self.assertEqual(row, (3, 500, '2026-03-01', '2026-04-01'))
+        self.assertEqual(self.ledger.estado(), (False, 3, 3))
+    
+    def test_reconciliar(self):
+        """Test que la auditoría corrige el ledger contra api_requests"""
+        self.ledger.registrar()
+        db.get_connection().execute("UPDATE api_quota SET usado=42")
+        
+        self.assertEqual(self.ledger.reconciliar(), {'2026-03': (42, 1)})
+        self.assertEqual(self.ledger.estado(), (True, 1, 3))
+        self.assertEqual(self.ledger.reconciliar(), {})
+
+
+class TestPlanificador(unittest.TestCase):
+    """Tests para el planificador adaptativo (reloj simulado)"""
+    
+    def test_simulacion_gasta_todo_el_mes(self):
+        """Test que la quota se reparte hasta fin de mes sin pasarse"""
+        inicio = datetime(2026, 3, 1, 8, 0)
+        ejecuciones = planificador.simular(inicio, 61, lambda _: 5, limite=100)
+        
+        for mes in ('2026-03', '2026-04'):
+            del_mes = [e for e in ejecuciones if e['fecha'].strftime('%Y-%m') == mes]
+            usado = del_mes[-1]['usado_mes']
+            self.assertLessEqual(usado, 100)
+            self.assertGreaterEqual(usado, 95)
+            # No se agota en la primera quincena
+            primera_quincena = [e for e in del_mes if e['fecha'].day <= 15]
+            self.assertLess(primera_quincena[-1]['usado_mes'], 65)
+    
+    def test_paginas_segun_rendimiento(self):
+        """Test más páginas con mucho rendimiento y una con poco"""
+        def plan(historial):
+            return planificador.Planificador(
+                disponible=lambda: 100, reloj=lambda: datetime(2026, 3, 10),
+                historial=lambda: historial, ultima_ejecucion=lambda: None,
+                adaptativo=True).planificar()
+        
+        self.assertEqual(plan([])['paginas'], config.MAX_PAGES_PER_DAY)
+        self.assertEqual(plan([(50, 2)])['paginas'], config.MAX_PAGES_PER_DAY)
+        self.assertEqual(plan([(0, 5), (1, 5)])['paginas'], 1)
+    
+    def test_sin_presupuesto(self):
+        """Test que sin quota se espera al mes siguiente"""
+        p = planificador.Planificador(
+            disponible=lambda: 1, reloj=lambda: datetime(2026, 3, 10, 12),
+            historial=lambda: [], ultima_ejecucion=lambda: datetime(2026, 3, 10)).planificar()
+        self.assertEqual(p['paginas'], 0)
+        self.assertEqual(p['proxima_ejecucion'], datetime(2026, 4, 1))
+    
+    def test_intervalo_desde_ultima_ejecucion(self):
+        """Test que la próxima búsqueda se calcula desde la última"""
+        ultima = datetime(2026, 3, 10)
+        p = planificador.Planificador(
+            disponible=lambda: 12, reloj=lambda: ultima + timedelta(hours=1),
+            historial=lambda: [(0, 1)], ultima_ejecucion=lambda: ultima,
+            adaptativo=True).planificar()
+        # 12 peticiones / (1 página + 1 token) = 6 búsquedas en ~22 días
+        self.assertEqual(p['ejecuciones_restantes'], 6)
+        horas = (p['proxima_ejecucion'] - ultima).total_seconds() / 3600
+        self.assertAlmostEqual(horas, p['intervalo_horas'], places=1)
+
+
+class TestBuscarPisosPlan(BDTemporalMixin, unittest.TestCase):
+    """Tests de integración del planificador con la BD"""
+    
+    def test_busqueda_omitida_no_se_registra(self):
+        """Test que una comprobación sin búsqueda no cuenta como ejecución"""
+        main_v2_quota.registrar_ejecucion({
+            'total_procesados': 50, 'totales_nuevos': 10, 'totales_modificados': 0,
+            'errores': 0, 'peticiones': 1, 'status': 'success'})
+        
+        estadisticas = main_v2_quota.buscar_pisos()
+        self.assertTrue(estadisticas['omitida'])
+        main_v2_quota.registrar_ejecucion(estadisticas)
+        
+        count = db.get_connection().execute("SELECT COUNT(*) FROM ejecuciones").fetchone()[0]
+        self.assertEqual(count, 1)
+        self.assertEqual(planificador.historial_bd(), [(10, 1)])
+
+
+def respuesta_api(pisos, total_paginas=5):
+    """Respuesta simulada de /search"""
+    response = MagicMock(status_code=200)
+    response.json.return_value = {
+        'elementList': pisos, 'total': total_paginas * len(pisos), 'totalPages': total_paginas}
+    response.content = json.dumps(response.json.return_value).encode()
+    return response
+
+
+class TestIncremental(BDTemporalMixin, unittest.TestCase):
+    """Tests para la paginación incremental"""
+    
+    def _buscar(self, paginas):
+        respuestas = [respuesta_api(p) for p in paginas]
+        with patch.object(main_v2_quota, '_post_busqueda', side_effect=respuestas) as post, \
+                patch.object(main_v2_quota, 'obtener_token', return_value='tok'), \
+                patch.object(main_v2_quota, 'should_search_now', return_value=True), \
+                patch.object(config, 'PAGE_WAIT_TIME', 0), \
+                patch.object(config, 'SEARCH_MODE', 'incremental'):
+            estadisticas = main_v2_quota.buscar_pisos(max_paginas=5)
+        return estadisticas, post
+    
+    def test_para_al_estar_al_dia(self):
+        """Test que deja de paginar cuando una página no trae novedades"""
+        pagina1 = [piso_api(i, 1000) for i in range(1, 4)]
+        pagina2 = [piso_api(i, 1000) for i in range(4, 7)]
+        self._buscar([pagina1, pagina2, pagina1, pagina1, pagina1])
+        
+        estadisticas, post = self._buscar([pagina1, pagina2])
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(estadisticas['peticiones_ahorradas'], 4)
+        self.assertEqual(post.call_args[0][0]['sort'], 'desc')
+        self.assertEqual(incremental.cargar_marca(), '1')
+    
+    def test_marca_de_agua(self):
+        """Test que las novedades por encima de la marca no obligan a seguir"""
+        self._buscar([[piso_api(i, 1000) for i in range(1, 4)]] * 5)
+        
+        pagina = [piso_api(10, 900), piso_api(1, 1000), piso_api(2, 1000)]
+        estadisticas, post = self._buscar([pagina] * 5)
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(estadisticas['totales_nuevos'], 1)
+        self.assertEqual(incremental.cargar_marca(), '10')
+    
+    def test_barrido_completo_sin_parada(self):
+        """Test que un barrido completo programado no para al estar al día"""
+        pagina1 = [piso_api(i, 1000) for i in range(1, 4)]
+        pagina2 = [piso_api(i, 1000) for i in range(4, 7)]
+        self._buscar([pagina1, pagina2, pagina1, pagina1, pagina1])
+        
+        with patch.object(config, 'DELISTING_FULL_SWEEP_EVERY', 1):
+            estadisticas, post = self._buscar([pagina1, pagina2] * 3)
+        self.assertEqual(post.call_count, 5)
+        self.assertEqual(estadisticas['peticiones_ahorradas'], 0)
+        self.assertEqual(post.call_args[0][0]['sort'], 'asc')
+    
+    def test_umbral_de_precio(self):
+        """Test que cambios de precio pequeños no cuentan como novedad"""
+        diff = {'nuevos': [], 'subidas': [], 'sin_cambios': [],
+                'bajadas': [{'id': '1', 'precio': 995, 'precio_anterior': 1000}]}
+        self.assertTrue(incremental.pagina_al_dia(['1'], diff, umbral=0.02))
+        self.assertFalse(incremental.pagina_al_dia(['1'], diff, umbral=0.001))
+
+
+class TestPerfiles(BDTemporalMixin, unittest.TestCase):
+    """Tests para los perfiles de búsqueda múltiples"""
+    
+    def _escribir_perfiles(self, datos):
+        with open(config.SEARCH_PROFILES_FILE, 'w', encoding='utf-8') as f:
+            json.dump(datos, f)
+    
+    def test_perfil_por_defecto(self):
+        """Test que sin fichero ni tabla se usa la configuración global"""
+        lista = perfiles.cargar_perfiles()
+        self.assertEqual(len(lista), 1)
+        self.assertEqual(lista[0]['nombre'], incremental.PERFIL_DEFECTO)
+        self.assertEqual(lista[0]['radio'], config.SEARCH_RADIUS)
+    
+    def test_cargar_desde_fichero(self):
+        """Test que el fichero JSON se completa con los valores por defecto"""
+        self._escribir_perfiles([
+            {'nombre': 'alquiler', 'operacion': 'rent'},
+            {'nombre': 'venta', 'operacion': 'sale', 'habitaciones': '1,2'},
+            {'nombre': 'inactivo', 'activo': False},
+        ])
+        lista = perfiles.cargar_perfiles()
+        self.assertEqual([p['nombre'] for p in lista], ['alquiler', 'venta'])
+        self.assertEqual(lista[1]['habitaciones'], ['1', '2'])
+        self.assertEqual(lista[0]['latitud'], config.SEARCH_LATITUDE)
+        params = perfiles.parametros_busqueda(lista[1], 3)
+        self.assertEqual(params['operation'], 'sale')
+        self.assertEqual(params['numPage'], 3)
+    
+    def test_cargar_desde_tabla(self):
+        """Test que sin fichero se leen los perfiles activos de la tabla"""
+        with db.transaction() as conn:
+            conn.execute("""INSERT INTO perfiles_busqueda (nombre, operacion, radio)
+                            VALUES ('venta', 'sale', 800)""")
+        lista = perfiles.cargar_perfiles()
+        self.assertEqual(len(lista), 1)
+        self.assertEqual((lista[0]['operacion'], lista[0]['radio']), ('sale', 800))
+    
+    def test_perfil_invalido(self):
+        """Test que una operación desconocida o nombres repetidos fallan"""
+        self._escribir_perfiles([{'nombre': 'x', 'operacion': 'alquilar'}])
+        with self.assertRaises(ValueError):
+            perfiles.cargar_perfiles()
+        self._escribir_perfiles([{'nombre': 'x'}, {'nombre': 'x'}])
+        with self.assertRaises(ValueError):
+            perfiles.cargar_perfiles()
+    
+    def test_perfiles_plan(self):
+        """Test que el planificador usa los perfiles de la última búsqueda sin releer el fichero"""
+        self._escribir_perfiles([{'nombre': 'x', 'operacion': 'alquilar'}])
+        with patch.object(main_v2_quota, '_num_perfiles', None):
+            self.assertEqual(main_v2_quota._perfiles_plan(), 1)
+        with patch.object(main_v2_quota, '_num_perfiles', 3):
+            self.assertEqual(main_v2_quota._perfiles_plan(), 3)
+    
+    def test_vistos_ciclo(self):
+        """Test que cada id solo lo reclama un perfil"""
+        vistos = perfiles.VistosCiclo()
+        self.assertEqual(vistos.reclamar(['1', '2']), ['1', '2'])
+        self.assertEqual(vistos.reclamar(['2', '3']), ['3'])
+        self.assertEqual(len(vistos), 3)
+    
+    def test_parada_incremental_con_pisos_de_otro_perfil(self):
+        """Test que un piso nuevo procesado por otro perfil impide dar la página por al día"""
+        vistos = perfiles.VistosCiclo()
+        vistos.reclamar(['1', '2'])
+        vistos.registrar(['1', '2'], {'1'})
+        propios = vistos.reclamar(['1', '2', '3'])
+        vacio = {'nuevos': [], 'bajadas': [], 'subidas': [], 'sin_cambios': [{'id': '3'}]}
+        ajenos = vistos.cambios(i for i in ['1', '2', '3'] if i not in propios)
+        self.assertEqual(ajenos, {'1'})
+        self.assertFalse(incremental.pagina_al_dia(['1', '2', '3'], vacio, ajenos=ajenos))
+        # Reclamado pero aún sin procesar: tampoco se puede dar por al día
+        vistos.reclamar(['4'])
+        self.assertEqual(vistos.cambios(['2', '4']), {'4'})
+        self.assertTrue(incremental.pagina_al_dia(['2', '3'], vacio, ajenos=vistos.cambios(['2'])))
+    
+    def test_perfiles_solapados(self):
+        """Test que dos perfiles solapados procesan y notifican cada piso una vez"""
+        self._escribir_perfiles([
+            {'nombre': 'alquiler', 'operacion': 'rent'},
+            {'nombre': 'venta', 'operacion': 'sale'},
+        ])
+        paginas = {
+            'rent': [piso_api(1, 1000), piso_api(2, 1100)],
+            'sale': [piso_api(2, 1100), piso_api(3, 200000)],
+        }
+        
+        def post(params):
+            return respuesta_api(paginas[params['operation']], total_paginas=1)
+        
+        with patch.object(main_v2_quota, '_post_busqueda', side_effect=post) as mock_post, \
+                patch.object(main_v2_quota, 'obtener_token', return_value='tok'), \
+                patch.object(main_v2_quota, 'should_search_now', return_value=True), \
+                patch.object(main_v2_quota, 'enviar_telegram') as telegram, \
+                patch.object(config, 'PAGE_WAIT_TIME', 0), \
+                patch.object(config, 'SEARCH_MODE', 'incremental'):
+            estadisticas = main_v2_quota.buscar_pisos(max_paginas=3)
+        
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(estadisticas['peticiones'], 2)
+        self.assertEqual(estadisticas['totales_nuevos'], 3)
+        novedades = [c for c in telegram.call_args_list if c.kwargs.get('notification_type') == 'new']
+        self.assertEqual(len(novedades), 3)
+        conn = db.get_connection()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM pisos").fetchone()[0], 3)
+        self.assertEqual(conn.execute("SELECT operacion FROM pisos WHERE id='3'").fetchone()[0], 'sale')
+        self.assertEqual(incremental.cargar_marca('alquiler'), '1')
+        self.assertEqual(incremental.cargar_marca('venta'), '2')
+    
+    def test_plan_por_perfil(self):
+        """Test que el planificador reparte la quota entre los perfiles"""
+        p = planificador.Planificador(
+            disponible=lambda: 12, reloj=lambda: datetime(2026, 3, 10),
+            historial=lambda: [(0, 1)], ultima_ejecucion=lambda: None,
+            adaptativo=True, num_perfiles=lambda: 3).planificar()
+        # 12 peticiones / (1 página x 3 perfiles + 1 token) = 3 búsquedas
+        self.assertEqual(p['ejecuciones_restantes'], 3)
+        self.assertEqual(p['perfiles'], 3)
+
+
+class TestFakeIdealista(BDTemporalMixin, unittest.TestCase):
+    """Tests del pipeline completo contra la API simulada"""
+    
+    def setUp(self):
+        super().setUp()
+        self.catalogo = fake_idealista.Catalogo(100, rotacion=0.1, cambios_precio=0.1)
+        self.servidor = fake_idealista.FakeIdealista(self.catalogo)
+        self.patchers = [
+            patch.object(config, 'IDEALISTA_API_URL', self.servidor.search_url),
+            patch.object(config, 'IDEALISTA_TOKEN_URL', self.servidor.token_url),
+            patch.object(config, 'ITEMS_PER_PAGE', 30),
+            patch.object(config, 'PAGE_WAIT_TIME', 0),
+            patch.object(config, 'SEARCH_MODE', 'completo'),
+            patch.object(main_v2_quota, '_quota', quota.QuotaLedger(limite=1000)),
+            patch.object(main_v2_quota, 'should_search_now', return_value=True),
+            patch.object(main_v2_quota, '_token_cache',
+                         token_cache.TokenCache('idealista', main_v2_quota.solicitar_token)),
+        ]
+        for p in self.patchers:
+            p.start()
+    
+    def tearDown(self):
+        for p in reversed(self.patchers):
+            p.stop()
+        self.servidor.close()
+        super().tearDown()
+    
+    def _ids(self):
+        paginas = [self.catalogo.pagina(n, 30)['elementList'] for n in range(1, 5)]
+        return [p['propertyCode'] for pagina in paginas for p in pagina]
+    
+    def test_catalogo_determinista(self):
+        """Test que la misma semilla genera las mismas páginas y cada ronda cubre todo"""
+        otro = fake_idealista.Catalogo(100, rotacion=0.1, cambios_precio=0.1)
+        self.assertEqual(self.catalogo.pagina(2, 30), otro.pagina(2, 30))
+        self.assertEqual(len(set(self._ids())), 100)
+        
+        antes = set(self._ids())
+        self.catalogo.avanzar()
+        despues = self._ids()
+        self.assertEqual(len(set(despues)), 100)
+        self.assertEqual(len(set(despues) - antes), 10)
+        # Lo tocado en la ronda sale primero (orden por recencia)
+        self.assertTrue(set(despues[:10]) - antes)
+    
+    def test_buscar_pisos_extremo_a_extremo(self):
+        """Test de buscar_pisos contra el servidor simulado con rotación entre rondas"""
+        estadisticas = main_v2_quota.buscar_pisos(max_paginas=10)
+        self.assertEqual(estadisticas['totales_nuevos'], 100)
+        self.assertEqual(estadisticas['peticiones'], 4)
+        self.assertEqual(self.servidor.peticiones['token'], 1)
+        
+        self.catalogo.avanzar()
+        estadisticas = main_v2_quota.buscar_pisos(max_paginas=10)
+        self.assertEqual(estadisticas['totales_nuevos'], self.catalogo.ultima_ronda['altas'])
+        self.assertEqual(estadisticas['totales_modificados'], self.catalogo.ultima_ronda['cambios_precio'])
+        self.assertEqual(self.servidor.peticiones['token'], 1)
+        conn = db.get_connection()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM pisos").fetchone()[0], 110)
+    
+    def test_bajas_tras_barrido_completo(self):
+        """Test que las bajas de la ronda se detectan y un barrido truncado no da de baja"""
+        self.assertTrue(main_v2_quota.buscar_pisos(max_paginas=10)['barrido_completo'])
+        self.catalogo.avanzar()
+        
+        estadisticas = main_v2_quota.buscar_pisos(max_paginas=2)
+        self.assertFalse(estadisticas['barrido_completo'])
+        self.assertEqual(estadisticas['bajas'], 0)
+        
+        estadisticas = main_v2_quota.buscar_pisos(max_paginas=10)
+        self.assertTrue(estadisticas['barrido_completo'])
+        self.assertEqual(estadisticas['bajas'], self.catalogo.ultima_ronda['altas'])
+        conn = db.get_connection()
+        retirados = {r[0] for r in conn.execute("SELECT id FROM pisos WHERE estado='retirado'")}
+        self.assertEqual(len(retirados), 10)
+        self.assertFalse(retirados & set(self._ids()))
+    
+    def test_respuestas_archivadas(self):
+        """Test que cada respuesta de la búsqueda queda archivada tal cual"""
+        main_v2_quota.buscar_pisos(max_paginas=10)
+        registros = list(archivo.iterar())
+        self.assertEqual([(r['perfil'], r['pagina']) for r, _ in registros],
+                         [('default', n) for n in range(1, 5)])
+        self.assertEqual(json.loads(registros[1][1]), self.catalogo.pagina(2, 30))
+    
+    def _volcado(self):
+        conn = db.get_connection()
+        return {tabla: conn.execute(f"SELECT * FROM {tabla} ORDER BY 1, 2, 3").fetchall()
+                for tabla in ('pisos', 'historial_precios', 'mercado_rollup', 'mercado_hist', 'barridos',
+                              'geo_celdas', 'lsh_buckets')}
+    
+    def test_replay_deja_la_bd_identica(self):
+        """Test que reproducir el archivo en una BD vacía reproduce las búsquedas reales"""
+        for ronda, paginas in enumerate((10, 2, 10, 10)):
+            if ronda:
+                self.catalogo.avanzar()
+            main_v2_quota.buscar_pisos(max_paginas=paginas)
+        original = self._volcado()
+        self.assertTrue(original['barridos'])
+        
+        with patch.object(config, 'DB_PATH', Path(self.temp_dir.name) / 'replay.db'), \
+                patch.object(main_v2_quota, 'enviar_telegram') as telegram:
+            estadisticas = replay.reproducir_archivo(lote=3)
+            self.assertEqual(self._volcado(), original)
+            db.close_all()
+        telegram.assert_not_called()
+        self.assertEqual(estadisticas['paginas'], 14)
+        self.assertEqual(estadisticas['ejecuciones'], 4)
+        # Las rotaciones de las rondas 2 y 3 se dan de baja juntas en el barrido completo de la 3
+        self.assertEqual(estadisticas['bajas'], 30)
+    
+    def test_replay_no_toca_una_bd_con_pisos(self):
+        """Test que reproducir sobre la BD de la que salió el archivo se rechaza sin escribir nada"""
+        main_v2_quota.buscar_pisos(max_paginas=10)
+        self.catalogo.avanzar()
+        main_v2_quota.buscar_pisos(max_paginas=10)
+        original = self._volcado()
+        with patch.object(main_v2_quota, 'enviar_telegram'), self.assertRaises(ValueError):
+            replay.reproducir_archivo(lote=3)
+        self.assertEqual(self._volcado(), original)
+    
+    def test_inyeccion_de_errores(self):
+        """Test que un error de la API corta la paginación y se contabiliza"""
+        self.servidor.tasa_error = 1.0
+        estadisticas = main_v2_quota.buscar_pisos(max_paginas=10)
+        self.assertEqual(estadisticas['errores'], 1)
+        self.assertEqual(estadisticas['total_procesados'], 0)
+        self.assertEqual(self.servidor.peticiones['errores'], 1)
+    
+    def test_token_rechazado(self):
+        """Test que un 401 renueva el token y repite la búsqueda"""
+        main_v2_quota.obtener_token()
+        self.servidor.tokens.clear()
+        estadisticas = main_v2_quota.buscar_pisos(max_paginas=1)
+        self.assertEqual(estadisticas['total_procesados'], 30)
+        self.assertEqual(self.servidor.peticiones['token'], 2)
+
+
+class TestBackup(BDTemporalMixin, unittest.TestCase):
+    """Tests para los backups incrementales con deduplicación de páginas"""
+    
+    def setUp(self):
+        super().setUp()
+        self.patcher_backup = patch.object(config, 'BACKUP_DIR', Path(self.temp_dir.name) / 'backups')
+        self.patcher_backup.start()
+        main_v2_quota.procesar_lote([piso_api(i, 1000 + i) for i in range(2000)])
+    
+    def tearDown(self):
+        self.patcher_backup.stop()
+        super().tearDown()
+    
+    def _contar(self, ruta):
+        conn = sqlite3.connect(str(ruta))
+        try:
+            return conn.execute("SELECT COUNT(*), SUM(precio) FROM pisos").fetchone()
+        finally:
+            conn.close()
+    
+    def test_instantaneas_incrementales(self):
+        """Test que la segunda instantánea solo guarda las páginas que cambiaron"""
+        primera = backup.crear()
+        # Las páginas repetidas (p. ej. vacías) ya se deduplican dentro de la misma instantánea
+        self.assertGreater(primera['paginas_nuevas'], primera['num_paginas'] / 2)
+        
+        main_v2_quota.procesar_lote([piso_api(5, 900)])
+        segunda = backup.crear()
+        self.assertGreater(segunda['paginas_nuevas'], 0)
+        self.assertLess(segunda['paginas_nuevas'], primera['num_paginas'] / 4)
+        self.assertLess(segunda['bytes_nuevos'], primera['bytes_nuevos'] / 4)
+        
+        sin_cambios = backup.crear()
+        self.assertLessEqual(sin_cambios['paginas_nuevas'], 1)
+    
+    def test_restaurar_verificado(self):
+        """Test que cada instantánea se restaura tal como era"""
+        primera = backup.crear()
+        esperado = self._contar(config.DB_PATH)
+        main_v2_quota.procesar_lote([piso_api(i, 500) for i in range(2000, 2100)])
+        segunda = backup.crear()
+        
+        restaurada = backup.restaurar(primera['id'], Path(self.temp_dir.name) / 'r1.db')
+        self.assertEqual(self._contar(restaurada), esperado)
+        restaurada = backup.restaurar(segunda['id'], Path(self.temp_dir.name) / 'r2.db')
+        self.assertEqual(self._contar(restaurada)[0], 2100)
+        self.assertTrue(backup.verificar())
+    
+    def test_detecta_corrupcion(self):
+        """Test que un paquete alterado no se restaura"""
+        resumen = backup.crear()
+        paquete = config.BACKUP_DIR / 'paquetes' / '1.pack'
+        datos = bytearray(paquete.read_bytes())
+        datos[len(datos) // 2] ^= 0xFF
+        paquete.write_bytes(bytes(datos))
+        
+        destino = Path(self.temp_dir.name) / 'r.db'
+        with self.assertRaises(backup.BackupCorrupto):
+            backup.restaurar(resumen['id'], destino)
+        self.assertFalse(destino.exists())
+        self.assertFalse(backup.verificar())
+    
+    def test_podar(self):
+        """Test que la poda conserva las últimas y borra lo no referenciado"""
+        for i in range(4):
+            main_v2_quota.procesar_lote([piso_api(i, 100 + i)])
+            backup.crear()
+        resumen = backup.podar(conservar=2)
+        self.assertEqual(resumen['instantaneas'], 2)
+        self.assertEqual([i['id'] for i in backup.listar()], [3, 4])
+        self.assertTrue(backup.verificar(3))
+        self.assertTrue(backup.verificar(4))
+    
+    def test_backup_database(self):
+        """Test que backup_database usa el almacén incremental"""
+        with patch.object(config, 'ENABLE_BACKUPS', True):
+            main_v2_quota.backup_database()
+        self.assertEqual(len(backup.listar()), 1)
+
+
+class TestMetricas(BDTemporalMixin, unittest.TestCase):
+    """Tests para el exportador de métricas Prometheus"""
+    
+    def _valor(self, linea_inicio):
+        for linea in metrics.exponer().splitlines():
+            if linea.startswith(linea_inicio + ' '):
+                return float(linea.split()[-1])
+        return 0.0
+    
+    def test_histograma_acumulado(self):
+        """Test que los cubos del histograma se exponen acumulados"""
+        h = metrics.Histogram('test_latencia_seconds', 'Latencia', ('tipo',), buckets=(0.1, 1.0))
+        self.addCleanup(metrics.REGISTRO.remove, h)
+        for valor in (0.05, 0.5, 0.5, 3):
+            h.labels('search').observe(valor)
+        texto = h.exponer()
+        self.assertIn('# TYPE test_latencia_seconds histogram', texto)
+        self.assertIn('test_latencia_seconds_bucket{tipo="search",le="0.1"} 1', texto)
+        self.assertIn('test_latencia_seconds_bucket{tipo="search",le="1"} 3', texto)
+        self.assertIn('test_latencia_seconds_bucket{tipo="search",le="+Inf"} 4', texto)
+        self.assertIn('test_latencia_seconds_count{tipo="search"} 4', texto)
+        self.assertIn('test_latencia_seconds_sum{tipo="search"} 4.05', texto)
+    
+    def test_contadores_del_pipeline(self):
+        """Test que procesar un lote actualiza contadores e histogramas"""
+        nuevos = self._valor('idealista_listings_new_total')
+        bajadas = self._valor('idealista_price_drops_total')
+        paginas = self._valor('idealista_page_processing_seconds_count')
+        commits = self._valor('idealista_sqlite_commit_seconds_count')
+        
+        main_v2_quota.procesar_lote([piso_api(1, 1000), piso_api(2, 1000)])
+        main_v2_quota.procesar_lote([piso_api(1, 900)])
+        
+        self.assertEqual(self._valor('idealista_listings_new_total'), nuevos + 2)
+        self.assertEqual(self._valor('idealista_price_drops_total'), bajadas + 1)
+        self.assertEqual(self._valor('idealista_page_processing_seconds_count'), paginas + 2)
+        self.assertGreaterEqual(self._valor('idealista_sqlite_commit_seconds_count'), commits + 2)
+    
+    def test_gauges_de_quota(self):
+        """Test que los gauges de quota se calculan al hacer scrape"""
+        main_v2_quota._quota.registrar()
+        self.assertEqual(self._valor('idealista_quota_used'), 1)
+        self.assertEqual(self._valor('idealista_quota_remaining'), config.MONTHLY_REQUEST_LIMIT - 1)
+    
+    def test_endpoint_metrics(self):
+        """Test que /metrics responde en formato de texto de Prometheus"""
+        servidor = metrics.iniciar_servidor(0, host='127.0.0.1')
+        self.addCleanup(servidor.server_close)
+        self.addCleanup(servidor.shutdown)
+        url = f"http://127.0.0.1:{servidor.server_port}"
+        
+        response = http_client.get_session(url).get(f"{url}/metrics", timeout=5)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('version=0.0.4', response.headers['Content-Type'])
+        self.assertIn('# TYPE idealista_errors_total counter', response.text)
+        self.assertEqual(http_client.get_session(url).get(f"{url}/otra", timeout=5).status_code, 404)
+
+
+class TestArchivo(BDTemporalMixin, unittest.TestCase):
+    """Tests para el archivo de respuestas crudas"""
+    
+    def _pagina(self, n):
+        return json.dumps({'elementList': [piso_api(str(i), 1000 + i) for i in range(n * 10, n * 10 + 10)],
+                           'actualPage': n}).encode()
+    
+    def test_acceso_aleatorio_e_iteracion(self):
+        """Test que cada página se lee por clave y el recorrido respeta el orden de escritura"""
+        with patch.object(config, 'ARCHIVE_SEGMENT_BYTES', 1):
+            ejecucion = archivo.iniciar_ejecucion()
+            for n in range(1, 4):
+                archivo.guardar(ejecucion, 'alquiler', n, self._pagina(n))
+            otra = archivo.iniciar_ejecucion()
+            archivo.guardar(otra, 'venta', 1, self._pagina(9))
+        
+        self.assertEqual(archivo.leer(ejecucion, 'alquiler', 2), self._pagina(2))
+        self.assertIsNone(archivo.leer(ejecucion, 'alquiler', 7))
+        
+        recorrido = [(r['ejecucion'], r['perfil'], r['pagina'], c) for r, c in archivo.iterar()]
+        self.assertEqual(recorrido, [(ejecucion, 'alquiler', n, self._pagina(n)) for n in range(1, 4)]
+                         + [(otra, 'venta', 1, self._pagina(9))])
+        self.assertEqual([r['perfil'] for r, _ in archivo.iterar(desde_ejecucion=otra)], ['venta'])
+        # Segmentos de 1 byte: cada registro en el suyo
+        self.assertEqual(len(list((config.ARCHIVE_DIR / 'segmentos').iterdir())), 4)
+        
+        resumen = archivo.listar()
+        self.assertEqual([e['paginas'] for e in resumen], [3, 1])
+        self.assertLess(resumen[0]['longitud'], resumen[0]['tamano'])
+    
+    def test_replay_directorio_con_procesos(self):
+        """Test que los volcados JSON se reproducen con el parseo en varios procesos"""
+        volcados = Path(self.temp_dir.name) / 'volcados'
+        volcados.mkdir()
+        for n in range(1, 4):
+            (volcados / f'{n:03d}.json').write_bytes(self._pagina(n))
+        (volcados / '004.json').write_bytes(json.dumps({'elementList': [piso_api('10', 900)]}).encode())
+        
+        estadisticas = replay.reproducir(replay.paginas_directorio(volcados), procesos=2, lote=2)
+        self.assertEqual((estadisticas['paginas'], estadisticas['nuevos'], estadisticas['modificados']),
+                         (4, 30, 1))
+        conn = db.get_connection()
+        self.assertEqual(conn.execute("SELECT precio FROM pisos WHERE id='10'").fetchone()[0], 900)
+    
+    def test_corrupcion_detectada(self):
+        """Test que un byte alterado en un segmento se detecta al leer"""
+        ejecucion = archivo.iniciar_ejecucion()
+        archivo.guardar(ejecucion, 'alquiler', 1, self._pagina(1))
+        archivo.guardar(ejecucion, 'alquiler', 2, self._pagina(2))
+        self.assertEqual(archivo.verificar(), 2)
+        
+        segmento = config.ARCHIVE_DIR / 'segmentos' / '1.seg'
+        datos = bytearray(segmento.read_bytes())
+        datos[-5] ^= 0xFF
+        segmento.write_bytes(bytes(datos))
+        self.assertEqual(archivo.leer(ejecucion, 'alquiler', 1), self._pagina(1))
+        with self.assertRaises(archivo.ArchivoCorrupto):
+            archivo.leer(ejecucion, 'alquiler', 2)
+        with self.assertRaises(archivo.ArchivoCorrupto):
+            archivo.verificar()
+
+
+class TestAnomalias(BDTemporalMixin, unittest.TestCase):
+    """Tests para la puntuación de anomalías de precio"""
+    
+    def setUp(self):
+        super().setUp()
+        anomalias.invalidar()
+        # Cohorte: 3 hab, 80 m², Centro, entre 800 y 960 € (10-12 €/m²)
+        main_v2_quota.procesar_lote([piso_api(str(i), 800 + 8 * i, district='Centro')
+                                     for i in range(21)])
+    
+    def tearDown(self):
+        anomalias.invalidar()
+        super().tearDown()
+    
+    def _puntuacion(self, id_piso):
+        return db.get_connection().execute(
+            "SELECT puntuacion_anomalia FROM pisos WHERE id=?", (id_piso,)).fetchone()[0]
+    
+    def test_barato_frente_a_su_cohorte(self):
+        """Test que un piso muy barato para su cohorte recibe un z muy negativo"""
+        main_v2_quota.procesar_lote([piso_api('barato', 400, district='Centro'),
+                                     piso_api('normal', 880, district='Centro')])
+        self.assertLess(self._puntuacion('barato'), config.ANOMALY_Z_THRESHOLD)
+        self.assertAlmostEqual(self._puntuacion('normal'), 0, delta=0.5)
+    
+    def test_cohorte_pequena_usa_la_mas_amplia(self):
+        """Test que sin pisos en la zona se puntúa contra la cohorte sin zona"""
+        main_v2_quota.procesar_lote([piso_api('otra_zona', 400, district='Zaidín'),
+                                     piso_api('sin_metros', 400, size=None)])
+        self.assertLess(self._puntuacion('otra_zona'), config.ANOMALY_Z_THRESHOLD)
+        self.assertIsNone(self._puntuacion('sin_metros'))
+    
+    def test_prioridad_de_notificaciones(self):
+        """Test que lo más anómalo se notifica primero y se destaca"""
+        with patch.object(main_v2_quota, 'enviar_telegram') as telegram:
+            main_v2_quota.procesar_lote([piso_api('normal', 880, district='Centro'),
+                                         piso_api('barato', 400, district='Centro')])
+        mensajes = [c.args[0] for c in telegram.call_args_list]
+        self.assertIn('Piso barato', mensajes[0])
+        self.assertIn('🔥', mensajes[0])
+        self.assertNotIn('🔥', mensajes[1])
+    
+    def test_incremental_igual_que_recarga(self):
+        """Test que el modelo actualizado página a página coincide con uno cargado de la BD"""
+        main_v2_quota.procesar_lote([piso_api(str(i), 700 + 5 * i, district='Centro')
+                                     for i in range(0, 21, 3)])
+        main_v2_quota.procesar_lote([piso_api('z', 500, district='Zaidín', rooms=1, size=45)])
+        sondas = [lotes.parsear_piso(piso_api(f's{i}', 600 + 40 * i, district=d, rooms=r, size=m))
+                  for i, (d, r, m) in enumerate([('Centro', 3, 80), ('Zaidín', 1, 45), ('Beiro', 2, 100)])]
+        conn = db.get_connection()
+        incremental = anomalias.modelo(conn).puntuar(sondas)
+        recargado = anomalias.ModeloMercado()
+        recargado.cargar(conn)
+        self.assertEqual(incremental.tolist(), recargado.puntuar(sondas).tolist())
+
+
+class TestBajas(BDTemporalMixin, unittest.TestCase):
+    """Tests para la detección de pisos retirados"""
+    
+    def setUp(self):
+        super().setUp()
+        main_v2_quota.procesar_lote([piso_api(str(i), 1000 + i) for i in range(1, 5)])
+        with db.transaction() as conn:
+            conn.execute("UPDATE pisos SET fecha_registro = '2026-10-01 12:00:00'")
+    
+    def _estado(self):
+        return {r[0]: r[1:] for r in db.get_connection().execute(
+            "SELECT id, estado, fecha_baja, dias_en_mercado FROM pisos")}
+    
+    def test_barrido_completo_da_de_baja(self):
+        """Test que los pisos no vistos en un barrido completo se retiran"""
+        resultado = bajas.cerrar_barrido({'1', '2', '3'}, completo=True, fecha='2026-10-11 13:00:00')
+        self.assertEqual(resultado['bajas'], 1)
+        estado = self._estado()
+        self.assertEqual(estado['4'], ('retirado', '2026-10-11 13:00:00', 10))
+        self.assertIsNone(estado['1'][0])
+        self.assertEqual(bajas.cargar_barrido(), {'1', '2', '3'})
+    
+    def test_barrido_parcial_no_da_de_baja(self):
+        """Test que un barrido parcial se registra sin dar de baja nada"""
+        resultado = bajas.cerrar_barrido({'1', '2', '3'}, completo=False)
+        self.assertEqual(resultado['bajas'], 0)
+        self.assertNotIn('retirado', [e[0] for e in self._estado().values()])
+        completo, num_ids = db.get_connection().execute(
+            "SELECT completo, num_ids FROM barridos").fetchone()
+        self.assertEqual((completo, num_ids), (0, 3))
+    
+    def test_reactivacion(self):
+        """Test que un piso retirado que reaparece vuelve a estar activo"""
+        bajas.cerrar_barrido({'1', '2', '3'}, completo=True)
+        resultado = bajas.cerrar_barrido({'4'}, completo=False)
+        self.assertEqual(resultado['reactivados'], 1)
+        self.assertEqual(self._estado()['4'], ('activo', None, None))
+    
+    def test_demasiadas_bajas_se_descartan(self):
+        """Test que un barrido que retiraría la mayoría de pisos se trata como parcial"""
+        resultado = bajas.cerrar_barrido({'1'}, completo=True)
+        self.assertEqual(resultado['bajas'], 0)
+        self.assertFalse(resultado['completo'])
+    
+    def test_barrido_completo_periodico(self):
+        """Test que en modo incremental se fuerza un barrido completo cada N ejecuciones"""
+        with patch.object(config, 'SEARCH_MODE', 'incremental'), \
+                patch.object(config, 'DELISTING_FULL_SWEEP_EVERY', 3):
+            bajas.cerrar_barrido({'1', '2', '3', '4'}, completo=True)
+            bajas.cerrar_barrido({'1'}, completo=False)
+            self.assertFalse(bajas.toca_barrido_completo())
+            bajas.cerrar_barrido({'1'}, completo=False)
+            self.assertTrue(bajas.toca_barrido_completo())
+            with patch.object(config, 'DELISTING_FULL_SWEEP_EVERY', 0):
+                self.assertFalse(bajas.toca_barrido_completo())
+        with patch.object(config, 'SEARCH_MODE', 'completo'):
+            self.assertFalse(bajas.toca_barrido_completo())
+    
+    def test_codificacion(self):
+        """Test que el conjunto de vistos se comprime y se recupera igual"""
+        ids = {str(i) for i in range(100000, 200000)}
+        blob = bajas.codificar(ids)
+        self.assertLess(len(blob), len(ids) * 3)
+        self.assertEqual(bajas.decodificar(blob), ids)
+        self.assertEqual(bajas.decodificar(bajas.codificar(set())), set())
+
+
+class TestRollups(BDTemporalMixin, unittest.TestCase):
+    """Tests para los agregados de mercado"""
+    
+    def _tablas(self):
+        conn = db.get_connection()
+        rollup = conn.execute("""SELECT granularidad, periodo, dimension, valor, operacion, nuevos,
+                                        bajadas, subidas, n_precio, round(suma_precio, 4),
+                                        n_precio_m2, round(suma_precio_m2, 4),
+                                        round(min_precio_m2, 4), round(max_precio_m2, 4)
+                                 FROM mercado_rollup ORDER BY 1, 2, 3, 4, 5""").fetchall()
+        hist = conn.execute("SELECT * FROM mercado_hist ORDER BY 1, 2, 3, 4, 5, 6").fetchall()
+        return rollup, hist
+    
+    def _cargar(self):
+        main_v2_quota.procesar_lote([
+            piso_api(1, 1000, district='Centro', rooms=2),
+            piso_api(2, 800, district='Zaidín', rooms=3),
+            piso_api(3, 1200, municipality='Armilla', rooms=3),
+            piso_api(4, 900),
+        ])
+        main_v2_quota.procesar_lote([piso_api(1, 950, district='Centro', rooms=2),
+                                     piso_api(2, 850, district='Zaidín', rooms=3),
+                                     piso_api(4, 900)])
+    
+    def test_incremental_igual_que_reconstruir(self):
+        """Test que los agregados incrementales coinciden con la reconstrucción"""
+        self._cargar()
+        incremental = self._tablas()
+        self.assertTrue(incremental[0])
+        rollups.reconstruir()
+        self.assertEqual(self._tablas(), incremental)
+    
+    def test_agregados(self):
+        """Test de los contadores por zona y habitaciones y de la mediana"""
+        self._cargar()
+        conn = db.get_connection()
+        total = conn.execute("""SELECT nuevos, bajadas, subidas, n_precio, precio_medio,
+                                       mediana_precio_m2
+                                FROM v_mercado WHERE granularidad='dia' AND dimension='total'""").fetchone()
+        self.assertEqual(total[:4], (4, 1, 1, 6))
+        self.assertAlmostEqual(total[4], (1000 + 800 + 1200 + 900 + 950 + 850) / 6, places=2)
+        # Precios/m² (80 m²): 10, 10.625, 11.25, 11.875, 12.5, 15 -> mediana inferior 11.25 (cubos de ~2%)
+        self.assertAlmostEqual(total[5], 11.25, delta=11.25 * 0.02)
+        
+        zonas = dict(conn.execute("""SELECT valor, nuevos FROM mercado_rollup
+                                     WHERE granularidad='semana' AND dimension='zona'"""))
+        self.assertEqual(zonas, {'Centro': 1, 'Zaidín': 1, 'Armilla': 1, 'desconocida': 1})
+        habitaciones = dict(conn.execute("""SELECT valor, bajadas + subidas FROM mercado_rollup
+                                            WHERE granularidad='dia' AND dimension='habitaciones'"""))
+        self.assertEqual(habitaciones, {'2': 1, '3': 1})
+    
+    def test_semana_empieza_en_lunes(self):
+        """Test que el periodo semanal que escribe actualizar_lote es el lunes de la semana"""
+        for i, fecha in enumerate(('2026-10-12 10:00:00', '2026-10-18 23:00:00', '2026-10-19 00:00:00')):
+            main_v2_quota.procesar_lote_diff([piso_api(i, 1000)], fecha)
+        conn = db.get_connection()
+        semanas = dict(conn.execute("""SELECT periodo, nuevos FROM mercado_rollup
+                                       WHERE granularidad='semana' AND dimension='total'"""))
+        self.assertEqual(semanas, {'2026-10-12': 2, '2026-10-19': 1})
+        dias = [r[0] for r in conn.execute("""SELECT periodo FROM mercado_rollup
+                                              WHERE granularidad='dia' AND dimension='total' ORDER BY periodo""")]
+        self.assertEqual(dias, ['2026-10-12', '2026-10-18', '2026-10-19'])
+
+class TestGeo(BDTemporalMixin, unittest.TestCase):
+    """Tests para el índice geoespacial por celdas"""
+    
+    # Puerta Real (Granada) y pisos a distancias conocidas hacia el norte
+    LAT, LON = 37.1730, -3.5990
+    
+    def setUp(self):
+        super().setUp()
+        main_v2_quota.procesar_lote([
+            piso_api('0', 1000, latitude=self.LAT, longitude=self.LON, district='Centro',
+                     neighborhood='Sagrario'),
+            piso_api('100', 900, latitude=self.LAT + 100 / geo.METROS_POR_GRADO, longitude=self.LON),
+            piso_api('600', 800, latitude=self.LAT + 600 / geo.METROS_POR_GRADO, longitude=self.LON),
+            piso_api('3000', 700, latitude=self.LAT + 3000 / geo.METROS_POR_GRADO, longitude=self.LON),
+            piso_api('sin_coordenadas', 600),
+        ])
+    
+    def _celdas(self):
+        return db.get_connection().execute(
+            """SELECT celda, operacion, n, n_precio, round(suma_precio, 4), n_precio_m2,
+                      round(suma_precio_m2, 4) FROM geo_celdas WHERE n != 0 ORDER BY 1, 2""").fetchall()
+    
+    def test_columnas_y_celda(self):
+        """Test que se guardan coordenadas, distrito, barrio y celda"""
+        fila = db.get_connection().execute(
+            "SELECT latitud, longitud, distrito, barrio, celda FROM pisos WHERE id='0'").fetchone()
+        self.assertEqual(fila, (self.LAT, self.LON, 'Centro', 'Sagrario', geo.celda(self.LAT, self.LON)))
+        self.assertIsNone(geo.celda(None, self.LON))
+        self.assertIsNone(db.get_connection().execute(
+            "SELECT celda FROM pisos WHERE id='sin_coordenadas'").fetchone()[0])
+    
+    def test_radio(self):
+        """Test que la búsqueda por radio filtra por distancia exacta y ordena"""
+        cercanos = geo.en_radio(self.LAT, self.LON, 650)
+        self.assertEqual([p['id'] for p in cercanos], ['0', '100', '600'])
+        self.assertAlmostEqual(cercanos[1]['distancia'], 100, delta=0.1)
+        self.assertAlmostEqual(cercanos[2]['distancia'], geo.distancia(
+            self.LAT, self.LON, cercanos[2]['latitud'], cercanos[2]['longitud']), delta=0.1)
+        self.assertEqual([p['id'] for p in geo.en_radio(self.LAT, self.LON, 5000)],
+                         ['0', '100', '600', '3000'])
+        self.assertEqual(geo.en_radio(self.LAT, self.LON, 50, operacion='sale'), [])
+    
+    def test_caja(self):
+        """Test de la búsqueda por caja de coordenadas"""
+        ids = {p['id'] for p in geo.en_caja(self.LAT + 0.0005, self.LON - 0.001,
+                                            self.LAT + 0.01, self.LON + 0.001)}
+        self.assertEqual(ids, {'100', '600'})
+    
+    def test_consulta_usa_el_indice(self):
+        """Test que la consulta espacial no recorre la tabla pisos"""
+        conn = db.get_connection()
+        sentencias = []
+        conn.set_trace_callback(sentencias.append)  # SQL con los parámetros ya sustituidos
+        try:
+            geo.en_radio(self.LAT, self.LON, 650)
+        finally:
+            conn.set_trace_callback(None)
+        plan = ' '.join(r[-1] for r in conn.execute(f"EXPLAIN QUERY PLAN {sentencias[-1]}"))
+        self.assertIn('idx_pisos_celda', plan)
+        self.assertNotIn('SCAN p', plan)
+    
+    def test_agregados_incrementales_igual_que_reconstruir(self):
+        """Test que geo_celdas sigue altas, cambios de precio, bajas y reactivaciones"""
+        main_v2_quota.procesar_lote([
+            piso_api('0', 950, latitude=self.LAT, longitude=self.LON),
+            piso_api('600', 850, latitude=self.LAT + 600 / geo.METROS_POR_GRADO, longitude=self.LON),
+        ])
+        bajas.cerrar_barrido({'0', '100', '600', 'sin_coordenadas'}, completo=True)
+        main_v2_quota.procesar_lote([
+            piso_api('3000', 650, latitude=self.LAT + 3000 / geo.METROS_POR_GRADO, longitude=self.LON)])
+        incremental = self._celdas()
+        self.assertEqual(sum(c[2] for c in incremental), 3)
+        
+        geo.reconstruir()
+        self.assertEqual(self._celdas(), incremental)
+        bajas.cerrar_barrido({'3000'}, completo=False)
+        self.assertEqual(sum(c[2] for c in self._celdas()), 4)
+        
+        mapa = db.get_connection().execute(
+            "SELECT n, precio_medio, lat_centro FROM v_geo_celdas WHERE celda = ?",
+            (geo.celda(self.LAT, self.LON),)).fetchone()
+        self.assertEqual(mapa[:2], (2, 925))  # 950 y 900
+        self.assertAlmostEqual(mapa[2], self.LAT, delta=geo.rejilla()[0])
+        self.assertEqual(sum(c['n'] for c in geo.celdas_en_caja(self.LAT - 0.01, self.LON - 0.01,
+                                                                 self.LAT + 0.01, self.LON + 0.01)), 3)
+    
+    def test_cambio_de_rejilla(self):
+        """Test que al cambiar el tamaño de celda init_db recalcula el índice"""
+        with patch.object(config, 'GEO_CELL_METERS', 1000):
+            main_v2_quota.init_db()
+            self.assertEqual(db.get_connection().execute(
+                "SELECT celda FROM pisos WHERE id='0'").fetchone()[0], geo.celda(self.LAT, self.LON))
+            self.assertEqual([p['id'] for p in geo.en_radio(self.LAT, self.LON, 650)],
+                             ['0', '100', '600'])
+    
+    def test_pisos_antiguos_reciben_coordenadas(self):
+        """Test que un piso guardado sin coordenadas las recibe al volver, con o sin cambio de precio"""
+        conn = db.get_connection()
+        conn.execute("""INSERT INTO pisos (id, titulo, precio, metros, link, operacion, fecha_registro)
+                        VALUES ('viejo', 'Piso viejo', 700, 80, '', 'rent', '2025-01-01 00:00:00')""")
+        lat = self.LAT + 100 / geo.METROS_POR_GRADO
+        main_v2_quota.procesar_lote([
+            piso_api('viejo', 700, latitude=lat, longitude=self.LON, district='Centro'),
+            piso_api('sin_coordenadas', 550, latitude=self.LAT, longitude=self.LON, district='Realejo'),
+            piso_api('0', 1000, latitude=0.0, longitude=0.0, district='Otro'),
+        ])
+        filas = {r[0]: r[1:] for r in conn.execute("SELECT id, latitud, zona, celda, precio FROM pisos")}
+        self.assertEqual(filas['viejo'], (lat, 'Centro', geo.celda(lat, self.LON), 700))
+        self.assertEqual(filas['sin_coordenadas'], (self.LAT, 'Realejo', geo.celda(self.LAT, self.LON), 550))
+        # Lo ya guardado no se sobrescribe
+        self.assertEqual(filas['0'], (self.LAT, 'Centro', geo.celda(self.LAT, self.LON), 1000))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM historial_precios WHERE id_piso='viejo'").fetchone()[0], 0)
+        
+        incremental = self._celdas()
+        self.assertEqual(sum(c[2] for c in incremental), 6)
+        geo.reconstruir()
+        self.assertEqual(self._celdas(), incremental)
+
+
+class TestDedup(BDTemporalMixin, unittest.TestCase):
+    """Tests para la detección de anuncios duplicados"""
+    
+    LAT, LON = 37.1730, -3.5990
+    
+    def _piso(self, codigo, precio, titulo, metros_norte=0, **extra):
+        datos = dict(latitude=self.LAT + metros_norte / geo.METROS_POR_GRADO, longitude=self.LON,
+                     floor='3', suggestedTexts={'title': titulo})
+        datos.update(extra)
+        return piso_api(codigo, precio, **datos)
+    
+    def _procesar(self, pisos):
+        with patch.object(main_v2_quota, 'enviar_telegram') as telegram:
+            diff = main_v2_quota.procesar_lote_diff(pisos)
+        return diff, [c.args[0] for c in telegram.call_args_list]
+    
+    def _cluster(self, id_piso):
+        return db.get_connection().execute("SELECT cluster_id FROM pisos WHERE id=?", (id_piso,)).fetchone()[0]
+    
+    def test_mismo_piso_de_otra_agencia(self):
+        """Test que el mismo piso con otro código y otro título no repite la NOVEDAD"""
+        self._procesar([self._piso('1', 1000, 'Piso en calle Recogidas, Centro')])
+        diff, mensajes = self._procesar([
+            self._piso('2', 990, 'Piso en Recogidas Centro Ref 123456', metros_norte=20),
+            self._piso('3', 1000, 'Ático en Zaidín', metros_norte=2000)])
+        self.assertEqual(diff['nuevos'][0]['duplicado_de'], '1')
+        self.assertIsNone(diff['nuevos'][1]['duplicado_de'])
+        self.assertEqual(len(mensajes), 1)
+        self.assertIn('Zaidín', mensajes[0])
+        self.assertEqual(self._cluster('2'), '1')
+        self.assertEqual([p['id'] for p in dedup.cluster('2')], ['1', '2'])
+        self.assertEqual(db.get_connection().execute("SELECT COUNT(*) FROM v_pisos_unicos").fetchone()[0], 2)
+    
+    def test_reconstruir_indexa_pisos_anteriores(self):
+        """Test que --reconstruir indexa los pisos guardados antes del índice y sus duplicados"""
+        self._procesar([self._piso('1', 1000, 'Piso en calle Recogidas, Centro'),
+                        self._piso('2', 1010, 'Piso en calle Recogidas (Centro)', metros_norte=10)])
+        conn = db.get_connection()
+        # Como antes del índice: sin cubetas ni clusters
+        conn.execute("DELETE FROM lsh_buckets")
+        conn.execute("UPDATE pisos SET cluster_id = NULL")
+        diff, _ = self._procesar([self._piso('3', 990, 'Piso en Recogidas Centro', metros_norte=20)])
+        self.assertIsNone(diff['nuevos'][0]['duplicado_de'])
+        
+        self.assertEqual(dedup.reconstruir(lote=2), 2)
+        self.assertEqual({self._cluster(i) for i in '123'}, {'1'})
+        diff, mensajes = self._procesar([self._piso('4', 1000, 'Piso calle Recogidas Centro', metros_norte=5)])
+        self.assertEqual(diff['nuevos'][0]['duplicado_de'], '1')
+        self.assertEqual(mensajes, [])
+    
+    def test_pisos_distintos_del_mismo_edificio(self):
+        """Test que otra planta, otro tamaño u otro precio no son duplicados"""
+        titulo = 'Piso en calle Recogidas, Centro'
+        diff, mensajes = self._procesar([
+            self._piso('1', 1000, titulo),
+            self._piso('2', 1000, titulo, floor='5'),
+            self._piso('3', 1000, titulo, size=95),
+            self._piso('4', 1400, titulo),
+            self._piso('5', 1000, titulo, rooms=2)])
+        self.assertEqual([f['duplicado_de'] for f in diff['nuevos']], [None] * 5)
+        self.assertEqual(len(mensajes), 5)
+    
+    def test_duplicados_en_la_misma_pagina(self):
+        """Test que el duplicado llega en la misma página que el original"""
+        diff, mensajes = self._procesar([
+            self._piso('1', 1000, 'Piso en calle Recogidas, Centro'),
+            self._piso('2', 1010, 'Piso en calle Recogidas (Centro)', metros_norte=10),
+            self._piso('3', 1000, 'Piso en calle Recogidas', metros_norte=5)])
+        self.assertEqual([f['duplicado_de'] for f in diff['nuevos']], [None, '1', '1'])
+        self.assertEqual({self._cluster(i) for i in '123'}, {'1'})
+        self.assertEqual(len(mensajes), 1)
+    
+    def test_duplicado_de_un_piso_retirado_se_notifica(self):
+        """Test que volver a publicar un piso retirado se agrupa pero se avisa"""
+        self._procesar([self._piso('1', 1000, 'Piso en calle Recogidas, Centro'),
+                        self._piso('2', 700, 'Estudio en Beiro', metros_norte=3000, rooms=1, size=40)])
+        bajas.cerrar_barrido({'2'}, completo=True)
+        diff, mensajes = self._procesar([self._piso('9', 1000, 'Piso en calle Recogidas, Centro')])
+        self.assertIsNone(diff['nuevos'][0]['duplicado_de'])
+        self.assertEqual(len(mensajes), 1)
+        self.assertEqual(self._cluster('9'), '1')
+    
+    def test_sin_coordenadas_no_hay_duplicados(self):
+        """Test que sin coordenadas no se agrupa ni se indexa"""
+        diff, mensajes = self._procesar([piso_api('1', 1000), piso_api('2', 1000)])
+        self.assertEqual([f['cluster_id'] for f in diff['nuevos']], ['1', '2'])
+        self.assertEqual(len(mensajes), 2)
+        self.assertEqual(db.get_connection().execute("SELECT COUNT(*) FROM lsh_buckets").fetchone()[0], 0)
+    
+    def test_rasgos_normalizados(self):
+        """Test que acentos, mayúsculas y referencias largas no cambian los rasgos"""
+        base = {'metros': 80, 'habitaciones': 3, 'planta': '3', 'operacion': 'rent',
+                'latitud': self.LAT, 'longitud': self.LON}
+        self.assertEqual(dedup.rasgos({**base, 'titulo': 'Ático en Albaicín'}),
+                         dedup.rasgos({**base, 'titulo': 'ATICO EN ALBAICIN 1234567'}))
+        f = dedup.firmador()
+        firma = f.firma(dedup.rasgos({**base, 'titulo': 'Ático en Albaicín'}))
+        self.assertEqual(len(firma), config.DEDUP_NUM_PERM)
+        claves = dedup.claves_busqueda({**base, 'titulo': 'Ático en Albaicín'}, firma)
+        # Se indexa solo en su bloque; se busca también en los vecinos
+        self.assertEqual(sum(propia for _, _, propia in claves), config.DEDUP_BANDS)
+        self.assertEqual(len(claves) % config.DEDUP_BANDS, 0)
+
+
+class TestReglas(BDTemporalMixin, unittest.TestCase):
+    """Tests para las reglas de alerta"""
+    
+    def _procesar(self, pisos):
+        with patch.object(main_v2_quota, 'enviar_telegram') as telegram:
+            main_v2_quota.procesar_lote_diff(pisos)
+        return [c.args[0] for c in telegram.call_args_list]
+    
+    def test_reglas_por_defecto(self):
+        """Test que sin reglas propias se avisa de cada novedad y de cada bajada"""
+        self.assertEqual(len(self._procesar([piso_api(1, 1000), piso_api(2, 1000)])), 2)
+        mensajes = self._procesar([piso_api(1, 999), piso_api(2, 1100)])
+        self.assertEqual(len(mensajes), 1)
+        self.assertIn('BAJADA DE PRECIO', mensajes[0])
+        self.assertNotIn('🔔', mensajes[0])
+    
+    def test_bajada_porcentual(self):
+        """Test que una regla de bajada >= 5% sustituye a la de cualquier bajada"""
+        reglas.activar('bajada', False)
+        reglas.anadir('bajada_fuerte', 'bajada', {'bajada_pct': {'>=': 5}})
+        self._procesar([piso_api(1, 1000), piso_api(2, 1000)])
+        mensajes = self._procesar([piso_api(1, 960), piso_api(2, 940)])
+        self.assertEqual(len(mensajes), 1)
+        self.assertIn('➡️ 940€', mensajes[0])
+        self.assertIn('🔔 bajada_fuerte', mensajes[0])
+    
+    def test_condiciones_de_zona_y_piso(self):
+        """Test de precio/m² en una zona y de exterior con 3 habitaciones o más"""
+        reglas.activar('novedad', False)
+        reglas.anadir('centro_barato', 'nuevo', {'zona': 'Centro', 'precio_m2': {'<': 10}})
+        reglas.anadir('exterior_grande', 'nuevo', {'exterior': True, 'habitaciones': {'>=': 3}})
+        mensajes = self._procesar([
+            piso_api(1, 700, district='Centro'),
+            piso_api(2, 700, district='Zaidín'),
+            piso_api(3, 900, district='Centro', exterior=True),
+            piso_api(4, 900, exterior=True, rooms=2)])
+        self.assertEqual(len(mensajes), 2)
+        self.assertIn('🔔 centro_barato\n', mensajes[0])
+        self.assertIn('🔔 exterior_grande\n', mensajes[1])
+    
+    def test_indice_por_zona(self):
+        """Test que solo se evalúan las reglas sin zona o de la zona del piso"""
+        motor = reglas.Motor([reglas.compilar(f'r{i}', 'nuevo', {'zona': f'Z{i % 100}'}) for i in range(300)]
+                             + [reglas.compilar('todas', 'nuevo', {})])
+        self.assertEqual([r.nombre for r in motor.candidatas('nuevo', 'Z7')], ['r7', 'r107', 'r207', 'todas'])
+        self.assertEqual([r.nombre for r in motor.candidatas('nuevo', None)], ['todas'])
+        self.assertEqual(motor.candidatas('bajada', 'Z7'), [])
+        alertas = motor.evaluar({'nuevos': [{'id': '1', 'zona': 'Z7'}], 'bajadas': [], 'subidas': []})
+        self.assertEqual(alertas[0]['reglas'], ['r7', 'r107', 'r207', 'todas'])
+    
+    def test_reglas_invalidas(self):
+        """Test que una regla mal escrita se rechaza al añadirla y se ignora al cargarla"""
+        for evento, condiciones in (('alta', {}), ('nuevo', {'precio_m3': 1}),
+                                    ('nuevo', {'precio': {'~': 1}}), ('nuevo', {'zona': {'en': 'Centro'}}),
+                                    ('nuevo', {'precio': {'<': '900'}}), ('nuevo', {'zona': {'>': 1}}),
+                                    ('nuevo', {'precio': {'>=': True}}), ('nuevo', {'zona': ['a', ['b']]}),
+                                    ('nuevo', {'titulo': {'contiene': {'a': 1}}})):
+            with self.assertRaises(ValueError):
+                reglas.anadir('mala', evento, condiciones)
+        with db.transaction() as conn:
+            conn.execute("INSERT INTO reglas_alerta (nombre, evento, condiciones) VALUES ('mala', 'alta', '{}')")
+        self.assertEqual(len(self._procesar([piso_api(1, 1000)])), 1)
+    
+    def test_regla_que_falla_no_corta_la_pagina(self):
+        """Test que una regla que lanza al evaluarse se omite y las demás siguen avisando"""
+        with db.transaction() as conn:
+            conn.execute("""INSERT INTO reglas_alerta (nombre, evento, condiciones)
+                            VALUES ('rota', 'nuevo', '{"precio": {"<": "900"}}')""")
+        motor = reglas.Motor([reglas.Regla('rota', 'nuevo', None, lambda v: v['precio'] < '900'),
+                              reglas.compilar('todas', 'nuevo', {})])
+        with self.assertLogs('idealista', 'WARNING') as logs:
+            alertas = motor.evaluar({'nuevos': [{'id': '1', 'precio': 800}, {'id': '2', 'precio': 700}]})
+        self.assertEqual([a['reglas'] for a in alertas], [['todas'], ['todas']])
+        self.assertEqual(len(logs.records), 1)
+        # Guardada a mano en la tabla: se descarta al cargar y la novedad sale igual
+        self.assertEqual(len(self._procesar([piso_api(1, 1000)])), 1)
+    
+    def test_motor_se_recompila_al_cambiar_la_tabla(self):
+        """Test que el motor compilado se reutiliza hasta que cambian las reglas"""
+        conn = db.get_connection()
+        primero = reglas.motor(conn)
+        self.assertIs(reglas.motor(conn), primero)
+        with db.transaction() as c:
+            c.execute("UPDATE reglas_alerta SET activa = 0 WHERE nombre = 'novedad'")
+        self.assertEqual([r.nombre for r in reglas.motor(conn).reglas], ['bajada'])
+
+
+class TestSuscripciones(BDTemporalMixin, unittest.TestCase):
+    """Tests para el reparto de avisos entre suscripciones"""
+    
+    def _procesar(self, pisos):
+        with patch.object(main_v2_quota, 'enviar_telegram') as telegram:
+            main_v2_quota.procesar_lote_diff(pisos)
+        return [(c.kwargs['chat_id'], c.args[0]) for c in telegram.call_args_list]
+    
+    def test_reparto_por_filtros(self):
+        """Test que cada chat recibe solo lo que pasa sus filtros"""
+        suscripciones.anadir({'chat_id': 'centro', 'zonas': 'Centro', 'habitaciones': '3,4'})
+        suscripciones.anadir({'chat_id': 'barato', 'precio_max': 900})
+        suscripciones.anadir({'chat_id': 'bajadas', 'eventos': 'bajada'})
+        envios = self._procesar([piso_api(1, 1000, district='Centro'), piso_api(2, 800, rooms=5),
+                                 piso_api(3, 850, district='Centro', rooms=2)])
+        destinos = {}
+        for chat, texto in envios:
+            destinos.setdefault(chat, []).append(texto.split('\n')[1])
+        self.assertEqual(destinos, {'centro': ['🏠 Piso 1'], 'barato': ['🏠 Piso 2', '🏠 Piso 3']})
+        envios = self._procesar([piso_api(1, 950, district='Centro')])
+        self.assertEqual(sorted(chat for chat, _ in envios), ['bajadas', 'centro'])
+    
+    def test_indice_equivale_a_recorrer_todas(self):
+        """Test que el índice invertido da lo mismo que filtrar suscripción a suscripción"""
+        rnd = random.Random(0)
+        zonas = ['Centro', 'Zaidín', 'Beiro', None]
+        
+        def opcional(valor):
+            return valor if rnd.random() < 0.5 else None
+        
+        todas = [suscripciones.normalizar({
+            'chat_id': i, 'eventos': opcional(rnd.choice(['nuevo', 'bajada', 'nuevo,subida'])),
+            'operacion': opcional(rnd.choice(['rent', 'sale'])),
+            'habitaciones': opcional(','.join(rnd.sample('01234', 2))),
+            'precio_min': opcional(rnd.randint(300, 900)), 'precio_max': opcional(rnd.randint(800, 2000)),
+            'zonas': opcional(rnd.choice(zonas[:3]))}) for i in range(300)]
+        indice = suscripciones.Indice(todas)
+        for _ in range(500):
+            evento = rnd.choice(['nuevo', 'bajada', 'subida'])
+            fila = {'operacion': rnd.choice(['rent', 'sale', None]), 'habitaciones': rnd.choice([0, 1, 3, 6, None]),
+                    'precio': rnd.choice([rnd.randint(200, 2500), None]), 'zona': rnd.choice(zonas)}
+            self.assertEqual(indice.suscriptores(evento, fila),
+                             [s for s in todas if suscripciones.coincide(s, evento, fila)])
+    
+    def test_horas_de_silencio(self):
+        """Test que en horas de silencio el aviso se encola para cuando terminan"""
+        s = suscripciones.normalizar({'chat_id': 'noche', 'silencio': '23:00-08:00'})
+        self.assertEqual(suscripciones.fin_silencio(s, datetime(2026, 3, 1, 23, 30)),
+                         datetime(2026, 3, 2, 8, 0).timestamp())
+        self.assertEqual(suscripciones.fin_silencio(s, datetime(2026, 3, 1, 7, 0)),
+                         datetime(2026, 3, 1, 8, 0).timestamp())
+        self.assertIsNone(suscripciones.fin_silencio(s, datetime(2026, 3, 1, 12, 0)))
+        with self.assertRaises(ValueError):
+            suscripciones.normalizar({'chat_id': 'x', 'silencio': '23h'})
+        
+        with patch.object(config, 'ENABLE_TELEGRAM', True):
+            notificaciones.encolar('hola', chat_id='noche', no_antes=time.time() + 3600)
+        trabajador = notificaciones.TrabajadorTelegram(enviar=MagicMock())
+        self.assertEqual(trabajador.procesar_pendientes()[0], 0)
+        trabajador.enviar.assert_not_called()
+    
+    def test_modo_digest(self):
+        """Test que el modo digest acumula hasta el final de la ejecución"""
+        suscripciones.anadir({'chat_id': 'resumen', 'modo': 'digest'})
+        suscripciones.anadir({'chat_id': 'directo'})
+        envios = self._procesar([piso_api(i, 1000) for i in range(20)])
+        self.assertEqual({chat for chat, _ in envios}, {'directo'})
+        with patch.object(main_v2_quota, 'enviar_telegram') as telegram:
+            self.assertFalse(main_v2_quota.enviar_resumenes('quota'))
+        self.assertEqual([c.kwargs['chat_id'] for c in telegram.call_args_list], ['resumen'])
+        resumen = telegram.call_args_list[0].args[0]
+        self.assertIn('Resumen: 20 avisos', resumen)
+        self.assertEqual(resumen.count('\n• '), 20)
+        self.assertEqual(list(digest.resumenes()), [])
+
+
+class TestDigest(BDTemporalMixin, unittest.TestCase):
+    """Tests para el resumen por ejecución"""
+    
+    def _alerta(self, i, evento='nuevo', z=None, anterior=None, titulo=None, reglas_=('novedad',)):
+        fila = {'id': str(i), 'titulo': titulo or f'Piso {i} en calle Recogidas', 'precio': 1000,
+                'precio_anterior': anterior, 'metros': 80, 'habitaciones': 3, 'puntuacion_anomalia': z,
+                'link': f'https://www.idealista.com/inmueble/{i}/'}
+        return {'evento': evento, 'fila': fila, 'reglas': list(reglas_)}
+    
+    def test_ranking_y_troceo(self):
+        """Test que un resumen grande cabe en DIGEST_MAX_MESSAGES y conserva lo mejor puntuado"""
+        alertas = [self._alerta(i, z=-i / 100) for i in range(300)]
+        alertas.append(self._alerta(999, 'bajada', anterior=1250))
+        with patch.object(config, 'DIGEST_MAX_MESSAGES', 2):
+            mensajes = digest.renderizar(alertas, pie='📊 quota')
+        self.assertLessEqual(len(mensajes), 2)
+        self.assertTrue(all(len(m) <= notificaciones.LIMITE_MENSAJE for m in mensajes))
+        texto = '\n'.join(mensajes)
+        self.assertIn('Resumen: 301 avisos', texto)
+        self.assertIn('avisos más', texto)
+        self.assertTrue(texto.endswith('📊 quota'))
+        # La bajada del 20% (4 puntos) y los pisos más baratos de su mercado entran; los normales no
+        self.assertIn('1.250€ ➡️ 1.000€ (-20%)', texto)
+        self.assertIn('/inmueble/299/', texto)
+        self.assertNotIn('/inmueble/0/', texto)
+        self.assertLess(texto.index('/inmueble/299/'), texto.index('/inmueble/298/'))
+    
+    def test_titulos_escapados_y_enlaces(self):
+        """Test que el HTML de los títulos se escapa y los enlaces son opcionales"""
+        alerta = self._alerta(1, titulo='Piso <b>grande</b> & luminoso')
+        mensaje = digest.renderizar([alerta])[0]
+        self.assertIn('Piso &lt;b&gt;grande&lt;/b&gt; &amp; luminoso</a>', mensaje)
+        self.assertIn('<a href="https://www.idealista.com/inmueble/1/">', mensaje)
+        with patch.object(config, 'DIGEST_LINKS', False):
+            self.assertNotIn('<a ', digest.renderizar([alerta])[0])
+    
+    def test_modo_hibrido(self):
+        """Test que en modo híbrido solo lo más relevante sale al momento, con tope por ejecución"""
+        with patch.object(config, 'NOTIFICATION_MODE', 'hibrido'), \
+                patch.object(config, 'HYBRID_MAX_IMMEDIATE', 1):
+            self.assertTrue(digest.inmediato('chat', self._alerta(1, z=-4)))
+            self.assertFalse(digest.inmediato('chat', self._alerta(2, z=-4)))
+            self.assertFalse(digest.inmediato('chat', self._alerta(3, z=-1)))
+            self.assertTrue(digest.inmediato('otro', self._alerta(4, 'bajada', anterior=1200)))
+            list(digest.resumenes())
+            self.assertTrue(digest.inmediato('chat', self._alerta(5, z=-4)))
+            list(digest.resumenes())
+            
+            with patch.object(main_v2_quota, 'enviar_telegram') as telegram:
+                main_v2_quota.procesar_lote_diff([piso_api(1, 1000), piso_api(2, 1000)])
+            telegram.assert_not_called()
+    
+    def test_estado_de_quota_dentro_del_resumen(self):
+        """Test que en modo digest el estado de la quota va al final del resumen, no aparte"""
+        with patch.object(config, 'NOTIFICATION_MODE', 'digest'), \
+                patch.object(main_v2_quota, 'enviar_telegram') as telegram:
+            main_v2_quota.procesar_lote_diff([piso_api(1, 1000)])
+            telegram.assert_not_called()
+            self.assertTrue(main_v2_quota.enviar_resumenes('📊 quota'))
+            self.assertFalse(main_v2_quota.enviar_resumenes('📊 quota'))
+        self.assertEqual(telegram.call_count, 1)
+        self.assertIn('📊 quota', telegram.call_args.args[0])
+        self.assertIsNone(telegram.call_args.kwargs['chat_id'])
+
 class TestLogging(unittest.TestCase):
     """Tests para sistema de logging"""
     
@@ -125,6 +1811,7 @@ class TestLogging(unittest.TestCase):
         logger = setup_logging(self.log_path, level='INFO')
         self.assertIsNotNone(logger)
         logger.info("Test message")
+        self.assertTrue(utils.vaciar_logging())
         
         # Verificar que se escribió en el archivo
         with open(self.log_path, 'r') as f:
@@ -135,10 +1822,101 @@ class TestLogging(unittest.TestCase):
         """Test registro de eventos"""
         logger = setup_logging(self.log_path, level='INFO')
         log_event(logger, 'TEST_EVENT', {'key': 'value'})
+        utils.vaciar_logging()
         
         with open(self.log_path, 'r') as f:
             content = f.read()
             self.assertIn("TEST_EVENT", content)
+    
+    def test_formato_json_una_pasada(self):
+        """Test que los eventos salen con event/data como campos y sin doble escape"""
+        for backend in (utils.orjson, None):
+            with patch.object(utils, 'orjson', backend):
+                logger = setup_logging(self.log_path, level='INFO')
+                log_event(logger, 'PRICE_DROP', {'id': '7', 'titulo': 'Ático "luminoso" ñ'})
+                try:
+                    raise ValueError("fallo")
+                except ValueError:
+                    logger.error("con traza", exc_info=True)
+                utils.detener_logging()
+                
+                with open(self.log_path, encoding='utf-8') as f:
+                    evento, error = [json.loads(l) for l in f.read().splitlines()[-2:]]
+                self.assertEqual(evento['event'], 'PRICE_DROP')
+                self.assertEqual(evento['data'], {'id': '7', 'titulo': 'Ático "luminoso" ñ'})
+                self.assertEqual(evento['level'], 'INFO')
+                self.assertEqual(evento['function'], 'test_formato_json_una_pasada')
+                datetime.fromisoformat(evento['timestamp'])
+                self.assertEqual(error['message'], 'con traza')
+                self.assertIn('ValueError: fallo', error['exception'])
+    
+    def test_log_event_perezoso(self):
+        """Test que un evento con el nivel desactivado no se serializa"""
+        class Contador:
+            llamadas = 0
+            
+            def __str__(self):
+                Contador.llamadas += 1
+                return 'x'
+        
+        logger = setup_logging(self.log_path, level='INFO')
+        log_event(logger, 'DEBUG_EVENT', {'obj': Contador()}, level='debug')
+        utils.vaciar_logging()
+        self.assertEqual(Contador.llamadas, 0)
+        
+        log_event(logger, 'INFO_EVENT', {'obj': Contador()})
+        utils.vaciar_logging()
+        self.assertGreaterEqual(Contador.llamadas, 1)
+    
+    def test_escritura_en_otro_hilo(self):
+        """Test que el llamador solo encola y el fichero lo escribe el hilo escritor"""
+        hilos = []
+        
+        class Espia(logging.Handler):
+            def emit(self, record):
+                hilos.append(threading.current_thread())
+        
+        logger = setup_logging(self.log_path, level='INFO')
+        utils._listener.handlers += (Espia(),)
+        logger.info("hola")
+        utils.vaciar_logging()
+        self.assertEqual(len(hilos), 1)
+        self.assertIsNot(hilos[0], threading.current_thread())
+    
+    def test_politica_de_descarte(self):
+        """Test que con la cola llena se descarta y se avisa al liberar hueco"""
+        cola = utils.queue.Queue(maxsize=2)
+        handler = utils.ColaAcotada(cola, espera=0)
+        registro = lambda nivel: logging.LogRecord('idealista', nivel, __file__, 1, 'm', None, None)
+        
+        for _ in range(4):
+            handler.handle(registro(logging.INFO))
+        self.assertEqual(handler.descartados, 2)
+        
+        cola.get_nowait()
+        cola.get_nowait()
+        handler.handle(registro(logging.INFO))
+        aviso = cola.get_nowait(), cola.get_nowait()
+        self.assertEqual(aviso[1].levelno, logging.WARNING)
+        self.assertEqual(aviso[1].getMessage(), "2 mensajes de log descartados (cola llena)")
+        self.assertEqual(handler.descartados, 0)
+
+
+class TestBenchmarks(unittest.TestCase):
+    """Tests para las utilidades de benchmarks"""
+    
+    def test_percentiles_nearest_rank(self):
+        """Test que el p99 usa el rango más cercano"""
+        self.assertEqual(benchmarks._percentiles(list(range(1, 51)), 'us')['p99_us'], 50)
+        self.assertEqual(benchmarks._percentiles(list(range(1, 101)), 'us')['p99_us'], 99)
+        self.assertEqual(benchmarks._percentiles([7.0], 'us')['p99_us'], 7.0)
+    
+    def test_bench_reglas(self):
+        """Test que el benchmark de reglas compila y evalúa ambos motores"""
+        with patch('sys.stdout', new_callable=io.StringIO) as salida:
+            benchmarks.main(['reglas', '-n', '10', '--reglas', '2,20', '--paginas', '3', '--por-pagina', '10'])
+        self.assertIn('20 reglas, indexado', salida.getvalue())
+        self.assertIn('20 reglas, sin índice', salida.getvalue())
 
 
 class TestPriceCalculation(unittest.TestCase):
@@ -0,0 +1,120 @@
+"""
+Caché persistente de tokens OAuth
+
+Guarda `access_token` y su caducidad en memoria y en SQLite (`oauth_tokens`)
+para reutilizarlo entre ciclos y reinicios. Solo se pide uno nuevo poco
+antes de caducar o cuando la API responde 401 (invalidar()).
+"""
+import logging
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+import config
+import db
+from utils import log_event
+
+logger = logging.getLogger('idealista')
+
+
+class TokenInvalido(Exception):
+    """La respuesta de token no trae un access_token y una caducidad utilizables"""
+
+
+def crear_tablas(conn):
+    """Crea la tabla de tokens (llamado desde init_db)"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS oauth_tokens (
+        servicio TEXT PRIMARY KEY,
+        access_token TEXT NOT NULL,
+        expira_en REAL NOT NULL,
+        fecha DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+
+class TokenCache:
+    """
+    Token OAuth cacheado con conocimiento de su caducidad
+
+    Args:
+        servicio: Clave en la tabla oauth_tokens (e.g. 'idealista')
+        solicitar: Función que pide un token nuevo y devuelve
+            (access_token, expires_in) o None si falla
+        margen: Segundos antes de caducar en los que ya se renueva
+        reloj: Fuente de tiempo (epoch), inyectable en tests
+    """
+
+    def __init__(self, servicio: str, solicitar: Callable[[], Optional[Tuple[str, int]]],
+                 margen: float = config.TOKEN_REFRESH_MARGIN,
+                 reloj: Callable[[], float] = time.time):
+        self.servicio = servicio
+        self.solicitar = solicitar
+        self.margen = margen
+        self.reloj = reloj
+        self._lock = threading.Lock()
+        self._token: Optional[str] = None
+        self._expira_en = 0.0
+        self._cargado = False
+
+    def _valido(self) -> bool:
+        return self._token is not None and self.reloj() < self._expira_en - self.margen
+
+    def _cargar(self):
+        """Lee de SQLite el token que dejó un ciclo o arranque anterior"""
+        self._cargado = True
+        row = db.get_connection().execute(
+            "SELECT access_token, expira_en FROM oauth_tokens WHERE servicio=?",
+            (self.servicio,)).fetchone()
+        if row:
+            self._token, self._expira_en = row[0], float(row[1])
+
+    def obtener(self) -> Optional[str]:
+        """
+        Devuelve un token válido, pidiendo uno nuevo solo si hace falta
+
+        Raises:
+            TokenInvalido: si la respuesta no trae access_token o expires_in (no se guarda)
+        """
+        with self._lock:
+            if not self._cargado:
+                self._cargar()
+            if self._valido():
+                logger.debug(f"Token {self.servicio} reutilizado "
+                             f"(caduca en {self._expira_en - self.reloj():.0f}s)")
+                return self._token
+
+            resultado = self.solicitar()
+            if not resultado:
+                return None
+            token, expires_in = resultado
+            if not token or not isinstance(token, str):
+                raise TokenInvalido(f"Respuesta de token {self.servicio} sin access_token válido: {token!r}")
+            try:
+                expires_in = float(expires_in)
+            except (TypeError, ValueError):
+                expires_in = 0
+            if expires_in <= 0:
+                raise TokenInvalido(f"Respuesta de token {self.servicio} sin expires_in válido: {resultado[1]!r}")
+            self._token = token
+            self._expira_en = self.reloj() + expires_in
+            with db.transaction() as conn:
+                conn.execute("""INSERT INTO oauth_tokens (servicio, access_token, expira_en, fecha)
+                                VALUES (?, ?, ?, datetime('now'))
+                                ON CONFLICT(servicio) DO UPDATE SET
+                                    access_token = excluded.access_token,
+                                    expira_en = excluded.expira_en,
+                                    fecha = excluded.fecha""",
+                             (self.servicio, token, self._expira_en))
+            log_event(logger, 'TOKEN_RENEWED', {
+                'servicio': self.servicio,
+                'expires_in': expires_in
+            })
+            return token
+
+    def invalidar(self):
+        """Descarta el token (e.g. tras un 401) para forzar uno nuevo"""
+        with self._lock:
+            self._token = None
+            self._expira_en = 0.0
+            self._cargado = True
+            with db.transaction() as conn:
+                conn.execute("DELETE FROM oauth_tokens WHERE servicio=?", (self.servicio,))
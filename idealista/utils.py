@@ -1,35 +1,174 @@
 """
 Sistema de logging y utilidades
+
+El logger 'idealista' solo encola registros (QueueHandler sobre una cola
+acotada); un hilo escritor (QueueListener) formatea y escribe en fichero y
+consola, así la rotación y el disco nunca bloquean al llamador.
 """
+import atexit
 import logging
 import logging.handlers
+import queue
 import sys
+import threading
+import time
 from pathlib import Path
 from typing import Optional
 from datetime import datetime
 import json
 
+try:
+    import orjson  # opcional: serializador más rápido
+except ImportError:
+    orjson = None
+
+
+def json_rapido(obj) -> str:
+    """json.dumps con orjson si está instalado (mismo resultado, sin escapar no-ASCII)"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj, ensure_ascii=False, default=str)
+
+
 class JSONFormatter(logging.Formatter):
-    """Formatea logs en JSON para mejor análisis en Metabase"""
+    """
+    Formatea logs en JSON para mejor análisis en Metabase
+    
+    Una sola serialización por línea: los eventos de log_event salen con
+    `event` y `data` como campos propios (sin JSON dentro del mensaje).
+    Los campos fijos de cada punto de llamada (nivel, módulo, función,
+    línea) y el timestamp por segundo se cachean ya codificados.
+    """
+    
+    MAX_CACHE = 4096
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._estaticos = {}
+        self._segundo = None
+        self._prefijo_fecha = ''
+    
+    def _fecha(self, creado: float) -> str:
+        segundo = int(creado)
+        if segundo != self._segundo:
+            self._segundo = segundo
+            self._prefijo_fecha = datetime.fromtimestamp(segundo).isoformat()
+        return f"{self._prefijo_fecha}.{int((creado - segundo) * 1e6):06d}"
+    
+    def _campos_estaticos(self, record: logging.LogRecord) -> str:
+        clave = (record.levelno, record.module, record.funcName, record.lineno)
+        fragmento = self._estaticos.get(clave)
+        if fragmento is None:
+            if len(self._estaticos) >= self.MAX_CACHE:
+                self._estaticos.clear()
+            fragmento = json_rapido({
+                'level': record.levelname,
+                'module': record.module,
+                'function': record.funcName,
+                'line': record.lineno,
+            })[1:-1]
+            self._estaticos[clave] = fragmento
+        return fragmento
     
     def format(self, record: logging.LogRecord) -> str:
-        log_data = {
-            'timestamp': datetime.fromtimestamp(record.created).isoformat(),
-            'level': record.levelname,
-            'message': record.getMessage(),
-            'module': record.module,
-            'function': record.funcName,
-            'line': record.lineno,
-        }
+        evento = getattr(record, 'event_type', None)
+        if evento is not None:
+            log_data = {'message': evento, 'event': evento, 'data': record.event_data}
+        else:
+            log_data = {'message': record.getMessage()}
         
         if record.exc_info:
             log_data['exception'] = self.formatException(record.exc_info)
         
-        return json.dumps(log_data, ensure_ascii=False)
+        return (f'{{"timestamp":"{self._fecha(record.created)}",'
+                f'{self._campos_estaticos(record)},{json_rapido(log_data)[1:]}')
+
+
+class ColaAcotada(logging.handlers.QueueHandler):
+    """
+    QueueHandler con cola acotada y política de descarte explícita
+    
+    Con la cola llena, DEBUG/INFO se descartan al momento; WARNING o superior
+    esperan hasta `espera` segundos (contrapresión) antes de descartarse.
+    Los descartes se cuentan y se avisa con un WARNING en cuanto hay hueco.
+    
+    Los registros se encolan sin formatear: el mensaje y los argumentos se
+    resuelven en el hilo escritor.
+    """
+    
+    def __init__(self, cola: queue.Queue, espera: float = 1.0):
+        super().__init__(cola)
+        self.espera = espera
+        self.descartados = 0
+        self._lock_descartes = threading.Lock()
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+    
+    def _poner(self, record: logging.LogRecord) -> bool:
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            if record.levelno < logging.WARNING or self.espera <= 0:
+                return False
+        try:
+            self.queue.put(record, timeout=self.espera)
+            return True
+        except queue.Full:
+            return False
+    
+    def enqueue(self, record: logging.LogRecord):
+        if not self._poner(record):
+            with self._lock_descartes:
+                self.descartados += 1
+            return
+        if self.descartados:
+            with self._lock_descartes:
+                descartados, self.descartados = self.descartados, 0
+            aviso = logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                                      "%d mensajes de log descartados (cola llena)",
+                                      (descartados,), None)
+            if not self._poner(aviso):
+                with self._lock_descartes:
+                    self.descartados += descartados
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_cola_handler: Optional[ColaAcotada] = None
+
+
+def vaciar_logging(timeout: float = 5.0) -> bool:
+    """Espera a que el hilo escritor haya escrito todo lo encolado"""
+    if _cola_handler is None:
+        return True
+    cola = _cola_handler.queue
+    limite = time.monotonic() + timeout
+    while cola.unfinished_tasks:
+        if time.monotonic() > limite:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+def detener_logging():
+    """Escribe lo pendiente, para el hilo escritor y cierra los handlers"""
+    global _listener, _cola_handler
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    logging.getLogger('idealista').removeHandler(_cola_handler)
+    _listener = _cola_handler = None
+
+
+atexit.register(detener_logging)
 
 
 def setup_logging(log_path: Path, level: str = 'INFO', 
-                  max_bytes: int = 5242880, backup_count: int = 5) -> logging.Logger:
+                  max_bytes: int = 5242880, backup_count: int = 5,
+                  queue_size: int = 10000, queue_timeout: float = 1.0) -> logging.Logger:
     """
     Configura logging con rotación de archivos y salida a consola
     
@@ -38,11 +177,15 @@ def setup_logging(log_path: Path, level: str = 'INFO',
         level: Nivel de logging (INFO, DEBUG, WARNING, ERROR)
         max_bytes: Tamaño máximo del archivo antes de rotar
         backup_count: Número de backups a mantener
+        queue_size: Registros que caben en la cola del hilo escritor
+        queue_timeout: Espera máxima de WARNING+ con la cola llena (segundos)
     """
+    global _listener, _cola_handler
     logger = logging.getLogger('idealista')
     logger.setLevel(getattr(logging, level.upper(), logging.INFO))
     
-    # Eliminar handlers anteriores si existen
+    # Eliminar handlers (y el hilo escritor) anteriores si existen
+    detener_logging()
     logger.handlers.clear()
     
     # Handler para archivo con rotación
@@ -64,12 +207,28 @@ def setup_logging(log_path: Path, level: str = 'INFO',
     )
     console_handler.setFormatter(console_formatter)
     
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    # El logger solo encola; el hilo escritor formatea y escribe
+    _cola_handler = ColaAcotada(queue.Queue(maxsize=queue_size), espera=queue_timeout)
+    _listener = logging.handlers.QueueListener(
+        _cola_handler.queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    logger.addHandler(_cola_handler)
     
     return logger
 
 
+class _JSONPerezoso:
+    """Serializa el payload de un evento solo cuando se formatea el mensaje"""
+    
+    __slots__ = ('data',)
+    
+    def __init__(self, data: dict):
+        self.data = data
+    
+    def __str__(self) -> str:
+        return json_rapido(self.data)
+
+
 def log_event(logger: logging.Logger, event_type: str, data: dict, level: str = 'INFO'):
     """
     Registra un evento estructurado
@@ -80,5 +239,10 @@ def log_event(logger: logging.Logger, event_type: str, data: dict, level: str =
         data: Diccionario con datos del evento
         level: Nivel de logging
     """
-    message = f"[{event_type}] {json.dumps(data, ensure_ascii=False)}"
-    getattr(logger, level.lower())(message)
+    nivel = logging.getLevelName(level.upper())
+    if not logger.isEnabledFor(nivel):
+        return
+    # Copia superficial: el registro se formatea más tarde en el hilo escritor
+    data = dict(data)
+    logger.log(nivel, "[%s] %s", event_type, _JSONPerezoso(data),
+               extra={'event_type': event_type, 'event_data': data}, stacklevel=2)